@@ -4,21 +4,133 @@
 -------------------------------------------------------------------------------
 local QlessAPI = {}
 
+-- The optional arguments understood by the commands that return job data.
+-- These come in pairs after the command's other arguments:
+--
+--  - `fields`: a comma-separated list of the fields to return for each job,
+--    like 'jid,klass,data,priority'. Only those fields are read.
+--  - `history`: how much of each job's history to return. One of 'all' (the
+--    default), 'none', 'last:N' for the N most recent items, or
+--    'range:OFFSET:COUNT'. Only the items returned are read.
+--  - `dependencies`: '0' to leave out each job's dependents and
+--    dependencies, or '1' (the default) to include them
+local job_options = {fields = true, history = true, dependencies = true}
+
+-- Read the optional job arguments for `command` out of `args`
+local function read_job_options(command, args)
+  if #args % 2 == 1 then
+    error(command .. '(): Odd number of additional args: ' .. tostring(#args))
+  end
+  local options = {}
+  for i = 1, #args, 2 do
+    assert(job_options[args[i]],
+      command .. '(): Unknown option "' .. tostring(args[i]) .. '"')
+    options[args[i]] = args[i + 1]
+  end
+
+  if options.fields then
+    local fields = {}
+    for field in string.gmatch(options.fields, '[^,]+') do
+      assert(QlessJob.fields[field],
+        command .. '(): Unknown field "' .. field .. '"')
+      table.insert(fields, field)
+    end
+    options.fields = fields
+  end
+
+  if options.history then
+    local history = options.history
+    local last = string.match(history, '^last:(%d+)$')
+    local offset, count = string.match(history, '^range:(%d+):(%d+)$')
+    if history == 'none' then
+      options.history = false
+    elseif history == 'all' then
+      options.history = nil
+    elseif last then
+      options.history = {offset = -tonumber(last), count = tonumber(last)}
+    elseif offset then
+      options.history = {offset = tonumber(offset), count = tonumber(count)}
+    else
+      error(command .. '(): Arg "history" must be "all", "none", "last:N" ' ..
+        'or "range:OFFSET:COUNT": ' .. history)
+    end
+  end
+
+  if options.dependencies then
+    assert(options.dependencies == '0' or options.dependencies == '1',
+      command .. '(): Arg "dependencies" must be 0 or 1: ' ..
+        options.dependencies)
+    options.dependencies = options.dependencies == '1'
+  end
+  return options
+end
+
+-- Return the data of the job identified by the provided jid, with just the
+-- fields and as much of its history asked for in `options`
+local function job_data(jid, options)
+  if options.history == nil and options.dependencies ~= false then
+    if options.fields then
+      return Qless.job(jid):data(options.fields)
+    end
+    return Qless.job(jid):data()
+  end
+
+  -- Leave out the lookups that aren't wanted, or that are read in part
+  local history = false
+  local fields = {}
+  for _, field in ipairs(options.fields or QlessJob.field_names) do
+    if field == 'history' then
+      history = true
+    elseif options.dependencies ~= false or (
+      field ~= 'dependents' and field ~= 'dependencies') then
+      table.insert(fields, field)
+    end
+  end
+
+  local job = Qless.job(jid)
+  local data = job:data(fields)
+  if data and history and options.history ~= false then
+    if options.history then
+      data.history = job:history_items(
+        options.history.offset, options.history.count)
+    else
+      data.history = job:history()
+    end
+  end
+  return data
+end
+
 -- Return json for the job identified by the provided jid. If the job is not
 -- present, then `nil` is returned
-function QlessAPI.get(now, jid)
-  local data = Qless.job(jid):data()
+function QlessAPI.get(now, jid, ...)
+  local data = job_data(jid, read_job_options('Get', arg))
   if not data then
     return nil
   end
   return cjson.encode(data)
 end
 
--- Return json blob of data or nil for each jid provided
+-- Take the pairs of arguments off the end of `args` whose names are in
+-- `names`, for commands whose options follow a variable number of arguments
+local function trailing_options(args, names)
+  local options = {}
+  while #args >= 2 and names[args[#args - 1]] do
+    table.insert(options, 1, table.remove(args))
+    table.insert(options, 1, table.remove(args))
+  end
+  return options
+end
+
+-- Return json blob of data or nil for each jid provided. Any job options
+-- follow the jids
 function QlessAPI.multiget(now, ...)
+  local jids = arg
+  local options = read_job_options('Multiget',
+    trailing_options(jids, job_options))
+
   local results = {}
-  for i, jid in ipairs(arg) do
-    table.insert(results, Qless.job(jid):data())
+  for i, jid in ipairs(jids) do
+    table.insert(results, job_data(jid, options))
   end
   return cjson.encode(results)
 end
@@ -46,14 +158,46 @@ QlessAPI.queues = function(now, queue)
   return cjson.encode(QlessQueue.counts(now, queue))
 end
 
+-- Get information about a page of the queues
+QlessAPI['queues.list'] = function(now, offset, count)
+  return cjson.encode(QlessQueue.list(now, offset, count))
+end
+
+-- Add the jobs waiting in a queue to the work sets of their klasses, a page
+-- at a time. Returns the cursor for the next page, or 0 when it's done
+QlessAPI['queue.reindex'] = function(now, queue, budget, cursor)
+  return Qless.queue(queue):reindex(budget, cursor)
+end
+
+-- Rebuild a queue's counters from its sets
+QlessAPI['queue.recount'] = function(now, queue)
+  return cjson.encode(Qless.queue(queue):recount())
+end
+
 QlessAPI.complete = function(now, jid, worker, queue, data, ...)
   return Qless.job(jid):complete(now, worker, queue, data, unpack(arg))
 end
 
+QlessAPI['complete.many'] = function(now, worker, queue, jobs)
+  return cjson.encode(Qless.queue(queue):complete_many(now, worker, jobs))
+end
+
+QlessAPI.gc = function(now, budget)
+  return Qless.gc(now, budget)
+end
+
 QlessAPI.failed = function(now, group, start, limit)
   return cjson.encode(Qless.failed(group, start, limit))
 end
 
+QlessAPI['failed.range'] = function(now, group, from, to, offset, count)
+  return cjson.encode(Qless.failed_range(group, from, to, offset, count))
+end
+
+QlessAPI['failed.migrate'] = function(now, budget)
+  return Qless.failed_migrate(now, budget)
+end
+
 QlessAPI.fail = function(now, jid, worker, group, message, data)
   return Qless.job(jid):fail(now, worker, group, message, data)
 end
@@ -74,18 +218,41 @@ QlessAPI.heartbeat = function(now, jid, worker, data)
   return Qless.job(jid):heartbeat(now, worker, data)
 end
 
+QlessAPI['heartbeat.many'] = function(now, worker, jobs)
+  return cjson.encode(QlessWorker.heartbeat(now, worker, jobs))
+end
+
 QlessAPI.workers = function(now, worker)
   return cjson.encode(QlessWorker.counts(now, worker))
 end
 
-QlessAPI.track = function(now, command, jid)
-  return cjson.encode(Qless.track(now, command, jid))
+QlessAPI['workers.list'] = function(now, offset, count)
+  return cjson.encode(QlessWorker.list(now, offset, count or 25))
+end
+
+QlessAPI['worker.reap'] = function(now, budget)
+  return QlessWorker.reap(now, budget)
+end
+
+-- With 'list', a page of the tracked jobs, followed by any job options
+QlessAPI.track = function(now, command, ...)
+  if command == 'list' then
+    local args = {}
+    for i = 3, #arg do table.insert(args, arg[i]) end
+    local options = read_job_options('Track', args)
+    return cjson.encode(Qless.tracked(arg[1], arg[2], options.fields))
+  end
+  return cjson.encode(Qless.track(now, command, arg[1]))
 end
 
 QlessAPI.tag = function(now, command, ...)
   return cjson.encode(Qless.tag(now, command, unpack(arg)))
 end
 
+QlessAPI['tag.query'] = function(now, query, offset, count)
+  return cjson.encode(Qless.tag_query(now, query, offset, count))
+end
+
 QlessAPI.stats = function(now, queue, date)
   return cjson.encode(Qless.queue(queue):stats(now, date))
 end
@@ -103,25 +270,90 @@ QlessAPI.log = function(now, jid, message, data)
       "Log(): Argument 'data' not cjson: " .. tostring(data))
   end
 
-  local job = Qless.job(jid)
-  assert(job:exists(), 'Log(): Job ' .. jid .. ' does not exist')
-  job:history(now, message, data)
+  local queue = redis.call('hget', QlessJob.ns .. jid, 'queue')
+  assert(queue, 'Log(): Job ' .. jid .. ' does not exist')
+  Qless.job(jid):history(now, message, data, queue)
+end
+
+-- Bring the history of these jobs up to date with how it's now stored.
+-- Returns the number of jobs that needed it. With 'scan', the jobs are found
+-- a page of the keyspace at a time instead, returning the cursor for the next
+-- page (0 once it's done) along with the number that needed it:
+--
+--  history.migrate(now, jid, [jid, ...])
+--  history.migrate(now, 'scan', cursor, [budget])
+QlessAPI['history.migrate'] = function(now, ...)
+  if arg[1] == 'scan' then
+    local cursor, migrated = QlessJob.migrate_histories(arg[2], arg[3])
+    return cjson.encode({cursor = cursor, migrated = migrated})
+  end
+  local migrated = 0
+  for _, jid in ipairs(arg) do
+    if Qless.job(jid):migrate_history() then
+      migrated = migrated + 1
+    end
+  end
+  return migrated
 end
 
-QlessAPI.peek = function(now, queue, count)
+QlessAPI.peek = function(now, queue, count, ...)
+  local options = read_job_options('Peek', arg)
   local jids = Qless.queue(queue):peek(now, count)
   local response = {}
   for i, jid in ipairs(jids) do
-    table.insert(response, Qless.job(jid):data())
+    table.insert(response, job_data(jid, options))
   end
   return cjson.encode(response)
 end
 
-QlessAPI.pop = function(now, queue, worker, count)
-  local jids = Qless.queue(queue):pop(now, worker, count)
+-- Pop jobs from a queue. Besides the job options, a 'klass' option of a
+-- comma-separated list of klasses limits pop to just jobs of those klasses
+QlessAPI.pop = function(now, queue, worker, count, ...)
+  local klasses
+  for i = #arg - 1, 1, -2 do
+    if arg[i] == 'klass' then
+      klasses = {}
+      for klass in string.gmatch(arg[i + 1], '[^,]+') do
+        table.insert(klasses, klass)
+      end
+      table.remove(arg, i + 1)
+      table.remove(arg, i)
+    end
+  end
+  local options = read_job_options('Pop', arg)
+  local jids = Qless.queue(queue):pop(now, worker, count, klasses)
   local response = {}
   for i, jid in ipairs(jids) do
-    table.insert(response, Qless.job(jid):data())
+    table.insert(response, job_data(jid, options))
+  end
+  return cjson.encode(response)
+end
+
+-- Pop jobs from several queues at once. The queues may be followed by a
+-- 'mode' of 'priority' or 'weighted', and by any job options
+QlessAPI['pop.multi'] = function(now, worker, count, ...)
+  local queues = arg
+  local args = trailing_options(queues,
+    {mode = true, fields = true, history = true, dependencies = true})
+  local mode
+  for i = #args - 1, 1, -2 do
+    if args[i] == 'mode' then
+      mode = args[i + 1]
+      table.remove(args, i + 1)
+      table.remove(args, i)
+    end
+  end
+  local options = read_job_options('PopMulti', args)
+
+  -- Each job says which queue it came from
+  if options.fields then
+    table.insert(options.fields, 'queue')
+  end
+
+  local jids = QlessQueue.pop_multi(now, worker, count, queues, mode)
+  local response = {}
+  for i, jid in ipairs(jids) do
+    table.insert(response, job_data(jid, options))
   end
   return cjson.encode(response)
 end
@@ -142,6 +374,10 @@ QlessAPI.cancel = function(now, ...)
   return Qless.cancel(now, unpack(arg))
 end
 
+QlessAPI['cancel.query'] = function(now, queue, query, budget, cursor)
+  return cjson.encode(Qless.cancel_query(now, queue, query, budget, cursor))
+end
+
 QlessAPI.timeout = function(now, ...)
   for _, jid in ipairs(arg) do
     Qless.job(jid):timeout(now)
@@ -152,6 +388,10 @@ QlessAPI.put = function(now, me, queue, jid, klass, data, delay, ...)
   return Qless.queue(queue):put(now, me, jid, klass, data, delay, unpack(arg))
 end
 
+QlessAPI['put.many'] = function(now, me, queue, jobs)
+  return cjson.encode(Qless.queue(queue):put_many(now, me, jobs))
+end
+
 QlessAPI.requeue = function(now, me, queue, jid, ...)
   local job = Qless.job(jid)
   assert(job:exists(), 'Requeue(): Job ' .. jid .. ' does not exist')
@@ -205,7 +445,11 @@ end
 
 -- Resource apis
 QlessAPI['resource.set'] = function(now, rid, max)
-  return Qless.resource(rid):set(max)
+  return Qless.resource(rid):set(now, max)
+end
+
+QlessAPI['resource.rebalance'] = function(now, rid)
+  return cjson.encode(Qless.resource(rid):promote(now))
 end
 
 QlessAPI['resource.get'] = function(now, rid)
@@ -216,6 +460,14 @@ QlessAPI['resource.get'] = function(now, rid)
   return cjson.encode(data)
 end
 
+QlessAPI['resource.pending'] = function(now, rid, offset, count)
+  return cjson.encode(Qless.resource(rid):pending(offset, count))
+end
+
+QlessAPI['resource.holders'] = function(now, rid, cursor, count)
+  return cjson.encode(Qless.resource(rid):holders(cursor, count))
+end
+
 QlessAPI['resource.unset'] = function(now, rid)
   return Qless.resource(rid):unset()
 end
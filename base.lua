@@ -112,21 +112,173 @@ function Qless.failed(group, start, limit)
 
   if group then
     -- If a group was provided, then we should do paginated lookup
+    local key, legacy = Qless.failure_group(group)
+    if legacy then
+      return {
+        total = redis.call('llen', key),
+        jobs  = redis.call('lrange', key, start, start + limit - 1)
+      }
+    end
     return {
-      total = redis.call('llen', 'ql:f:' .. group),
-      jobs  = redis.call('lrange', 'ql:f:' .. group, start, start + limit - 1)
+      total = redis.call('zcard', key),
+      jobs  = redis.call('zrevrange', key, start, start + limit - 1)
     }
   else
-    -- Otherwise, we should just list all the known failure groups we have
+    -- Otherwise, we should just list all the known failure groups we have,
+    -- counting any that haven't been counted yet
     local response = {}
-    local groups = redis.call('smembers', 'ql:failures')
-    for index, group in ipairs(groups) do
-      response[group] = redis.call('llen', 'ql:f:' .. group)
+    local counts = redis.call('hgetall', 'ql:failure-counts')
+    for i = 1, #counts, 2 do
+      response[counts[i]] = tonumber(counts[i + 1])
+    end
+    if #counts / 2 ~= redis.call('scard', 'ql:failures') then
+      for index, group in ipairs(redis.call('smembers', 'ql:failures')) do
+        if not response[group] then
+          local key, legacy = Qless.failure_group(group)
+          response[group] = legacy and redis.call('llen', key) or
+            redis.call('zcard', key)
+        end
+      end
     end
     return response
   end
 end
 
+-- FailedRange(group, [from, [to, [offset, [count]]]])
+-- ---------------------------------------------------
+-- Like `failed` with a group, but only for the jobs that failed between the
+-- times `from` and `to` (inclusive), most recent first. `total` is the number
+-- of jobs that failed in that range.
+function Qless.failed_range(group, from, to, offset, count)
+  assert(group, 'FailedRange(): Arg "group" missing')
+  from = assert(tonumber(from or '-inf'),
+    'FailedRange(): Arg "from" is not a number: ' .. tostring(from))
+  to = assert(tonumber(to or '+inf'),
+    'FailedRange(): Arg "to" is not a number: ' .. tostring(to))
+  offset = assert(tonumber(offset or 0),
+    'FailedRange(): Arg "offset" is not a number: ' .. tostring(offset))
+  count = assert(tonumber(count or 25),
+    'FailedRange(): Arg "count" is not a number: ' .. tostring(count))
+
+  local key, legacy = Qless.failure_group(group)
+  assert(not legacy, 'FailedRange(): Group "' .. group ..
+    '" is still a list, and needs "failed.migrate" first')
+  return {
+    total = redis.call('zcount', key, from, to),
+    jobs  = redis.call('zrevrangebyscore', key, to, from,
+      'LIMIT', offset, count)
+  }
+end
+
+-- Each failure group is a sorted set of jids at `ql:f:<group>`, scored by
+-- when they failed, and the number of jobs in each is kept in the hash
+-- `ql:failure-counts`. Groups from before then are lists, newest first, which
+-- keep working as lists until `failed.migrate` has converted them, and aren't
+-- counted until a job is next added. Returns the group's key, and whether or
+-- not it's still a list.
+function Qless.failure_group(group)
+  local key = 'ql:f:' .. group
+  return key, redis.call('type', key)['ok'] == 'list'
+end
+
+-- Add a job that failed at `when` to a failure group
+function Qless.add_failure(group, jid, when)
+  local key, legacy = Qless.failure_group(group)
+  redis.call('sadd', 'ql:failures', group)
+  if legacy then
+    redis.call('hsetnx', 'ql:failure-counts', group, redis.call('llen', key))
+    redis.call('lpush', key, jid)
+    redis.call('hincrby', 'ql:failure-counts', group, 1)
+  elseif redis.call('zadd', key, when, jid) == 1 then
+    redis.call('hincrby', 'ql:failure-counts', group, 1)
+  end
+end
+
+-- Adjust the count of a failure group after `removed` of its jobs have been
+-- taken out, forgetting the group once it's empty
+function Qless.removed_failures(group, removed)
+  if removed == 0 then
+    return
+  end
+  local remaining
+  if redis.call('hexists', 'ql:failure-counts', group) == 1 then
+    remaining = redis.call('hincrby', 'ql:failure-counts', group, -removed)
+  else
+    -- A group that hasn't been counted yet is empty once its key is gone
+    remaining = redis.call('exists', 'ql:f:' .. group)
+  end
+  if remaining <= 0 then
+    redis.call('hdel', 'ql:failure-counts', group)
+    redis.call('srem', 'ql:failures', group)
+  end
+end
+
+-- Take jobs out of a failure group
+function Qless.remove_failures(group, ...)
+  local key, legacy = Qless.failure_group(group)
+  local removed = 0
+  if legacy then
+    for _, jid in ipairs(arg) do
+      removed = removed + redis.call('lrem', key, 0, jid)
+      redis.call('zrem', key .. '-migrating', jid)
+    end
+  else
+    removed = redis.call('zrem', key, unpack(arg))
+  end
+  Qless.removed_failures(group, removed)
+end
+
+-- FailedMigrate(now, [budget])
+-- ----------------------------
+-- Convert failure groups still kept as lists into sorted sets, copying at most
+-- `budget` jobs (1000 by default) per call, oldest first, into
+-- `ql:f:<group>-migrating`. The copied jobs are the tail of the list, so the
+-- list stays the group until the copy is complete and replaces it. Returns how
+-- many jobs are still to be copied, so call it until that's 0.
+function Qless.failed_migrate(now, budget)
+  budget = assert(tonumber(budget or 1000),
+    'FailedMigrate(): Arg "budget" not a number: ' .. tostring(budget))
+
+  local remaining = 0
+  for _, group in ipairs(redis.call('smembers', 'ql:failures')) do
+    local key, legacy = Qless.failure_group(group)
+    if legacy then
+      local migrating = key .. '-migrating'
+      local copied = redis.call('zcard', migrating)
+      local length = redis.call('llen', key)
+      if budget > 0 then
+        local jids = redis.call('lrange', key,
+          -(copied + budget), -(copied + 1))
+        -- Add them in batches, to keep clear of the limit on unpack
+        for i = #jids, 1, -100 do
+          local args = {}
+          for j = i, math.max(i - 99, 1), -1 do
+            local failure = redis.call(
+              'hget', QlessJob.ns .. jids[j], 'failure')
+            local when = 0
+            if failure then
+              when = tonumber(cjson.decode(failure)['when']) or 0
+            end
+            table.insert(args, when)
+            table.insert(args, jids[j])
+          end
+          redis.call('zadd', migrating, unpack(args))
+        end
+        budget = budget - #jids
+        copied = redis.call('zcard', migrating)
+      end
+
+      if copied >= length then
+        redis.call('rename', migrating, key)
+        redis.call('hset', 'ql:failure-counts', group, copied)
+      else
+        remaining = remaining + length - copied
+      end
+    end
+  end
+  return remaining
+end
+
 -- Jobs(now, 'complete', [offset, [count]])
 -- Jobs(now, (
 --          'stalled' | 'running' | 'scheduled' | 'depends', 'recurring'
@@ -162,7 +314,7 @@ function Qless.jobs(now, state, ...)
     elseif state == 'stalled' then
       return queue.locks.expired(now, offset, count)
     elseif state == 'scheduled' then
-      queue:check_scheduled(now, queue.scheduled.length())
+      queue:signal(queue:check_scheduled(now, queue.scheduled.length()))
       return queue.scheduled.peek(now, offset, count)
     elseif state == 'depends' then
       return queue.depends.peek(now, offset, count)
@@ -178,10 +330,10 @@ end
 -- Track(now, ('track' | 'untrack'), jid)
 -- ------------------------------------------
 -- If no arguments are provided, it returns details of all currently-tracked
--- jobs. If the first argument is 'track', then it will start tracking the job
--- associated with that id, and 'untrack' stops tracking it. In this context,
--- tracking is nothing more than saving the job to a list of jobs that are
--- considered special.
+-- jobs (see `Qless.tracked` for a page of them). If the first argument is
+-- 'track', then it will start tracking the job associated with that id, and
+-- 'untrack' stops tracking it. In this context, tracking is nothing more than
+-- saving the job to a list of jobs that are considered special.
 --
 --  {
 --      'jobs': [
@@ -231,6 +383,45 @@ function Qless.track(now, command, jid)
   end
 end
 
+-- Tracked([offset, [count, [fields]]])
+-- ------------------------------------
+-- A page of the tracked jobs, in the order they were tracked, with just the
+-- `fields` of each job if they're given. The jids in the page whose jobs have
+-- since expired are listed apart, and cost just the one read to find.
+--
+--  {
+--      'total': 2,
+--      'jobs': [{'jid': ..., ...}],
+--      'expired': ['deadbeef']
+--  }
+function Qless.tracked(offset, count, fields)
+  offset = assert(tonumber(offset or 0),
+    'Track(): Arg "offset" not a number: ' .. tostring(offset))
+  count  = assert(tonumber(count or 25),
+    'Track(): Arg "count" not a number: ' .. tostring(count))
+
+  local response = {
+    total   = redis.call('zcard', 'ql:tracked'),
+    jobs    = {},
+    expired = {}
+  }
+  local jids = redis.call('zrange', 'ql:tracked', offset, offset + count - 1)
+  for _, jid in ipairs(jids) do
+    local data
+    if fields then
+      data = Qless.job(jid):data(fields)
+    else
+      data = Qless.job(jid):data()
+    end
+    if data then
+      table.insert(response.jobs, data)
+    else
+      table.insert(response.expired, jid)
+    end
+  end
+  return response
+end
+
 -- tag(now, ('add' | 'remove'), jid, tag, [tag, ...])
 -- tag(now, 'get', tag, [offset, [count]])
 -- tag(now, 'top', [offset, [count]])
@@ -329,6 +520,156 @@ function Qless.tag(now, command, ...)
   end
 end
 
+-- Move a job from the `old` list of tags to the `new` one, touching only the
+-- tags that differ between them. Tags the job keeps also keep their score, the
+-- time they were first added to the job.
+function Qless.retag(now, jid, old, new)
+  local kept = {}
+  for _, tag in ipairs(old) do kept[tag] = false end
+  for _, tag in ipairs(new) do
+    if kept[tag] == nil then
+      redis.call('zadd', 'ql:t:' .. tag, now, jid)
+      redis.call('zincrby', 'ql:tags', 1, tag)
+    end
+    kept[tag] = true
+  end
+  for tag, keep in pairs(kept) do
+    if not keep then
+      redis.call('zrem', 'ql:t:' .. tag, jid)
+      redis.call('zincrby', 'ql:tags', -1, tag)
+    end
+  end
+end
+
+-- TagQuery(now, query, [offset, [count]])
+-- ----------------------------------------
+-- Find the jobs matching a JSON combination of tags. A query is either a tag,
+-- or an object of one of these forms:
+--
+--  {"and": [query, ...]}  # jobs matching all of the queries
+--  {"or" : [query, ...]}  # jobs matching any of the queries
+--  {"not": query}         # jobs not matching the query, only inside an "and"
+--                         # with at least one other query
+--
+-- Returns a page of the matching jids along with how many there are in total,
+-- like `tag get`. The whole result is kept for `tag-query-ttl` seconds (60 by
+-- default) so that later pages of the same query don't have to work it out
+-- again, which means they may be that far out of date.
+function Qless.tag_query(now, query, offset, count)
+  assert(query, 'TagQuery(): Arg "query" missing')
+  local parsed = assert(cjson.decode(query),
+    'TagQuery(): Arg "query" not JSON: ' .. tostring(query))
+  offset = assert(tonumber(offset or 0),
+    'TagQuery(): Arg "offset" not a number: ' .. tostring(offset))
+  count = assert(tonumber(count or 25),
+    'TagQuery(): Arg "count" not a number: ' .. tostring(count))
+
+  -- A lone tag is read straight from its own set
+  local key = 'ql:tq:' .. redis.sha1hex(query)
+  if type(parsed) == 'string' then
+    key = 'ql:t:' .. parsed
+  else
+    local cached = redis.call('type', key)['ok']
+    if cached == 'string' then
+      -- An empty result, which Redis won't keep as a sorted set
+      return {total = 0, jobs = {}}
+    elseif cached == 'none' then
+      local temporary = {}
+      Qless.tag_query_key(parsed, key, temporary)
+      redis.call('del', unpack(temporary))
+      local ttl = tonumber(Qless.config.get('tag-query-ttl', 60))
+      if redis.call('exists', key) == 0 then
+        redis.call('set', key, '', 'EX', ttl)
+        return {total = 0, jobs = {}}
+      end
+      redis.call('expire', key, ttl)
+    end
+  end
+
+  return {
+    total = redis.call('zcard', key),
+    jobs  = redis.call('zrange', key, offset, offset + count - 1)
+  }
+end
+
+-- Work out the jobs matching a parsed tag query, and return the key of the
+-- sorted set holding them. That's the tag's own key for a lone tag, and
+-- otherwise `key`. Any other keys made along the way are added to `temporary`.
+function Qless.tag_query_key(query, key, temporary)
+  if type(query) == 'string' then
+    return 'ql:t:' .. query
+  end
+  assert(type(query) == 'table', 'TagQuery(): Query not a tag or an object')
+  assert(query['not'] == nil,
+    'TagQuery(): "not" is only allowed inside an "and"')
+
+  local operator = (query['and'] and 'and') or (query['or'] and 'or')
+  assert(operator, 'TagQuery(): Query must have an "and" or an "or"')
+  local terms = query[operator]
+  assert(type(terms) == 'table' and #terms > 0,
+    'TagQuery(): "' .. operator .. '" must have a list of queries')
+
+  -- Work out the keys of each term first
+  local keys = {}
+  local excluded = {}
+  for i, term in ipairs(terms) do
+    local sub = key .. ':' .. (#temporary + 1)
+    if type(term) == 'table' and term['not'] ~= nil then
+      assert(operator == 'and',
+        'TagQuery(): "not" is only allowed inside an "and"')
+      table.insert(temporary, sub)
+      table.insert(excluded, Qless.tag_query_key(term['not'], sub, temporary))
+    else
+      table.insert(temporary, sub)
+      table.insert(keys, Qless.tag_query_key(term, sub, temporary))
+    end
+  end
+  assert(#keys > 0,
+    'TagQuery(): "and" needs at least one query that isn\'t a "not"')
+
+  -- Every tag scores a job by when it was put, so keep that score rather
+  -- than the default sum, or jobs with more tags would sort later
+  local count = #keys
+  table.insert(keys, 'aggregate')
+  table.insert(keys, 'max')
+  if operator == 'and' then
+    redis.call('zinterstore', key, count, unpack(keys))
+    for _, exclude in ipairs(excluded) do
+      Qless.zdiff(key, exclude)
+    end
+  else
+    redis.call('zunionstore', key, count, unpack(keys))
+  end
+  return key
+end
+
+-- Remove the members of `exclude` from the sorted set at `key`, with
+-- ZDIFFSTORE where the server supports it
+function Qless.zdiff(key, exclude)
+  if Qless.can_zdiff ~= false then
+    local reply = redis.pcall('zdiffstore', key, 2, key, exclude)
+    if type(reply) ~= 'table' or not reply.err then
+      Qless.can_zdiff = true
+      return
+    end
+    Qless.can_zdiff = false
+  end
+
+  -- Otherwise, walk whichever of the two is smaller
+  if redis.call('zcard', exclude) < redis.call('zcard', key) then
+    local members = redis.call('zrange', exclude, 0, -1)
+    for i = 1, #members, 100 do
+      redis.call('zrem', key, unpack(members, i, math.min(i + 99, #members)))
+    end
+  else
+    for _, member in ipairs(redis.call('zrange', key, 0, -1)) do
+      if redis.call('zscore', exclude, member) then
+        redis.call('zrem', key, member)
+      end
+    end
+  end
+end
+
 -- Cancel(...)
 -- --------------
 -- Cancel a job from taking place. It will be deleted from the system, and any
@@ -358,86 +699,192 @@ function Qless.cancel(now, ...)
   -- If we've made it this far, then we are good to go. We can now just
   -- remove any trace of all these jobs, as they form a dependent clique
   for _, jid in ipairs(arg) do
-    -- Find any stage it's associated with and remove its from that stage
-    local real_jid, state, queue, failure, worker = unpack(redis.call(
-      'hmget', QlessJob.ns .. jid, 'jid', 'state', 'queue', 'failure', 'worker'))
-
-    if state ~= false and state ~= 'complete' then
+    if Qless.job(jid):cancel(now) then
       table.insert(cancelled_jids, jid)
+    end
+  end
 
-      -- Send a message out on the appropriate channels
-      local encoded = cjson.encode({
-        jid    = jid,
-        worker = worker,
-        event  = 'canceled',
-        queue  = queue
-      })
-      Qless.publish('log', encoded)
-
-      -- Remove this job from whatever worker has it, if any
-      if worker and (worker ~= '') then
-        redis.call('zrem', 'ql:w:' .. worker .. ':jobs', jid)
-        -- If necessary, send a message to the appropriate worker, too
-        Qless.publish('w:' .. worker, encoded)
+  return cancelled_jids
+end
+
+-- Where a queue keeps its jobs in each state that `cancel.query` can select
+local cancel_query_sets = {
+  depends   = 'depends',
+  scheduled = 'scheduled',
+  waiting   = 'work',
+  running   = 'locks',
+  failed    = false
+}
+
+-- CancelQuery(now, queue, query, [budget, [cursor]])
+-- ---------------------------------------------------
+-- Cancel the jobs in `queue` matching a JSON query of any of a "state", a
+-- "tag" and a "klass", like {"state": "waiting", "klass": "Foo"}. Jobs are
+-- read from the tag's set if there is one, or else from the sets of the
+-- queue's states, dependent jobs first. Failed jobs are read from every
+-- failure group, by name, since those aren't kept per queue. At most `budget`
+-- jobs (1000 by default) are looked at, and the returned cursor picks up
+-- where this call left off:
+--
+--  {
+--      'cancelled': [jid, ...],
+--      'cursor': '1:20',
+--      'done': false
+--  }
+--
+-- Jobs that other jobs still depend on are left alone, so they can be
+-- cancelled by going through the query again once their dependents are gone.
+function Qless.cancel_query(now, name, query, budget, cursor)
+  assert(name, 'CancelQuery(): Arg "queue" missing')
+  query = assert(cjson.decode(query or '{}'),
+    'CancelQuery(): Arg "query" not JSON: ' .. tostring(query))
+  assert(type(query) == 'table' and (query.state or query.tag or query.klass),
+    'CancelQuery(): Arg "query" needs a "state", "tag" or "klass"')
+  budget = assert(tonumber(budget or 1000),
+    'CancelQuery(): Arg "budget" not a number: ' .. tostring(budget))
+  local source, offset = string.match(cursor or '0:0', '^(%d+):(%d+)$')
+  assert(source, 'CancelQuery(): Arg "cursor" not valid: ' .. tostring(cursor))
+  source, offset = tonumber(source) + 1, tonumber(offset)
+
+  local queue = Qless.queue(name)
+  local keys = {}
+  if query.tag then
+    keys = {'ql:t:' .. query.tag}
+  else
+    local states = {'depends', 'scheduled', 'waiting', 'running', 'failed'}
+    if query.state then
+      assert(cancel_query_sets[query.state] ~= nil,
+        'CancelQuery(): Unknown state "' .. tostring(query.state) .. '"')
+      states = {query.state}
+    end
+    for _, state in ipairs(states) do
+      if state == 'failed' then
+        local groups = redis.call('smembers', 'ql:failures')
+        table.sort(groups)
+        for _, group in ipairs(groups) do
+          table.insert(keys, 'ql:f:' .. group)
+        end
+      elseif state == 'waiting' and query.klass and queue:indexed() then
+        table.insert(keys, queue:prefix('work-' .. query.klass))
+      else
+        table.insert(keys, queue:prefix(cancel_query_sets[state]))
       end
+    end
+  end
 
-      -- Remove it from that queue
-      if queue then
-        local queue = Qless.queue(queue)
-        queue.work.remove(jid)
-        queue.locks.remove(jid)
-        queue.scheduled.remove(jid)
-        queue.depends.remove(jid)
+  -- Cancelled jobs leave the set they're read from, so the offset only
+  -- counts the jobs that were passed over
+  local cancelled = {}
+  while budget > 0 and keys[source] do
+    -- Failure groups that haven't been migrated yet are still lists
+    local range = 'zrange'
+    if redis.call('type', keys[source])['ok'] == 'list' then
+      range = 'lrange'
+    end
+    local jids = redis.call(range, keys[source], offset, offset + budget - 1)
+    budget = budget - #jids
+    for _, jid in ipairs(jids) do
+      local job_queue, state, klass = unpack(redis.call('hmget',
+        QlessJob.ns .. jid, 'queue', 'state', 'klass'))
+      if job_queue == name
+        and (query.state == nil or state == query.state)
+        and (query.klass == nil or klass == query.klass)
+        and redis.call('scard', QlessJob.ns .. jid .. '-dependents') == 0
+        and Qless.job(jid):cancel(now) then
+        table.insert(cancelled, jid)
+      else
+        offset = offset + 1
       end
+    end
+    if budget > 0 then
+      source, offset = source + 1, 0
+    end
+  end
 
-      Qless.job(jid):release_resources(now)
+  return {
+    cancelled = cancelled,
+    cursor    = (source - 1) .. ':' .. offset,
+    done      = keys[source] == nil
+  }
+end
 
-      -- We should probably go through all our dependencies and remove
-      -- ourselves from the list of dependents
-      for i, j in ipairs(redis.call(
-        'smembers', QlessJob.ns .. jid .. '-dependencies')) do
-        redis.call('srem', QlessJob.ns .. j .. '-dependents', jid)
-      end
 
-      -- Delete any notion of dependencies it has
-      redis.call('del', QlessJob.ns .. jid .. '-dependencies')
+-- ZADD a flat list of score and member pairs to `key`, in batches to keep
+-- clear of the limit on unpack. Returns the number of members added
+function Qless.zadd(key, members)
+  local added = 0
+  for i = 1, #members, 200 do
+    added = added + redis.call('zadd', key,
+      unpack(members, i, math.min(i + 199, #members)))
+  end
+  return added
+end
 
-      -- If we're in the failed state, remove all of our data
-      if state == 'failed' then
-        failure = cjson.decode(failure)
-        -- We need to make this remove it from the failed queues
-        redis.call('lrem', 'ql:f:' .. failure.group, 0, jid)
-        if redis.call('llen', 'ql:f:' .. failure.group) == 0 then
-          redis.call('srem', 'ql:failures', failure.group)
-        end
-        -- Remove one count from the failed count of the particular
-        -- queue
-        local bin = failure.when - (failure.when % 86400)
-        local failed = redis.call(
-          'hget', 'ql:s:stats:' .. bin .. ':' .. queue, 'failed')
-        redis.call('hset',
-          'ql:s:stats:' .. bin .. ':' .. queue, 'failed', failed - 1)
-      end
+-- Call `func`, catching any error it raises, for the batched commands that
+-- report the failure of one item without stopping the rest. Returns whether
+-- it succeeded, and either what it returned or the error's message
+function Qless.attempt(func)
+  local ok, result = pcall(func)
+  if ok then
+    return true, result
+  end
+  -- Errors raised by redis.call come back as a table
+  if type(result) == 'table' then
+    result = result.err
+  end
+  -- Drop the script position that error() prepends to the message
+  return false, (string.gsub(tostring(result), '^[^:]*:%d+: ', ''))
+end
 
-      -- Remove it as a job that's tagged with this particular tag
-      local tags = cjson.decode(
-        redis.call('hget', QlessJob.ns .. jid, 'tags') or '{}')
-      for i, tag in ipairs(tags) do
-        redis.call('zrem', 'ql:t:' .. tag, jid)
-        redis.call('zincrby', 'ql:tags', -1, tag)
-      end
+-- Delete the given keys. Where the server supports UNLINK, the memory is
+-- reclaimed in the background rather than while this script holds the server
+function Qless.unlink(...)
+  if Qless.can_unlink ~= false then
+    local reply = redis.pcall('unlink', unpack(arg))
+    if type(reply) ~= 'table' or not reply.err then
+      Qless.can_unlink = true
+      return reply
+    end
+    Qless.can_unlink = false
+  end
+  return redis.call('del', unpack(arg))
+end
 
-      -- If the job was being tracked, we should notify
-      if redis.call('zscore', 'ql:tracked', jid) ~= false then
-        Qless.publish('canceled', jid)
-      end
+-- GC(now, budget)
+-- ---------------
+-- Delete the data of completed jobs that have aged out, either because
+-- they're older than `jobs-history` seconds or because they're beyond the
+-- most recent `jobs-history-count` completed jobs. At most `budget` jobs are
+-- deleted, oldest first, and the number of aged-out jobs that remain is
+-- returned, so that this can be called until it returns 0.
+function Qless.gc(now, budget)
+  budget = assert(tonumber(budget),
+    'GC(): Arg "budget" not a number: ' .. tostring(budget))
+
+  local count = tonumber(Qless.config.get('jobs-history-count'))
+  local time  = tonumber(Qless.config.get('jobs-history'))
+
+  -- Completed jobs are ordered by when they were completed, so those that
+  -- have aged out by either measure are all at the start of the set
+  local expired = math.max(
+    redis.call('zcard', 'ql:completed') - count,
+    redis.call('zcount', 'ql:completed', 0, now - time))
+  local reaped = math.max(math.min(expired, budget), 0)
+  if reaped == 0 then
+    return math.max(expired, 0)
+  end
 
-      -- Just go ahead and delete our data
-      redis.call('del', QlessJob.ns .. jid)
-      redis.call('del', QlessJob.ns .. jid .. '-history')
+  local jids = redis.call('zrange', 'ql:completed', 0, reaped - 1)
+  for index, jid in ipairs(jids) do
+    local tags = cjson.decode(
+      redis.call('hget', QlessJob.ns .. jid, 'tags') or '{}')
+    for i, tag in ipairs(tags) do
+      redis.call('zrem', 'ql:t:' .. tag, jid)
+      redis.call('zincrby', 'ql:tags', -1, tag)
     end
+    Qless.unlink(QlessJob.ns .. jid, QlessJob.ns .. jid .. '-history')
   end
+  redis.call('zremrangebyrank', 'ql:completed', 0, reaped - 1)
 
-  return cancelled_jids
+  return expired - reaped
 end
-
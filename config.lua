@@ -13,18 +13,36 @@ Qless.config.defaults = {
   ['jobs-history']       = 604800
 }
 
+-- Read the whole of `ql:config` the first time it's needed in this script
+-- run, and serve every later lookup from memory. This is kept apart from the
+-- defaults, so that they're never overwritten by what's stored.
+Qless.config.load = function()
+  if not Qless.config.cache then
+    -- Inspired by redis-lua https://github.com/nrk/redis-lua/blob/version-2.0/src/redis.lua
+    local cache = {}
+    local reply = redis.call('hgetall', 'ql:config')
+    for i = 1, #reply, 2 do
+      cache[reply[i]] = reply[i + 1]
+    end
+    Qless.config.cache = cache
+  end
+  return Qless.config.cache
+end
+
 -- Get one or more of the keys
 Qless.config.get = function(key, default)
+  local cache = Qless.config.load()
   if key then
-    return redis.call('hget', 'ql:config', key) or
-      Qless.config.defaults[key] or default
+    return cache[key] or Qless.config.defaults[key] or default
   else
-    -- Inspired by redis-lua https://github.com/nrk/redis-lua/blob/version-2.0/src/redis.lua
-    local reply = redis.call('hgetall', 'ql:config')
-    for i = 1, #reply, 2 do
-      Qless.config.defaults[reply[i]] = reply[i + 1]
+    local reply = {}
+    for option, value in pairs(Qless.config.defaults) do
+      reply[option] = value
     end
-    return Qless.config.defaults
+    for option, value in pairs(cache) do
+      reply[option] = value
+    end
+    return reply
   end
 end
 
@@ -40,6 +58,9 @@ Qless.config.set = function(option, value)
   }))
 
   redis.call('hset', 'ql:config', option, value)
+  if Qless.config.cache then
+    Qless.config.cache[option] = tostring(value)
+  end
 end
 
 -- Unset a configuration option
@@ -52,4 +73,7 @@ Qless.config.unset = function(option)
   }))
 
   redis.call('hdel', 'ql:config', option)
+  if Qless.config.cache then
+    Qless.config.cache[option] = nil
+  end
 end
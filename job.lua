@@ -4,54 +4,122 @@
 -- It returns an object that represents the job with the provided JID
 -------------------------------------------------------------------------------
 
+-- How to read each field of a job's data. Most of them come straight from
+-- the job's hash, and are converted from what's stored there. The rest need
+-- lookups of their own, and are only done when asked for.
+QlessJob.fields = {
+  jid              = {stored = true},
+  klass            = {stored = true},
+  state            = {stored = true},
+  queue            = {stored = true},
+  worker           = {stored = true, convert = function(value)
+    return value or ''
+  end},
+  priority         = {stored = true, convert = tonumber},
+  expires          = {stored = true, convert = function(value)
+    return tonumber(value) or 0
+  end},
+  retries          = {stored = true, convert = tonumber},
+  remaining        = {stored = true, convert = function(value)
+    return math.floor(tonumber(value))
+  end},
+  data             = {stored = true},
+  tags             = {stored = true, convert = cjson.decode},
+  failure          = {stored = true, convert = function(value)
+    return cjson.decode(value or '{}')
+  end},
+  spawned_from_jid = {stored = true},
+  resources        = {stored = true, convert = function(value)
+    return cjson.decode(value or '[]')
+  end},
+  concurrency_key  = {stored = true, convert = function(value)
+    -- Left out of the job's data altogether when it hasn't got one
+    return value or nil
+  end},
+  tracked          = {lookup = function(job)
+    return redis.call('zscore', 'ql:tracked', job.jid) ~= false
+  end},
+  history          = {lookup = function(job)
+    return job:history()
+  end},
+  dependents       = {lookup = function(job)
+    return redis.call('smembers', QlessJob.ns .. job.jid .. '-dependents')
+  end},
+  dependencies     = {lookup = function(job)
+    return redis.call('smembers', QlessJob.ns .. job.jid .. '-dependencies')
+  end}
+}
+
+-- The order in which fields are reported when they're all asked for
+QlessJob.field_names = {
+  'jid', 'klass', 'state', 'queue', 'worker', 'tracked', 'priority',
+  'expires', 'retries', 'remaining', 'data', 'tags', 'history', 'failure',
+  'spawned_from_jid', 'resources', 'concurrency_key', 'dependents',
+  'dependencies'}
+
 -- This gets all the data associated with the job with the provided id. If the
 -- job is not found, it returns nil. If found, it returns an object with the
--- appropriate properties
+-- appropriate properties.
+--
+-- If field names are provided, then only those fields are read, and a list of
+-- their values is returned in the same order. If instead a table of field
+-- names is provided, then an object with just those fields is returned.
+-- Either way, the history, dependency and tracking lookups are only made for
+-- the fields that need them.
 function QlessJob:data(...)
-  local job = redis.call(
-      'hmget', QlessJob.ns .. self.jid, 'jid', 'klass', 'state', 'queue',
-      'worker', 'priority', 'expires', 'retries', 'remaining', 'data',
-      'tags', 'failure', 'spawned_from_jid', 'resources')
+  local fields = arg
+  local projection = type(arg[1]) == 'table'
+  if projection then
+    fields = arg[1]
+  elseif #arg == 0 then
+    fields = QlessJob.field_names
+    projection = true
+  end
+
+  -- We always read the jid, to know whether or not the job exists
+  local stored = {'jid'}
+  for _, field in ipairs(fields) do
+    local spec = QlessJob.fields[field]
+    if spec and spec.stored and field ~= 'jid' then
+      table.insert(stored, field)
+    end
+  end
+  local job = redis.call('hmget', QlessJob.ns .. self.jid, unpack(stored))
 
   -- Return nil if we haven't found it
   if not job[1] then
     return nil
   end
 
-  local data = {
-    jid              = job[1],
-    klass            = job[2],
-    state            = job[3],
-    queue            = job[4],
-    worker           = job[5] or '',
-    tracked          = redis.call(
-      'zscore', 'ql:tracked', self.jid) ~= false,
-    priority         = tonumber(job[6]),
-    expires          = tonumber(job[7]) or 0,
-    retries          = tonumber(job[8]),
-    remaining        = math.floor(tonumber(job[9])),
-    data             = job[10],
-    tags             = cjson.decode(job[11]),
-    history          = self:history(),
-    failure          = cjson.decode(job[12] or '{}'),
-    spawned_from_jid = job[13],
-    resources    = cjson.decode(job[14] or '[]'),
-    dependents       = redis.call(
-      'smembers', QlessJob.ns .. self.jid .. '-dependents'),
-    dependencies     = redis.call(
-      'smembers', QlessJob.ns .. self.jid .. '-dependencies')
-  }
-
-  if #arg > 0 then
-    -- This section could probably be optimized, but I wanted the interface
-    -- in place first
-    local response = {}
-    for index, key in ipairs(arg) do
-      table.insert(response, data[key])
+  local values = {}
+  for index, field in ipairs(stored) do
+    local convert = QlessJob.fields[field].convert
+    if convert then
+      values[field] = convert(job[index])
+    else
+      values[field] = job[index]
     end
-    return response
-  else
+  end
+
+  local data = {}
+  local response = {}
+  for index, field in ipairs(fields) do
+    local spec = QlessJob.fields[field]
+    local value = values[field]
+    if spec and spec.lookup then
+      value = spec.lookup(self)
+    end
+    if projection then
+      data[field] = value
+    else
+      response[index] = value
+    end
+  end
+
+  if projection then
     return data
+  else
+    return response
   end
 end
 
@@ -68,15 +136,26 @@ end
 --          '["jid1", "jid2", ...]')
 ---
 function QlessJob:complete(now, worker, queue, raw_data, ...)
-  assert(worker, 'Complete(): Arg "worker" missing')
-  assert(queue , 'Complete(): Arg "queue" missing')
-  local data = assert(cjson.decode(raw_data),
-    'Complete(): Arg "data" missing or not JSON: ' .. tostring(raw_data))
-
   -- Read in all the optional parameters
   local options = {}
   for i = 1, #arg, 2 do options[arg[i]] = arg[i + 1] end
 
+  return self:finish(now, worker, queue, raw_data, options)
+end
+
+-- Do the actual work of completing this job, with its optional arguments
+-- already collected into `options`. If `batch` is provided, this job is part
+-- of a `complete_many`, and the stats, the worker's job list and the reaping
+-- of old completed jobs are left for the caller to do once for the whole batch.
+function QlessJob:finish(now, worker, queue, raw_data, options, batch)
+  assert(worker, 'Complete(): Arg "worker" missing')
+  assert(queue , 'Complete(): Arg "queue" missing')
+  -- Jobs completed in a batch may leave out their data, and keep what they had
+  if raw_data ~= nil or not batch then
+    assert(cjson.decode(raw_data),
+      'Complete(): Arg "data" missing or not JSON: ' .. tostring(raw_data))
+  end
+
   -- Sanity check on optional args
   local nextq   = options['next']
   local delay   = assert(tonumber(options['delay'] or 0))
@@ -121,7 +200,7 @@ function QlessJob:complete(now, worker, queue, raw_data, ...)
   --    3) Update the data
   --    4) Mark the job as completed, remove the worker, remove expires, and
   --          update history
-  self:history(now, 'done')
+  self:history(now, 'done', nil, queue)
 
   if raw_data then
     redis.call('hset', QlessJob.ns .. self.jid, 'data', raw_data)
@@ -143,14 +222,23 @@ function QlessJob:complete(now, worker, queue, raw_data, ...)
   local time = tonumber(
     redis.call('hget', QlessJob.ns .. self.jid, 'time') or now)
   local waiting = now - time
-  Qless.queue(queue):stat(now, 'run', waiting)
+  if batch then
+    table.insert(batch.waits, waiting)
+  else
+    Qless.queue(queue):stat(now, 'run', waiting)
+  end
   redis.call('hset', QlessJob.ns .. self.jid,
     'time', string.format("%.20f", now))
 
   -- Remove this job from the jobs that the worker that was running it has
-  redis.call('zrem', 'ql:w:' .. worker .. ':jobs', self.jid)
+  if batch then
+    table.insert(batch.jids, self.jid)
+  else
+    redis.call('zrem', 'ql:w:' .. worker .. ':jobs', self.jid)
+  end
 
-  if redis.call('zscore', 'ql:tracked', self.jid) ~= false then
+  if (not batch or batch.tracked) and
+    redis.call('zscore', 'ql:tracked', self.jid) ~= false then
     Qless.publish('completed', self.jid)
   end
 
@@ -165,12 +253,17 @@ function QlessJob:complete(now, worker, queue, raw_data, ...)
     }))
 
     -- Enqueue the job
-    self:history(now, 'put', {q = nextq})
+    self:history(now, 'put', {q = nextq}, nextq)
 
     -- We're going to make sure that this queue is in the
     -- set of known queues
-    if redis.call('zscore', 'ql:queues', nextq) == false then
-      redis.call('zadd', 'ql:queues', now, nextq)
+    if not (batch and batch.queues[nextq]) then
+      if redis.call('zscore', 'ql:queues', nextq) == false then
+        redis.call('zadd', 'ql:queues', now, nextq)
+      end
+      if batch then
+        batch.queues[nextq] = true
+      end
     end
 
     redis.call('hmset', QlessJob.ns .. self.jid,
@@ -211,6 +304,7 @@ function QlessJob:complete(now, worker, queue, raw_data, ...)
       else
         if self:acquire_resources(now) then
           queue_obj.work.add(now, priority, self.jid)
+          queue_obj:signal(1)
         end
         return 'waiting'
       end
@@ -231,46 +325,14 @@ function QlessJob:complete(now, worker, queue, raw_data, ...)
       'expires', 0,
       'remaining', tonumber(retries))
 
-    -- Do the completion dance
-    local count = Qless.config.get('jobs-history-count')
-    local time  = Qless.config.get('jobs-history')
-
-    -- These are the default values
-    count = tonumber(count or 50000)
-    time  = tonumber(time  or 7 * 24 * 60 * 60)
-
     -- Schedule this job for destructination eventually
     redis.call('zadd', 'ql:completed', now, self.jid)
 
-    -- Now look at the expired job data. First, based on the current time
-    local jids = redis.call('zrangebyscore', 'ql:completed', 0, now - time)
-    -- Any jobs that need to be expired... delete
-    for index, jid in ipairs(jids) do
-      local tags = cjson.decode(
-        redis.call('hget', QlessJob.ns .. jid, 'tags') or '{}')
-      for i, tag in ipairs(tags) do
-        redis.call('zrem', 'ql:t:' .. tag, jid)
-        redis.call('zincrby', 'ql:tags', -1, tag)
-      end
-      redis.call('del', QlessJob.ns .. jid)
-      redis.call('del', QlessJob.ns .. jid .. '-history')
+    -- Do the completion dance, reaping a few old completed jobs. The rest
+    -- are left for `gc`
+    if not batch then
+      Qless.gc(now, Qless.config.get('gc-inline-budget', 10))
     end
-    -- And now remove those from the queued-for-cleanup queue
-    redis.call('zremrangebyscore', 'ql:completed', 0, now - time)
-
-    -- Now take the all by the most recent 'count' ids
-    jids = redis.call('zrange', 'ql:completed', 0, (-1-count))
-    for index, jid in ipairs(jids) do
-      local tags = cjson.decode(
-        redis.call('hget', QlessJob.ns .. jid, 'tags') or '{}')
-      for i, tag in ipairs(tags) do
-        redis.call('zrem', 'ql:t:' .. tag, jid)
-        redis.call('zincrby', 'ql:tags', -1, tag)
-      end
-      redis.call('del', QlessJob.ns .. jid)
-      redis.call('del', QlessJob.ns .. jid .. '-history')
-    end
-    redis.call('zremrangebyrank', 'ql:completed', 0, (-1-count))
 
     -- Alright, if this has any dependents, then we should go ahead
     -- and unstick those guys.
@@ -291,6 +353,7 @@ function QlessJob:complete(now, worker, queue, raw_data, ...)
           else
             if Qless.job(j):acquire_resources(now) then
               queue.work.add(now, p, j)
+              queue:signal(1)
             end
             redis.call('hset', QlessJob.ns .. j, 'state', 'waiting')
           end
@@ -376,7 +439,7 @@ function QlessJob:fail(now, worker, group, message, data)
 
   -- Now, take the element of the history for which our provided worker is
   -- the worker, and update 'failed'
-  self:history(now, 'failed', {worker = worker, group = group})
+  self:history(now, 'failed', {worker = worker, group = group}, queue)
 
   -- Increment the number of failures for that queue for the
   -- given day.
@@ -410,10 +473,8 @@ function QlessJob:fail(now, worker, group, message, data)
       ['worker']  = worker
     }))
 
-  -- Add this group of failure to the list of failures
-  redis.call('sadd', 'ql:failures', group)
-  -- And add this particular instance to the failed groups
-  redis.call('lpush', 'ql:f:' .. group, self.jid)
+  -- Add this particular instance to the failed groups
+  Qless.add_failure(group, self.jid, now)
 
   -- Here is where we'd intcrement stats about the particular stage
   -- and possibly the workers
@@ -478,7 +539,7 @@ function QlessJob:retry(now, queue, worker, delay, group, message)
     -- Now remove the instance from the schedule, and work queues for the
     -- queue it's in
     local group = group or 'failed-retries-' .. queue
-    self:history(now, 'failed', {['group'] = group})
+    self:history(now, 'failed', {['group'] = group}, oldqueue)
 
     redis.call('hmset', QlessJob.ns .. self.jid, 'state', 'failed',
       'worker', '',
@@ -504,10 +565,8 @@ function QlessJob:retry(now, queue, worker, delay, group, message)
       }))
     end
 
-    -- Add this type of failure to the list of failures
-    redis.call('sadd', 'ql:failures', group)
-    -- And add this particular instance to the failed types
-    redis.call('lpush', 'ql:f:' .. group, self.jid)
+    -- Add this particular instance to the failed types
+    Qless.add_failure(group, self.jid, now)
     -- Increment the count of the failed jobs
     local bin = now - (now % 86400)
     redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. queue, 'failures', 1)
@@ -521,6 +580,7 @@ function QlessJob:retry(now, queue, worker, delay, group, message)
     else
       if self:acquire_resources(now) then
         queue_obj.work.add(now, priority, self.jid)
+        queue_obj:signal(1)
       end
       redis.call('hset', QlessJob.ns .. self.jid, 'state', 'waiting')
     end
@@ -587,6 +647,7 @@ function QlessJob:depends(now, command, ...)
         queue_obj.depends.remove(self.jid)
         if self:acquire_resources(now) then
           queue_obj.work.add(now, p, self.jid)
+          queue_obj:signal(1)
         end
         redis.call('hset', QlessJob.ns .. self.jid, 'state', 'waiting')
       end
@@ -604,6 +665,7 @@ function QlessJob:depends(now, command, ...)
             queue_obj.depends.remove(self.jid)
             if self:acquire_resources(now) then
               queue_obj.work.add(now, p, self.jid)
+              queue_obj:signal(1)
             end
             redis.call('hset',
               QlessJob.ns .. self.jid, 'state', 'waiting')
@@ -624,25 +686,21 @@ end
 --      - the job's been completed
 --      - the job's been canceled
 --      - the job's not running
-function QlessJob:heartbeat(now, worker, data)
+--
+-- If `batch` is provided, this heartbeat is part of a `heartbeat.many`, and
+-- the worker's job list, the locks and the list of seen workers are left for
+-- the caller to update once for the whole batch.
+function QlessJob:heartbeat(now, worker, data, batch)
   assert(worker, 'Heatbeat(): Arg "worker" missing')
 
-  -- We should find the heartbeat interval for this queue
-  -- heartbeat. First, though, we need to find the queue
-  -- this particular job is in
-  local queue = redis.call('hget', QlessJob.ns .. self.jid, 'queue') or ''
-  local expires = now + tonumber(
-    Qless.config.get(queue .. '-heartbeat') or
-    Qless.config.get('heartbeat', 60))
-
   if data then
     data = cjson.decode(data)
   end
 
   -- First, let's see if the worker still owns this job, and there is a
   -- worker
-  local job_worker, state = unpack(
-    redis.call('hmget', QlessJob.ns .. self.jid, 'worker', 'state'))
+  local job_worker, state, queue = unpack(
+    redis.call('hmget', QlessJob.ns .. self.jid, 'worker', 'state', 'queue'))
   if job_worker == false then
     -- This means the job doesn't exist
     error('Heartbeat(): Job ' .. self.jid .. ' does not exist')
@@ -653,31 +711,55 @@ function QlessJob:heartbeat(now, worker, data)
     error(
       'Heartbeat(): Job ' .. self.jid ..
       ' given out to another worker: ' .. job_worker)
-  else
-    -- Otherwise, optionally update the user data, and the heartbeat
-    if data then
-      -- I don't know if this is wise, but I'm decoding and encoding
-      -- the user data to hopefully ensure its sanity
-      redis.call('hmset', QlessJob.ns .. self.jid, 'expires',
-        expires, 'worker', worker, 'data', cjson.encode(data))
-    else
-      redis.call('hmset', QlessJob.ns .. self.jid,
-        'expires', expires, 'worker', worker)
-    end
+  end
 
-    -- Update hwen this job was last updated on that worker
-    -- Add this job to the list of jobs handled by this worker
-    redis.call('zadd', 'ql:w:' .. worker .. ':jobs', expires, self.jid)
+  -- We should find the heartbeat interval for this queue
+  local interval = batch and batch.intervals[queue]
+  if not interval then
+    interval = tonumber(
+      Qless.config.get(queue .. '-heartbeat') or
+      Qless.config.get('heartbeat', 60))
+    if batch then
+      batch.intervals[queue] = interval
+    end
+  end
+  local expires = now + interval
 
-    -- Make sure we this worker to the list of seen workers
-    redis.call('zadd', 'ql:workers', now, worker)
+  -- Otherwise, optionally update the user data, and the heartbeat
+  if data then
+    -- I don't know if this is wise, but I'm decoding and encoding
+    -- the user data to hopefully ensure its sanity
+    redis.call('hmset', QlessJob.ns .. self.jid, 'expires',
+      expires, 'worker', worker, 'data', cjson.encode(data))
+  else
+    redis.call('hmset', QlessJob.ns .. self.jid,
+      'expires', expires, 'worker', worker)
+  end
 
-    -- And now we should just update the locks
-    local queue = Qless.queue(
-      redis.call('hget', QlessJob.ns .. self.jid, 'queue'))
-    queue.locks.add(expires, self.jid)
+  if batch then
+    -- The worker's job list, the list of seen workers and the locks are
+    -- updated by the caller once for the whole batch
+    table.insert(batch.jobs, expires)
+    table.insert(batch.jobs, self.jid)
+    if not batch.locks[queue] then
+      batch.locks[queue] = {}
+      table.insert(batch.queues, queue)
+    end
+    table.insert(batch.locks[queue], expires)
+    table.insert(batch.locks[queue], self.jid)
     return expires
   end
+
+  -- Update hwen this job was last updated on that worker
+  -- Add this job to the list of jobs handled by this worker
+  redis.call('zadd', 'ql:w:' .. worker .. ':jobs', expires, self.jid)
+
+  -- Make sure we this worker to the list of seen workers
+  redis.call('zadd', 'ql:workers', now, worker)
+
+  -- And now we should just update the locks
+  Qless.queue(queue).locks.add(expires, self.jid)
+  return expires
 end
 
 -- Priority
@@ -731,10 +813,11 @@ function QlessJob:timeout(now)
     error('Timeout(): Job ' .. self.jid .. ' not running')
   else
     -- Time out the job
-    self:history(now, 'timed-out')
+    self:history(now, 'timed-out', nil, queue_name)
     local queue = Qless.queue(queue_name)
     queue.locks.remove(self.jid)
     queue.work.add(now, '+inf', self.jid)
+    queue:signal(1)
     redis.call('hmset', QlessJob.ns .. self.jid,
       'state', 'stalled', 'expires', 0)
     local encoded = cjson.encode({
@@ -748,94 +831,325 @@ function QlessJob:timeout(now)
   end
 end
 
+-- Cancel this job, removing every trace of it. Returns whether or not there
+-- was a job to cancel, as jobs that are complete are left alone. It's up to
+-- the caller to make sure no other job depends on this one.
+function QlessJob:cancel(now)
+  local jid = self.jid
+  -- Find any stage it's associated with and remove its from that stage
+  local real_jid, state, queue, failure, worker = unpack(redis.call(
+    'hmget', QlessJob.ns .. jid, 'jid', 'state', 'queue', 'failure', 'worker'))
+
+  if state ~= false and state ~= 'complete' then
+    -- Send a message out on the appropriate channels
+    local encoded = cjson.encode({
+      jid    = jid,
+      worker = worker,
+      event  = 'canceled',
+      queue  = queue
+    })
+    Qless.publish('log', encoded)
+
+    -- Remove this job from whatever worker has it, if any
+    if worker and (worker ~= '') then
+      redis.call('zrem', 'ql:w:' .. worker .. ':jobs', jid)
+      -- If necessary, send a message to the appropriate worker, too
+      Qless.publish('w:' .. worker, encoded)
+    end
+
+    -- Remove it from that queue
+    if queue then
+      local queue = Qless.queue(queue)
+      queue.work.remove(jid)
+      queue.locks.remove(jid)
+      queue.scheduled.remove(jid)
+      queue.depends.remove(jid)
+    end
+
+    self:release_resources(now)
+
+    -- We should probably go through all our dependencies and remove
+    -- ourselves from the list of dependents
+    for i, j in ipairs(redis.call(
+      'smembers', QlessJob.ns .. jid .. '-dependencies')) do
+      redis.call('srem', QlessJob.ns .. j .. '-dependents', jid)
+    end
+
+    -- Delete any notion of dependencies it has
+    redis.call('del', QlessJob.ns .. jid .. '-dependencies')
+
+    -- If we're in the failed state, remove all of our data
+    if state == 'failed' then
+      failure = cjson.decode(failure)
+      -- We need to make this remove it from the failed queues
+      Qless.remove_failures(failure.group, jid)
+      -- Remove one count from the failed count of the particular
+      -- queue
+      local bin = failure.when - (failure.when % 86400)
+      local failed = redis.call(
+        'hget', 'ql:s:stats:' .. bin .. ':' .. queue, 'failed')
+      redis.call('hset',
+        'ql:s:stats:' .. bin .. ':' .. queue, 'failed', failed - 1)
+    end
+
+    -- Remove it as a job that's tagged with this particular tag
+    local tags = cjson.decode(
+      redis.call('hget', QlessJob.ns .. jid, 'tags') or '{}')
+    for i, tag in ipairs(tags) do
+      redis.call('zrem', 'ql:t:' .. tag, jid)
+      redis.call('zincrby', 'ql:tags', -1, tag)
+    end
+
+    -- If the job was being tracked, we should notify
+    if redis.call('zscore', 'ql:tracked', jid) ~= false then
+      Qless.publish('canceled', jid)
+    end
+
+    -- Just go ahead and delete our data
+    Qless.unlink(QlessJob.ns .. jid, QlessJob.ns .. jid .. '-history')
+    return true
+  end
+  return false
+end
+
 -- Return whether or not this job exists
 function QlessJob:exists()
   return redis.call('exists', QlessJob.ns .. self.jid) == 1
 end
 
--- Get or append to history
-function QlessJob:history(now, what, item)
+-- The most history items to keep for jobs in `queue`, from its
+-- `<queue>-history` setting:
+--
+--  - `full`: keep every item
+--  - `capped:N`: keep the first item and the most recent N - 1
+--  - `off`: keep nothing
+--
+-- Without a setting, jobs are capped at `max-job-history` items. Returns the
+-- number of items to keep, or -1 for all of them.
+function QlessJob.history_limit(queue)
+  local policy
+  if queue and queue ~= '' then
+    policy = Qless.config.get(queue .. '-history')
+  end
+  policy = policy or ('capped:' .. Qless.config.get('max-job-history', 100))
+
+  if policy == 'full' then
+    return -1
+  elseif policy == 'off' then
+    return 0
+  end
+  local limit = tonumber(string.match(policy, '^capped:(%d+)$'))
+  if not limit then
+    error('History(): Unknown history policy for ' .. tostring(queue) ..
+      ': ' .. policy)
+  end
+  -- A cap of 0 has always meant no cap at all
+  if limit == 0 then
+    return -1
+  end
+  return limit
+end
+
+-- Start the history of a new job in `queue`. The first item is kept in the
+-- job's hash, so that the rest of the history can be capped with a single
+-- LTRIM
+function QlessJob:start_history(now, what, item, queue)
+  if QlessJob.history_limit(queue) ~= 0 then
+    redis.call('hset', QlessJob.ns .. self.jid, 'history_first',
+      cjson.encode({math.floor(now), what, item}))
+  end
+end
+
+-- Get or append to history. Appending uses the history policy of `queue`,
+-- which is read from the job if it's not provided. It expects the job's
+-- history to be up to date with how it's now stored (see `history.migrate`)
+function QlessJob:history(now, what, item, queue)
+  if what == nil then
+    -- Get the history
+    return self:history_items(0)
+  else
+    queue = queue or redis.call('hget', QlessJob.ns .. self.jid, 'queue')
+    local limit = QlessJob.history_limit(queue)
+    if limit == 0 then
+      return 0
+    end
+
+    -- Append to the history. If the length of the history should be limited,
+    -- then we'll truncate it, bearing in mind that the first item is kept
+    -- in the job's hash
+    local length = redis.call('rpush', QlessJob.ns .. self.jid .. '-history',
+      cjson.encode({math.floor(now), what, item}))
+    if limit > 0 and length > limit - 1 then
+      redis.call('ltrim', QlessJob.ns .. self.jid .. '-history',
+        length - limit + 1, -1)
+    end
+    return length
+  end
+end
+
+-- Get `count` items of this job's history starting from `offset`, or all of
+-- them from there if `count` is nil. A negative `offset` counts back from the
+-- most recent item. Only the items asked for are read and decoded.
+function QlessJob:history_items(offset, count)
+  local key = QlessJob.ns .. self.jid .. '-history'
+  local first, legacy = unpack(redis.call('hmget', QlessJob.ns .. self.jid,
+    'history_first', 'history'))
+  -- Very old jobs are brought up to date when they're read, as their whole
+  -- history is in the job's hash anyway
+  if legacy then
+    self:migrate_history()
+    first = redis.call('hget', QlessJob.ns .. self.jid, 'history_first')
+  end
+  if offset < 0 then
+    local length = redis.call('llen', key) + (first and 1 or 0)
+    offset = math.max(length + offset, 0)
+  end
+
+  -- The first item is kept in the job's hash, ahead of the history list
+  local values = {}
+  if count == 0 then
+    return values
+  elseif first then
+    if offset == 0 then
+      table.insert(values, first)
+      count = count and count - 1
+    else
+      offset = offset - 1
+    end
+  end
+  if count == nil or count > 0 then
+    local stop = count and offset + count - 1 or -1
+    for _, value in ipairs(redis.call('lrange', key, offset, stop)) do
+      table.insert(values, value)
+    end
+  end
+
+  local response = {}
+  for i, value in ipairs(values) do
+    value = cjson.decode(value)
+    local dict = value[3] or {}
+    dict['when'] = value[1]
+    dict['what'] = value[2]
+    table.insert(response, dict)
+  end
+  return response
+end
+
+-- Bring the history of this job up to date with how it's now stored. Very
+-- old jobs kept their history as JSON in the job's hash, and until recently
+-- the first item was kept at the head of the history list rather than in the
+-- job's hash. Returns true if anything was changed.
+function QlessJob:migrate_history()
+  local key = QlessJob.ns .. self.jid .. '-history'
+  local migrated = false
+
   -- First, check if there's an old-style history, and update it if there is
   local history = redis.call('hget', QlessJob.ns .. self.jid, 'history')
   if history then
     history = cjson.decode(history)
     for i, value in ipairs(history) do
-      redis.call('rpush', QlessJob.ns .. self.jid .. '-history',
+      redis.call('rpush', key,
         cjson.encode({math.floor(value.put), 'put', {q = value.q}}))
 
       -- If there's any popped time
       if value.popped then
-        redis.call('rpush', QlessJob.ns .. self.jid .. '-history',
+        redis.call('rpush', key,
           cjson.encode({math.floor(value.popped), 'popped',
             {worker = value.worker}}))
       end
 
       -- If there's any failure
       if value.failed then
-        redis.call('rpush', QlessJob.ns .. self.jid .. '-history',
+        redis.call('rpush', key,
           cjson.encode(
             {math.floor(value.failed), 'failed', nil}))
       end
 
       -- If it was completed
       if value.done then
-        redis.call('rpush', QlessJob.ns .. self.jid .. '-history',
+        redis.call('rpush', key,
           cjson.encode(
             {math.floor(value.done), 'done', nil}))
       end
     end
     -- With all this ported forward, delete the old-style history
     redis.call('hdel', QlessJob.ns .. self.jid, 'history')
+    migrated = true
   end
 
-  -- Now to the meat of the function
-  if what == nil then
-    -- Get the history
-    local response = {}
-    for i, value in ipairs(redis.call('lrange',
-      QlessJob.ns .. self.jid .. '-history', 0, -1)) do
-      value = cjson.decode(value)
-      local dict = value[3] or {}
-      dict['when'] = value[1]
-      dict['what'] = value[2]
-      table.insert(response, dict)
+  -- And now move the first item out of the list, if it's still there
+  if redis.call('hexists', QlessJob.ns .. self.jid, 'history_first') == 0 then
+    local first = redis.call('lpop', key)
+    if first then
+      redis.call('hset', QlessJob.ns .. self.jid, 'history_first', first)
+      migrated = true
     end
-    return response
-  else
-    -- Append to the history. If the length of the history should be limited,
-    -- then we'll truncate it.
-    local count = tonumber(Qless.config.get('max-job-history', 100))
-    if count > 0 then
-      -- We'll always keep the first item around
-      local obj = redis.call('lpop', QlessJob.ns .. self.jid .. '-history')
-      redis.call('ltrim', QlessJob.ns .. self.jid .. '-history', -count + 2, -1)
-      if obj ~= nil and obj ~= false then
-        redis.call('lpush', QlessJob.ns .. self.jid .. '-history', obj)
-      end
+  end
+  return migrated
+end
+
+-- Bring the history of the jobs in a page of the keyspace up to date, using
+-- a SCAN cursor that looks at about `budget` keys (100 by default). Start
+-- with 0, and pass back the returned cursor until it's 0 again. Returns the
+-- cursor and the number of jobs that needed migrating.
+function QlessJob.migrate_histories(cursor, budget)
+  cursor = assert(tonumber(cursor or 0),
+    'HistoryMigrate(): Arg "cursor" not a number: ' .. tostring(cursor))
+  budget = assert(tonumber(budget or 100),
+    'HistoryMigrate(): Arg "budget" not a number: ' .. tostring(budget))
+
+  local reply = redis.call('scan', cursor,
+    'match', QlessJob.ns .. '*', 'count', budget)
+  local migrated = 0
+  for _, key in ipairs(reply[2]) do
+    -- Jobs' history lists and dependency sets match too, but only the jobs
+    -- themselves are hashes
+    if redis.call('type', key)['ok'] == 'hash' and
+      Qless.job(string.sub(key, #QlessJob.ns + 1)):migrate_history() then
+      migrated = migrated + 1
     end
-    return redis.call('rpush', QlessJob.ns .. self.jid .. '-history',
-      cjson.encode({math.floor(now), what, item}))
   end
+  return tonumber(reply[1]), migrated
 end
 
 function QlessJob:release_resources(now)
   local resources = redis.call('hget', QlessJob.ns .. self.jid, 'resources')
-  resources = cjson.decode(resources or '[]')
+  resources = QlessResource.weights(cjson.decode(resources or '[]'))
+  -- Give up every lock before handing any of them on, so that a waiter
+  -- needing several of these resources can take them all together
+  for _, res in ipairs(resources) do
+    Qless.resource(res[1]):release(now, self.jid, res[2])
+  end
   for _, res in ipairs(resources) do
-    Qless.resource(res):release(now, self.jid)
+    Qless.resource(res[1]):promote(now)
   end
 end
 
+-- Takes a lock on every one of the job's resources, or on none of them. If
+-- any is at its limit, the job holds nothing and waits in the pending queue of
+-- each resource that's blocking it, so that the release of one of those
+-- resources will try it again.
 function QlessJob:acquire_resources(now)
   local resources, priority = unpack(redis.call('hmget', QlessJob.ns .. self.jid, 'resources', 'priority'))
-  resources = cjson.decode(resources or '[]')
+  resources = QlessResource.weights(cjson.decode(resources or '[]'))
   if (#resources == 0) then
     return true
   end
 
-  local acquired_all = true
-  for _, res in ipairs(resources) do
-    acquired_all = acquired_all and Qless.resource(res):acquire(now, priority, self.jid)
+  local available, acquired_all = {}, true
+  for i, res in ipairs(resources) do
+    available[i] = Qless.resource(res[1]):available(self.jid, res[2])
+    acquired_all = acquired_all and available[i]
+  end
+
+  for i, res in ipairs(resources) do
+    if acquired_all then
+      Qless.resource(res[1]):acquire(self.jid, res[2])
+    elseif available[i] then
+      Qless.resource(res[1]):release(now, self.jid, res[2])
+    else
+      Qless.resource(res[1]):wait(now, priority, self.jid)
+    end
   end
   return acquired_all
 end
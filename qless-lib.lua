@@ -0,0 +1,4538 @@
+-- Current SHA: d722b2e0a4d4d1b86e462523416711894b31a115
+-- This is a generated file
+-------------------------------------------------------------------------------
+-- Forward declarations to make everything happy
+-------------------------------------------------------------------------------
+local Qless = {
+  ns = 'ql:'
+}
+
+-- Queue forward delcaration
+local QlessQueue = {
+  ns = Qless.ns .. 'q:'
+}
+QlessQueue.__index = QlessQueue
+
+-- Worker forward declaration
+local QlessWorker = {
+  ns = Qless.ns .. 'w:'
+}
+QlessWorker.__index = QlessWorker
+
+-- Job forward declaration
+local QlessJob = {
+  ns = Qless.ns .. 'j:'
+}
+QlessJob.__index = QlessJob
+
+-- RecurringJob forward declaration
+local QlessRecurringJob = {}
+QlessRecurringJob.__index = QlessRecurringJob
+
+-- Resource forward declaration
+local QlessResource = {
+    ns = Qless.ns .. 'rs:'
+}
+QlessResource.__index = QlessResource;
+
+-- Config forward declaration
+Qless.config = {}
+
+-- Extend a table. This comes up quite frequently
+function table.extend(self, other)
+  for i, v in ipairs(other) do
+    table.insert(self, v)
+  end
+end
+
+-- This is essentially the same as redis' publish, but it prefixes the channel
+-- with the Qless namespace
+function Qless.publish(channel, message)
+  redis.call('publish', Qless.ns .. channel, message)
+end
+
+-- Return a job object given its job id
+function Qless.job(jid)
+  assert(jid, 'Job(): no jid provided')
+  local job = {}
+  setmetatable(job, QlessJob)
+  job.jid = jid
+  return job
+end
+
+-- Return a recurring job object
+function Qless.recurring(jid)
+  assert(jid, 'Recurring(): no jid provided')
+  local job = {}
+  setmetatable(job, QlessRecurringJob)
+  job.jid = jid
+  return job
+end
+
+-- Return a resource object
+function Qless.resource(rid)
+  assert(rid, 'Resource(): no rid provided')
+  local res = {}
+  setmetatable(res, QlessResource)
+  res.rid = rid
+  return res
+end
+
+-- Failed([group, [start, [limit]]])
+-- ------------------------------------
+-- If no group is provided, this returns a JSON blob of the counts of the
+-- various groups of failures known. If a group is provided, it will report up
+-- to `limit` from `start` of the jobs affected by that issue.
+--
+--  # If no group, then...
+--  {
+--      'group1': 1,
+--      'group2': 5,
+--      ...
+--  }
+--
+--  # If a group is provided, then...
+--  {
+--      'total': 20,
+--      'jobs': [
+--          {
+--              # All the normal keys for a job
+--              'jid': ...,
+--              'data': ...
+--              # The message for this particular instance
+--              'message': ...,
+--              'group': ...,
+--          }, ...
+--      ]
+--  }
+--
+function Qless.failed(group, start, limit)
+  start = assert(tonumber(start or 0),
+    'Failed(): Arg "start" is not a number: ' .. (start or 'nil'))
+  limit = assert(tonumber(limit or 25),
+    'Failed(): Arg "limit" is not a number: ' .. (limit or 'nil'))
+
+  if group then
+    -- If a group was provided, then we should do paginated lookup
+    local key, legacy = Qless.failure_group(group)
+    if legacy then
+      return {
+        total = redis.call('llen', key),
+        jobs  = redis.call('lrange', key, start, start + limit - 1)
+      }
+    end
+    return {
+      total = redis.call('zcard', key),
+      jobs  = redis.call('zrevrange', key, start, start + limit - 1)
+    }
+  else
+    -- Otherwise, we should just list all the known failure groups we have,
+    -- counting any that haven't been counted yet
+    local response = {}
+    local counts = redis.call('hgetall', 'ql:failure-counts')
+    for i = 1, #counts, 2 do
+      response[counts[i]] = tonumber(counts[i + 1])
+    end
+    if #counts / 2 ~= redis.call('scard', 'ql:failures') then
+      for index, group in ipairs(redis.call('smembers', 'ql:failures')) do
+        if not response[group] then
+          local key, legacy = Qless.failure_group(group)
+          response[group] = legacy and redis.call('llen', key) or
+            redis.call('zcard', key)
+        end
+      end
+    end
+    return response
+  end
+end
+
+-- FailedRange(group, [from, [to, [offset, [count]]]])
+-- ---------------------------------------------------
+-- Like `failed` with a group, but only for the jobs that failed between the
+-- times `from` and `to` (inclusive), most recent first. `total` is the number
+-- of jobs that failed in that range.
+function Qless.failed_range(group, from, to, offset, count)
+  assert(group, 'FailedRange(): Arg "group" missing')
+  from = assert(tonumber(from or '-inf'),
+    'FailedRange(): Arg "from" is not a number: ' .. tostring(from))
+  to = assert(tonumber(to or '+inf'),
+    'FailedRange(): Arg "to" is not a number: ' .. tostring(to))
+  offset = assert(tonumber(offset or 0),
+    'FailedRange(): Arg "offset" is not a number: ' .. tostring(offset))
+  count = assert(tonumber(count or 25),
+    'FailedRange(): Arg "count" is not a number: ' .. tostring(count))
+
+  local key, legacy = Qless.failure_group(group)
+  assert(not legacy, 'FailedRange(): Group "' .. group ..
+    '" is still a list, and needs "failed.migrate" first')
+  return {
+    total = redis.call('zcount', key, from, to),
+    jobs  = redis.call('zrevrangebyscore', key, to, from,
+      'LIMIT', offset, count)
+  }
+end
+
+-- Each failure group is a sorted set of jids at `ql:f:<group>`, scored by
+-- when they failed, and the number of jobs in each is kept in the hash
+-- `ql:failure-counts`. Groups from before then are lists, newest first, which
+-- keep working as lists until `failed.migrate` has converted them, and aren't
+-- counted until a job is next added. Returns the group's key, and whether or
+-- not it's still a list.
+function Qless.failure_group(group)
+  local key = 'ql:f:' .. group
+  return key, redis.call('type', key)['ok'] == 'list'
+end
+
+-- Add a job that failed at `when` to a failure group
+function Qless.add_failure(group, jid, when)
+  local key, legacy = Qless.failure_group(group)
+  redis.call('sadd', 'ql:failures', group)
+  if legacy then
+    redis.call('hsetnx', 'ql:failure-counts', group, redis.call('llen', key))
+    redis.call('lpush', key, jid)
+    redis.call('hincrby', 'ql:failure-counts', group, 1)
+  elseif redis.call('zadd', key, when, jid) == 1 then
+    redis.call('hincrby', 'ql:failure-counts', group, 1)
+  end
+end
+
+-- Adjust the count of a failure group after `removed` of its jobs have been
+-- taken out, forgetting the group once it's empty
+function Qless.removed_failures(group, removed)
+  if removed == 0 then
+    return
+  end
+  local remaining
+  if redis.call('hexists', 'ql:failure-counts', group) == 1 then
+    remaining = redis.call('hincrby', 'ql:failure-counts', group, -removed)
+  else
+    -- A group that hasn't been counted yet is empty once its key is gone
+    remaining = redis.call('exists', 'ql:f:' .. group)
+  end
+  if remaining <= 0 then
+    redis.call('hdel', 'ql:failure-counts', group)
+    redis.call('srem', 'ql:failures', group)
+  end
+end
+
+-- Take jobs out of a failure group
+function Qless.remove_failures(group, ...)
+  local key, legacy = Qless.failure_group(group)
+  local removed = 0
+  if legacy then
+    for _, jid in ipairs(arg) do
+      removed = removed + redis.call('lrem', key, 0, jid)
+      redis.call('zrem', key .. '-migrating', jid)
+    end
+  else
+    removed = redis.call('zrem', key, unpack(arg))
+  end
+  Qless.removed_failures(group, removed)
+end
+
+-- FailedMigrate(now, [budget])
+-- ----------------------------
+-- Convert failure groups still kept as lists into sorted sets, copying at most
+-- `budget` jobs (1000 by default) per call, oldest first, into
+-- `ql:f:<group>-migrating`. The copied jobs are the tail of the list, so the
+-- list stays the group until the copy is complete and replaces it. Returns how
+-- many jobs are still to be copied, so call it until that's 0.
+function Qless.failed_migrate(now, budget)
+  budget = assert(tonumber(budget or 1000),
+    'FailedMigrate(): Arg "budget" not a number: ' .. tostring(budget))
+
+  local remaining = 0
+  for _, group in ipairs(redis.call('smembers', 'ql:failures')) do
+    local key, legacy = Qless.failure_group(group)
+    if legacy then
+      local migrating = key .. '-migrating'
+      local copied = redis.call('zcard', migrating)
+      local length = redis.call('llen', key)
+      if budget > 0 then
+        local jids = redis.call('lrange', key,
+          -(copied + budget), -(copied + 1))
+        -- Add them in batches, to keep clear of the limit on unpack
+        for i = #jids, 1, -100 do
+          local args = {}
+          for j = i, math.max(i - 99, 1), -1 do
+            local failure = redis.call(
+              'hget', QlessJob.ns .. jids[j], 'failure')
+            local when = 0
+            if failure then
+              when = tonumber(cjson.decode(failure)['when']) or 0
+            end
+            table.insert(args, when)
+            table.insert(args, jids[j])
+          end
+          redis.call('zadd', migrating, unpack(args))
+        end
+        budget = budget - #jids
+        copied = redis.call('zcard', migrating)
+      end
+
+      if copied >= length then
+        redis.call('rename', migrating, key)
+        redis.call('hset', 'ql:failure-counts', group, copied)
+      else
+        remaining = remaining + length - copied
+      end
+    end
+  end
+  return remaining
+end
+
+-- Jobs(now, 'complete', [offset, [count]])
+-- Jobs(now, (
+--          'stalled' | 'running' | 'scheduled' | 'depends', 'recurring'
+--      ), queue, [offset, [count]])
+-------------------------------------------------------------------------------
+-- Return all the job ids currently considered to be in the provided state
+-- in a particular queue. The response is a list of job ids:
+--
+--  [
+--      jid1,
+--      jid2,
+--      ...
+--  ]
+function Qless.jobs(now, state, ...)
+  assert(state, 'Jobs(): Arg "state" missing')
+  if state == 'complete' then
+    local offset = assert(tonumber(arg[1] or 0),
+      'Jobs(): Arg "offset" not a number: ' .. tostring(arg[1]))
+    local count  = assert(tonumber(arg[2] or 25),
+      'Jobs(): Arg "count" not a number: ' .. tostring(arg[2]))
+    return redis.call('zrevrange', 'ql:completed', offset,
+      offset + count - 1)
+  else
+    local name  = assert(arg[1], 'Jobs(): Arg "queue" missing')
+    local offset = assert(tonumber(arg[2] or 0),
+      'Jobs(): Arg "offset" not a number: ' .. tostring(arg[2]))
+    local count  = assert(tonumber(arg[3] or 25),
+      'Jobs(): Arg "count" not a number: ' .. tostring(arg[3]))
+
+    local queue = Qless.queue(name)
+    if state == 'running' then
+      return queue.locks.peek(now, offset, count)
+    elseif state == 'stalled' then
+      return queue.locks.expired(now, offset, count)
+    elseif state == 'scheduled' then
+      queue:signal(queue:check_scheduled(now, queue.scheduled.length()))
+      return queue.scheduled.peek(now, offset, count)
+    elseif state == 'depends' then
+      return queue.depends.peek(now, offset, count)
+    elseif state == 'recurring' then
+      return queue.recurring.peek('+inf', offset, count)
+    else
+      error('Jobs(): Unknown type "' .. state .. '"')
+    end
+  end
+end
+
+-- Track()
+-- Track(now, ('track' | 'untrack'), jid)
+-- ------------------------------------------
+-- If no arguments are provided, it returns details of all currently-tracked
+-- jobs (see `Qless.tracked` for a page of them). If the first argument is
+-- 'track', then it will start tracking the job associated with that id, and
+-- 'untrack' stops tracking it. In this context, tracking is nothing more than
+-- saving the job to a list of jobs that are considered special.
+--
+--  {
+--      'jobs': [
+--          {
+--              'jid': ...,
+--              # All the other details you'd get from 'get'
+--          }, {
+--              ...
+--          }
+--      ], 'expired': [
+--          # These are all the jids that are completed and whose data expired
+--          'deadbeef',
+--          ...,
+--          ...,
+--      ]
+--  }
+--
+function Qless.track(now, command, jid)
+  if command ~= nil then
+    assert(jid, 'Track(): Arg "jid" missing')
+    -- Verify that job exists
+    assert(Qless.job(jid):exists(), 'Track(): Job does not exist')
+    if string.lower(command) == 'track' then
+      Qless.publish('track', jid)
+      return redis.call('zadd', 'ql:tracked', now, jid)
+    elseif string.lower(command) == 'untrack' then
+      Qless.publish('untrack', jid)
+      return redis.call('zrem', 'ql:tracked', jid)
+    else
+      error('Track(): Unknown action "' .. command .. '"')
+    end
+  else
+    local response = {
+      jobs = {},
+      expired = {}
+    }
+    local jids = redis.call('zrange', 'ql:tracked', 0, -1)
+    for index, jid in ipairs(jids) do
+      local data = Qless.job(jid):data()
+      if data then
+        table.insert(response.jobs, data)
+      else
+        table.insert(response.expired, jid)
+      end
+    end
+    return response
+  end
+end
+
+-- Tracked([offset, [count, [fields]]])
+-- ------------------------------------
+-- A page of the tracked jobs, in the order they were tracked, with just the
+-- `fields` of each job if they're given. The jids in the page whose jobs have
+-- since expired are listed apart, and cost just the one read to find.
+--
+--  {
+--      'total': 2,
+--      'jobs': [{'jid': ..., ...}],
+--      'expired': ['deadbeef']
+--  }
+function Qless.tracked(offset, count, fields)
+  offset = assert(tonumber(offset or 0),
+    'Track(): Arg "offset" not a number: ' .. tostring(offset))
+  count  = assert(tonumber(count or 25),
+    'Track(): Arg "count" not a number: ' .. tostring(count))
+
+  local response = {
+    total   = redis.call('zcard', 'ql:tracked'),
+    jobs    = {},
+    expired = {}
+  }
+  local jids = redis.call('zrange', 'ql:tracked', offset, offset + count - 1)
+  for _, jid in ipairs(jids) do
+    local data
+    if fields then
+      data = Qless.job(jid):data(fields)
+    else
+      data = Qless.job(jid):data()
+    end
+    if data then
+      table.insert(response.jobs, data)
+    else
+      table.insert(response.expired, jid)
+    end
+  end
+  return response
+end
+
+-- tag(now, ('add' | 'remove'), jid, tag, [tag, ...])
+-- tag(now, 'get', tag, [offset, [count]])
+-- tag(now, 'top', [offset, [count]])
+-- -----------------------------------------------------------------------------
+-- Accepts a jid, 'add' or 'remove', and then a list of tags
+-- to either add or remove from the job. Alternatively, 'get',
+-- a tag to get jobs associated with that tag, and offset and
+-- count
+--
+-- If 'add' or 'remove', the response is a list of the jobs
+-- current tags, or False if the job doesn't exist. If 'get',
+-- the response is of the form:
+--
+--  {
+--      total: ...,
+--      jobs: [
+--          jid,
+--          ...
+--      ]
+--  }
+--
+-- If 'top' is supplied, it returns the most commonly-used tags
+-- in a paginated fashion.
+function Qless.tag(now, command, ...)
+  assert(command,
+    'Tag(): Arg "command" must be "add", "remove", "get" or "top"')
+
+  if command == 'add' then
+    local jid  = assert(arg[1], 'Tag(): Arg "jid" missing')
+    local tags = redis.call('hget', QlessJob.ns .. jid, 'tags')
+    -- If the job has been canceled / deleted, then return false
+    if tags then
+      -- Decode the json blob, convert to dictionary
+      tags = cjson.decode(tags)
+      local _tags = {}
+      for i,v in ipairs(tags) do _tags[v] = true end
+
+      -- Otherwise, add the job to the sorted set with that tags
+      for i=2,#arg do
+        local tag = arg[i]
+        if _tags[tag] == nil or _tags[tag] == false then
+          _tags[tag] = true
+          table.insert(tags, tag)
+        end
+        redis.call('zadd', 'ql:t:' .. tag, now, jid)
+        redis.call('zincrby', 'ql:tags', 1, tag)
+      end
+
+      redis.call('hset', QlessJob.ns .. jid, 'tags', cjson.encode(tags))
+      return tags
+    else
+      error('Tag(): Job ' .. jid .. ' does not exist')
+    end
+  elseif command == 'remove' then
+    local jid  = assert(arg[1], 'Tag(): Arg "jid" missing')
+    local tags = redis.call('hget', QlessJob.ns .. jid, 'tags')
+    -- If the job has been canceled / deleted, then return false
+    if tags then
+      -- Decode the json blob, convert to dictionary
+      tags = cjson.decode(tags)
+      local _tags = {}
+      for i,v in ipairs(tags) do _tags[v] = true end
+
+      -- Otherwise, add the job to the sorted set with that tags
+      for i=2,#arg do
+        local tag = arg[i]
+        _tags[tag] = nil
+        redis.call('zrem', 'ql:t:' .. tag, jid)
+        redis.call('zincrby', 'ql:tags', -1, tag)
+      end
+
+      local results = {}
+      for i,tag in ipairs(tags) do if _tags[tag] then table.insert(results, tag) end end
+
+      redis.call('hset', QlessJob.ns .. jid, 'tags', cjson.encode(results))
+      return results
+    else
+      error('Tag(): Job ' .. jid .. ' does not exist')
+    end
+  elseif command == 'get' then
+    local tag    = assert(arg[1], 'Tag(): Arg "tag" missing')
+    local offset = assert(tonumber(arg[2] or 0),
+      'Tag(): Arg "offset" not a number: ' .. tostring(arg[2]))
+    local count  = assert(tonumber(arg[3] or 25),
+      'Tag(): Arg "count" not a number: ' .. tostring(arg[3]))
+    return {
+      total = redis.call('zcard', 'ql:t:' .. tag),
+      jobs  = redis.call('zrange', 'ql:t:' .. tag, offset, offset + count - 1)
+    }
+  elseif command == 'top' then
+    local offset = assert(tonumber(arg[1] or 0) , 'Tag(): Arg "offset" not a number: ' .. tostring(arg[1]))
+    local count  = assert(tonumber(arg[2] or 25), 'Tag(): Arg "count" not a number: ' .. tostring(arg[2]))
+    return redis.call('zrevrangebyscore', 'ql:tags', '+inf', 2, 'limit', offset, count)
+  else
+    error('Tag(): First argument must be "add", "remove" or "get"')
+  end
+end
+
+-- Move a job from the `old` list of tags to the `new` one, touching only the
+-- tags that differ between them. Tags the job keeps also keep their score, the
+-- time they were first added to the job.
+function Qless.retag(now, jid, old, new)
+  local kept = {}
+  for _, tag in ipairs(old) do kept[tag] = false end
+  for _, tag in ipairs(new) do
+    if kept[tag] == nil then
+      redis.call('zadd', 'ql:t:' .. tag, now, jid)
+      redis.call('zincrby', 'ql:tags', 1, tag)
+    end
+    kept[tag] = true
+  end
+  for tag, keep in pairs(kept) do
+    if not keep then
+      redis.call('zrem', 'ql:t:' .. tag, jid)
+      redis.call('zincrby', 'ql:tags', -1, tag)
+    end
+  end
+end
+
+-- TagQuery(now, query, [offset, [count]])
+-- ----------------------------------------
+-- Find the jobs matching a JSON combination of tags. A query is either a tag,
+-- or an object of one of these forms:
+--
+--  {"and": [query, ...]}  # jobs matching all of the queries
+--  {"or" : [query, ...]}  # jobs matching any of the queries
+--  {"not": query}         # jobs not matching the query, only inside an "and"
+--                         # with at least one other query
+--
+-- Returns a page of the matching jids along with how many there are in total,
+-- like `tag get`. The whole result is kept for `tag-query-ttl` seconds (60 by
+-- default) so that later pages of the same query don't have to work it out
+-- again, which means they may be that far out of date.
+function Qless.tag_query(now, query, offset, count)
+  assert(query, 'TagQuery(): Arg "query" missing')
+  local parsed = assert(cjson.decode(query),
+    'TagQuery(): Arg "query" not JSON: ' .. tostring(query))
+  offset = assert(tonumber(offset or 0),
+    'TagQuery(): Arg "offset" not a number: ' .. tostring(offset))
+  count = assert(tonumber(count or 25),
+    'TagQuery(): Arg "count" not a number: ' .. tostring(count))
+
+  -- A lone tag is read straight from its own set
+  local key = 'ql:tq:' .. redis.sha1hex(query)
+  if type(parsed) == 'string' then
+    key = 'ql:t:' .. parsed
+  else
+    local cached = redis.call('type', key)['ok']
+    if cached == 'string' then
+      -- An empty result, which Redis won't keep as a sorted set
+      return {total = 0, jobs = {}}
+    elseif cached == 'none' then
+      local temporary = {}
+      Qless.tag_query_key(parsed, key, temporary)
+      redis.call('del', unpack(temporary))
+      local ttl = tonumber(Qless.config.get('tag-query-ttl', 60))
+      if redis.call('exists', key) == 0 then
+        redis.call('set', key, '', 'EX', ttl)
+        return {total = 0, jobs = {}}
+      end
+      redis.call('expire', key, ttl)
+    end
+  end
+
+  return {
+    total = redis.call('zcard', key),
+    jobs  = redis.call('zrange', key, offset, offset + count - 1)
+  }
+end
+
+-- Work out the jobs matching a parsed tag query, and return the key of the
+-- sorted set holding them. That's the tag's own key for a lone tag, and
+-- otherwise `key`. Any other keys made along the way are added to `temporary`.
+function Qless.tag_query_key(query, key, temporary)
+  if type(query) == 'string' then
+    return 'ql:t:' .. query
+  end
+  assert(type(query) == 'table', 'TagQuery(): Query not a tag or an object')
+  assert(query['not'] == nil,
+    'TagQuery(): "not" is only allowed inside an "and"')
+
+  local operator = (query['and'] and 'and') or (query['or'] and 'or')
+  assert(operator, 'TagQuery(): Query must have an "and" or an "or"')
+  local terms = query[operator]
+  assert(type(terms) == 'table' and #terms > 0,
+    'TagQuery(): "' .. operator .. '" must have a list of queries')
+
+  -- Work out the keys of each term first
+  local keys = {}
+  local excluded = {}
+  for i, term in ipairs(terms) do
+    local sub = key .. ':' .. (#temporary + 1)
+    if type(term) == 'table' and term['not'] ~= nil then
+      assert(operator == 'and',
+        'TagQuery(): "not" is only allowed inside an "and"')
+      table.insert(temporary, sub)
+      table.insert(excluded, Qless.tag_query_key(term['not'], sub, temporary))
+    else
+      table.insert(temporary, sub)
+      table.insert(keys, Qless.tag_query_key(term, sub, temporary))
+    end
+  end
+  assert(#keys > 0,
+    'TagQuery(): "and" needs at least one query that isn\'t a "not"')
+
+  -- Every tag scores a job by when it was put, so keep that score rather
+  -- than the default sum, or jobs with more tags would sort later
+  local count = #keys
+  table.insert(keys, 'aggregate')
+  table.insert(keys, 'max')
+  if operator == 'and' then
+    redis.call('zinterstore', key, count, unpack(keys))
+    for _, exclude in ipairs(excluded) do
+      Qless.zdiff(key, exclude)
+    end
+  else
+    redis.call('zunionstore', key, count, unpack(keys))
+  end
+  return key
+end
+
+-- Remove the members of `exclude` from the sorted set at `key`, with
+-- ZDIFFSTORE where the server supports it
+function Qless.zdiff(key, exclude)
+  if Qless.can_zdiff ~= false then
+    local reply = redis.pcall('zdiffstore', key, 2, key, exclude)
+    if type(reply) ~= 'table' or not reply.err then
+      Qless.can_zdiff = true
+      return
+    end
+    Qless.can_zdiff = false
+  end
+
+  -- Otherwise, walk whichever of the two is smaller
+  if redis.call('zcard', exclude) < redis.call('zcard', key) then
+    local members = redis.call('zrange', exclude, 0, -1)
+    for i = 1, #members, 100 do
+      redis.call('zrem', key, unpack(members, i, math.min(i + 99, #members)))
+    end
+  else
+    for _, member in ipairs(redis.call('zrange', key, 0, -1)) do
+      if redis.call('zscore', exclude, member) then
+        redis.call('zrem', key, member)
+      end
+    end
+  end
+end
+
+-- Cancel(...)
+-- --------------
+-- Cancel a job from taking place. It will be deleted from the system, and any
+-- attempts to renew a heartbeat will fail, and any attempts to complete it
+-- will fail. If you try to get the data on the object, you will get nothing.
+function Qless.cancel(now, ...)
+  -- Dependents is a mapping of a job to its dependent jids
+  local dependents = {}
+  for _, jid in ipairs(arg) do
+    dependents[jid] = redis.call(
+      'smembers', QlessJob.ns .. jid .. '-dependents') or {}
+  end
+
+  -- Now, we'll loop through every jid we intend to cancel, and we'll go
+  -- make sure that this operation will be ok
+  for i, jid in ipairs(arg) do
+    for j, dep in ipairs(dependents[jid]) do
+      if dependents[dep] == nil or dependents[dep] == false then
+        error('Cancel(): ' .. jid .. ' is a dependency of ' .. dep ..
+           ' but is not mentioned to be canceled')
+      end
+    end
+  end
+
+  local cancelled_jids = {}
+
+  -- If we've made it this far, then we are good to go. We can now just
+  -- remove any trace of all these jobs, as they form a dependent clique
+  for _, jid in ipairs(arg) do
+    if Qless.job(jid):cancel(now) then
+      table.insert(cancelled_jids, jid)
+    end
+  end
+
+  return cancelled_jids
+end
+
+-- Where a queue keeps its jobs in each state that `cancel.query` can select
+local cancel_query_sets = {
+  depends   = 'depends',
+  scheduled = 'scheduled',
+  waiting   = 'work',
+  running   = 'locks',
+  failed    = false
+}
+
+-- CancelQuery(now, queue, query, [budget, [cursor]])
+-- ---------------------------------------------------
+-- Cancel the jobs in `queue` matching a JSON query of any of a "state", a
+-- "tag" and a "klass", like {"state": "waiting", "klass": "Foo"}. Jobs are
+-- read from the tag's set if there is one, or else from the sets of the
+-- queue's states, dependent jobs first. Failed jobs are read from every
+-- failure group, by name, since those aren't kept per queue. At most `budget`
+-- jobs (1000 by default) are looked at, and the returned cursor picks up
+-- where this call left off:
+--
+--  {
+--      'cancelled': [jid, ...],
+--      'cursor': '1:20',
+--      'done': false
+--  }
+--
+-- Jobs that other jobs still depend on are left alone, so they can be
+-- cancelled by going through the query again once their dependents are gone.
+function Qless.cancel_query(now, name, query, budget, cursor)
+  assert(name, 'CancelQuery(): Arg "queue" missing')
+  query = assert(cjson.decode(query or '{}'),
+    'CancelQuery(): Arg "query" not JSON: ' .. tostring(query))
+  assert(type(query) == 'table' and (query.state or query.tag or query.klass),
+    'CancelQuery(): Arg "query" needs a "state", "tag" or "klass"')
+  budget = assert(tonumber(budget or 1000),
+    'CancelQuery(): Arg "budget" not a number: ' .. tostring(budget))
+  local source, offset = string.match(cursor or '0:0', '^(%d+):(%d+)$')
+  assert(source, 'CancelQuery(): Arg "cursor" not valid: ' .. tostring(cursor))
+  source, offset = tonumber(source) + 1, tonumber(offset)
+
+  local queue = Qless.queue(name)
+  local keys = {}
+  if query.tag then
+    keys = {'ql:t:' .. query.tag}
+  else
+    local states = {'depends', 'scheduled', 'waiting', 'running', 'failed'}
+    if query.state then
+      assert(cancel_query_sets[query.state] ~= nil,
+        'CancelQuery(): Unknown state "' .. tostring(query.state) .. '"')
+      states = {query.state}
+    end
+    for _, state in ipairs(states) do
+      if state == 'failed' then
+        local groups = redis.call('smembers', 'ql:failures')
+        table.sort(groups)
+        for _, group in ipairs(groups) do
+          table.insert(keys, 'ql:f:' .. group)
+        end
+      elseif state == 'waiting' and query.klass and queue:indexed() then
+        table.insert(keys, queue:prefix('work-' .. query.klass))
+      else
+        table.insert(keys, queue:prefix(cancel_query_sets[state]))
+      end
+    end
+  end
+
+  -- Cancelled jobs leave the set they're read from, so the offset only
+  -- counts the jobs that were passed over
+  local cancelled = {}
+  while budget > 0 and keys[source] do
+    -- Failure groups that haven't been migrated yet are still lists
+    local range = 'zrange'
+    if redis.call('type', keys[source])['ok'] == 'list' then
+      range = 'lrange'
+    end
+    local jids = redis.call(range, keys[source], offset, offset + budget - 1)
+    budget = budget - #jids
+    for _, jid in ipairs(jids) do
+      local job_queue, state, klass = unpack(redis.call('hmget',
+        QlessJob.ns .. jid, 'queue', 'state', 'klass'))
+      if job_queue == name
+        and (query.state == nil or state == query.state)
+        and (query.klass == nil or klass == query.klass)
+        and redis.call('scard', QlessJob.ns .. jid .. '-dependents') == 0
+        and Qless.job(jid):cancel(now) then
+        table.insert(cancelled, jid)
+      else
+        offset = offset + 1
+      end
+    end
+    if budget > 0 then
+      source, offset = source + 1, 0
+    end
+  end
+
+  return {
+    cancelled = cancelled,
+    cursor    = (source - 1) .. ':' .. offset,
+    done      = keys[source] == nil
+  }
+end
+
+
+-- ZADD a flat list of score and member pairs to `key`, in batches to keep
+-- clear of the limit on unpack. Returns the number of members added
+function Qless.zadd(key, members)
+  local added = 0
+  for i = 1, #members, 200 do
+    added = added + redis.call('zadd', key,
+      unpack(members, i, math.min(i + 199, #members)))
+  end
+  return added
+end
+
+-- Call `func`, catching any error it raises, for the batched commands that
+-- report the failure of one item without stopping the rest. Returns whether
+-- it succeeded, and either what it returned or the error's message
+function Qless.attempt(func)
+  local ok, result = pcall(func)
+  if ok then
+    return true, result
+  end
+  -- Errors raised by redis.call come back as a table
+  if type(result) == 'table' then
+    result = result.err
+  end
+  -- Drop the script position that error() prepends to the message
+  return false, (string.gsub(tostring(result), '^[^:]*:%d+: ', ''))
+end
+
+-- Delete the given keys. Where the server supports UNLINK, the memory is
+-- reclaimed in the background rather than while this script holds the server
+function Qless.unlink(...)
+  if Qless.can_unlink ~= false then
+    local reply = redis.pcall('unlink', unpack(arg))
+    if type(reply) ~= 'table' or not reply.err then
+      Qless.can_unlink = true
+      return reply
+    end
+    Qless.can_unlink = false
+  end
+  return redis.call('del', unpack(arg))
+end
+
+-- GC(now, budget)
+-- ---------------
+-- Delete the data of completed jobs that have aged out, either because
+-- they're older than `jobs-history` seconds or because they're beyond the
+-- most recent `jobs-history-count` completed jobs. At most `budget` jobs are
+-- deleted, oldest first, and the number of aged-out jobs that remain is
+-- returned, so that this can be called until it returns 0.
+function Qless.gc(now, budget)
+  budget = assert(tonumber(budget),
+    'GC(): Arg "budget" not a number: ' .. tostring(budget))
+
+  local count = tonumber(Qless.config.get('jobs-history-count'))
+  local time  = tonumber(Qless.config.get('jobs-history'))
+
+  -- Completed jobs are ordered by when they were completed, so those that
+  -- have aged out by either measure are all at the start of the set
+  local expired = math.max(
+    redis.call('zcard', 'ql:completed') - count,
+    redis.call('zcount', 'ql:completed', 0, now - time))
+  local reaped = math.max(math.min(expired, budget), 0)
+  if reaped == 0 then
+    return math.max(expired, 0)
+  end
+
+  local jids = redis.call('zrange', 'ql:completed', 0, reaped - 1)
+  for index, jid in ipairs(jids) do
+    local tags = cjson.decode(
+      redis.call('hget', QlessJob.ns .. jid, 'tags') or '{}')
+    for i, tag in ipairs(tags) do
+      redis.call('zrem', 'ql:t:' .. tag, jid)
+      redis.call('zincrby', 'ql:tags', -1, tag)
+    end
+    Qless.unlink(QlessJob.ns .. jid, QlessJob.ns .. jid .. '-history')
+  end
+  redis.call('zremrangebyrank', 'ql:completed', 0, reaped - 1)
+
+  return expired - reaped
+end
+-------------------------------------------------------------------------------
+-- Configuration interactions
+-------------------------------------------------------------------------------
+
+-- This represents our default configuration settings
+Qless.config.defaults = {
+  ['application']        = 'qless',
+  ['heartbeat']          = 60,
+  ['grace-period']       = 10,
+  ['stats-history']      = 30,
+  ['histogram-history']  = 7,
+  ['jobs-history-count'] = 50000,
+  ['jobs-history']       = 604800
+}
+
+-- Read the whole of `ql:config` the first time it's needed in this script
+-- run, and serve every later lookup from memory. This is kept apart from the
+-- defaults, so that they're never overwritten by what's stored.
+Qless.config.load = function()
+  if not Qless.config.cache then
+    -- Inspired by redis-lua https://github.com/nrk/redis-lua/blob/version-2.0/src/redis.lua
+    local cache = {}
+    local reply = redis.call('hgetall', 'ql:config')
+    for i = 1, #reply, 2 do
+      cache[reply[i]] = reply[i + 1]
+    end
+    Qless.config.cache = cache
+  end
+  return Qless.config.cache
+end
+
+-- Get one or more of the keys
+Qless.config.get = function(key, default)
+  local cache = Qless.config.load()
+  if key then
+    return cache[key] or Qless.config.defaults[key] or default
+  else
+    local reply = {}
+    for option, value in pairs(Qless.config.defaults) do
+      reply[option] = value
+    end
+    for option, value in pairs(cache) do
+      reply[option] = value
+    end
+    return reply
+  end
+end
+
+-- Set a configuration variable
+Qless.config.set = function(option, value)
+  assert(option, 'config.set(): Arg "option" missing')
+  assert(value , 'config.set(): Arg "value" missing')
+  -- Send out a log message
+  Qless.publish('log', cjson.encode({
+    event  = 'config_set',
+    option = option,
+    value  = value
+  }))
+
+  redis.call('hset', 'ql:config', option, value)
+  if Qless.config.cache then
+    Qless.config.cache[option] = tostring(value)
+  end
+end
+
+-- Unset a configuration option
+Qless.config.unset = function(option)
+  assert(option, 'config.unset(): Arg "option" missing')
+  -- Send out a log message
+  Qless.publish('log', cjson.encode({
+    event  = 'config_unset',
+    option = option
+  }))
+
+  redis.call('hdel', 'ql:config', option)
+  if Qless.config.cache then
+    Qless.config.cache[option] = nil
+  end
+end
+-------------------------------------------------------------------------------
+-- Job Class
+--
+-- It returns an object that represents the job with the provided JID
+-------------------------------------------------------------------------------
+
+-- How to read each field of a job's data. Most of them come straight from
+-- the job's hash, and are converted from what's stored there. The rest need
+-- lookups of their own, and are only done when asked for.
+QlessJob.fields = {
+  jid              = {stored = true},
+  klass            = {stored = true},
+  state            = {stored = true},
+  queue            = {stored = true},
+  worker           = {stored = true, convert = function(value)
+    return value or ''
+  end},
+  priority         = {stored = true, convert = tonumber},
+  expires          = {stored = true, convert = function(value)
+    return tonumber(value) or 0
+  end},
+  retries          = {stored = true, convert = tonumber},
+  remaining        = {stored = true, convert = function(value)
+    return math.floor(tonumber(value))
+  end},
+  data             = {stored = true},
+  tags             = {stored = true, convert = cjson.decode},
+  failure          = {stored = true, convert = function(value)
+    return cjson.decode(value or '{}')
+  end},
+  spawned_from_jid = {stored = true},
+  resources        = {stored = true, convert = function(value)
+    return cjson.decode(value or '[]')
+  end},
+  concurrency_key  = {stored = true, convert = function(value)
+    -- Left out of the job's data altogether when it hasn't got one
+    return value or nil
+  end},
+  tracked          = {lookup = function(job)
+    return redis.call('zscore', 'ql:tracked', job.jid) ~= false
+  end},
+  history          = {lookup = function(job)
+    return job:history()
+  end},
+  dependents       = {lookup = function(job)
+    return redis.call('smembers', QlessJob.ns .. job.jid .. '-dependents')
+  end},
+  dependencies     = {lookup = function(job)
+    return redis.call('smembers', QlessJob.ns .. job.jid .. '-dependencies')
+  end}
+}
+
+-- The order in which fields are reported when they're all asked for
+QlessJob.field_names = {
+  'jid', 'klass', 'state', 'queue', 'worker', 'tracked', 'priority',
+  'expires', 'retries', 'remaining', 'data', 'tags', 'history', 'failure',
+  'spawned_from_jid', 'resources', 'concurrency_key', 'dependents',
+  'dependencies'}
+
+-- This gets all the data associated with the job with the provided id. If the
+-- job is not found, it returns nil. If found, it returns an object with the
+-- appropriate properties.
+--
+-- If field names are provided, then only those fields are read, and a list of
+-- their values is returned in the same order. If instead a table of field
+-- names is provided, then an object with just those fields is returned.
+-- Either way, the history, dependency and tracking lookups are only made for
+-- the fields that need them.
+function QlessJob:data(...)
+  local fields = arg
+  local projection = type(arg[1]) == 'table'
+  if projection then
+    fields = arg[1]
+  elseif #arg == 0 then
+    fields = QlessJob.field_names
+    projection = true
+  end
+
+  -- We always read the jid, to know whether or not the job exists
+  local stored = {'jid'}
+  for _, field in ipairs(fields) do
+    local spec = QlessJob.fields[field]
+    if spec and spec.stored and field ~= 'jid' then
+      table.insert(stored, field)
+    end
+  end
+  local job = redis.call('hmget', QlessJob.ns .. self.jid, unpack(stored))
+
+  -- Return nil if we haven't found it
+  if not job[1] then
+    return nil
+  end
+
+  local values = {}
+  for index, field in ipairs(stored) do
+    local convert = QlessJob.fields[field].convert
+    if convert then
+      values[field] = convert(job[index])
+    else
+      values[field] = job[index]
+    end
+  end
+
+  local data = {}
+  local response = {}
+  for index, field in ipairs(fields) do
+    local spec = QlessJob.fields[field]
+    local value = values[field]
+    if spec and spec.lookup then
+      value = spec.lookup(self)
+    end
+    if projection then
+      data[field] = value
+    else
+      response[index] = value
+    end
+  end
+
+  if projection then
+    return data
+  else
+    return response
+  end
+end
+
+-- Complete a job and optionally put it in another queue, either scheduled or
+-- to be considered waiting immediately. It can also optionally accept other
+-- jids on which this job will be considered dependent before it's considered
+-- valid.
+--
+-- The variable-length arguments may be pairs of the form:
+--
+--      ('next'   , queue) : The queue to advance it to next
+--      ('delay'  , delay) : The delay for the next queue
+--      ('depends',        : Json of jobs it depends on in the new queue
+--          '["jid1", "jid2", ...]')
+---
+function QlessJob:complete(now, worker, queue, raw_data, ...)
+  -- Read in all the optional parameters
+  local options = {}
+  for i = 1, #arg, 2 do options[arg[i]] = arg[i + 1] end
+
+  return self:finish(now, worker, queue, raw_data, options)
+end
+
+-- Do the actual work of completing this job, with its optional arguments
+-- already collected into `options`. If `batch` is provided, this job is part
+-- of a `complete_many`, and the stats, the worker's job list and the reaping
+-- of old completed jobs are left for the caller to do once for the whole batch.
+function QlessJob:finish(now, worker, queue, raw_data, options, batch)
+  assert(worker, 'Complete(): Arg "worker" missing')
+  assert(queue , 'Complete(): Arg "queue" missing')
+  -- Jobs completed in a batch may leave out their data, and keep what they had
+  if raw_data ~= nil or not batch then
+    assert(cjson.decode(raw_data),
+      'Complete(): Arg "data" missing or not JSON: ' .. tostring(raw_data))
+  end
+
+  -- Sanity check on optional args
+  local nextq   = options['next']
+  local delay   = assert(tonumber(options['delay'] or 0))
+  local depends = assert(cjson.decode(options['depends'] or '[]'),
+    'Complete(): Arg "depends" not JSON: ' .. tostring(options['depends']))
+
+  -- Depends doesn't make sense without nextq
+  if options['delay'] and nextq == nil then
+    error('Complete(): "delay" cannot be used without a "next".')
+  end
+
+  -- Depends doesn't make sense without nextq
+  if options['depends'] and nextq == nil then
+    error('Complete(): "depends" cannot be used without a "next".')
+  end
+
+  -- The bin is midnight of the provided day
+  -- 24 * 60 * 60 = 86400
+  local bin = now - (now % 86400)
+
+  -- First things first, we should see if the worker still owns this job
+  local lastworker, state, priority, retries, current_queue = unpack(
+    redis.call('hmget', QlessJob.ns .. self.jid, 'worker', 'state',
+      'priority', 'retries', 'queue'))
+
+  if lastworker == false then
+    error('Complete(): Job ' .. self.jid .. ' does not exist')
+  elseif (state ~= 'running') then
+    error('Complete(): Job ' .. self.jid .. ' is not currently running: ' ..
+      state)
+  elseif lastworker ~= worker then
+    error('Complete(): Job ' .. self.jid ..
+      ' has been handed out to another worker: ' .. tostring(lastworker))
+  elseif queue ~= current_queue then
+    error('Complete(): Job ' .. self.jid .. ' running in another queue: ' ..
+      tostring(current_queue))
+  end
+
+  -- Now we can assume that the worker does own the job. We need to
+  --    1) Remove the job from the 'locks' from the old queue
+  --    2) Enqueue it in the next stage if necessary
+  --    3) Update the data
+  --    4) Mark the job as completed, remove the worker, remove expires, and
+  --          update history
+  self:history(now, 'done', nil, queue)
+
+  if raw_data then
+    redis.call('hset', QlessJob.ns .. self.jid, 'data', raw_data)
+  end
+
+  -- Remove the job from the previous queue
+  local queue_obj = Qless.queue(queue)
+  queue_obj.work.remove(self.jid)
+  queue_obj.locks.remove(self.jid)
+  queue_obj.scheduled.remove(self.jid)
+
+  self:release_resources(now)
+
+  ----------------------------------------------------------
+  -- This is the massive stats update that we have to do
+  ----------------------------------------------------------
+  -- This is how long we've been waiting to get popped
+  -- local waiting = math.floor(now) - history[#history]['popped']
+  local time = tonumber(
+    redis.call('hget', QlessJob.ns .. self.jid, 'time') or now)
+  local waiting = now - time
+  if batch then
+    table.insert(batch.waits, waiting)
+  else
+    Qless.queue(queue):stat(now, 'run', waiting)
+  end
+  redis.call('hset', QlessJob.ns .. self.jid,
+    'time', string.format("%.20f", now))
+
+  -- Remove this job from the jobs that the worker that was running it has
+  if batch then
+    table.insert(batch.jids, self.jid)
+  else
+    redis.call('zrem', 'ql:w:' .. worker .. ':jobs', self.jid)
+  end
+
+  if (not batch or batch.tracked) and
+    redis.call('zscore', 'ql:tracked', self.jid) ~= false then
+    Qless.publish('completed', self.jid)
+  end
+
+  if nextq then
+    queue_obj = Qless.queue(nextq)
+    -- Send a message out to log
+    Qless.publish('log', cjson.encode({
+      jid   = self.jid,
+      event = 'advanced',
+      queue = queue,
+      to    = nextq
+    }))
+
+    -- Enqueue the job
+    self:history(now, 'put', {q = nextq}, nextq)
+
+    -- We're going to make sure that this queue is in the
+    -- set of known queues
+    if not (batch and batch.queues[nextq]) then
+      if redis.call('zscore', 'ql:queues', nextq) == false then
+        redis.call('zadd', 'ql:queues', now, nextq)
+      end
+      if batch then
+        batch.queues[nextq] = true
+      end
+    end
+
+    redis.call('hmset', QlessJob.ns .. self.jid,
+      'state', 'waiting',
+      'worker', '',
+      'failure', '{}',
+      'queue', nextq,
+      'expires', 0,
+      'remaining', tonumber(retries))
+
+    if (delay > 0) and (#depends == 0) then
+      queue_obj.scheduled.add(now + delay, self.jid)
+      return 'scheduled'
+    else
+      -- These are the jids we legitimately have to wait on
+      local count = 0
+      for i, j in ipairs(depends) do
+        -- Make sure it's something other than 'nil' or complete.
+        local state = redis.call('hget', QlessJob.ns .. j, 'state')
+        if (state and state ~= 'complete') then
+          count = count + 1
+          redis.call(
+            'sadd', QlessJob.ns .. j .. '-dependents',self.jid)
+          redis.call(
+            'sadd', QlessJob.ns .. self.jid .. '-dependencies', j)
+        end
+      end
+      if count > 0 then
+        queue_obj.depends.add(now, self.jid)
+        redis.call('hset', QlessJob.ns .. self.jid, 'state', 'depends')
+        if delay > 0 then
+          -- We've already put it in 'depends'. Now, we must just save the data
+          -- for when it's scheduled
+          queue_obj.depends.add(now, self.jid)
+          redis.call('hset', QlessJob.ns .. self.jid, 'scheduled', now + delay)
+        end
+        return 'depends'
+      else
+        if self:acquire_resources(now) then
+          queue_obj.work.add(now, priority, self.jid)
+          queue_obj:signal(1)
+        end
+        return 'waiting'
+      end
+    end
+  else
+    -- Send a message out to log
+    Qless.publish('log', cjson.encode({
+      jid   = self.jid,
+      event = 'completed',
+      queue = queue
+    }))
+
+    redis.call('hmset', QlessJob.ns .. self.jid,
+      'state', 'complete',
+      'worker', '',
+      'failure', '{}',
+      'queue', '',
+      'expires', 0,
+      'remaining', tonumber(retries))
+
+    -- Schedule this job for destructination eventually
+    redis.call('zadd', 'ql:completed', now, self.jid)
+
+    -- Do the completion dance, reaping a few old completed jobs. The rest
+    -- are left for `gc`
+    if not batch then
+      Qless.gc(now, Qless.config.get('gc-inline-budget', 10))
+    end
+
+    -- Alright, if this has any dependents, then we should go ahead
+    -- and unstick those guys.
+    for i, j in ipairs(redis.call(
+      'smembers', QlessJob.ns .. self.jid .. '-dependents')) do
+      redis.call('srem', QlessJob.ns .. j .. '-dependencies', self.jid)
+      if redis.call(
+        'scard', QlessJob.ns .. j .. '-dependencies') == 0 then
+        local q, p, scheduled = unpack(
+          redis.call('hmget', QlessJob.ns .. j, 'queue', 'priority', 'scheduled'))
+        if q then
+          local queue = Qless.queue(q)
+          queue.depends.remove(j)
+          if scheduled then
+            queue.scheduled.add(scheduled, j)
+            redis.call('hset', QlessJob.ns .. j, 'state', 'scheduled')
+            redis.call('hdel', QlessJob.ns .. j, 'scheduled')
+          else
+            if Qless.job(j):acquire_resources(now) then
+              queue.work.add(now, p, j)
+              queue:signal(1)
+            end
+            redis.call('hset', QlessJob.ns .. j, 'state', 'waiting')
+          end
+        end
+      end
+    end
+
+    -- Delete our dependents key
+    redis.call('del', QlessJob.ns .. self.jid .. '-dependents')
+
+    return 'complete'
+  end
+end
+
+-- Fail(now, worker, group, message, [data])
+-- -------------------------------------------------
+-- Mark the particular job as failed, with the provided group, and a more
+-- specific message. By `group`, we mean some phrase that might be one of
+-- several categorical modes of failure. The `message` is something more
+-- job-specific, like perhaps a traceback.
+--
+-- This method should __not__ be used to note that a job has been dropped or
+-- has failed in a transient way. This method __should__ be used to note that
+-- a job has something really wrong with it that must be remedied.
+--
+-- The motivation behind the `group` is so that similar errors can be grouped
+-- together. Optionally, updated data can be provided for the job. A job in
+-- any state can be marked as failed. If it has been given to a worker as a
+-- job, then its subsequent requests to heartbeat or complete that job will
+-- fail. Failed jobs are kept until they are canceled or completed.
+--
+-- __Returns__ the id of the failed job if successful, or `False` on failure.
+--
+-- Args:
+--    1) jid
+--    2) worker
+--    3) group
+--    4) message
+--    5) the current time
+--    6) [data]
+function QlessJob:fail(now, worker, group, message, data)
+  local worker  = assert(worker           , 'Fail(): Arg "worker" missing')
+  local group   = assert(group            , 'Fail(): Arg "group" missing')
+  local message = assert(message          , 'Fail(): Arg "message" missing')
+
+  -- The bin is midnight of the provided day
+  -- 24 * 60 * 60 = 86400
+  local bin = now - (now % 86400)
+
+  if data then
+    data = cjson.decode(data)
+  end
+
+  -- First things first, we should get the history
+  local queue, state, oldworker = unpack(redis.call(
+    'hmget', QlessJob.ns .. self.jid, 'queue', 'state', 'worker'))
+
+  -- If the job has been completed, we cannot fail it
+  if not state then
+    error('Fail(): Job ' .. self.jid .. 'does not exist')
+  elseif state ~= 'running' then
+    error('Fail(): Job ' .. self.jid .. 'not currently running: ' .. state)
+  elseif worker ~= oldworker then
+    error('Fail(): Job ' .. self.jid .. ' running with another worker: ' ..
+      oldworker)
+  end
+
+  -- Send out a log message
+  Qless.publish('log', cjson.encode({
+    jid     = self.jid,
+    event   = 'failed',
+    worker  = worker,
+    group   = group,
+    message = message
+  }))
+
+  if redis.call('zscore', 'ql:tracked', self.jid) ~= false then
+    Qless.publish('failed', self.jid)
+  end
+
+  -- Remove this job from the jobs that the worker that was running it has
+  redis.call('zrem', 'ql:w:' .. worker .. ':jobs', self.jid)
+
+  -- Now, take the element of the history for which our provided worker is
+  -- the worker, and update 'failed'
+  self:history(now, 'failed', {worker = worker, group = group}, queue)
+
+  -- Increment the number of failures for that queue for the
+  -- given day.
+  redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. queue, 'failures', 1)
+  redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. queue, 'failed'  , 1)
+
+  -- Now remove the instance from the schedule, and work queues for the
+  -- queue it's in
+  local queue_obj = Qless.queue(queue)
+  queue_obj.work.remove(self.jid)
+  queue_obj.locks.remove(self.jid)
+  queue_obj.scheduled.remove(self.jid)
+
+  -- release any resource locks the job might have
+  self:release_resources(now)
+
+  -- The reason that this appears here is that the above will fail if the 
+  -- job doesn't exist
+  if data then
+    redis.call('hset', QlessJob.ns .. self.jid, 'data', cjson.encode(data))
+  end
+
+  redis.call('hmset', QlessJob.ns .. self.jid,
+    'state', 'failed',
+    'worker', '',
+    'expires', '',
+    'failure', cjson.encode({
+      ['group']   = group,
+      ['message'] = message,
+      ['when']    = math.floor(now),
+      ['worker']  = worker
+    }))
+
+  -- Add this particular instance to the failed groups
+  Qless.add_failure(group, self.jid, now)
+
+  -- Here is where we'd intcrement stats about the particular stage
+  -- and possibly the workers
+
+  return self.jid
+end
+
+-- retry(now, queue, worker, [delay, [group, [message]]])
+-- ------------------------------------------
+-- This script accepts jid, queue, worker and delay for retrying a job. This
+-- is similar in functionality to `put`, except that this counts against the
+-- retries a job has for a stage.
+--
+-- Throws an exception if:
+--      - the worker is not the worker with a lock on the job
+--      - the job is not actually running
+--
+-- Otherwise, it returns the number of retries remaining. If the allowed
+-- retries have been exhausted, then it is automatically failed, and a negative
+-- number is returned.
+--
+-- If a group and message is provided, then if the retries are exhausted, then
+-- the provided group and message will be used in place of the default
+-- messaging about retries in the particular queue being exhausted
+function QlessJob:retry(now, queue, worker, delay, group, message)
+  assert(queue , 'Retry(): Arg "queue" missing')
+  assert(worker, 'Retry(): Arg "worker" missing')
+  delay = assert(tonumber(delay or 0),
+    'Retry(): Arg "delay" not a number: ' .. tostring(delay))
+
+  -- Let's see what the old priority, and tags were
+  local oldqueue, state, retries, oldworker, priority, failure = unpack(
+    redis.call('hmget', QlessJob.ns .. self.jid, 'queue', 'state',
+      'retries', 'worker', 'priority', 'failure'))
+
+  -- If this isn't the worker that owns
+  if oldworker == false then
+    error('Retry(): Job ' .. self.jid .. ' does not exist')
+  elseif state ~= 'running' then
+    error('Retry(): Job ' .. self.jid .. ' is not currently running: ' ..
+      state)
+  elseif oldworker ~= worker then
+    error('Retry(): Job ' .. self.jid ..
+      ' has been given to another worker: ' .. oldworker)
+  end
+
+  -- For each of these, decrement their retries. If any of them
+  -- have exhausted their retries, then we should mark them as
+  -- failed.
+  local remaining = tonumber(redis.call(
+    'hincrby', QlessJob.ns .. self.jid, 'remaining', -1))
+  redis.call('hdel', QlessJob.ns .. self.jid, 'grace')
+
+  -- Remove it from the locks key of the old queue
+  Qless.queue(oldqueue).locks.remove(self.jid)
+  self:release_resources(now)
+
+  -- Remove this job from the worker that was previously working it
+  redis.call('zrem', 'ql:w:' .. worker .. ':jobs', self.jid)
+
+  if remaining < 0 then
+    -- Now remove the instance from the schedule, and work queues for the
+    -- queue it's in
+    local group = group or 'failed-retries-' .. queue
+    self:history(now, 'failed', {['group'] = group}, oldqueue)
+
+    redis.call('hmset', QlessJob.ns .. self.jid, 'state', 'failed',
+      'worker', '',
+      'expires', '')
+    -- If the failure has not already been set, then set it
+    if group ~= nil and message ~= nil then
+      redis.call('hset', QlessJob.ns .. self.jid,
+        'failure', cjson.encode({
+          ['group']   = group,
+          ['message'] = message,
+          ['when']    = math.floor(now),
+          ['worker']  = worker
+        })
+      )
+    else
+      redis.call('hset', QlessJob.ns .. self.jid,
+      'failure', cjson.encode({
+        ['group']   = group,
+        ['message'] =
+          'Job exhausted retries in queue "' .. oldqueue .. '"',
+        ['when']    = now,
+        ['worker']  = unpack(self:data('worker'))
+      }))
+    end
+
+    -- Add this particular instance to the failed types
+    Qless.add_failure(group, self.jid, now)
+    -- Increment the count of the failed jobs
+    local bin = now - (now % 86400)
+    redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. queue, 'failures', 1)
+    redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. queue, 'failed'  , 1)
+  else
+    -- Put it in the queue again with a delay. Like put()
+    local queue_obj = Qless.queue(queue)
+    if delay > 0 then
+      queue_obj.scheduled.add(now + delay, self.jid)
+      redis.call('hset', QlessJob.ns .. self.jid, 'state', 'scheduled')
+    else
+      if self:acquire_resources(now) then
+        queue_obj.work.add(now, priority, self.jid)
+        queue_obj:signal(1)
+      end
+      redis.call('hset', QlessJob.ns .. self.jid, 'state', 'waiting')
+    end
+
+    -- If a group and a message was provided, then we should save it
+    if group ~= nil and message ~= nil then
+      redis.call('hset', QlessJob.ns .. self.jid,
+        'failure', cjson.encode({
+          ['group']   = group,
+          ['message'] = message,
+          ['when']    = math.floor(now),
+          ['worker']  = worker
+        })
+      )
+    end
+  end
+
+  return math.floor(remaining)
+end
+
+-- Depends(jid, 'on', [jid, [jid, [...]]]
+-- Depends(jid, 'off', [jid, [jid, [...]]])
+-- Depends(jid, 'off', 'all')
+-------------------------------------------------------------------------------
+-- Add or remove dependencies a job has. If 'on' is provided, the provided
+-- jids are added as dependencies. If 'off' and 'all' are provided, then all
+-- the current dependencies are removed. If 'off' is provided and the next
+-- argument is not 'all', then those jids are removed as dependencies.
+--
+-- If a job is not already in the 'depends' state, then this call will return
+-- false. Otherwise, it will return true
+function QlessJob:depends(now, command, ...)
+  assert(command, 'Depends(): Arg "command" missing')
+  local state = redis.call('hget', QlessJob.ns .. self.jid, 'state')
+  if state ~= 'depends' then
+    error('Depends(): Job ' .. self.jid ..
+      ' not in the depends state: ' .. tostring(state))
+  end
+
+  if command == 'on' then
+    -- These are the jids we legitimately have to wait on
+    for i, j in ipairs(arg) do
+      -- Make sure it's something other than 'nil' or complete.
+      local state = redis.call('hget', QlessJob.ns .. j, 'state')
+      if (state and state ~= 'complete') then
+        redis.call(
+          'sadd', QlessJob.ns .. j .. '-dependents'  , self.jid)
+        redis.call(
+          'sadd', QlessJob.ns .. self.jid .. '-dependencies', j)
+      end
+    end
+    return true
+  elseif command == 'off' then
+    if arg[1] == 'all' then
+      for i, j in ipairs(redis.call(
+        'smembers', QlessJob.ns .. self.jid .. '-dependencies')) do
+        redis.call('srem', QlessJob.ns .. j .. '-dependents', self.jid)
+      end
+      redis.call('del', QlessJob.ns .. self.jid .. '-dependencies')
+      local q, p = unpack(redis.call(
+        'hmget', QlessJob.ns .. self.jid, 'queue', 'priority'))
+      if q then
+        local queue_obj = Qless.queue(q)
+        queue_obj.depends.remove(self.jid)
+        if self:acquire_resources(now) then
+          queue_obj.work.add(now, p, self.jid)
+          queue_obj:signal(1)
+        end
+        redis.call('hset', QlessJob.ns .. self.jid, 'state', 'waiting')
+      end
+    else
+      for i, j in ipairs(arg) do
+        redis.call('srem', QlessJob.ns .. j .. '-dependents', self.jid)
+        redis.call(
+          'srem', QlessJob.ns .. self.jid .. '-dependencies', j)
+        if redis.call('scard',
+          QlessJob.ns .. self.jid .. '-dependencies') == 0 then
+          local q, p = unpack(redis.call(
+            'hmget', QlessJob.ns .. self.jid, 'queue', 'priority'))
+          if q then
+            local queue_obj = Qless.queue(q)
+            queue_obj.depends.remove(self.jid)
+            if self:acquire_resources(now) then
+              queue_obj.work.add(now, p, self.jid)
+              queue_obj:signal(1)
+            end
+            redis.call('hset',
+              QlessJob.ns .. self.jid, 'state', 'waiting')
+          end
+        end
+      end
+    end
+    return true
+  else
+    error('Depends(): Argument "command" must be "on" or "off"')
+  end
+end
+
+-- Heartbeat
+------------
+-- Renew this worker's lock on this job. Throws an exception if:
+--      - the job's been given to another worker
+--      - the job's been completed
+--      - the job's been canceled
+--      - the job's not running
+--
+-- If `batch` is provided, this heartbeat is part of a `heartbeat.many`, and
+-- the worker's job list, the locks and the list of seen workers are left for
+-- the caller to update once for the whole batch.
+function QlessJob:heartbeat(now, worker, data, batch)
+  assert(worker, 'Heatbeat(): Arg "worker" missing')
+
+  if data then
+    data = cjson.decode(data)
+  end
+
+  -- First, let's see if the worker still owns this job, and there is a
+  -- worker
+  local job_worker, state, queue = unpack(
+    redis.call('hmget', QlessJob.ns .. self.jid, 'worker', 'state', 'queue'))
+  if job_worker == false then
+    -- This means the job doesn't exist
+    error('Heartbeat(): Job ' .. self.jid .. ' does not exist')
+  elseif state ~= 'running' then
+    error(
+      'Heartbeat(): Job ' .. self.jid .. ' not currently running: ' .. state)
+  elseif job_worker ~= worker or #job_worker == 0 then
+    error(
+      'Heartbeat(): Job ' .. self.jid ..
+      ' given out to another worker: ' .. job_worker)
+  end
+
+  -- We should find the heartbeat interval for this queue
+  local interval = batch and batch.intervals[queue]
+  if not interval then
+    interval = tonumber(
+      Qless.config.get(queue .. '-heartbeat') or
+      Qless.config.get('heartbeat', 60))
+    if batch then
+      batch.intervals[queue] = interval
+    end
+  end
+  local expires = now + interval
+
+  -- Otherwise, optionally update the user data, and the heartbeat
+  if data then
+    -- I don't know if this is wise, but I'm decoding and encoding
+    -- the user data to hopefully ensure its sanity
+    redis.call('hmset', QlessJob.ns .. self.jid, 'expires',
+      expires, 'worker', worker, 'data', cjson.encode(data))
+  else
+    redis.call('hmset', QlessJob.ns .. self.jid,
+      'expires', expires, 'worker', worker)
+  end
+
+  if batch then
+    -- The worker's job list, the list of seen workers and the locks are
+    -- updated by the caller once for the whole batch
+    table.insert(batch.jobs, expires)
+    table.insert(batch.jobs, self.jid)
+    if not batch.locks[queue] then
+      batch.locks[queue] = {}
+      table.insert(batch.queues, queue)
+    end
+    table.insert(batch.locks[queue], expires)
+    table.insert(batch.locks[queue], self.jid)
+    return expires
+  end
+
+  -- Update hwen this job was last updated on that worker
+  -- Add this job to the list of jobs handled by this worker
+  redis.call('zadd', 'ql:w:' .. worker .. ':jobs', expires, self.jid)
+
+  -- Make sure we this worker to the list of seen workers
+  redis.call('zadd', 'ql:workers', now, worker)
+
+  -- And now we should just update the locks
+  Qless.queue(queue).locks.add(expires, self.jid)
+  return expires
+end
+
+-- Priority
+-- --------
+-- Update the priority of this job. If the job doesn't exist, throws an
+-- exception
+function QlessJob:priority(priority)
+  priority = assert(tonumber(priority),
+    'Priority(): Arg "priority" missing or not a number: ' ..
+    tostring(priority))
+
+  -- Get the queue the job is currently in, if any
+  local queue = redis.call('hget', QlessJob.ns .. self.jid, 'queue')
+
+  if queue == nil or queue == false then
+    -- If the job doesn't exist, throw an error
+    error('Priority(): Job ' .. self.jid .. ' does not exist')
+  elseif queue == '' then
+    -- Just adjust the priority
+    redis.call('hset', QlessJob.ns .. self.jid, 'priority', priority)
+    return priority
+  else
+    -- Adjust the priority and see if it's a candidate for updating
+    -- its priority in the queue it's currently in
+    local queue_obj = Qless.queue(queue)
+    if queue_obj.work.score(self.jid) then
+      queue_obj.work.add(0, priority, self.jid)
+    end
+    redis.call('hset', QlessJob.ns .. self.jid, 'priority', priority)
+    return priority
+  end
+end
+
+-- Update the jobs' attributes with the provided dictionary
+function QlessJob:update(data)
+  local tmp = {}
+  for k, v in pairs(data) do
+    table.insert(tmp, k)
+    table.insert(tmp, v)
+  end
+  redis.call('hmset', QlessJob.ns .. self.jid, unpack(tmp))
+end
+
+-- Times out the job now rather than when its lock is normally set to expire
+function QlessJob:timeout(now)
+  local queue_name, state, worker = unpack(redis.call('hmget',
+    QlessJob.ns .. self.jid, 'queue', 'state', 'worker'))
+  if queue_name == nil or queue_name == false then
+    error('Timeout(): Job ' .. self.jid .. ' does not exist')
+  elseif state ~= 'running' then
+    error('Timeout(): Job ' .. self.jid .. ' not running')
+  else
+    -- Time out the job
+    self:history(now, 'timed-out', nil, queue_name)
+    local queue = Qless.queue(queue_name)
+    queue.locks.remove(self.jid)
+    queue.work.add(now, '+inf', self.jid)
+    queue:signal(1)
+    redis.call('hmset', QlessJob.ns .. self.jid,
+      'state', 'stalled', 'expires', 0)
+    local encoded = cjson.encode({
+      jid    = self.jid,
+      event  = 'lock_lost',
+      worker = worker
+    })
+    Qless.publish('w:' .. worker, encoded)
+    Qless.publish('log', encoded)
+    return queue_name
+  end
+end
+
+-- Cancel this job, removing every trace of it. Returns whether or not there
+-- was a job to cancel, as jobs that are complete are left alone. It's up to
+-- the caller to make sure no other job depends on this one.
+function QlessJob:cancel(now)
+  local jid = self.jid
+  -- Find any stage it's associated with and remove its from that stage
+  local real_jid, state, queue, failure, worker = unpack(redis.call(
+    'hmget', QlessJob.ns .. jid, 'jid', 'state', 'queue', 'failure', 'worker'))
+
+  if state ~= false and state ~= 'complete' then
+    -- Send a message out on the appropriate channels
+    local encoded = cjson.encode({
+      jid    = jid,
+      worker = worker,
+      event  = 'canceled',
+      queue  = queue
+    })
+    Qless.publish('log', encoded)
+
+    -- Remove this job from whatever worker has it, if any
+    if worker and (worker ~= '') then
+      redis.call('zrem', 'ql:w:' .. worker .. ':jobs', jid)
+      -- If necessary, send a message to the appropriate worker, too
+      Qless.publish('w:' .. worker, encoded)
+    end
+
+    -- Remove it from that queue
+    if queue then
+      local queue = Qless.queue(queue)
+      queue.work.remove(jid)
+      queue.locks.remove(jid)
+      queue.scheduled.remove(jid)
+      queue.depends.remove(jid)
+    end
+
+    self:release_resources(now)
+
+    -- We should probably go through all our dependencies and remove
+    -- ourselves from the list of dependents
+    for i, j in ipairs(redis.call(
+      'smembers', QlessJob.ns .. jid .. '-dependencies')) do
+      redis.call('srem', QlessJob.ns .. j .. '-dependents', jid)
+    end
+
+    -- Delete any notion of dependencies it has
+    redis.call('del', QlessJob.ns .. jid .. '-dependencies')
+
+    -- If we're in the failed state, remove all of our data
+    if state == 'failed' then
+      failure = cjson.decode(failure)
+      -- We need to make this remove it from the failed queues
+      Qless.remove_failures(failure.group, jid)
+      -- Remove one count from the failed count of the particular
+      -- queue
+      local bin = failure.when - (failure.when % 86400)
+      local failed = redis.call(
+        'hget', 'ql:s:stats:' .. bin .. ':' .. queue, 'failed')
+      redis.call('hset',
+        'ql:s:stats:' .. bin .. ':' .. queue, 'failed', failed - 1)
+    end
+
+    -- Remove it as a job that's tagged with this particular tag
+    local tags = cjson.decode(
+      redis.call('hget', QlessJob.ns .. jid, 'tags') or '{}')
+    for i, tag in ipairs(tags) do
+      redis.call('zrem', 'ql:t:' .. tag, jid)
+      redis.call('zincrby', 'ql:tags', -1, tag)
+    end
+
+    -- If the job was being tracked, we should notify
+    if redis.call('zscore', 'ql:tracked', jid) ~= false then
+      Qless.publish('canceled', jid)
+    end
+
+    -- Just go ahead and delete our data
+    Qless.unlink(QlessJob.ns .. jid, QlessJob.ns .. jid .. '-history')
+    return true
+  end
+  return false
+end
+
+-- Return whether or not this job exists
+function QlessJob:exists()
+  return redis.call('exists', QlessJob.ns .. self.jid) == 1
+end
+
+-- The most history items to keep for jobs in `queue`, from its
+-- `<queue>-history` setting:
+--
+--  - `full`: keep every item
+--  - `capped:N`: keep the first item and the most recent N - 1
+--  - `off`: keep nothing
+--
+-- Without a setting, jobs are capped at `max-job-history` items. Returns the
+-- number of items to keep, or -1 for all of them.
+function QlessJob.history_limit(queue)
+  local policy
+  if queue and queue ~= '' then
+    policy = Qless.config.get(queue .. '-history')
+  end
+  policy = policy or ('capped:' .. Qless.config.get('max-job-history', 100))
+
+  if policy == 'full' then
+    return -1
+  elseif policy == 'off' then
+    return 0
+  end
+  local limit = tonumber(string.match(policy, '^capped:(%d+)$'))
+  if not limit then
+    error('History(): Unknown history policy for ' .. tostring(queue) ..
+      ': ' .. policy)
+  end
+  -- A cap of 0 has always meant no cap at all
+  if limit == 0 then
+    return -1
+  end
+  return limit
+end
+
+-- Start the history of a new job in `queue`. The first item is kept in the
+-- job's hash, so that the rest of the history can be capped with a single
+-- LTRIM
+function QlessJob:start_history(now, what, item, queue)
+  if QlessJob.history_limit(queue) ~= 0 then
+    redis.call('hset', QlessJob.ns .. self.jid, 'history_first',
+      cjson.encode({math.floor(now), what, item}))
+  end
+end
+
+-- Get or append to history. Appending uses the history policy of `queue`,
+-- which is read from the job if it's not provided. It expects the job's
+-- history to be up to date with how it's now stored (see `history.migrate`)
+function QlessJob:history(now, what, item, queue)
+  if what == nil then
+    -- Get the history
+    return self:history_items(0)
+  else
+    queue = queue or redis.call('hget', QlessJob.ns .. self.jid, 'queue')
+    local limit = QlessJob.history_limit(queue)
+    if limit == 0 then
+      return 0
+    end
+
+    -- Append to the history. If the length of the history should be limited,
+    -- then we'll truncate it, bearing in mind that the first item is kept
+    -- in the job's hash
+    local length = redis.call('rpush', QlessJob.ns .. self.jid .. '-history',
+      cjson.encode({math.floor(now), what, item}))
+    if limit > 0 and length > limit - 1 then
+      redis.call('ltrim', QlessJob.ns .. self.jid .. '-history',
+        length - limit + 1, -1)
+    end
+    return length
+  end
+end
+
+-- Get `count` items of this job's history starting from `offset`, or all of
+-- them from there if `count` is nil. A negative `offset` counts back from the
+-- most recent item. Only the items asked for are read and decoded.
+function QlessJob:history_items(offset, count)
+  local key = QlessJob.ns .. self.jid .. '-history'
+  local first, legacy = unpack(redis.call('hmget', QlessJob.ns .. self.jid,
+    'history_first', 'history'))
+  -- Very old jobs are brought up to date when they're read, as their whole
+  -- history is in the job's hash anyway
+  if legacy then
+    self:migrate_history()
+    first = redis.call('hget', QlessJob.ns .. self.jid, 'history_first')
+  end
+  if offset < 0 then
+    local length = redis.call('llen', key) + (first and 1 or 0)
+    offset = math.max(length + offset, 0)
+  end
+
+  -- The first item is kept in the job's hash, ahead of the history list
+  local values = {}
+  if count == 0 then
+    return values
+  elseif first then
+    if offset == 0 then
+      table.insert(values, first)
+      count = count and count - 1
+    else
+      offset = offset - 1
+    end
+  end
+  if count == nil or count > 0 then
+    local stop = count and offset + count - 1 or -1
+    for _, value in ipairs(redis.call('lrange', key, offset, stop)) do
+      table.insert(values, value)
+    end
+  end
+
+  local response = {}
+  for i, value in ipairs(values) do
+    value = cjson.decode(value)
+    local dict = value[3] or {}
+    dict['when'] = value[1]
+    dict['what'] = value[2]
+    table.insert(response, dict)
+  end
+  return response
+end
+
+-- Bring the history of this job up to date with how it's now stored. Very
+-- old jobs kept their history as JSON in the job's hash, and until recently
+-- the first item was kept at the head of the history list rather than in the
+-- job's hash. Returns true if anything was changed.
+function QlessJob:migrate_history()
+  local key = QlessJob.ns .. self.jid .. '-history'
+  local migrated = false
+
+  -- First, check if there's an old-style history, and update it if there is
+  local history = redis.call('hget', QlessJob.ns .. self.jid, 'history')
+  if history then
+    history = cjson.decode(history)
+    for i, value in ipairs(history) do
+      redis.call('rpush', key,
+        cjson.encode({math.floor(value.put), 'put', {q = value.q}}))
+
+      -- If there's any popped time
+      if value.popped then
+        redis.call('rpush', key,
+          cjson.encode({math.floor(value.popped), 'popped',
+            {worker = value.worker}}))
+      end
+
+      -- If there's any failure
+      if value.failed then
+        redis.call('rpush', key,
+          cjson.encode(
+            {math.floor(value.failed), 'failed', nil}))
+      end
+
+      -- If it was completed
+      if value.done then
+        redis.call('rpush', key,
+          cjson.encode(
+            {math.floor(value.done), 'done', nil}))
+      end
+    end
+    -- With all this ported forward, delete the old-style history
+    redis.call('hdel', QlessJob.ns .. self.jid, 'history')
+    migrated = true
+  end
+
+  -- And now move the first item out of the list, if it's still there
+  if redis.call('hexists', QlessJob.ns .. self.jid, 'history_first') == 0 then
+    local first = redis.call('lpop', key)
+    if first then
+      redis.call('hset', QlessJob.ns .. self.jid, 'history_first', first)
+      migrated = true
+    end
+  end
+  return migrated
+end
+
+-- Bring the history of the jobs in a page of the keyspace up to date, using
+-- a SCAN cursor that looks at about `budget` keys (100 by default). Start
+-- with 0, and pass back the returned cursor until it's 0 again. Returns the
+-- cursor and the number of jobs that needed migrating.
+function QlessJob.migrate_histories(cursor, budget)
+  cursor = assert(tonumber(cursor or 0),
+    'HistoryMigrate(): Arg "cursor" not a number: ' .. tostring(cursor))
+  budget = assert(tonumber(budget or 100),
+    'HistoryMigrate(): Arg "budget" not a number: ' .. tostring(budget))
+
+  local reply = redis.call('scan', cursor,
+    'match', QlessJob.ns .. '*', 'count', budget)
+  local migrated = 0
+  for _, key in ipairs(reply[2]) do
+    -- Jobs' history lists and dependency sets match too, but only the jobs
+    -- themselves are hashes
+    if redis.call('type', key)['ok'] == 'hash' and
+      Qless.job(string.sub(key, #QlessJob.ns + 1)):migrate_history() then
+      migrated = migrated + 1
+    end
+  end
+  return tonumber(reply[1]), migrated
+end
+
+function QlessJob:release_resources(now)
+  local resources = redis.call('hget', QlessJob.ns .. self.jid, 'resources')
+  resources = QlessResource.weights(cjson.decode(resources or '[]'))
+  -- Give up every lock before handing any of them on, so that a waiter
+  -- needing several of these resources can take them all together
+  for _, res in ipairs(resources) do
+    Qless.resource(res[1]):release(now, self.jid, res[2])
+  end
+  for _, res in ipairs(resources) do
+    Qless.resource(res[1]):promote(now)
+  end
+end
+
+-- Takes a lock on every one of the job's resources, or on none of them. If
+-- any is at its limit, the job holds nothing and waits in the pending queue of
+-- each resource that's blocking it, so that the release of one of those
+-- resources will try it again.
+function QlessJob:acquire_resources(now)
+  local resources, priority = unpack(redis.call('hmget', QlessJob.ns .. self.jid, 'resources', 'priority'))
+  resources = QlessResource.weights(cjson.decode(resources or '[]'))
+  if (#resources == 0) then
+    return true
+  end
+
+  local available, acquired_all = {}, true
+  for i, res in ipairs(resources) do
+    available[i] = Qless.resource(res[1]):available(self.jid, res[2])
+    acquired_all = acquired_all and available[i]
+  end
+
+  for i, res in ipairs(resources) do
+    if acquired_all then
+      Qless.resource(res[1]):acquire(self.jid, res[2])
+    elseif available[i] then
+      Qless.resource(res[1]):release(now, self.jid, res[2])
+    else
+      Qless.resource(res[1]):wait(now, priority, self.jid)
+    end
+  end
+  return acquired_all
+end
+-------------------------------------------------------------------------------
+-- Queue class
+-------------------------------------------------------------------------------
+-- Return a queue object
+function Qless.queue(name)
+  assert(name, 'Queue(): no queue name provided')
+  local queue = {}
+  setmetatable(queue, QlessQueue)
+  queue.name = name
+
+  -- Access to our work
+  queue.work = {
+    peek = function(count, klasses)
+      if count == 0 then
+        return {}
+      end
+      if klasses then
+        return queue:peek_klasses(count, klasses)
+      end
+      local jids = {}
+      for index, jid in ipairs(redis.call(
+        'zrevrange', queue:prefix('work'), 0, count - 1)) do
+        table.insert(jids, jid)
+      end
+      return jids
+    end, remove = function(...)
+      if #arg > 0 then
+        -- Each job is also kept in the work set for its klass
+        for _, jid in ipairs(arg) do
+          local klass = redis.call('hget', QlessJob.ns .. jid, 'klass')
+          if klass then
+            redis.call('zrem', queue:prefix('work-' .. klass), jid)
+          end
+        end
+        local removed = redis.call('zrem', queue:prefix('work'), unpack(arg))
+        queue:count('waiting', -removed)
+        return removed
+      end
+    end, add = function(now, priority, jid)
+      if priority ~= '+inf' then
+        priority = priority - (now / 10000000000)
+      end
+      local klass = redis.call('hget', QlessJob.ns .. jid, 'klass')
+      if klass then
+        redis.call('zadd', queue:prefix('work-' .. klass), priority, jid)
+      end
+      -- Once the work set has been empty, every job in it is in its klass's
+      -- work set too
+      if redis.call('zcard', queue:prefix('work')) == 0 then
+        redis.call('set', queue:prefix('klass-indexed'), 1)
+      end
+      local added = redis.call('zadd', queue:prefix('work'), priority, jid)
+      queue:count('waiting', added)
+      return added
+    end, score = function(jid)
+      return redis.call('zscore', queue:prefix('work'), jid)
+    end, length = function()
+      return redis.call('zcard', queue:prefix('work'))
+    end
+  }
+
+  -- Access to our locks
+  queue.locks = {
+    expired = function(now, offset, count)
+      return redis.call('zrangebyscore',
+        queue:prefix('locks'), '-inf', now, 'LIMIT', offset, count)
+    end, peek = function(now, offset, count)
+      return redis.call('zrangebyscore', queue:prefix('locks'),
+        now, '+inf', 'LIMIT', offset, count)
+    end, add = function(expires, jid)
+      -- Jobs only count against their concurrency key when they start
+      -- running, and not when their lock is renewed
+      if redis.call('zadd', queue:prefix('locks'), expires, jid) == 1 then
+        queue:count('running', 1)
+        queue:concurrency(jid, 1)
+      end
+    end, add_many = function(members)
+      -- Renew a flat list of expires and jid pairs at once. Any job that
+      -- isn't locked yet goes through `add`, to be counted as running
+      local renewed = {}
+      for i = 1, #members, 2 do
+        if redis.call('zscore', queue:prefix('locks'), members[i + 1]) then
+          table.insert(renewed, members[i])
+          table.insert(renewed, members[i + 1])
+        else
+          queue.locks.add(members[i], members[i + 1])
+        end
+      end
+      Qless.zadd(queue:prefix('locks'), renewed)
+    end, remove = function(...)
+      local removed = 0
+      for _, jid in ipairs(arg) do
+        if redis.call('zrem', queue:prefix('locks'), jid) == 1 then
+          queue:concurrency(jid, -1)
+          removed = removed + 1
+        end
+      end
+      queue:count('running', -removed)
+      return removed
+    end, running = function(now)
+      return redis.call('zcount', queue:prefix('locks'), now, '+inf')
+    end, length = function(now)
+      -- If a 'now' is provided, we're interested in how many are before
+      -- that time
+      if now then
+        return redis.call('zcount', queue:prefix('locks'), 0, now)
+      else
+        return redis.call('zcard', queue:prefix('locks'))
+      end
+    end, job_time_left = function(now, jid)
+      return tonumber(redis.call('zscore', queue:prefix('locks'), jid) or 0) - now
+    end
+  }
+
+  -- Access to our dependent jobs
+  queue.depends = {
+    peek = function(now, offset, count)
+      return redis.call('zrange',
+        queue:prefix('depends'), offset, offset + count - 1)
+    end, add = function(now, jid)
+      queue:count('depends',
+        redis.call('zadd', queue:prefix('depends'), now, jid))
+    end, remove = function(...)
+      if #arg > 0 then
+        local removed = redis.call('zrem', queue:prefix('depends'), unpack(arg))
+        queue:count('depends', -removed)
+        return removed
+      end
+    end, length = function()
+      return redis.call('zcard', queue:prefix('depends'))
+    end
+  }
+
+  -- Access to our scheduled jobs
+  queue.scheduled = {
+    peek = function(now, offset, count)
+      return redis.call('zrange',
+        queue:prefix('scheduled'), offset, offset + count - 1)
+    end, ready = function(now, offset, count)
+      return redis.call('zrangebyscore',
+        queue:prefix('scheduled'), 0, now, 'LIMIT', offset, count)
+    end, add = function(when, jid)
+      queue:count('scheduled',
+        redis.call('zadd', queue:prefix('scheduled'), when, jid))
+    end, remove = function(...)
+      if #arg > 0 then
+        local removed = redis.call(
+          'zrem', queue:prefix('scheduled'), unpack(arg))
+        queue:count('scheduled', -removed)
+        return removed
+      end
+    end, length = function()
+      return redis.call('zcard', queue:prefix('scheduled'))
+    end
+  }
+
+  -- Access to our recurring jobs
+  queue.recurring = {
+    peek = function(now, offset, count)
+      return redis.call('zrangebyscore', queue:prefix('recur'),
+        0, now, 'LIMIT', offset, count)
+    end, ready = function(now, offset, count)
+    end, add = function(when, jid)
+      queue:count('recurring',
+        redis.call('zadd', queue:prefix('recur'), when, jid))
+    end, remove = function(...)
+      if #arg > 0 then
+        local removed = redis.call('zrem', queue:prefix('recur'), unpack(arg))
+        queue:count('recurring', -removed)
+        return removed
+      end
+    end, update = function(increment, jid)
+      redis.call('zincrby', queue:prefix('recur'), increment, jid)
+    end, score = function(jid)
+      return redis.call('zscore', queue:prefix('recur'), jid)
+    end, length = function()
+      return redis.call('zcard', queue:prefix('recur'))
+    end
+  }
+  return queue
+end
+
+-- Return the prefix for this particular queue
+function QlessQueue:prefix(group)
+  if group then
+    return QlessQueue.ns..self.name..'-'..group
+  else
+    return QlessQueue.ns..self.name
+  end
+end
+
+-- Let workers waiting on this queue know that `count` jobs have become ready
+-- to pop, by pushing a token per job onto the list `ql:q:<name>-signal`.
+-- Workers can BLPOP that list rather than polling `pop`. The list is kept to
+-- at most `max-queue-signals` tokens, since one token is enough to wake a
+-- worker that then pops many jobs.
+function QlessQueue:signal(count)
+  local limit = tonumber(Qless.config.get('max-queue-signals', 100))
+  count = math.min(count or 1, limit)
+  if count <= 0 then
+    return
+  end
+  local tokens = {}
+  for i = 1, count do
+    table.insert(tokens, 1)
+  end
+  local key = self:prefix('signal')
+  local length = redis.call('rpush', key, unpack(tokens))
+  if length > limit then
+    redis.call('ltrim', key, -limit, -1)
+  end
+end
+
+-- Stats(now, date)
+-- ---------------------
+-- Return the current statistics for a given queue on a given date. The
+-- results are returned are a JSON blob:
+--
+--
+--  {
+--      # These are unimplemented as of yet
+--      'failed': 3,
+--      'retries': 5,
+--      'wait' : {
+--          'total'    : ...,
+--          'mean'     : ...,
+--          'variance' : ...,
+--          'histogram': [
+--              ...
+--          ]
+--      }, 'run': {
+--          'total'    : ...,
+--          'mean'     : ...,
+--          'variance' : ...,
+--          'histogram': [
+--              ...
+--          ]
+--      }
+--  }
+--
+-- The histogram's data points are at the second resolution for the first
+-- minute, the minute resolution for the first hour, the 15-minute resolution
+-- for the first day, the hour resolution for the first 3 days, and then at
+-- the day resolution from there on out. The `histogram` key is a list of
+-- those values.
+function QlessQueue:stats(now, date)
+  date = assert(tonumber(date),
+    'Stats(): Arg "date" missing or not a number: '.. (date or 'nil'))
+
+  -- The bin is midnight of the provided day
+  -- 24 * 60 * 60 = 86400
+  local bin = date - (date % 86400)
+
+  local mkstats = function(name, bin, queue)
+    -- The results we'll be sending back
+    local results = {}
+
+    local key = 'ql:s:' .. name .. ':' .. bin .. ':' .. queue
+    local count, mean, vk, compact = unpack(
+      redis.call('hmget', key, 'total', 'mean', 'vk', 'compact'))
+
+    count = tonumber(count) or 0
+    mean  = tonumber(mean) or 0
+    vk    = tonumber(vk)
+
+    results.count     = count or 0
+    results.mean      = mean  or 0
+    results.histogram = {}
+
+    if not count then
+      results.std = 0
+    else
+      if count > 1 then
+        results.std = math.sqrt(vk / (count - 1))
+      else
+        results.std = 0
+      end
+    end
+
+    if compact then
+      results.histogram = QlessQueue.histogram_counts(key .. '-histogram')
+    else
+      -- Bins from before the histogram was kept compact
+      local histogram = redis.call('hmget', key, unpack(QlessQueue.histokeys))
+      for i=1,#QlessQueue.histokeys do
+        table.insert(results.histogram, tonumber(histogram[i]) or 0)
+      end
+    end
+    return results
+  end
+
+  local retries, failed, failures = unpack(redis.call('hmget', 'ql:s:stats:' .. bin .. ':' .. self.name, 'retries', 'failed', 'failures'))
+  return {
+    retries  = tonumber(retries  or 0),
+    failed   = tonumber(failed   or 0),
+    failures = tonumber(failures or 0),
+    wait     = mkstats('wait', bin, self.name),
+    run      = mkstats('run' , bin, self.name)
+  }
+end
+
+-- Peek
+-------
+-- Examine the next jobs that would be popped from the queue without actually
+-- popping them.
+function QlessQueue:peek(now, count)
+  count = assert(tonumber(count),
+    'Peek(): Arg "count" missing or not a number: ' .. tostring(count))
+
+  -- These are the ids that we're going to return. We'll begin with any jobs
+  -- that have lost their locks
+  local jids = self.locks.expired(now, 0, count)
+
+  -- If we still need jobs in order to meet demand, then we should
+  -- look for all the recurring jobs that need jobs run
+  self:check_recurring(now, count - #jids)
+
+  -- Now we've checked __all__ the locks for this queue the could
+  -- have expired, and are no more than the number requested. If
+  -- we still need values in order to meet the demand, then we
+  -- should check if any scheduled items, and if so, we should
+  -- insert them to ensure correctness when pulling off the next
+  -- unit of work. Since peek doesn't take them, waiting workers are told.
+  self:signal(self:check_scheduled(now, count - #jids))
+
+  -- With these in place, we can expand this list of jids based on the work
+  -- queue itself and the priorities therein
+  local per_key = tonumber(
+    Qless.config.get(self.name .. '-max-concurrency-per-key', 0))
+  if per_key > 0 then
+    table.extend(jids, self:concurrency_peek(count - #jids, per_key))
+  else
+    table.extend(jids, self.work.peek(count - #jids))
+  end
+
+  return jids
+end
+
+-- Return true if this queue is paused
+function QlessQueue:paused()
+  return redis.call('sismember', 'ql:paused_queues', self.name) == 1
+end
+
+-- Pause this queue
+--
+-- Note: long term, we have discussed adding a rate-limiting
+-- feature to qless-core, which would be more flexible and
+-- could be used for pausing (i.e. pause = set the rate to 0).
+-- For now, this is far simpler, but we should rewrite this
+-- in terms of the rate limiting feature if/when that is added.
+function QlessQueue.pause(now, ...)
+  redis.call('sadd', 'ql:paused_queues', unpack(arg))
+end
+
+-- Unpause this queue
+function QlessQueue.unpause(...)
+  redis.call('srem', 'ql:paused_queues', unpack(arg))
+end
+
+-- Checks for expired locks, scheduled and recurring jobs, returning any
+-- jobs that are ready to be processes
+function QlessQueue:pop(now, worker, count, klasses)
+  assert(worker, 'Pop(): Arg "worker" missing')
+  count = assert(tonumber(count),
+    'Pop(): Arg "count" missing or not a number: ' .. tostring(count))
+
+  -- We should find the heartbeat interval for this queue heartbeat
+  local expires = now + tonumber(
+    Qless.config.get(self.name .. '-heartbeat') or
+    Qless.config.get('heartbeat', 60))
+
+  -- If this queue is paused, then return no jobs
+  if self:paused() then
+    return {}
+  end
+
+  -- Make sure we this worker to the list of seen workers
+  redis.call('zadd', 'ql:workers', now, worker)
+
+  -- Check our max concurrency, and limit the count
+  local max_concurrency = tonumber(
+    Qless.config.get(self.name .. '-max-concurrency', 0))
+
+  if max_concurrency > 0 then
+    -- Allow at most max_concurrency - #running
+    local allowed = math.max(0, max_concurrency - self.locks.running(now))
+    count = math.min(allowed, count)
+    if count == 0 then
+      return {}
+    end
+  end
+
+  local jids = self:invalidate_locks(now, count, klasses)
+  -- Now we've checked __all__ the locks for this queue the could
+  -- have expired, and are no more than the number requested.
+
+  -- If we still need jobs in order to meet demand, then we should
+  -- look for all the recurring jobs that need jobs run
+  self:check_recurring(now, count - #jids)
+
+  -- If we still need values in order to meet the demand, then we
+  -- should check if any scheduled items, and if so, we should
+  -- insert them to ensure correctness when pulling off the next
+  -- unit of work.
+  local ready = self:check_scheduled(now, count - #jids)
+
+  -- With these in place, we can expand this list of jids based on the work
+  -- queue itself and the priorities therein
+  local invalidated = #jids
+  local per_key = tonumber(
+    Qless.config.get(self.name .. '-max-concurrency-per-key', 0))
+  if per_key > 0 then
+    table.extend(jids, self:concurrency_peek(count - #jids, per_key, klasses))
+  else
+    table.extend(jids, self.work.peek(count - #jids, klasses))
+  end
+
+  -- Scheduled jobs this pop passed over, for their klass or concurrency key,
+  -- are left waiting for other workers
+  self:signal(ready - (#jids - invalidated))
+
+  local state
+  for index, jid in ipairs(jids) do
+    local job = Qless.job(jid)
+    state = unpack(job:data('state'))
+    job:history(now, 'popped', {worker = worker}, self.name)
+
+    -- Update the wait time statistics
+    local time = tonumber(
+      redis.call('hget', QlessJob.ns .. jid, 'time') or now)
+    local waiting = now - time
+    self:stat(now, 'wait', waiting)
+    redis.call('hset', QlessJob.ns .. jid,
+      'time', string.format("%.20f", now))
+
+    -- Add this job to the list of jobs handled by this worker
+    redis.call('zadd', 'ql:w:' .. worker .. ':jobs', expires, jid)
+
+    -- Update the jobs data, and add its locks, and return the job
+    job:update({
+      worker  = worker,
+      expires = expires,
+      state   = 'running'
+    })
+
+    self.locks.add(expires, jid)
+
+    local tracked = redis.call('zscore', 'ql:tracked', jid) ~= false
+    if tracked then
+      Qless.publish('popped', jid)
+    end
+  end
+
+  -- If we are returning any jobs, then we should remove them from the work
+  -- queue
+  self.work.remove(unpack(jids))
+
+  return jids
+end
+
+-- Like `work.peek`, but only for jobs of the provided klasses. The first
+-- `count` jobs of each klass's work set are merged in the order they'd have
+-- in the queue's work set.
+function QlessQueue:peek_klasses(count, klasses)
+  local seen = {}
+  local found = {}
+  local candidates = {}
+  for _, klass in ipairs(klasses) do
+    if not seen[klass] then
+      seen[klass] = true
+      local reply = redis.call('zrevrange', self:prefix('work-' .. klass),
+        0, count - 1, 'withscores')
+      for i = 1, #reply, 2 do
+        found[reply[i]] = true
+        table.insert(candidates,
+          {jid = reply[i], score = tonumber(reply[i + 1])})
+      end
+    end
+  end
+
+  -- Jobs that were waiting before the klass work sets were kept may be missing
+  -- from them until `reindex` is done, so the top of the work set is checked
+  -- for them as well
+  if not self:indexed() then
+    local limit = tonumber(Qless.config.get('pop-scan-limit', 100))
+    local reply = redis.call('zrevrange', self:prefix('work'),
+      0, count + limit - 1, 'withscores')
+    for i = 1, #reply, 2 do
+      local klass = redis.call('hget', QlessJob.ns .. reply[i], 'klass')
+      if not found[reply[i]] and klass and seen[klass] then
+        table.insert(candidates,
+          {jid = reply[i], score = tonumber(reply[i + 1])})
+      end
+    end
+  end
+
+  -- Ties are broken the same way zrevrange breaks them
+  table.sort(candidates, function(a, b)
+    if a.score ~= b.score then
+      return a.score > b.score
+    end
+    return a.jid > b.jid
+  end)
+
+  local jids = {}
+  for i = 1, math.min(count, #candidates) do
+    table.insert(jids, candidates[i].jid)
+  end
+  return jids
+end
+
+-- Whether every job in the work set is also in the work set of its klass
+function QlessQueue:indexed()
+  return redis.call('exists', self:prefix('klass-indexed')) == 1
+end
+
+-- Add up to `budget` jobs of the work set (100 by default) to the work sets
+-- of their klasses, for jobs that were waiting before those were kept. It
+-- scans the work set with a ZSCAN cursor: start with 0, and pass back the
+-- returned cursor until it's 0 again, when the queue is marked as indexed.
+function QlessQueue:reindex(budget, cursor)
+  budget = assert(tonumber(budget or 100),
+    'Reindex(): Arg "budget" not a number: ' .. tostring(budget))
+  cursor = assert(tonumber(cursor or 0),
+    'Reindex(): Arg "cursor" not a number: ' .. tostring(cursor))
+
+  local reply = redis.call('zscan', self:prefix('work'), cursor,
+    'count', budget)
+  local jids = reply[2]
+  for i = 1, #jids, 2 do
+    local klass = redis.call('hget', QlessJob.ns .. jids[i], 'klass')
+    if klass then
+      redis.call('zadd', self:prefix('work-' .. klass), jids[i + 1], jids[i])
+    end
+  end
+
+  cursor = tonumber(reply[1])
+  if cursor == 0 then
+    redis.call('set', self:prefix('klass-indexed'), 1)
+  end
+  return cursor
+end
+
+-- Update the number of running jobs that share a job's concurrency key, if
+-- it has one. Counters are made the first time a key is used, and deleted
+-- when no jobs with that key are running.
+function QlessQueue:concurrency(jid, delta)
+  local key = redis.call('hget', QlessJob.ns .. jid, 'concurrency_key')
+  if key then
+    local running = redis.call(
+      'hincrby', self:prefix('concurrency'), key, delta)
+    if running <= 0 then
+      redis.call('hdel', self:prefix('concurrency'), key)
+    end
+  end
+end
+
+-- Like `work.peek`, but passes over jobs whose concurrency key already has
+-- `limit` jobs running, counting those that'll be popped along with them. At
+-- most `pop-scan-limit` jobs past the `count` wanted are looked at, so a
+-- queue full of saturated keys can't make pop scan the whole work set.
+function QlessQueue:concurrency_peek(count, limit, klasses)
+  if count <= 0 then
+    return {}
+  end
+
+  local scan = tonumber(Qless.config.get('pop-scan-limit', 100))
+  local jids = {}
+  local taken = {}
+  for _, jid in ipairs(self.work.peek(count + scan, klasses)) do
+    local key = redis.call('hget', QlessJob.ns .. jid, 'concurrency_key')
+    if key then
+      if not taken[key] then
+        taken[key] = tonumber(redis.call(
+          'hget', self:prefix('concurrency'), key) or 0)
+      end
+      if taken[key] < limit then
+        taken[key] = taken[key] + 1
+        table.insert(jids, jid)
+      end
+    else
+      table.insert(jids, jid)
+    end
+
+    if #jids >= count then
+      break
+    end
+  end
+  return jids
+end
+
+-- PopMulti(now, worker, count, queues, mode)
+-- ------------------------------------------
+-- Pop up to `count` jobs from across several queues, each popped just as
+-- `pop` would, so their pause state, `max-concurrency` and heartbeat settings
+-- all apply. With the `priority` mode (the default), the queues are served in
+-- the order they're listed, and a queue is only popped from when those
+-- before it can't fill the count. With the `weighted` mode, the count is
+-- shared between the queues by their `<queue>-weight` setting (default 1),
+-- and whatever a queue can't fill is offered to the others in order.
+function QlessQueue.pop_multi(now, worker, count, queues, mode)
+  assert(worker, 'PopMulti(): Arg "worker" missing')
+  count = assert(tonumber(count),
+    'PopMulti(): Arg "count" missing or not a number: ' .. tostring(count))
+  assert(#queues > 0, 'PopMulti(): No queues provided')
+  mode = mode or 'priority'
+  assert(mode == 'priority' or mode == 'weighted',
+    'PopMulti(): Arg "mode" must be "priority" or "weighted": ' ..
+    tostring(mode))
+
+  -- How many jobs we've asked each queue for, and whether it gave them all
+  local shares = {}
+  local exhausted = {}
+  for i = 1, #queues do shares[i] = 0 end
+
+  if mode == 'weighted' then
+    local weights = {}
+    local total = 0
+    for i, name in ipairs(queues) do
+      weights[i] = assert(tonumber(Qless.config.get(name .. '-weight', 1)),
+        'PopMulti(): Weight for ' .. name .. ' not a number')
+      weights[i] = math.max(weights[i], 0)
+      total = total + weights[i]
+    end
+
+    -- Hand out each job in turn, at points spread evenly along the weights.
+    -- The points start somewhere different each second, so that queues with
+    -- small weights get their share over successive pops even when the
+    -- count is small.
+    if total > 0 then
+      local golden = 0.6180339887498949
+      for n = 1, count do
+        local point = ((math.floor(now) + n) * golden) % 1 * total
+        for i = 1, #queues do
+          point = point - weights[i]
+          if point < 0 or i == #queues then
+            shares[i] = shares[i] + 1
+            break
+          end
+        end
+      end
+    end
+  else
+    shares[1] = count
+  end
+
+  local jids = {}
+  local pop_from = function(i, share)
+    local queue = Qless.queue(queues[i])
+    local found = queue:pop(now, worker, share)
+    if #found < share then
+      exhausted[i] = true
+    end
+    table.extend(jids, found)
+  end
+
+  for i = 1, #queues do
+    if shares[i] > 0 then
+      pop_from(i, shares[i])
+    end
+  end
+
+  -- And now offer whatever is left over to the queues in order
+  for i = 1, #queues do
+    if #jids >= count then
+      break
+    end
+    if not exhausted[i] then
+      pop_from(i, count - #jids)
+    end
+  end
+
+  return jids
+end
+
+-- The names of the histogram's buckets, in the order that they're reported
+-- by `stats`. The histogram of each day's bin is kept as an array of unsigned
+-- 32-bit big-endian counters, in this order, in the string key
+-- `ql:s:<stat>:<bin>:<queue>-histogram`.
+QlessQueue.histokeys = {
+  's0','s1','s2','s3','s4','s5','s6','s7','s8','s9','s10','s11','s12','s13','s14','s15','s16','s17','s18','s19','s20','s21','s22','s23','s24','s25','s26','s27','s28','s29','s30','s31','s32','s33','s34','s35','s36','s37','s38','s39','s40','s41','s42','s43','s44','s45','s46','s47','s48','s49','s50','s51','s52','s53','s54','s55','s56','s57','s58','s59',
+  'm1','m2','m3','m4','m5','m6','m7','m8','m9','m10','m11','m12','m13','m14','m15','m16','m17','m18','m19','m20','m21','m22','m23','m24','m25','m26','m27','m28','m29','m30','m31','m32','m33','m34','m35','m36','m37','m38','m39','m40','m41','m42','m43','m44','m45','m46','m47','m48','m49','m50','m51','m52','m53','m54','m55','m56','m57','m58','m59',
+  'h1','h2','h3','h4','h5','h6','h7','h8','h9','h10','h11','h12','h13','h14','h15','h16','h17','h18','h19','h20','h21','h22','h23',
+  'd1','d2','d3','d4','d5','d6'
+}
+
+-- The 0-based index of the histogram bucket for a value in seconds, or nil
+-- if the histogram doesn't cover it
+function QlessQueue.histogram_index(val)
+  val = math.floor(val)
+  if val < 0 then
+    return nil
+  elseif val < 60 then -- seconds
+    return val
+  elseif val < 3600 then -- minutes
+    return 59 + math.floor(val / 60)
+  elseif val < 86400 then -- hours
+    return 118 + math.floor(val / 3600)
+  elseif val < 7 * 86400 then -- days
+    return 141 + math.floor(val / 86400)
+  end
+end
+
+-- Read all the counters of the histogram stored at `key`
+function QlessQueue.histogram_counts(key)
+  local packed = redis.call('get', key) or ''
+  local counts = {}
+  for i = 1, #QlessQueue.histokeys do
+    local a, b, c, d = string.byte(packed, 4 * i - 3, 4 * i)
+    table.insert(counts,
+      (((a or 0) * 256 + (b or 0)) * 256 + (c or 0)) * 256 + (d or 0))
+  end
+  return counts
+end
+
+-- Add to the counters of the histogram stored at `key`. `increments` maps
+-- each 0-based bucket index to how much to add, and `order` lists the
+-- indexes to update. Servers without BITFIELD update each counter in turn.
+function QlessQueue.histogram_add(key, increments, order)
+  if #order == 0 then
+    return
+  end
+
+  if Qless.can_bitfield ~= false then
+    local args = {'OVERFLOW', 'SAT'}
+    for _, index in ipairs(order) do
+      table.insert(args, 'INCRBY')
+      table.insert(args, 'u32')
+      table.insert(args, '#' .. index)
+      table.insert(args, increments[index])
+    end
+    local reply = redis.pcall('bitfield', key, unpack(args))
+    if type(reply) ~= 'table' or not reply.err then
+      Qless.can_bitfield = true
+      return
+    end
+    Qless.can_bitfield = false
+  end
+
+  for _, index in ipairs(order) do
+    local offset = 4 * index
+    local a, b, c, d = string.byte(
+      redis.call('getrange', key, offset, offset + 3), 1, 4)
+    local value = math.min(4294967295,
+      (((a or 0) * 256 + (b or 0)) * 256 + (c or 0)) * 256 + (d or 0) +
+      increments[index])
+    redis.call('setrange', key, offset, string.char(
+      math.floor(value / 16777216) % 256,
+      math.floor(value / 65536) % 256,
+      math.floor(value / 256) % 256,
+      value % 256))
+  end
+end
+
+-- Update the stats for this queue
+function QlessQueue:stat(now, stat, val)
+  return self:stat_many(now, stat, {val})
+end
+
+-- Update the stats for this queue with several values at once, reading and
+-- writing the summary and each histogram bin only once
+function QlessQueue:stat_many(now, stat, vals)
+  if #vals == 0 then
+    return
+  end
+
+  -- The bin is midnight of the provided day
+  local bin = now - (now % 86400)
+  local key = 'ql:s:' .. stat .. ':' .. bin .. ':' .. self.name
+
+  -- Get the current data
+  local count, mean, vk, compact = unpack(
+    redis.call('hmget', key, 'total', 'mean', 'vk', 'compact'))
+
+  -- If there isn't any data there presently, then we must initialize it
+  count = tonumber(count or 0)
+  mean  = tonumber(mean or 0)
+  vk    = tonumber(vk or 0)
+
+  -- Now, update the histogram, counting up how much each bucket changes
+  local increments = {}
+  local order = {}
+  local increment = function(index, by)
+    if not increments[index] then
+      increments[index] = 0
+      table.insert(order, index)
+    end
+    increments[index] = increments[index] + by
+  end
+
+  -- If this bin was started before the histogram was kept compact, then
+  -- move its counts over
+  if count > 0 and not compact then
+    local histogram = redis.call('hmget', key, unpack(QlessQueue.histokeys))
+    for i = 1, #QlessQueue.histokeys do
+      local value = tonumber(histogram[i])
+      if value then
+        increment(i - 1, value)
+      end
+    end
+    redis.call('hdel', key, unpack(QlessQueue.histokeys))
+  end
+
+  for _, val in ipairs(vals) do
+    if count == 0 then
+      mean  = val
+      vk    = 0
+      count = 1
+    else
+      count = count + 1
+      local oldmean = mean
+      mean  = mean + (val - mean) / count
+      vk    = vk + (val - mean) * (val - oldmean)
+    end
+
+    local index = QlessQueue.histogram_index(val)
+    if index then
+      increment(index, 1)
+    end
+  end
+
+  QlessQueue.histogram_add(key .. '-histogram', increments, order)
+  redis.call('hmset', key,
+    'total', count, 'mean', mean, 'vk', vk, 'compact', 1)
+end
+
+-- Put(now, jid, klass, data, delay,
+--     [priority, p],
+--     [tags, t],
+--     [retries, r],
+--     [depends, '[...]'],
+--     [concurrency_key, k])
+-- -----------------------
+-- Insert a job into the queue with the given priority, tags, delay, klass and
+-- data. Jobs with the same concurrency key run at most
+-- `<queue>-max-concurrency-per-key` at a time in this queue. Putting a job
+-- again with an empty concurrency key clears the one it had.
+function QlessQueue:put(now, worker, jid, klass, raw_data, delay, ...)
+  assert(jid  , 'Put(): Arg "jid" missing')
+  assert(klass, 'Put(): Arg "klass" missing')
+  local data = assert(cjson.decode(raw_data),
+    'Put(): Arg "data" missing or not JSON: ' .. tostring(raw_data))
+  delay = assert(tonumber(delay),
+    'Put(): Arg "delay" not a number: ' .. tostring(delay))
+
+  -- Read in all the optional parameters. All of these must come in pairs, so
+  -- if we have an odd number of extra args, raise an error
+  if #arg % 2 == 1 then
+    error('Odd number of additional args: ' .. tostring(arg))
+  end
+  local options = {}
+  for i = 1, #arg, 2 do options[arg[i]] = arg[i + 1] end
+
+  return self:enqueue(now, worker, jid, klass, raw_data, delay, options)
+end
+
+-- PutMany(now, worker, jobs)
+-- --------------------------
+-- Insert a batch of jobs into the queue. `jobs` is a JSON array of job specs:
+--
+--  [
+--      {
+--          'jid'      : ...,
+--          'klass'    : ...,
+--          'data'     : {...},
+--          # All of these are optional, and mean the same as they do in `put`
+--          'delay'    : 0,
+--          'priority' : 0,
+--          'tags'     : [...],
+--          'retries'  : 5,
+--          'depends'  : [...],
+--          'resources': [...],
+--          'concurrency_key': ...,
+--          'replace'  : 1
+--      }, {
+--          ...
+--      }
+--  ]
+--
+-- Every spec is validated before any job is inserted. The work shared by all
+-- the jobs (registering the queue, checking for tracked jobs, signalling
+-- workers) is done once for the batch. Returns a list with one entry per spec,
+-- holding whatever `put` would have returned for that job.
+function QlessQueue:put_many(now, worker, raw_jobs)
+  assert(raw_jobs, 'PutMany(): Arg "jobs" missing')
+  local jobs = assert(cjson.decode(raw_jobs),
+    'PutMany(): Arg "jobs" not JSON: ' .. tostring(raw_jobs))
+  assert(type(jobs) == 'table',
+    'PutMany(): Arg "jobs" not a JSON array: ' .. tostring(raw_jobs))
+
+  -- Validate everything first, so that a bad spec doesn't leave the batch
+  -- half-inserted, since what's already been written isn't rolled back. That
+  -- includes the queue's history policy, which every job's history uses
+  QlessJob.history_limit(self.name)
+  local specs = {}
+  for i, job in ipairs(jobs) do
+    assert(type(job) == 'table',
+      'PutMany(): Job ' .. i .. ' is not a JSON object')
+    local jid = assert(job.jid, 'PutMany(): Job ' .. i .. ' missing "jid"')
+    assert(type(jid) == 'string' or type(jid) == 'number',
+      'PutMany(): Job ' .. i .. ' "jid" not a string')
+    assert(job.klass, 'PutMany(): Job ' .. jid .. ' missing "klass"')
+    assert(type(job.klass) == 'string',
+      'PutMany(): Job ' .. jid .. ' "klass" not a string')
+
+    local raw_data = job.data
+    if type(raw_data) == 'string' then
+      assert(cjson.decode(raw_data),
+        'PutMany(): Job ' .. jid .. ' "data" not JSON: ' .. raw_data)
+    else
+      raw_data = cjson.encode(raw_data or {})
+    end
+
+    local delay = assert(tonumber(job.delay or 0),
+      'PutMany(): Job ' .. jid .. ' "delay" not a number: ' ..
+      tostring(job.delay))
+
+    local options = {}
+    for _, key in ipairs({'priority', 'retries', 'replace'}) do
+      if job[key] ~= nil then
+        options[key] = assert(tonumber(job[key]),
+          'PutMany(): Job ' .. jid .. ' "' .. key .. '" not a number: ' ..
+          tostring(job[key]))
+      end
+    end
+    for _, key in ipairs({'tags', 'depends'}) do
+      if job[key] ~= nil then
+        assert(type(job[key]) == 'table',
+          'PutMany(): Job ' .. jid .. ' "' .. key .. '" not a JSON array')
+        for _, value in ipairs(job[key]) do
+          assert(type(value) == 'string' or type(value) == 'number',
+            'PutMany(): Job ' .. jid .. ' "' .. key .. '" not all strings')
+        end
+        options[key] = cjson.encode(job[key])
+      end
+    end
+    if job.resources ~= nil then
+      assert(type(job.resources) == 'table', 'PutMany(): Job ' .. jid ..
+        ' "resources" not a JSON array or object')
+      QlessResource.check(QlessResource.weights(job.resources), 'PutMany')
+      options.resources = cjson.encode(job.resources)
+    end
+    if job.concurrency_key ~= nil then
+      options.concurrency_key = tostring(job.concurrency_key)
+    end
+
+    table.insert(specs, {
+      jid      = tostring(jid),
+      klass    = job.klass,
+      raw_data = raw_data,
+      delay    = delay,
+      options  = options
+    })
+  end
+
+  local batch = {
+    jids    = {},
+    ready   = 0,
+    tracked = redis.call('zcard', 'ql:tracked') > 0
+  }
+  local response = {}
+  for _, spec in ipairs(specs) do
+    table.insert(response, self:enqueue(now, worker, spec.jid, spec.klass,
+      spec.raw_data, spec.delay, spec.options, batch))
+  end
+
+  if #batch.jids > 0 then
+    if redis.call('zscore', 'ql:queues', self.name) == false then
+      redis.call('zadd', 'ql:queues', now, self.name)
+    end
+  end
+  self:signal(batch.ready)
+
+  return response
+end
+
+-- CompleteMany(now, worker, jobs)
+-- -------------------------------
+-- Complete a batch of jobs that `worker` is running in this queue. `jobs` is a
+-- JSON array of completions:
+--
+--  [
+--      {
+--          'jid'    : ...,
+--          # All of these are optional, and mean the same as they do in
+--          # `complete`, except that a job without 'data' keeps its own
+--          'data'   : {...},
+--          'next'   : 'queue',
+--          'delay'  : 0,
+--          'depends': [...]
+--      }, {
+--          ...
+--      }
+--  ]
+--
+-- Each job is completed on its own, so one that can't be completed (because
+-- it has been handed to another worker, for instance) doesn't stop the rest.
+-- The run stats, the worker's job list and the inline reaping of old
+-- completed jobs are handled once for the whole batch. Returns a list with
+-- one entry per job, either `{jid, state}` or `{jid, error}`.
+function QlessQueue:complete_many(now, worker, raw_jobs)
+  assert(worker, 'CompleteMany(): Arg "worker" missing')
+  assert(raw_jobs, 'CompleteMany(): Arg "jobs" missing')
+  local jobs = assert(cjson.decode(raw_jobs),
+    'CompleteMany(): Arg "jobs" not JSON: ' .. tostring(raw_jobs))
+  assert(type(jobs) == 'table',
+    'CompleteMany(): Arg "jobs" not a JSON array: ' .. tostring(raw_jobs))
+
+  local batch = {
+    jids    = {},
+    waits   = {},
+    queues  = {},
+    tracked = redis.call('zcard', 'ql:tracked') > 0
+  }
+  local response = {}
+  for i, job in ipairs(jobs) do
+    assert(type(job) == 'table' and job.jid,
+      'CompleteMany(): Job ' .. i .. ' is not a JSON object with a "jid"')
+    local jid = tostring(job.jid)
+
+    -- Without any data, the job keeps the data it has
+    local raw_data = job.data
+    if raw_data ~= nil and type(raw_data) ~= 'string' then
+      raw_data = cjson.encode(raw_data)
+    end
+    local options = {
+      next  = job.next,
+      delay = job.delay
+    }
+    if job.depends ~= nil then
+      options.depends = cjson.encode(job.depends)
+    end
+
+    local ok, result = Qless.attempt(function()
+      return Qless.job(jid):finish(
+        now, worker, self.name, raw_data, options, batch)
+    end)
+    if ok then
+      table.insert(response, {jid = jid, state = result})
+    else
+      table.insert(response, {jid = jid, error = result})
+    end
+  end
+
+  if #batch.jids > 0 then
+    self:stat_many(now, 'run', batch.waits)
+    redis.call('zrem', 'ql:w:' .. worker .. ':jobs', unpack(batch.jids))
+    Qless.gc(now,
+      Qless.config.get('gc-inline-budget', 10) * #batch.jids)
+  end
+
+  return response
+end
+
+-- Do the actual work of putting a job in this queue, with its optional
+-- arguments already collected into `options`. If `batch` is provided, this
+-- job is part of a `put_many`, and the per-batch work is left to the caller.
+function QlessQueue:enqueue(now, worker, jid, klass, raw_data, delay, options,
+  batch)
+  -- Let's see what the old priority and tags were
+  local job = Qless.job(jid)
+  local priority, tags, oldqueue, state, failure, retries, oldworker,
+    concurrency_key = unpack(redis.call('hmget', QlessJob.ns .. jid,
+      'priority', 'tags', 'queue', 'state', 'failure', 'retries', 'worker',
+      'concurrency_key'))
+
+  -- true if empty or anything other than false
+  local replace = assert(tonumber(options['replace'] or 1) ,
+    'Put(): Arg "replace" not a number: ' .. tostring(options['replace']))
+
+  if replace == 0 and state == 'running' then
+    local time_left = self.locks.job_time_left(now, jid)
+    if time_left > 0 then
+      return time_left
+    end
+  end
+
+  -- Sanity check on optional args
+  retries  = assert(tonumber(options['retries']  or retries or 5) ,
+    'Put(): Arg "retries" not a number: ' .. tostring(options['retries']))
+  local oldtags = cjson.decode(tags or '[]')
+  tags     = assert(cjson.decode(options['tags'] or tags or '[]' ),
+    'Put(): Arg "tags" not JSON'          .. tostring(options['tags']))
+  priority = assert(tonumber(options['priority'] or priority or 0),
+    'Put(): Arg "priority" not a number'  .. tostring(options['priority']))
+  local depends = assert(cjson.decode(options['depends'] or '[]') ,
+    'Put(): Arg "depends" not JSON: '     .. tostring(options['depends']))
+  local resources = assert(cjson.decode(options['resources'] or '[]'),
+    'Put(): Arg "resources" not JSON array or object: '     .. tostring(options['resources']))
+  QlessResource.check(QlessResource.weights(resources), 'Put')
+
+  -- If the job has old dependencies, determine which dependencies are
+  -- in the new dependencies but not in the old ones, and which are in the
+  -- old ones but not in the new
+  if #depends > 0 then
+    -- This makes it easier to check if it's in the new list
+    local new = {}
+    for _, d in ipairs(depends) do new[d] = 1 end
+
+    -- Now find what's in the original, but not the new
+    local original = redis.call(
+      'smembers', QlessJob.ns .. jid .. '-dependencies')
+    for _, dep in pairs(original) do
+      if new[dep] == nil or new[dep] == false then
+        -- Remove k as a dependency
+        redis.call('srem', QlessJob.ns .. dep .. '-dependents'  , jid)
+        redis.call('srem', QlessJob.ns .. jid .. '-dependencies', dep)
+      end
+    end
+  end
+
+  -- Send out a log message
+  if batch then
+    table.insert(batch.jids, jid)
+  end
+  Qless.publish('log', cjson.encode({
+    jid   = jid,
+    event = 'put',
+    queue = self.name
+  }))
+
+  -- Update the history to include this new change
+  if state then
+    job:history(now, 'put', {q = self.name}, self.name)
+  else
+    job:start_history(now, 'put', {q = self.name}, self.name)
+  end
+
+  -- If this item was previously in another queue, then we should remove it from there
+  if oldqueue then
+    local queue_obj = Qless.queue(oldqueue)
+    queue_obj.work.remove(jid)
+    queue_obj.locks.remove(jid)
+    queue_obj.depends.remove(jid)
+    queue_obj.scheduled.remove(jid)
+  end
+
+  -- If this had previously been given out to a worker, make sure to remove it
+  -- from that worker's jobs
+  if oldworker and oldworker ~= '' then
+    redis.call('zrem', 'ql:w:' .. oldworker .. ':jobs', jid)
+    -- If it's a different worker that's putting this job, send a notification
+    -- to the last owner of the job
+    if oldworker ~= worker then
+      -- We need to inform whatever worker had that job
+      local encoded = cjson.encode({
+        jid    = jid,
+        event  = 'lock_lost',
+        worker = oldworker
+      })
+      Qless.publish('w:' .. oldworker, encoded)
+      Qless.publish('log', encoded)
+    end
+  end
+
+  -- If the job was previously in the 'completed' state, then we should
+  -- remove it from being enqueued for destructination
+  if state == 'complete' then
+    redis.call('zrem', 'ql:completed', jid)
+  end
+
+  -- Bring the job's entries in the tag sets in line with the tags supplied,
+  -- leaving alone those it already had
+  Qless.retag(now, jid, oldtags, tags)
+
+  -- If we're in the failed state, remove all of our data
+  if state == 'failed' then
+    failure = cjson.decode(failure)
+    -- We need to make this remove it from the failed queues
+    Qless.remove_failures(failure.group, jid)
+    -- The bin is midnight of the provided day
+    -- 24 * 60 * 60 = 86400
+    local bin = failure.when - (failure.when % 86400)
+    -- We also need to decrement the stats about the queue on
+    -- the day that this failure actually happened.
+    redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. self.name, 'failed'  , -1)
+  end
+
+  -- First, let's save its data
+  redis.call('hmset', QlessJob.ns .. jid,
+    'jid'      , jid,
+    'klass'    , klass,
+    'data'     , raw_data,
+    'priority' , priority,
+    'tags'     , cjson.encode(tags),
+    'resources', cjson.encode(resources),
+    'state'    , ((delay > 0) and 'scheduled') or 'waiting',
+    'worker'   , '',
+    'expires'  , 0,
+    'queue'    , self.name,
+    'retries'  , retries,
+    'remaining', retries,
+    'time'     , string.format("%.20f", now))
+  -- An empty concurrency key clears the one the job had, and leaving it out
+  -- keeps it. The job isn't running by now, so it's not in any counts.
+  concurrency_key = options['concurrency_key'] or concurrency_key
+  if concurrency_key and concurrency_key ~= '' then
+    redis.call('hset', QlessJob.ns .. jid, 'concurrency_key', concurrency_key)
+  else
+    redis.call('hdel', QlessJob.ns .. jid, 'concurrency_key')
+  end
+
+  -- These are the jids we legitimately have to wait on
+  for i, j in ipairs(depends) do
+    -- Make sure it's something other than 'nil' or complete.
+    local state = redis.call('hget', QlessJob.ns .. j, 'state')
+    if (state and state ~= 'complete') then
+      redis.call('sadd', QlessJob.ns .. j .. '-dependents'  , jid)
+      redis.call('sadd', QlessJob.ns .. jid .. '-dependencies', j)
+    end
+  end
+
+  -- Now, if a delay was provided, and if it's in the future,
+  -- then we'll have to schedule it. Otherwise, we're just
+  -- going to add it to the work queue.
+  local ready = false
+  if delay > 0 then
+    if redis.call('scard', QlessJob.ns .. jid .. '-dependencies') > 0 then
+      -- We've already put it in 'depends'. Now, we must just save the data
+      -- for when it's scheduled
+      self.depends.add(now, jid)
+      redis.call('hmset', QlessJob.ns .. jid,
+        'state', 'depends',
+        'scheduled', now + delay)
+    else
+      self.scheduled.add(now + delay, jid)
+    end
+  else
+    if redis.call('scard', QlessJob.ns .. jid .. '-dependencies') > 0 then
+      self.depends.add(now, jid)
+      redis.call('hset', QlessJob.ns .. jid, 'state', 'depends')
+    elseif next(resources) then
+      if Qless.job(jid):acquire_resources(now) then
+        self.work.add(now, priority, jid)
+        ready = true
+      end
+    else
+      self.work.add(now, priority, jid)
+      ready = true
+    end
+  end
+
+  -- Wake up a worker waiting for work in this queue
+  if ready then
+    if batch then
+      batch.ready = batch.ready + 1
+    else
+      self:signal(1)
+    end
+  end
+
+  -- Lastly, we're going to make sure that this item is in the
+  -- set of known queues. We should keep this sorted by the
+  -- order in which we saw each of these queues
+  if not batch and redis.call('zscore', 'ql:queues', self.name) == false then
+    redis.call('zadd', 'ql:queues', now, self.name)
+  end
+
+  if (not batch or batch.tracked) and
+    redis.call('zscore', 'ql:tracked', jid) ~= false then
+    Qless.publish('put', jid)
+  end
+
+  return jid
+end
+
+-- Move `count` jobs out of the failed state and into this queue
+function QlessQueue:unfail(now, group, count)
+  assert(group, 'Unfail(): Arg "group" missing')
+  count = assert(tonumber(count or 25),
+    'Unfail(): Arg "count" not a number: ' .. tostring(count))
+
+  -- Get up to that many of the oldest jobs, and we'll put them in the
+  -- appropriate queue
+  local key, legacy = Qless.failure_group(group)
+  local jids
+  if legacy then
+    jids = redis.call('lrange', key, -count, -1)
+  else
+    jids = redis.call('zrange', key, 0, count - 1)
+  end
+
+  -- And now set each job's state, and put it into the appropriate queue
+  local toinsert = {}
+  local ready = 0
+  for index, jid in ipairs(jids) do
+    local job = Qless.job(jid)
+    local data = job:data()
+    job:history(now, 'put', {q = self.name}, self.name)
+    redis.call('hmset', QlessJob.ns .. data.jid,
+      'state'    , 'waiting',
+      'worker'   , '',
+      'expires'  , 0,
+      'queue'    , self.name,
+      'remaining', data.retries or 5)
+
+    if #data['resources'] then
+      if job:acquire_resources(now) then
+        self.work.add(now, data.priority, data.jid)
+        ready = ready + 1
+      end
+    else
+      self.work.add(now, data.priority, data.jid)
+      ready = ready + 1
+    end
+  end
+  self:signal(ready)
+
+  -- Remove these jobs from the failed state
+  if #jids > 0 then
+    if legacy then
+      redis.call('ltrim', key, 0, -#jids - 1)
+      for _, jid in ipairs(jids) do
+        redis.call('zrem', key .. '-migrating', jid)
+      end
+    else
+      redis.call('zremrangebyrank', key, 0, #jids - 1)
+    end
+    Qless.removed_failures(group, #jids)
+  end
+
+  return #jids
+end
+
+-- Recur a job of type klass in this queue
+function QlessQueue:recur(now, jid, klass, raw_data, spec, ...)
+  assert(jid  , 'RecurringJob On(): Arg "jid" missing')
+  assert(klass, 'RecurringJob On(): Arg "klass" missing')
+  assert(spec , 'RecurringJob On(): Arg "spec" missing')
+  local data = assert(cjson.decode(raw_data),
+    'RecurringJob On(): Arg "data" not JSON: ' .. tostring(raw_data))
+
+  -- At some point in the future, we may have different types of recurring
+  -- jobs, but for the time being, we only have 'interval'-type jobs
+  if spec == 'interval' then
+    local interval = assert(tonumber(arg[1]),
+      'Recur(): Arg "interval" not a number: ' .. tostring(arg[1]))
+    local offset   = assert(tonumber(arg[2]),
+      'Recur(): Arg "offset" not a number: '   .. tostring(arg[2]))
+    if interval <= 0 then
+      error('Recur(): Arg "interval" must be greater than 0')
+    end
+
+    -- Read in all the optional parameters. All of these must come in
+    -- pairs, so if we have an odd number of extra args, raise an error
+    if #arg % 2 == 1 then
+      error('Odd number of additional args: ' .. tostring(arg))
+    end
+
+    -- Read in all the optional parameters
+    local options = {}
+    for i = 3, #arg, 2 do options[arg[i]] = arg[i + 1] end
+    options.tags = assert(cjson.decode(options.tags or '{}'),
+      'Recur(): Arg "tags" must be JSON string array: ' .. tostring(
+        options.tags))
+    options.priority = assert(tonumber(options.priority or 0),
+      'Recur(): Arg "priority" not a number: ' .. tostring(
+        options.priority))
+    options.retries = assert(tonumber(options.retries  or 0),
+      'Recur(): Arg "retries" not a number: ' .. tostring(
+        options.retries))
+    options.backlog = assert(tonumber(options.backlog  or 0),
+      'Recur(): Arg "backlog" not a number: ' .. tostring(
+        options.backlog))
+    options.resources = assert(cjson.decode(options['resources'] or '[]'),
+      'Recur(): Arg "resources" not JSON array or object: '     .. tostring(options['resources']))
+    QlessResource.check(QlessResource.weights(options.resources), 'Recur')
+
+    local count, old_queue = unpack(redis.call('hmget', 'ql:r:' .. jid, 'count', 'queue'))
+    count = count or 0
+
+    -- If it has previously been in another queue, then we should remove
+    -- some information about it
+    if old_queue then
+      Qless.queue(old_queue).recurring.remove(jid)
+    end
+
+    -- Do some insertions
+    redis.call('hmset', 'ql:r:' .. jid,
+      'jid'     , jid,
+      'klass'   , klass,
+      'data'    , raw_data,
+      'priority', options.priority,
+      'tags'    , cjson.encode(options.tags or {}),
+      'state'   , 'recur',
+      'queue'   , self.name,
+      'type'    , 'interval',
+      -- How many jobs we've spawned from this
+      'count'   , count,
+      'interval', interval,
+      'retries' , options.retries,
+      'backlog' , options.backlog,
+      'resources', cjson.encode(options.resources))
+    -- Now, we should schedule the next run of the job
+    self.recurring.add(now + offset, jid)
+
+    -- Lastly, we're going to make sure that this item is in the
+    -- set of known queues. We should keep this sorted by the
+    -- order in which we saw each of these queues
+    if redis.call('zscore', 'ql:queues', self.name) == false then
+      redis.call('zadd', 'ql:queues', now, self.name)
+    end
+
+    return jid
+  else
+    error('Recur(): schedule type "' .. tostring(spec) .. '" unknown')
+  end
+end
+
+-- Return the length of the queue
+function QlessQueue:length()
+  return  self.locks.length() + self.work.length() + self.scheduled.length()
+end
+
+-------------------------------------------------------------------------------
+-- Housekeeping methods
+-------------------------------------------------------------------------------
+-- Instantiate any recurring jobs that are ready
+function QlessQueue:check_recurring(now, count)
+  -- This is how many jobs we've moved so far
+  local moved = 0
+  -- These are the recurring jobs that need work
+  local r = self.recurring.peek(now, 0, count)
+  for index, jid in ipairs(r) do
+    -- For each of the jids that need jobs scheduled, first
+    -- get the last time each of them was run, and then increment
+    -- it by its interval. While this time is less than now,
+    -- we need to keep putting jobs on the queue
+    local klass, data, priority, tags, retries, interval, backlog, resources = unpack(
+      redis.call('hmget', 'ql:r:' .. jid, 'klass', 'data', 'priority',
+        'tags', 'retries', 'interval', 'backlog', 'resources'))
+    local _tags = cjson.decode(tags)
+    local resources = cjson.decode(resources or '[]')
+    local score = math.floor(tonumber(self.recurring.score(jid)))
+    interval = tonumber(interval)
+
+    -- If the backlog is set for this job, then see if it's been a long
+    -- time since the last pop
+    backlog = tonumber(backlog or 0)
+    if backlog ~= 0 then
+      -- Check how many jobs we could concievably generate
+      local num = ((now - score) / interval)
+      if num > backlog then
+        -- Update the score
+        score = score + (
+          math.ceil(num - backlog) * interval
+        )
+      end
+    end
+
+    -- We're saving this value so that in the history, we can accurately
+    -- reflect when the job would normally have been scheduled
+    while (score <= now) and (moved < count) do
+      local count = redis.call('hincrby', 'ql:r:' .. jid, 'count', 1)
+      moved = moved + 1
+
+      local child_jid = jid .. '-' .. count
+
+      -- Add this job to the list of jobs tagged with whatever tags were
+      -- supplied
+      Qless.retag(now, child_jid, {}, _tags)
+
+      -- First, let's save its data
+      redis.call('hmset', QlessJob.ns .. child_jid,
+        'jid'             , child_jid,
+        'klass'           , klass,
+        'data'            , data,
+        'priority'        , priority,
+        'tags'            , tags,
+        'state'           , 'waiting',
+        'worker'          , '',
+        'expires'         , 0,
+        'queue'           , self.name,
+        'retries'         , retries,
+        'remaining'       , retries,
+        'time'            , string.format("%.20f", score),
+        'spawned_from_jid', jid,
+        'resources', cjson.encode(resources))
+
+      local job = Qless.job(child_jid)
+      job:start_history(score, 'put', {q = self.name}, self.name)
+      
+      -- Now, if a delay was provided, and if it's in the future,
+      -- then we'll have to schedule it. Otherwise, we're just
+      -- going to add it to the work queue.
+
+      local add_job = true
+      if #resources then
+        add_job = job:acquire_resources(score)
+      end
+      if add_job then
+        self.work.add(score, priority, child_jid)
+      end
+      
+      score = score + interval
+      self.recurring.add(score, jid)
+    end
+  end
+end
+
+-- Check for any jobs that have been scheduled, and shovel them onto
+-- the work queue. Afterwards, up to `count` scheduled jobs will be moved
+-- into the work queue, and the number that were is returned. It's up to
+-- callers to `signal` the jobs they don't take themselves.
+function QlessQueue:check_scheduled(now, count)
+  -- zadd is a list of arguments that we'll be able to use to
+  -- insert into the work queue
+  local ready = 0
+  local scheduled = self.scheduled.ready(now, 0, count)
+  for index, jid in ipairs(scheduled) do
+    -- With these in hand, we'll have to go out and find the
+    -- priorities of these jobs, and then we'll insert them
+    -- into the work queue and then when that's complete, we'll
+    -- remove them from the scheduled queue
+    local priority = tonumber(
+      redis.call('hget', QlessJob.ns .. jid, 'priority') or 0)
+    if Qless.job(jid):acquire_resources(now) then
+      self.work.add(now, priority, jid)
+      ready = ready + 1
+    end
+    self.scheduled.remove(jid)
+
+    -- We should also update them to have the state 'waiting'
+    -- instead of 'scheduled'
+    redis.call('hset', QlessJob.ns .. jid, 'state', 'waiting')
+  end
+  return ready
+end
+
+-- Check for and invalidate any locks that have been lost. Returns the
+-- list of jids that have been invalidated
+function QlessQueue:invalidate_locks(now, count, klasses)
+  local jids = {}
+  local expired = self.locks.expired(now, 0, count)
+  -- A worker that only runs some klasses is only handed those jobs
+  if klasses then
+    local allowed = {}
+    for _, klass in ipairs(klasses) do allowed[klass] = true end
+    local filtered = {}
+    for _, jid in ipairs(expired) do
+      if allowed[redis.call('hget', QlessJob.ns .. jid, 'klass')] then
+        table.insert(filtered, jid)
+      end
+    end
+    -- The rest are ready to be handed out to workers for their klasses
+    self:signal(#expired - #filtered)
+    expired = filtered
+  end
+
+  -- Iterate through all the expired locks and add them to the list
+  -- of keys that we'll return
+  for index, jid in ipairs(expired) do
+    -- Remove this job from the jobs that the worker that was running it
+    -- has
+    local worker, failure = unpack(
+      redis.call('hmget', QlessJob.ns .. jid, 'worker', 'failure'))
+    redis.call('zrem', 'ql:w:' .. worker .. ':jobs', jid)
+
+    -- We'll provide a grace period after jobs time out for them to give
+    -- some indication of the failure mode. After that time, however, we'll
+    -- consider the worker dust in the wind
+    local grace_period = tonumber(Qless.config.get('grace-period'))
+
+    -- Whether or not we've already sent a coutesy message
+    local courtesy_sent = tonumber(
+      redis.call('hget', QlessJob.ns .. jid, 'grace') or 0)
+
+    -- If the remaining value is an odd multiple of 0.5, then we'll assume
+    -- that we're just sending the message. Otherwise, it's time to
+    -- actually hand out the work to another worker
+    local send_message = (courtesy_sent ~= 1)
+    local invalidate   = not send_message
+
+    -- If the grace period has been disabled, then we'll do both.
+    if grace_period <= 0 then
+      send_message = true
+      invalidate   = true
+    end
+
+    if send_message then
+      -- This is where we supply a courtesy message and give the worker
+      -- time to provide a failure message
+      if redis.call('zscore', 'ql:tracked', jid) ~= false then
+        Qless.publish('stalled', jid)
+      end
+      Qless.job(jid):history(now, 'timed-out', nil, self.name)
+      redis.call('hset', QlessJob.ns .. jid, 'grace', 1)
+
+      -- Send a message to let the worker know that its lost its lock on
+      -- the job
+      local encoded = cjson.encode({
+        jid    = jid,
+        event  = 'lock_lost',
+        worker = worker
+      })
+      Qless.publish('w:' .. worker, encoded)
+      Qless.publish('log', encoded)
+      self.locks.add(now + grace_period, jid)
+
+      -- If we got any expired locks, then we should increment the
+      -- number of retries for this stage for this bin. The bin is
+      -- midnight of the provided day
+      local bin = now - (now % 86400)
+      redis.call('hincrby',
+        'ql:s:stats:' .. bin .. ':' .. self.name, 'retries', 1)
+    end
+
+    if invalidate then
+      -- Unset the grace period attribute so that next time we'll send
+      -- the grace period
+      redis.call('hdel', QlessJob.ns .. jid, 'grace', 0)
+
+      -- See how many remaining retries the job has
+      local remaining = tonumber(redis.call(
+        'hincrby', QlessJob.ns .. jid, 'remaining', -1))
+
+      -- This is where we actually have to time out the work
+      if remaining < 0 then
+        Qless.job(jid):release_resources(now)
+
+        -- Now remove the instance from the schedule, and work queues
+        -- for the queue it's in
+        self.work.remove(jid)
+        self.locks.remove(jid)
+        self.scheduled.remove(jid)
+
+        local group = 'failed-retries-' .. Qless.job(jid):data()['queue']
+        local job = Qless.job(jid)
+        job:history(now, 'failed', {group = group}, self.name)
+        redis.call('hmset', QlessJob.ns .. jid, 'state', 'failed',
+          'worker', '',
+          'expires', '')
+        -- If the failure has not already been set, then set it
+        redis.call('hset', QlessJob.ns .. jid,
+        'failure', cjson.encode({
+          ['group']   = group,
+          ['message'] =
+            'Job exhausted retries in queue "' .. self.name .. '"',
+          ['when']    = now,
+          ['worker']  = unpack(job:data('worker'))
+        }))
+
+        -- Add this particular instance to the failed types
+        Qless.add_failure(group, jid, now)
+
+        if redis.call('zscore', 'ql:tracked', jid) ~= false then
+          Qless.publish('failed', jid)
+        end
+        Qless.publish('log', cjson.encode({
+          jid     = jid,
+          event   = 'failed',
+          group   = group,
+          worker  = worker,
+          message =
+            'Job exhausted retries in queue "' .. self.name .. '"'
+        }))
+
+        -- Increment the count of the failed jobs
+        local bin = now - (now % 86400)
+        redis.call('hincrby',
+          'ql:s:stats:' .. bin .. ':' .. self.name, 'failures', 1)
+        redis.call('hincrby',
+          'ql:s:stats:' .. bin .. ':' .. self.name, 'failed'  , 1)
+      else
+        table.insert(jids, jid)
+      end
+    end
+  end
+
+  return jids
+end
+
+-- Forget the provided queues. As in, remove them from the list of known queues
+function QlessQueue.deregister(...)
+  redis.call('zrem', Qless.ns .. 'queues', unpack(arg))
+end
+
+-- Return information about a particular queue, or all queues
+--  [
+--      {
+--          'name': 'testing',
+--          'stalled': 2,
+--          'waiting': 5,
+--          'running': 5,
+--          'scheduled': 10,
+--          'depends': 5,
+--          'recurring': 0
+--      }, {
+--          ...
+--      }
+--  ]
+--
+-- The sizes of the queue's sets are read from its counters, so this doesn't
+-- move any scheduled jobs. Those that are due are reported as waiting, since
+-- that's where the next pop or peek will put them.
+function QlessQueue.counts(now, name)
+  if name then
+    local queue = Qless.queue(name)
+    local counts = queue:counters()
+    local stalled = queue.locks.length(now)
+    local ready = redis.call('zcount', queue:prefix('scheduled'), 0, now)
+    return {
+      name      = name,
+      waiting   = counts.waiting + ready,
+      stalled   = stalled,
+      running   = counts.running - stalled,
+      scheduled = counts.scheduled - ready,
+      depends   = counts.depends,
+      recurring = counts.recurring,
+      paused    = queue:paused()
+    }
+  else
+    local queues = redis.call('zrange', 'ql:queues', 0, -1)
+    local response = {}
+    for index, qname in ipairs(queues) do
+      table.insert(response, QlessQueue.counts(now, qname))
+    end
+    return response
+  end
+end
+
+-- The counts of a page of the known queues, in the order they were first seen
+function QlessQueue.list(now, offset, count)
+  offset = assert(tonumber(offset or 0),
+    'List(): Arg "offset" not a number: ' .. tostring(offset))
+  count = assert(tonumber(count or 25),
+    'List(): Arg "count" not a number: ' .. tostring(count))
+  local response = {}
+  for index, qname in ipairs(redis.call(
+    'zrange', 'ql:queues', offset, offset + count - 1)) do
+    table.insert(response, QlessQueue.counts(now, qname))
+  end
+  return response
+end
+
+-- The number of jobs in each of this queue's sets is kept in the hash
+-- `ql:q:<name>-counts`, and updated by the accessors as jobs are added and removed.
+QlessQueue.counter_names = {
+  'waiting', 'running', 'scheduled', 'depends', 'recurring'}
+
+-- Adjust one of this queue's counters. A queue without counters, like one
+-- from before they were kept, is recounted instead. That count already
+-- includes the change being made, so there's nothing left to add.
+function QlessQueue:count(name, delta)
+  if delta == 0 then
+    return
+  end
+  if not self.counted then
+    self.counted = true
+    if redis.call('exists', self:prefix('counts')) == 0 then
+      self:recount()
+      return
+    end
+  end
+  redis.call('hincrby', self:prefix('counts'), name, delta)
+end
+
+-- Read this queue's counters, or the sizes of its sets if it hasn't got any
+function QlessQueue:counters()
+  local values = redis.call(
+    'hmget', self:prefix('counts'), unpack(QlessQueue.counter_names))
+  if not values[1] then
+    return self:sizes()
+  end
+  local counts = {}
+  for index, name in ipairs(QlessQueue.counter_names) do
+    counts[name] = tonumber(values[index] or 0)
+  end
+  return counts
+end
+
+-- The number of jobs in each of this queue's sets
+function QlessQueue:sizes()
+  return {
+    waiting   = self.work.length(),
+    running   = self.locks.length(),
+    scheduled = self.scheduled.length(),
+    depends   = self.depends.length(),
+    recurring = self.recurring.length()
+  }
+end
+
+-- Set this queue's counters from the sizes of its sets
+function QlessQueue:recount()
+  local counts = self:sizes()
+  local args = {}
+  for _, name in ipairs(QlessQueue.counter_names) do
+    table.insert(args, name)
+    table.insert(args, counts[name])
+  end
+  redis.call('hmset', self:prefix('counts'), unpack(args))
+  self.counted = true
+  return counts
+end
+-- Get all the attributes of this particular job
+function QlessRecurringJob:data()
+  local job = redis.call(
+    'hmget', 'ql:r:' .. self.jid, 'jid', 'klass', 'state', 'queue',
+    'priority', 'interval', 'retries', 'count', 'data', 'tags', 'backlog')
+
+  if not job[1] then
+    return nil
+  end
+
+  return {
+    jid          = job[1],
+    klass        = job[2],
+    state        = job[3],
+    queue        = job[4],
+    priority     = tonumber(job[5]),
+    interval     = tonumber(job[6]),
+    retries      = tonumber(job[7]),
+    count        = tonumber(job[8]),
+    data         = job[9],
+    tags         = cjson.decode(job[10]),
+    backlog      = tonumber(job[11] or 0)
+  }
+end
+
+-- Update the recurring job data. Key can be:
+--      - priority
+--      - interval
+--      - retries
+--      - data
+--      - klass
+--      - queue
+--      - backlog
+function QlessRecurringJob:update(now, ...)
+  local options = {}
+  -- Make sure that the job exists
+  if redis.call('exists', 'ql:r:' .. self.jid) ~= 0 then
+    for i = 1, #arg, 2 do
+      local key = arg[i]
+      local value = arg[i+1]
+      assert(value, 'No value provided for ' .. tostring(key))
+      if key == 'priority' or key == 'interval' or key == 'retries' then
+        value = assert(tonumber(value), 'Recur(): Arg "' .. key .. '" must be a number: ' .. tostring(value))
+        -- If the command is 'interval', then we need to update the
+        -- time when it should next be scheduled
+        if key == 'interval' then
+          local queue, interval = unpack(redis.call('hmget', 'ql:r:' .. self.jid, 'queue', 'interval'))
+          Qless.queue(queue).recurring.update(
+            value - tonumber(interval), self.jid)
+        end
+        redis.call('hset', 'ql:r:' .. self.jid, key, value)
+      elseif key == 'data' then
+        assert(cjson.decode(value), 'Recur(): Arg "data" is not JSON-encoded: ' .. tostring(value))
+        redis.call('hset', 'ql:r:' .. self.jid, 'data', value)
+      elseif key == 'klass' then
+        redis.call('hset', 'ql:r:' .. self.jid, 'klass', value)
+      elseif key == 'queue' then
+        local queue_obj = Qless.queue(
+          redis.call('hget', 'ql:r:' .. self.jid, 'queue'))
+        local score = queue_obj.recurring.score(self.jid)
+        queue_obj.recurring.remove(self.jid)
+        Qless.queue(value).recurring.add(score, self.jid)
+        redis.call('hset', 'ql:r:' .. self.jid, 'queue', value)
+        -- If we don't already know about the queue, learn about it
+        if redis.call('zscore', 'ql:queues', value) == false then
+          redis.call('zadd', 'ql:queues', now, value)
+        end
+      elseif key == 'backlog' then
+        value = assert(tonumber(value),
+          'Recur(): Arg "backlog" not a number: ' .. tostring(value))
+        redis.call('hset', 'ql:r:' .. self.jid, 'backlog', value)
+      else
+        error('Recur(): Unrecognized option "' .. key .. '"')
+      end
+    end
+    return true
+  else
+    error('Recur(): No recurring job ' .. self.jid)
+  end
+end
+
+-- Tags this recurring job with the provided tags
+function QlessRecurringJob:tag(...)
+  local tags = redis.call('hget', 'ql:r:' .. self.jid, 'tags')
+  -- If the job has been canceled / deleted, then return false
+  if tags then
+    -- Decode the json blob, convert to dictionary
+    tags = cjson.decode(tags)
+    local _tags = {}
+    for i,v in ipairs(tags) do _tags[v] = true end
+
+    -- Otherwise, add the job to the sorted set with that tags
+    for i=1,#arg do if _tags[arg[i]] == nil or _tags[arg[i]] == false then table.insert(tags, arg[i]) end end
+
+    tags = cjson.encode(tags)
+    redis.call('hset', 'ql:r:' .. self.jid, 'tags', tags)
+    return tags
+  else
+    error('Tag(): Job ' .. self.jid .. ' does not exist')
+  end
+end
+
+-- Removes a tag from the recurring job
+function QlessRecurringJob:untag(...)
+  -- Get the existing tags
+  local tags = redis.call('hget', 'ql:r:' .. self.jid, 'tags')
+  -- If the job has been canceled / deleted, then return false
+  if tags then
+    -- Decode the json blob, convert to dictionary
+    tags = cjson.decode(tags)
+    local _tags    = {}
+    -- Make a hash
+    for i,v in ipairs(tags) do _tags[v] = true end
+    -- Delete these from the hash
+    for i = 1,#arg do _tags[arg[i]] = nil end
+    -- Back into a list
+    local results = {}
+    for i, tag in ipairs(tags) do if _tags[tag] then table.insert(results, tag) end end
+    -- json encode them, set, and return
+    tags = cjson.encode(results)
+    redis.call('hset', 'ql:r:' .. self.jid, 'tags', tags)
+    return tags
+  else
+    error('Untag(): Job ' .. self.jid .. ' does not exist')
+  end
+end
+
+-- Stop further occurrences of this job
+function QlessRecurringJob:unrecur()
+  -- First, find out what queue it was attached to
+  local queue = redis.call('hget', 'ql:r:' .. self.jid, 'queue')
+  if queue then
+    -- Now, delete it from the queue it was attached to, and delete the
+    -- thing itself
+    Qless.queue(queue).recurring.remove(self.jid)
+    redis.call('del', 'ql:r:' .. self.jid)
+    return true
+  else
+    return true
+  end
+end
+-- Deregisters these workers from the list of known workers
+function QlessWorker.deregister(...)
+  redis.call('zrem', 'ql:workers', unpack(arg))
+end
+
+-- Renew the locks on a batch of jobs that `worker` is running. `jobs` is a
+-- JSON array of the form:
+--
+--  [
+--      {
+--          'jid' : ...,
+--          # Optional, replaces the job's data as with `heartbeat`
+--          'data': {...}
+--      }, {
+--          ...
+--      }
+--  ]
+--
+-- Returns a list with one entry per job, either `{jid, expires}` or, if the
+-- worker has lost the job, `{jid, error}`
+function QlessWorker.heartbeat(now, worker, raw_jobs)
+  assert(worker, 'HeartbeatMany(): Arg "worker" missing')
+  assert(raw_jobs, 'HeartbeatMany(): Arg "jobs" missing')
+  local jobs = assert(cjson.decode(raw_jobs),
+    'HeartbeatMany(): Arg "jobs" not JSON: ' .. tostring(raw_jobs))
+  assert(type(jobs) == 'table',
+    'HeartbeatMany(): Arg "jobs" not a JSON array: ' .. tostring(raw_jobs))
+
+  local batch = {
+    jobs      = {},
+    locks     = {},
+    queues    = {},
+    intervals = {}
+  }
+  local response = {}
+  for i, job in ipairs(jobs) do
+    assert(type(job) == 'table' and job.jid,
+      'HeartbeatMany(): Job ' .. i .. ' is not a JSON object with a "jid"')
+    local jid = tostring(job.jid)
+
+    local data = job.data
+    if data ~= nil and type(data) ~= 'string' then
+      data = cjson.encode(data)
+    end
+
+    local ok, result = Qless.attempt(function()
+      return Qless.job(jid):heartbeat(now, worker, data, batch)
+    end)
+    if ok then
+      table.insert(response, {jid = jid, expires = result})
+    else
+      table.insert(response, {jid = jid, error = result})
+    end
+  end
+
+  if #batch.jobs > 0 then
+    Qless.zadd('ql:w:' .. worker .. ':jobs', batch.jobs)
+    for _, queue in ipairs(batch.queues) do
+      Qless.queue(queue).locks.add_many(batch.locks[queue])
+    end
+  end
+
+  -- Make sure we this worker to the list of seen workers
+  redis.call('zadd', 'ql:workers', now, worker)
+
+  return response
+end
+
+-- Provide data about all the workers, or if a specific worker is provided,
+-- then which jobs that worker is responsible for. If no worker is provided,
+-- expect a response of the form:
+--
+--  [
+--      # This is sorted by the recency of activity from that worker
+--      {
+--          'name'   : 'hostname1-pid1',
+--          'jobs'   : 20,
+--          'stalled': 0
+--      }, {
+--          ...
+--      }
+--  ]
+--
+-- If a worker id is provided, then expect a response of the form:
+--
+--  {
+--      'jobs': [
+--          jid1,
+--          jid2,
+--          ...
+--      ], 'stalled': [
+--          jid1,
+--          ...
+--      ]
+--  }
+--
+function QlessWorker.counts(now, worker)
+  if worker then
+    return {
+      jobs    = redis.call('zrevrangebyscore', 'ql:w:' .. worker .. ':jobs', now + 8640000, now),
+      stalled = redis.call('zrevrangebyscore', 'ql:w:' .. worker .. ':jobs', now, 0)
+    }
+  else
+    return QlessWorker.list(now)
+  end
+end
+
+-- The counts of a page of the workers that have been seen recently, as in
+-- `counts`, most recently seen first. Workers that haven't been seen in
+-- `max-worker-age` seconds aren't listed, whether or not they've been reaped.
+function QlessWorker.list(now, offset, count)
+  offset = assert(tonumber(offset or 0),
+    'List(): Arg "offset" not a number: ' .. tostring(offset))
+  local interval = tonumber(Qless.config.get('max-worker-age', 86400))
+  local workers
+  if count then
+    count = assert(tonumber(count),
+      'List(): Arg "count" not a number: ' .. tostring(count))
+    workers = redis.call('zrevrangebyscore', 'ql:workers',
+      '+inf', '(' .. (now - interval), 'LIMIT', offset, count)
+  else
+    workers = redis.call('zrevrangebyscore', 'ql:workers',
+      '+inf', '(' .. (now - interval))
+  end
+
+  local response = {}
+  for index, worker in ipairs(workers) do
+    table.insert(response, {
+      name    = worker,
+      jobs    = redis.call('zcount', 'ql:w:' .. worker .. ':jobs', now, now + 8640000),
+      stalled = redis.call('zcount', 'ql:w:' .. worker .. ':jobs', 0, now)
+    })
+  end
+  return response
+end
+
+-- Reap(now, budget)
+-- -----------------
+-- Forget the workers that haven't been seen in `max-worker-age` seconds
+-- (defaulting to the last day), along with their lists of jobs. At most
+-- `budget` workers are reaped, and the number of stale workers that remain is
+-- returned, so that this can be called until it returns 0.
+function QlessWorker.reap(now, budget)
+  budget = assert(tonumber(budget),
+    'Reap(): Arg "budget" not a number: ' .. tostring(budget))
+  local interval = tonumber(Qless.config.get('max-worker-age', 86400))
+
+  local workers = {}
+  if budget > 0 then
+    workers = redis.call('zrangebyscore', 'ql:workers',
+      0, now - interval, 'LIMIT', 0, budget)
+  end
+  -- Remove them in batches, to keep clear of the limit on unpack
+  for i = 1, #workers, 100 do
+    local last = math.min(i + 99, #workers)
+    local keys = {}
+    for index = i, last do
+      table.insert(keys, 'ql:w:' .. workers[index] .. ':jobs')
+    end
+    Qless.unlink(unpack(keys))
+    redis.call('zrem', 'ql:workers', unpack(workers, i, last))
+  end
+
+  return redis.call('zcount', 'ql:workers', 0, now - interval)
+end
+-------------------------------------------------------------------------------
+-- Resource Class
+--
+-- Returns an object that represents a resource with the provided RID
+-------------------------------------------------------------------------------
+
+----
+-- This gets all the data associated with the resource with the provided id. If the
+-- job is not found, it returns nil. If found, it returns an object with the
+-- appropriate properties
+function QlessResource:data(...)
+  local res = redis.call(
+      'hmget', QlessResource.ns .. self.rid, 'rid', 'max')
+
+  -- Return nil if we haven't found it
+  if not res[1] then
+    return nil
+  end
+
+  local data = {
+    rid          = res[1],
+    max          = tonumber(res[2] or 0),
+    used         = self:used(),
+    pending      = redis.call('zrevrange', self:prefix('pending'), 0, -1),
+    locks        = redis.call('smembers', self:prefix('locks')),
+  }
+
+  return data
+end
+
+---
+-- Stats oriented call to view the counts of a single resource with the
+-- provided name or all resource stats.  If a single or all resource are
+-- not found, it returns nil.
+-- @param now
+-- @param name
+--
+function QlessResource:counts(now, rid)
+  if rid then
+    local resource = redis.call(
+      'hmget', QlessResource.ns .. rid, 'rid', 'max', 'used')
+
+    -- Return nil if we haven't found it
+    if not resource[1] then
+      return nil
+    end
+
+    return {
+      rid          = resource[1],
+      max          = tonumber(resource[2] or 0),
+      used         = tonumber(resource[3] or
+        redis.call('scard', QlessResource.ns .. rid .. '-locks')),
+      pending      = redis.call('zcard', QlessResource.ns .. rid .. '-pending'),
+      locks        = redis.call('scard', QlessResource.ns .. rid .. '-locks')
+    }
+  else
+    local resources = redis.call('smembers', 'ql:resources')
+    local response = {}
+    for _, rname in ipairs(resources) do
+      local c = QlessResource:counts(now, rname)
+      response[rname] = {
+        max        = c.max,
+        used       = c.used,
+        pending    = c.pending,
+        locks      = c.locks
+      }
+    end
+
+    return response
+  end
+end
+
+---
+-- A page of the jobs waiting on this resource, in the order in which they'll
+-- be given a lock, along with how many are waiting in total
+-- @param offset
+-- @param count
+--
+function QlessResource:pending(offset, count)
+  offset = assert(tonumber(offset or 0),
+    'Pending(): Arg "offset" not a number: ' .. tostring(offset))
+  count = assert(tonumber(count or 25),
+    'Pending(): Arg "count" not a number: ' .. tostring(count))
+  return {
+    total = redis.call('zcard', self:prefix('pending')),
+    jobs  = redis.call('zrevrange', self:prefix('pending'),
+      offset, offset + count - 1)
+  }
+end
+
+---
+-- A page of the jobs holding a lock on this resource. The locks are kept in
+-- an unordered set, so this pages with an SSCAN cursor rather than an offset:
+-- start with cursor 0, and pass back the returned cursor until it's 0 again.
+-- Like SSCAN, a page may hold more or fewer than `count` jobs.
+-- @param cursor
+-- @param count
+--
+function QlessResource:holders(cursor, count)
+  cursor = assert(tonumber(cursor or 0),
+    'Holders(): Arg "cursor" not a number: ' .. tostring(cursor))
+  count = assert(tonumber(count or 25),
+    'Holders(): Arg "count" not a number: ' .. tostring(count))
+  local reply = redis.call('sscan', self:prefix('locks'), cursor,
+    'count', count)
+  return {
+    total  = redis.call('scard', self:prefix('locks')),
+    cursor = tonumber(reply[1]),
+    jobs   = reply[2]
+  }
+end
+
+function QlessResource:set(now, max)
+  local max = assert(tonumber(max), 'Set(): Arg "max" not a number: ' .. tostring(max))
+
+  redis.call('sadd', 'ql:resources', self.rid)
+  redis.call('hmset', QlessResource.ns .. self.rid, 'rid', self.rid, 'max', max);
+
+  -- If we've just raised the limit, put the new capacity to use right away
+  -- rather than waiting for a release for each slot
+  self:promote(now)
+
+  return self.rid
+end
+
+--- Turns a job's `resources` into a list of {rid, weight} pairs. They may be
+-- given as a list of resource ids, each of which uses a single unit, or as an
+-- object of resource ids to the number of units the job uses.
+-- @param resources -- the decoded resources of a job
+--
+function QlessResource.weights(resources)
+  local weights = {}
+  if #resources > 0 then
+    for _, rid in ipairs(resources) do
+      table.insert(weights, {rid, 1})
+    end
+  else
+    -- Sorted, so that jobs wait on and take their resources in a fixed order
+    local rids = {}
+    for rid, _ in pairs(resources) do
+      table.insert(rids, rid)
+    end
+    table.sort(rids)
+    for _, rid in ipairs(rids) do
+      local weight = tonumber(resources[rid])
+      assert(weight and weight > 0 and weight == math.floor(weight),
+        'Resources(): Weight for "' .. rid .. '" not a positive integer: ' ..
+        tostring(resources[rid]))
+      table.insert(weights, {rid, weight})
+    end
+  end
+  return weights
+end
+
+--- Raises an error unless every one of the {rid, weight} pairs names a
+-- resource that exists. A job may use more units than its resource has for
+-- now, since the limit can be set to zero to hold jobs back, and such a job
+-- waits until the limit is raised to fit it.
+-- @param weights -- from `QlessResource.weights`
+-- @param command -- the name of the command, for the error
+--
+function QlessResource.check(weights, command)
+  for _, res in ipairs(weights) do
+    assert(redis.call('exists', QlessResource.ns .. res[1]) == 1,
+      command .. '(): resource ' .. res[1] .. ' does not exist')
+  end
+end
+
+function QlessResource:unset()
+  redis.call('srem', 'ql:resources', self.rid)
+  return redis.call('del', QlessResource.ns .. self.rid);
+end
+
+function QlessResource:prefix(group)
+  if group then
+    return QlessResource.ns..self.rid..'-'..group
+  end
+
+  return QlessResource.ns..self.rid
+end
+
+--- Whether the job with the provided jid could take a lock on this resource,
+-- either because it already holds one or because there's a free slot.
+-- @param jid
+--
+function QlessResource:available(jid, weight)
+  local keyLocks = self:prefix('locks')
+  -- Only read the limit here rather than all of data(), which would load the
+  -- whole pending and locks sets and make every acquire cost grow with them
+  local max = redis.call('hget', self:prefix(), 'max')
+  assert(max, 'Acquire(): resource ' .. self.rid .. ' does not exist')
+  assert(type(jid) ~= 'table', 'Acquire(): invalid jid')
+
+  -- Don't allow multiple locks on same aquire
+  if redis.call('sismember', keyLocks, jid) == 1 then
+    return true
+  end
+
+  return self:used() + (weight or 1) <= tonumber(max)
+end
+
+--- Takes a lock for the job, and releases it from the pending queue. This
+-- doesn't check the limit, so it's only to be used after `available`.
+-- @param jid
+-- @param weight -- how many units of the resource the job uses
+--
+function QlessResource:acquire(jid, weight)
+  self:used()
+  if redis.call('sadd', self:prefix('locks'), jid) == 1 then
+    -- Remember what was taken, as the job's weight may change before it's
+    -- given back
+    redis.call('hset', self:prefix('units'), jid, weight or 1)
+    redis.call('hincrby', self:prefix(), 'used', weight or 1)
+  end
+  redis.call('zrem', self:prefix('pending'), jid)
+end
+
+--- Adds the job to the pending queue, if it's not already waiting
+-- @param now
+-- @param priority
+-- @param jid
+--
+function QlessResource:wait(now, priority, jid)
+  local pending = redis.call('zscore', self:prefix('pending'), jid)
+  if pending == nil or pending == false then
+    redis.call('zadd', self:prefix('pending'), priority - (now / 10000000000), jid)
+  end
+end
+
+--- Releases the resource for the specified job identifier, giving back the
+-- units it took. The freed slot is handed on by `promote`, which is left to
+-- the caller so that a job giving up several resources can release all of
+-- them first.
+-- @param now
+-- @param jid
+-- @param weight -- the job's weight, for locks taken before units were kept
+--
+function QlessResource:release(now, jid, weight)
+  self:used()
+  if redis.call('srem', self:prefix('locks'), jid) == 1 then
+    local units = redis.call('hget', self:prefix('units'), jid)
+    redis.call('hdel', self:prefix('units'), jid)
+    redis.call('hincrby', self:prefix(), 'used', -(tonumber(units) or weight or 1))
+  end
+  redis.call('zrem', self:prefix('pending'), jid)
+end
+
+--- Returns how many units of this resource are held. Resources locked before
+-- units were tracked have no `used` count, and so it's set from the number of
+-- locks the first time it's needed, each of which held a single unit.
+--
+function QlessResource:used()
+  local used = redis.call('hget', self:prefix(), 'used')
+  if not used then
+    used = redis.call('scard', self:prefix('locks'))
+    if redis.call('exists', self:prefix()) == 1 then
+      redis.call('hset', self:prefix(), 'used', used)
+    end
+  end
+  return tonumber(used)
+end
+
+--- Hands any free capacity to the jobs waiting on this resource, in the order
+-- they're waiting, and moves them into the work sets of their queues. A job
+-- only takes its locks if it can take all of them at once, and so waiters
+-- that are still blocked on another resource are skipped (and left to wait
+-- on that resource instead). At most `resource-scan-limit` waiters are looked
+-- at. Returns the promoted jids.
+-- @param now
+--
+function QlessResource:promote(now)
+  local max = redis.call('hget', self:prefix(), 'max')
+  if not max then
+    return {}
+  end
+
+  local free = tonumber(max) - self:used()
+  if free <= 0 then
+    return {}
+  end
+
+  local promoted = {}
+  local limit = tonumber(Qless.config.get('resource-scan-limit', 100))
+  local jids = redis.call('zrevrange', self:prefix('pending'),
+    0, math.max(free, limit) - 1, 'withscores')
+  for i = 1, #jids, 2 do
+    if self:used() >= tonumber(max) then
+      break
+    end
+
+    local jid, score = jids[i], jids[i + 1]
+    if Qless.job(jid):acquire_resources(now) then
+      table.insert(promoted, jid)
+      local queue = Qless.queue(
+        redis.call('hget', QlessJob.ns .. jid, 'queue'))
+      queue.work.add(score, 0, jid)
+      queue:signal(1)
+    end
+  end
+
+  return promoted
+end
+
+--- Return the number of active locks for this resource
+--
+function QlessResource:locks()
+  return redis.call('scard', self:prefix('locks'))
+end
+
+function QlessResource:exists()
+  return redis.call('exists', self:prefix())
+end
\ No newline at end of file
@@ -0,0 +1,3921 @@
+-- Current SHA: d722b2e0a4d4d1b86e462523416711894b31a115
+-- This is a generated file
+local Qless = {
+  ns = 'ql:'
+}
+
+local QlessQueue = {
+  ns = Qless.ns .. 'q:'
+}
+QlessQueue.__index = QlessQueue
+
+local QlessWorker = {
+  ns = Qless.ns .. 'w:'
+}
+QlessWorker.__index = QlessWorker
+
+local QlessJob = {
+  ns = Qless.ns .. 'j:'
+}
+QlessJob.__index = QlessJob
+
+local QlessRecurringJob = {}
+QlessRecurringJob.__index = QlessRecurringJob
+
+local QlessResource = {
+    ns = Qless.ns .. 'rs:'
+}
+QlessResource.__index = QlessResource;
+
+Qless.config = {}
+
+function table.extend(self, other)
+  for i, v in ipairs(other) do
+    table.insert(self, v)
+  end
+end
+
+function Qless.publish(channel, message)
+  redis.call('publish', Qless.ns .. channel, message)
+end
+
+function Qless.job(jid)
+  assert(jid, 'Job(): no jid provided')
+  local job = {}
+  setmetatable(job, QlessJob)
+  job.jid = jid
+  return job
+end
+
+function Qless.recurring(jid)
+  assert(jid, 'Recurring(): no jid provided')
+  local job = {}
+  setmetatable(job, QlessRecurringJob)
+  job.jid = jid
+  return job
+end
+
+function Qless.resource(rid)
+  assert(rid, 'Resource(): no rid provided')
+  local res = {}
+  setmetatable(res, QlessResource)
+  res.rid = rid
+  return res
+end
+
+function Qless.failed(group, start, limit)
+  start = assert(tonumber(start or 0),
+    'Failed(): Arg "start" is not a number: ' .. (start or 'nil'))
+  limit = assert(tonumber(limit or 25),
+    'Failed(): Arg "limit" is not a number: ' .. (limit or 'nil'))
+
+  if group then
+    local key, legacy = Qless.failure_group(group)
+    if legacy then
+      return {
+        total = redis.call('llen', key),
+        jobs  = redis.call('lrange', key, start, start + limit - 1)
+      }
+    end
+    return {
+      total = redis.call('zcard', key),
+      jobs  = redis.call('zrevrange', key, start, start + limit - 1)
+    }
+  else
+    local response = {}
+    local counts = redis.call('hgetall', 'ql:failure-counts')
+    for i = 1, #counts, 2 do
+      response[counts[i]] = tonumber(counts[i + 1])
+    end
+    if #counts / 2 ~= redis.call('scard', 'ql:failures') then
+      for index, group in ipairs(redis.call('smembers', 'ql:failures')) do
+        if not response[group] then
+          local key, legacy = Qless.failure_group(group)
+          response[group] = legacy and redis.call('llen', key) or
+            redis.call('zcard', key)
+        end
+      end
+    end
+    return response
+  end
+end
+
+function Qless.failed_range(group, from, to, offset, count)
+  assert(group, 'FailedRange(): Arg "group" missing')
+  from = assert(tonumber(from or '-inf'),
+    'FailedRange(): Arg "from" is not a number: ' .. tostring(from))
+  to = assert(tonumber(to or '+inf'),
+    'FailedRange(): Arg "to" is not a number: ' .. tostring(to))
+  offset = assert(tonumber(offset or 0),
+    'FailedRange(): Arg "offset" is not a number: ' .. tostring(offset))
+  count = assert(tonumber(count or 25),
+    'FailedRange(): Arg "count" is not a number: ' .. tostring(count))
+
+  local key, legacy = Qless.failure_group(group)
+  assert(not legacy, 'FailedRange(): Group "' .. group ..
+    '" is still a list, and needs "failed.migrate" first')
+  return {
+    total = redis.call('zcount', key, from, to),
+    jobs  = redis.call('zrevrangebyscore', key, to, from,
+      'LIMIT', offset, count)
+  }
+end
+
+function Qless.failure_group(group)
+  local key = 'ql:f:' .. group
+  return key, redis.call('type', key)['ok'] == 'list'
+end
+
+function Qless.add_failure(group, jid, when)
+  local key, legacy = Qless.failure_group(group)
+  redis.call('sadd', 'ql:failures', group)
+  if legacy then
+    redis.call('hsetnx', 'ql:failure-counts', group, redis.call('llen', key))
+    redis.call('lpush', key, jid)
+    redis.call('hincrby', 'ql:failure-counts', group, 1)
+  elseif redis.call('zadd', key, when, jid) == 1 then
+    redis.call('hincrby', 'ql:failure-counts', group, 1)
+  end
+end
+
+function Qless.removed_failures(group, removed)
+  if removed == 0 then
+    return
+  end
+  local remaining
+  if redis.call('hexists', 'ql:failure-counts', group) == 1 then
+    remaining = redis.call('hincrby', 'ql:failure-counts', group, -removed)
+  else
+    remaining = redis.call('exists', 'ql:f:' .. group)
+  end
+  if remaining <= 0 then
+    redis.call('hdel', 'ql:failure-counts', group)
+    redis.call('srem', 'ql:failures', group)
+  end
+end
+
+function Qless.remove_failures(group, ...)
+  local key, legacy = Qless.failure_group(group)
+  local removed = 0
+  if legacy then
+    for _, jid in ipairs(arg) do
+      removed = removed + redis.call('lrem', key, 0, jid)
+      redis.call('zrem', key .. '-migrating', jid)
+    end
+  else
+    removed = redis.call('zrem', key, unpack(arg))
+  end
+  Qless.removed_failures(group, removed)
+end
+
+function Qless.failed_migrate(now, budget)
+  budget = assert(tonumber(budget or 1000),
+    'FailedMigrate(): Arg "budget" not a number: ' .. tostring(budget))
+
+  local remaining = 0
+  for _, group in ipairs(redis.call('smembers', 'ql:failures')) do
+    local key, legacy = Qless.failure_group(group)
+    if legacy then
+      local migrating = key .. '-migrating'
+      local copied = redis.call('zcard', migrating)
+      local length = redis.call('llen', key)
+      if budget > 0 then
+        local jids = redis.call('lrange', key,
+          -(copied + budget), -(copied + 1))
+        for i = #jids, 1, -100 do
+          local args = {}
+          for j = i, math.max(i - 99, 1), -1 do
+            local failure = redis.call(
+              'hget', QlessJob.ns .. jids[j], 'failure')
+            local when = 0
+            if failure then
+              when = tonumber(cjson.decode(failure)['when']) or 0
+            end
+            table.insert(args, when)
+            table.insert(args, jids[j])
+          end
+          redis.call('zadd', migrating, unpack(args))
+        end
+        budget = budget - #jids
+        copied = redis.call('zcard', migrating)
+      end
+
+      if copied >= length then
+        redis.call('rename', migrating, key)
+        redis.call('hset', 'ql:failure-counts', group, copied)
+      else
+        remaining = remaining + length - copied
+      end
+    end
+  end
+  return remaining
+end
+
+function Qless.jobs(now, state, ...)
+  assert(state, 'Jobs(): Arg "state" missing')
+  if state == 'complete' then
+    local offset = assert(tonumber(arg[1] or 0),
+      'Jobs(): Arg "offset" not a number: ' .. tostring(arg[1]))
+    local count  = assert(tonumber(arg[2] or 25),
+      'Jobs(): Arg "count" not a number: ' .. tostring(arg[2]))
+    return redis.call('zrevrange', 'ql:completed', offset,
+      offset + count - 1)
+  else
+    local name  = assert(arg[1], 'Jobs(): Arg "queue" missing')
+    local offset = assert(tonumber(arg[2] or 0),
+      'Jobs(): Arg "offset" not a number: ' .. tostring(arg[2]))
+    local count  = assert(tonumber(arg[3] or 25),
+      'Jobs(): Arg "count" not a number: ' .. tostring(arg[3]))
+
+    local queue = Qless.queue(name)
+    if state == 'running' then
+      return queue.locks.peek(now, offset, count)
+    elseif state == 'stalled' then
+      return queue.locks.expired(now, offset, count)
+    elseif state == 'scheduled' then
+      queue:signal(queue:check_scheduled(now, queue.scheduled.length()))
+      return queue.scheduled.peek(now, offset, count)
+    elseif state == 'depends' then
+      return queue.depends.peek(now, offset, count)
+    elseif state == 'recurring' then
+      return queue.recurring.peek('+inf', offset, count)
+    else
+      error('Jobs(): Unknown type "' .. state .. '"')
+    end
+  end
+end
+
+function Qless.track(now, command, jid)
+  if command ~= nil then
+    assert(jid, 'Track(): Arg "jid" missing')
+    assert(Qless.job(jid):exists(), 'Track(): Job does not exist')
+    if string.lower(command) == 'track' then
+      Qless.publish('track', jid)
+      return redis.call('zadd', 'ql:tracked', now, jid)
+    elseif string.lower(command) == 'untrack' then
+      Qless.publish('untrack', jid)
+      return redis.call('zrem', 'ql:tracked', jid)
+    else
+      error('Track(): Unknown action "' .. command .. '"')
+    end
+  else
+    local response = {
+      jobs = {},
+      expired = {}
+    }
+    local jids = redis.call('zrange', 'ql:tracked', 0, -1)
+    for index, jid in ipairs(jids) do
+      local data = Qless.job(jid):data()
+      if data then
+        table.insert(response.jobs, data)
+      else
+        table.insert(response.expired, jid)
+      end
+    end
+    return response
+  end
+end
+
+function Qless.tracked(offset, count, fields)
+  offset = assert(tonumber(offset or 0),
+    'Track(): Arg "offset" not a number: ' .. tostring(offset))
+  count  = assert(tonumber(count or 25),
+    'Track(): Arg "count" not a number: ' .. tostring(count))
+
+  local response = {
+    total   = redis.call('zcard', 'ql:tracked'),
+    jobs    = {},
+    expired = {}
+  }
+  local jids = redis.call('zrange', 'ql:tracked', offset, offset + count - 1)
+  for _, jid in ipairs(jids) do
+    local data
+    if fields then
+      data = Qless.job(jid):data(fields)
+    else
+      data = Qless.job(jid):data()
+    end
+    if data then
+      table.insert(response.jobs, data)
+    else
+      table.insert(response.expired, jid)
+    end
+  end
+  return response
+end
+
+function Qless.tag(now, command, ...)
+  assert(command,
+    'Tag(): Arg "command" must be "add", "remove", "get" or "top"')
+
+  if command == 'add' then
+    local jid  = assert(arg[1], 'Tag(): Arg "jid" missing')
+    local tags = redis.call('hget', QlessJob.ns .. jid, 'tags')
+    if tags then
+      tags = cjson.decode(tags)
+      local _tags = {}
+      for i,v in ipairs(tags) do _tags[v] = true end
+
+      for i=2,#arg do
+        local tag = arg[i]
+        if _tags[tag] == nil or _tags[tag] == false then
+          _tags[tag] = true
+          table.insert(tags, tag)
+        end
+        redis.call('zadd', 'ql:t:' .. tag, now, jid)
+        redis.call('zincrby', 'ql:tags', 1, tag)
+      end
+
+      redis.call('hset', QlessJob.ns .. jid, 'tags', cjson.encode(tags))
+      return tags
+    else
+      error('Tag(): Job ' .. jid .. ' does not exist')
+    end
+  elseif command == 'remove' then
+    local jid  = assert(arg[1], 'Tag(): Arg "jid" missing')
+    local tags = redis.call('hget', QlessJob.ns .. jid, 'tags')
+    if tags then
+      tags = cjson.decode(tags)
+      local _tags = {}
+      for i,v in ipairs(tags) do _tags[v] = true end
+
+      for i=2,#arg do
+        local tag = arg[i]
+        _tags[tag] = nil
+        redis.call('zrem', 'ql:t:' .. tag, jid)
+        redis.call('zincrby', 'ql:tags', -1, tag)
+      end
+
+      local results = {}
+      for i,tag in ipairs(tags) do if _tags[tag] then table.insert(results, tag) end end
+
+      redis.call('hset', QlessJob.ns .. jid, 'tags', cjson.encode(results))
+      return results
+    else
+      error('Tag(): Job ' .. jid .. ' does not exist')
+    end
+  elseif command == 'get' then
+    local tag    = assert(arg[1], 'Tag(): Arg "tag" missing')
+    local offset = assert(tonumber(arg[2] or 0),
+      'Tag(): Arg "offset" not a number: ' .. tostring(arg[2]))
+    local count  = assert(tonumber(arg[3] or 25),
+      'Tag(): Arg "count" not a number: ' .. tostring(arg[3]))
+    return {
+      total = redis.call('zcard', 'ql:t:' .. tag),
+      jobs  = redis.call('zrange', 'ql:t:' .. tag, offset, offset + count - 1)
+    }
+  elseif command == 'top' then
+    local offset = assert(tonumber(arg[1] or 0) , 'Tag(): Arg "offset" not a number: ' .. tostring(arg[1]))
+    local count  = assert(tonumber(arg[2] or 25), 'Tag(): Arg "count" not a number: ' .. tostring(arg[2]))
+    return redis.call('zrevrangebyscore', 'ql:tags', '+inf', 2, 'limit', offset, count)
+  else
+    error('Tag(): First argument must be "add", "remove" or "get"')
+  end
+end
+
+function Qless.retag(now, jid, old, new)
+  local kept = {}
+  for _, tag in ipairs(old) do kept[tag] = false end
+  for _, tag in ipairs(new) do
+    if kept[tag] == nil then
+      redis.call('zadd', 'ql:t:' .. tag, now, jid)
+      redis.call('zincrby', 'ql:tags', 1, tag)
+    end
+    kept[tag] = true
+  end
+  for tag, keep in pairs(kept) do
+    if not keep then
+      redis.call('zrem', 'ql:t:' .. tag, jid)
+      redis.call('zincrby', 'ql:tags', -1, tag)
+    end
+  end
+end
+
+function Qless.tag_query(now, query, offset, count)
+  assert(query, 'TagQuery(): Arg "query" missing')
+  local parsed = assert(cjson.decode(query),
+    'TagQuery(): Arg "query" not JSON: ' .. tostring(query))
+  offset = assert(tonumber(offset or 0),
+    'TagQuery(): Arg "offset" not a number: ' .. tostring(offset))
+  count = assert(tonumber(count or 25),
+    'TagQuery(): Arg "count" not a number: ' .. tostring(count))
+
+  local key = 'ql:tq:' .. redis.sha1hex(query)
+  if type(parsed) == 'string' then
+    key = 'ql:t:' .. parsed
+  else
+    local cached = redis.call('type', key)['ok']
+    if cached == 'string' then
+      return {total = 0, jobs = {}}
+    elseif cached == 'none' then
+      local temporary = {}
+      Qless.tag_query_key(parsed, key, temporary)
+      redis.call('del', unpack(temporary))
+      local ttl = tonumber(Qless.config.get('tag-query-ttl', 60))
+      if redis.call('exists', key) == 0 then
+        redis.call('set', key, '', 'EX', ttl)
+        return {total = 0, jobs = {}}
+      end
+      redis.call('expire', key, ttl)
+    end
+  end
+
+  return {
+    total = redis.call('zcard', key),
+    jobs  = redis.call('zrange', key, offset, offset + count - 1)
+  }
+end
+
+function Qless.tag_query_key(query, key, temporary)
+  if type(query) == 'string' then
+    return 'ql:t:' .. query
+  end
+  assert(type(query) == 'table', 'TagQuery(): Query not a tag or an object')
+  assert(query['not'] == nil,
+    'TagQuery(): "not" is only allowed inside an "and"')
+
+  local operator = (query['and'] and 'and') or (query['or'] and 'or')
+  assert(operator, 'TagQuery(): Query must have an "and" or an "or"')
+  local terms = query[operator]
+  assert(type(terms) == 'table' and #terms > 0,
+    'TagQuery(): "' .. operator .. '" must have a list of queries')
+
+  local keys = {}
+  local excluded = {}
+  for i, term in ipairs(terms) do
+    local sub = key .. ':' .. (#temporary + 1)
+    if type(term) == 'table' and term['not'] ~= nil then
+      assert(operator == 'and',
+        'TagQuery(): "not" is only allowed inside an "and"')
+      table.insert(temporary, sub)
+      table.insert(excluded, Qless.tag_query_key(term['not'], sub, temporary))
+    else
+      table.insert(temporary, sub)
+      table.insert(keys, Qless.tag_query_key(term, sub, temporary))
+    end
+  end
+  assert(#keys > 0,
+    'TagQuery(): "and" needs at least one query that isn\'t a "not"')
+
+  local count = #keys
+  table.insert(keys, 'aggregate')
+  table.insert(keys, 'max')
+  if operator == 'and' then
+    redis.call('zinterstore', key, count, unpack(keys))
+    for _, exclude in ipairs(excluded) do
+      Qless.zdiff(key, exclude)
+    end
+  else
+    redis.call('zunionstore', key, count, unpack(keys))
+  end
+  return key
+end
+
+function Qless.zdiff(key, exclude)
+  if Qless.can_zdiff ~= false then
+    local reply = redis.pcall('zdiffstore', key, 2, key, exclude)
+    if type(reply) ~= 'table' or not reply.err then
+      Qless.can_zdiff = true
+      return
+    end
+    Qless.can_zdiff = false
+  end
+
+  if redis.call('zcard', exclude) < redis.call('zcard', key) then
+    local members = redis.call('zrange', exclude, 0, -1)
+    for i = 1, #members, 100 do
+      redis.call('zrem', key, unpack(members, i, math.min(i + 99, #members)))
+    end
+  else
+    for _, member in ipairs(redis.call('zrange', key, 0, -1)) do
+      if redis.call('zscore', exclude, member) then
+        redis.call('zrem', key, member)
+      end
+    end
+  end
+end
+
+function Qless.cancel(now, ...)
+  local dependents = {}
+  for _, jid in ipairs(arg) do
+    dependents[jid] = redis.call(
+      'smembers', QlessJob.ns .. jid .. '-dependents') or {}
+  end
+
+  for i, jid in ipairs(arg) do
+    for j, dep in ipairs(dependents[jid]) do
+      if dependents[dep] == nil or dependents[dep] == false then
+        error('Cancel(): ' .. jid .. ' is a dependency of ' .. dep ..
+           ' but is not mentioned to be canceled')
+      end
+    end
+  end
+
+  local cancelled_jids = {}
+
+  for _, jid in ipairs(arg) do
+    if Qless.job(jid):cancel(now) then
+      table.insert(cancelled_jids, jid)
+    end
+  end
+
+  return cancelled_jids
+end
+
+local cancel_query_sets = {
+  depends   = 'depends',
+  scheduled = 'scheduled',
+  waiting   = 'work',
+  running   = 'locks',
+  failed    = false
+}
+
+function Qless.cancel_query(now, name, query, budget, cursor)
+  assert(name, 'CancelQuery(): Arg "queue" missing')
+  query = assert(cjson.decode(query or '{}'),
+    'CancelQuery(): Arg "query" not JSON: ' .. tostring(query))
+  assert(type(query) == 'table' and (query.state or query.tag or query.klass),
+    'CancelQuery(): Arg "query" needs a "state", "tag" or "klass"')
+  budget = assert(tonumber(budget or 1000),
+    'CancelQuery(): Arg "budget" not a number: ' .. tostring(budget))
+  local source, offset = string.match(cursor or '0:0', '^(%d+):(%d+)$')
+  assert(source, 'CancelQuery(): Arg "cursor" not valid: ' .. tostring(cursor))
+  source, offset = tonumber(source) + 1, tonumber(offset)
+
+  local queue = Qless.queue(name)
+  local keys = {}
+  if query.tag then
+    keys = {'ql:t:' .. query.tag}
+  else
+    local states = {'depends', 'scheduled', 'waiting', 'running', 'failed'}
+    if query.state then
+      assert(cancel_query_sets[query.state] ~= nil,
+        'CancelQuery(): Unknown state "' .. tostring(query.state) .. '"')
+      states = {query.state}
+    end
+    for _, state in ipairs(states) do
+      if state == 'failed' then
+        local groups = redis.call('smembers', 'ql:failures')
+        table.sort(groups)
+        for _, group in ipairs(groups) do
+          table.insert(keys, 'ql:f:' .. group)
+        end
+      elseif state == 'waiting' and query.klass and queue:indexed() then
+        table.insert(keys, queue:prefix('work-' .. query.klass))
+      else
+        table.insert(keys, queue:prefix(cancel_query_sets[state]))
+      end
+    end
+  end
+
+  local cancelled = {}
+  while budget > 0 and keys[source] do
+    local range = 'zrange'
+    if redis.call('type', keys[source])['ok'] == 'list' then
+      range = 'lrange'
+    end
+    local jids = redis.call(range, keys[source], offset, offset + budget - 1)
+    budget = budget - #jids
+    for _, jid in ipairs(jids) do
+      local job_queue, state, klass = unpack(redis.call('hmget',
+        QlessJob.ns .. jid, 'queue', 'state', 'klass'))
+      if job_queue == name
+        and (query.state == nil or state == query.state)
+        and (query.klass == nil or klass == query.klass)
+        and redis.call('scard', QlessJob.ns .. jid .. '-dependents') == 0
+        and Qless.job(jid):cancel(now) then
+        table.insert(cancelled, jid)
+      else
+        offset = offset + 1
+      end
+    end
+    if budget > 0 then
+      source, offset = source + 1, 0
+    end
+  end
+
+  return {
+    cancelled = cancelled,
+    cursor    = (source - 1) .. ':' .. offset,
+    done      = keys[source] == nil
+  }
+end
+
+
+function Qless.zadd(key, members)
+  local added = 0
+  for i = 1, #members, 200 do
+    added = added + redis.call('zadd', key,
+      unpack(members, i, math.min(i + 199, #members)))
+  end
+  return added
+end
+
+function Qless.attempt(func)
+  local ok, result = pcall(func)
+  if ok then
+    return true, result
+  end
+  if type(result) == 'table' then
+    result = result.err
+  end
+  return false, (string.gsub(tostring(result), '^[^:]*:%d+: ', ''))
+end
+
+function Qless.unlink(...)
+  if Qless.can_unlink ~= false then
+    local reply = redis.pcall('unlink', unpack(arg))
+    if type(reply) ~= 'table' or not reply.err then
+      Qless.can_unlink = true
+      return reply
+    end
+    Qless.can_unlink = false
+  end
+  return redis.call('del', unpack(arg))
+end
+
+function Qless.gc(now, budget)
+  budget = assert(tonumber(budget),
+    'GC(): Arg "budget" not a number: ' .. tostring(budget))
+
+  local count = tonumber(Qless.config.get('jobs-history-count'))
+  local time  = tonumber(Qless.config.get('jobs-history'))
+
+  local expired = math.max(
+    redis.call('zcard', 'ql:completed') - count,
+    redis.call('zcount', 'ql:completed', 0, now - time))
+  local reaped = math.max(math.min(expired, budget), 0)
+  if reaped == 0 then
+    return math.max(expired, 0)
+  end
+
+  local jids = redis.call('zrange', 'ql:completed', 0, reaped - 1)
+  for index, jid in ipairs(jids) do
+    local tags = cjson.decode(
+      redis.call('hget', QlessJob.ns .. jid, 'tags') or '{}')
+    for i, tag in ipairs(tags) do
+      redis.call('zrem', 'ql:t:' .. tag, jid)
+      redis.call('zincrby', 'ql:tags', -1, tag)
+    end
+    Qless.unlink(QlessJob.ns .. jid, QlessJob.ns .. jid .. '-history')
+  end
+  redis.call('zremrangebyrank', 'ql:completed', 0, reaped - 1)
+
+  return expired - reaped
+end
+
+Qless.config.defaults = {
+  ['application']        = 'qless',
+  ['heartbeat']          = 60,
+  ['grace-period']       = 10,
+  ['stats-history']      = 30,
+  ['histogram-history']  = 7,
+  ['jobs-history-count'] = 50000,
+  ['jobs-history']       = 604800
+}
+
+Qless.config.load = function()
+  if not Qless.config.cache then
+    local cache = {}
+    local reply = redis.call('hgetall', 'ql:config')
+    for i = 1, #reply, 2 do
+      cache[reply[i]] = reply[i + 1]
+    end
+    Qless.config.cache = cache
+  end
+  return Qless.config.cache
+end
+
+Qless.config.get = function(key, default)
+  local cache = Qless.config.load()
+  if key then
+    return cache[key] or Qless.config.defaults[key] or default
+  else
+    local reply = {}
+    for option, value in pairs(Qless.config.defaults) do
+      reply[option] = value
+    end
+    for option, value in pairs(cache) do
+      reply[option] = value
+    end
+    return reply
+  end
+end
+
+Qless.config.set = function(option, value)
+  assert(option, 'config.set(): Arg "option" missing')
+  assert(value , 'config.set(): Arg "value" missing')
+  Qless.publish('log', cjson.encode({
+    event  = 'config_set',
+    option = option,
+    value  = value
+  }))
+
+  redis.call('hset', 'ql:config', option, value)
+  if Qless.config.cache then
+    Qless.config.cache[option] = tostring(value)
+  end
+end
+
+Qless.config.unset = function(option)
+  assert(option, 'config.unset(): Arg "option" missing')
+  Qless.publish('log', cjson.encode({
+    event  = 'config_unset',
+    option = option
+  }))
+
+  redis.call('hdel', 'ql:config', option)
+  if Qless.config.cache then
+    Qless.config.cache[option] = nil
+  end
+end
+
+QlessJob.fields = {
+  jid              = {stored = true},
+  klass            = {stored = true},
+  state            = {stored = true},
+  queue            = {stored = true},
+  worker           = {stored = true, convert = function(value)
+    return value or ''
+  end},
+  priority         = {stored = true, convert = tonumber},
+  expires          = {stored = true, convert = function(value)
+    return tonumber(value) or 0
+  end},
+  retries          = {stored = true, convert = tonumber},
+  remaining        = {stored = true, convert = function(value)
+    return math.floor(tonumber(value))
+  end},
+  data             = {stored = true},
+  tags             = {stored = true, convert = cjson.decode},
+  failure          = {stored = true, convert = function(value)
+    return cjson.decode(value or '{}')
+  end},
+  spawned_from_jid = {stored = true},
+  resources        = {stored = true, convert = function(value)
+    return cjson.decode(value or '[]')
+  end},
+  concurrency_key  = {stored = true, convert = function(value)
+    return value or nil
+  end},
+  tracked          = {lookup = function(job)
+    return redis.call('zscore', 'ql:tracked', job.jid) ~= false
+  end},
+  history          = {lookup = function(job)
+    return job:history()
+  end},
+  dependents       = {lookup = function(job)
+    return redis.call('smembers', QlessJob.ns .. job.jid .. '-dependents')
+  end},
+  dependencies     = {lookup = function(job)
+    return redis.call('smembers', QlessJob.ns .. job.jid .. '-dependencies')
+  end}
+}
+
+QlessJob.field_names = {
+  'jid', 'klass', 'state', 'queue', 'worker', 'tracked', 'priority',
+  'expires', 'retries', 'remaining', 'data', 'tags', 'history', 'failure',
+  'spawned_from_jid', 'resources', 'concurrency_key', 'dependents',
+  'dependencies'}
+
+function QlessJob:data(...)
+  local fields = arg
+  local projection = type(arg[1]) == 'table'
+  if projection then
+    fields = arg[1]
+  elseif #arg == 0 then
+    fields = QlessJob.field_names
+    projection = true
+  end
+
+  local stored = {'jid'}
+  for _, field in ipairs(fields) do
+    local spec = QlessJob.fields[field]
+    if spec and spec.stored and field ~= 'jid' then
+      table.insert(stored, field)
+    end
+  end
+  local job = redis.call('hmget', QlessJob.ns .. self.jid, unpack(stored))
+
+  if not job[1] then
+    return nil
+  end
+
+  local values = {}
+  for index, field in ipairs(stored) do
+    local convert = QlessJob.fields[field].convert
+    if convert then
+      values[field] = convert(job[index])
+    else
+      values[field] = job[index]
+    end
+  end
+
+  local data = {}
+  local response = {}
+  for index, field in ipairs(fields) do
+    local spec = QlessJob.fields[field]
+    local value = values[field]
+    if spec and spec.lookup then
+      value = spec.lookup(self)
+    end
+    if projection then
+      data[field] = value
+    else
+      response[index] = value
+    end
+  end
+
+  if projection then
+    return data
+  else
+    return response
+  end
+end
+
+function QlessJob:complete(now, worker, queue, raw_data, ...)
+  local options = {}
+  for i = 1, #arg, 2 do options[arg[i]] = arg[i + 1] end
+
+  return self:finish(now, worker, queue, raw_data, options)
+end
+
+function QlessJob:finish(now, worker, queue, raw_data, options, batch)
+  assert(worker, 'Complete(): Arg "worker" missing')
+  assert(queue , 'Complete(): Arg "queue" missing')
+  if raw_data ~= nil or not batch then
+    assert(cjson.decode(raw_data),
+      'Complete(): Arg "data" missing or not JSON: ' .. tostring(raw_data))
+  end
+
+  local nextq   = options['next']
+  local delay   = assert(tonumber(options['delay'] or 0))
+  local depends = assert(cjson.decode(options['depends'] or '[]'),
+    'Complete(): Arg "depends" not JSON: ' .. tostring(options['depends']))
+
+  if options['delay'] and nextq == nil then
+    error('Complete(): "delay" cannot be used without a "next".')
+  end
+
+  if options['depends'] and nextq == nil then
+    error('Complete(): "depends" cannot be used without a "next".')
+  end
+
+  local bin = now - (now % 86400)
+
+  local lastworker, state, priority, retries, current_queue = unpack(
+    redis.call('hmget', QlessJob.ns .. self.jid, 'worker', 'state',
+      'priority', 'retries', 'queue'))
+
+  if lastworker == false then
+    error('Complete(): Job ' .. self.jid .. ' does not exist')
+  elseif (state ~= 'running') then
+    error('Complete(): Job ' .. self.jid .. ' is not currently running: ' ..
+      state)
+  elseif lastworker ~= worker then
+    error('Complete(): Job ' .. self.jid ..
+      ' has been handed out to another worker: ' .. tostring(lastworker))
+  elseif queue ~= current_queue then
+    error('Complete(): Job ' .. self.jid .. ' running in another queue: ' ..
+      tostring(current_queue))
+  end
+
+  self:history(now, 'done', nil, queue)
+
+  if raw_data then
+    redis.call('hset', QlessJob.ns .. self.jid, 'data', raw_data)
+  end
+
+  local queue_obj = Qless.queue(queue)
+  queue_obj.work.remove(self.jid)
+  queue_obj.locks.remove(self.jid)
+  queue_obj.scheduled.remove(self.jid)
+
+  self:release_resources(now)
+
+  local time = tonumber(
+    redis.call('hget', QlessJob.ns .. self.jid, 'time') or now)
+  local waiting = now - time
+  if batch then
+    table.insert(batch.waits, waiting)
+  else
+    Qless.queue(queue):stat(now, 'run', waiting)
+  end
+  redis.call('hset', QlessJob.ns .. self.jid,
+    'time', string.format("%.20f", now))
+
+  if batch then
+    table.insert(batch.jids, self.jid)
+  else
+    redis.call('zrem', 'ql:w:' .. worker .. ':jobs', self.jid)
+  end
+
+  if (not batch or batch.tracked) and
+    redis.call('zscore', 'ql:tracked', self.jid) ~= false then
+    Qless.publish('completed', self.jid)
+  end
+
+  if nextq then
+    queue_obj = Qless.queue(nextq)
+    Qless.publish('log', cjson.encode({
+      jid   = self.jid,
+      event = 'advanced',
+      queue = queue,
+      to    = nextq
+    }))
+
+    self:history(now, 'put', {q = nextq}, nextq)
+
+    if not (batch and batch.queues[nextq]) then
+      if redis.call('zscore', 'ql:queues', nextq) == false then
+        redis.call('zadd', 'ql:queues', now, nextq)
+      end
+      if batch then
+        batch.queues[nextq] = true
+      end
+    end
+
+    redis.call('hmset', QlessJob.ns .. self.jid,
+      'state', 'waiting',
+      'worker', '',
+      'failure', '{}',
+      'queue', nextq,
+      'expires', 0,
+      'remaining', tonumber(retries))
+
+    if (delay > 0) and (#depends == 0) then
+      queue_obj.scheduled.add(now + delay, self.jid)
+      return 'scheduled'
+    else
+      local count = 0
+      for i, j in ipairs(depends) do
+        local state = redis.call('hget', QlessJob.ns .. j, 'state')
+        if (state and state ~= 'complete') then
+          count = count + 1
+          redis.call(
+            'sadd', QlessJob.ns .. j .. '-dependents',self.jid)
+          redis.call(
+            'sadd', QlessJob.ns .. self.jid .. '-dependencies', j)
+        end
+      end
+      if count > 0 then
+        queue_obj.depends.add(now, self.jid)
+        redis.call('hset', QlessJob.ns .. self.jid, 'state', 'depends')
+        if delay > 0 then
+          queue_obj.depends.add(now, self.jid)
+          redis.call('hset', QlessJob.ns .. self.jid, 'scheduled', now + delay)
+        end
+        return 'depends'
+      else
+        if self:acquire_resources(now) then
+          queue_obj.work.add(now, priority, self.jid)
+          queue_obj:signal(1)
+        end
+        return 'waiting'
+      end
+    end
+  else
+    Qless.publish('log', cjson.encode({
+      jid   = self.jid,
+      event = 'completed',
+      queue = queue
+    }))
+
+    redis.call('hmset', QlessJob.ns .. self.jid,
+      'state', 'complete',
+      'worker', '',
+      'failure', '{}',
+      'queue', '',
+      'expires', 0,
+      'remaining', tonumber(retries))
+
+    redis.call('zadd', 'ql:completed', now, self.jid)
+
+    if not batch then
+      Qless.gc(now, Qless.config.get('gc-inline-budget', 10))
+    end
+
+    for i, j in ipairs(redis.call(
+      'smembers', QlessJob.ns .. self.jid .. '-dependents')) do
+      redis.call('srem', QlessJob.ns .. j .. '-dependencies', self.jid)
+      if redis.call(
+        'scard', QlessJob.ns .. j .. '-dependencies') == 0 then
+        local q, p, scheduled = unpack(
+          redis.call('hmget', QlessJob.ns .. j, 'queue', 'priority', 'scheduled'))
+        if q then
+          local queue = Qless.queue(q)
+          queue.depends.remove(j)
+          if scheduled then
+            queue.scheduled.add(scheduled, j)
+            redis.call('hset', QlessJob.ns .. j, 'state', 'scheduled')
+            redis.call('hdel', QlessJob.ns .. j, 'scheduled')
+          else
+            if Qless.job(j):acquire_resources(now) then
+              queue.work.add(now, p, j)
+              queue:signal(1)
+            end
+            redis.call('hset', QlessJob.ns .. j, 'state', 'waiting')
+          end
+        end
+      end
+    end
+
+    redis.call('del', QlessJob.ns .. self.jid .. '-dependents')
+
+    return 'complete'
+  end
+end
+
+function QlessJob:fail(now, worker, group, message, data)
+  local worker  = assert(worker           , 'Fail(): Arg "worker" missing')
+  local group   = assert(group            , 'Fail(): Arg "group" missing')
+  local message = assert(message          , 'Fail(): Arg "message" missing')
+
+  local bin = now - (now % 86400)
+
+  if data then
+    data = cjson.decode(data)
+  end
+
+  local queue, state, oldworker = unpack(redis.call(
+    'hmget', QlessJob.ns .. self.jid, 'queue', 'state', 'worker'))
+
+  if not state then
+    error('Fail(): Job ' .. self.jid .. 'does not exist')
+  elseif state ~= 'running' then
+    error('Fail(): Job ' .. self.jid .. 'not currently running: ' .. state)
+  elseif worker ~= oldworker then
+    error('Fail(): Job ' .. self.jid .. ' running with another worker: ' ..
+      oldworker)
+  end
+
+  Qless.publish('log', cjson.encode({
+    jid     = self.jid,
+    event   = 'failed',
+    worker  = worker,
+    group   = group,
+    message = message
+  }))
+
+  if redis.call('zscore', 'ql:tracked', self.jid) ~= false then
+    Qless.publish('failed', self.jid)
+  end
+
+  redis.call('zrem', 'ql:w:' .. worker .. ':jobs', self.jid)
+
+  self:history(now, 'failed', {worker = worker, group = group}, queue)
+
+  redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. queue, 'failures', 1)
+  redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. queue, 'failed'  , 1)
+
+  local queue_obj = Qless.queue(queue)
+  queue_obj.work.remove(self.jid)
+  queue_obj.locks.remove(self.jid)
+  queue_obj.scheduled.remove(self.jid)
+
+  self:release_resources(now)
+
+  if data then
+    redis.call('hset', QlessJob.ns .. self.jid, 'data', cjson.encode(data))
+  end
+
+  redis.call('hmset', QlessJob.ns .. self.jid,
+    'state', 'failed',
+    'worker', '',
+    'expires', '',
+    'failure', cjson.encode({
+      ['group']   = group,
+      ['message'] = message,
+      ['when']    = math.floor(now),
+      ['worker']  = worker
+    }))
+
+  Qless.add_failure(group, self.jid, now)
+
+
+  return self.jid
+end
+
+function QlessJob:retry(now, queue, worker, delay, group, message)
+  assert(queue , 'Retry(): Arg "queue" missing')
+  assert(worker, 'Retry(): Arg "worker" missing')
+  delay = assert(tonumber(delay or 0),
+    'Retry(): Arg "delay" not a number: ' .. tostring(delay))
+
+  local oldqueue, state, retries, oldworker, priority, failure = unpack(
+    redis.call('hmget', QlessJob.ns .. self.jid, 'queue', 'state',
+      'retries', 'worker', 'priority', 'failure'))
+
+  if oldworker == false then
+    error('Retry(): Job ' .. self.jid .. ' does not exist')
+  elseif state ~= 'running' then
+    error('Retry(): Job ' .. self.jid .. ' is not currently running: ' ..
+      state)
+  elseif oldworker ~= worker then
+    error('Retry(): Job ' .. self.jid ..
+      ' has been given to another worker: ' .. oldworker)
+  end
+
+  local remaining = tonumber(redis.call(
+    'hincrby', QlessJob.ns .. self.jid, 'remaining', -1))
+  redis.call('hdel', QlessJob.ns .. self.jid, 'grace')
+
+  Qless.queue(oldqueue).locks.remove(self.jid)
+  self:release_resources(now)
+
+  redis.call('zrem', 'ql:w:' .. worker .. ':jobs', self.jid)
+
+  if remaining < 0 then
+    local group = group or 'failed-retries-' .. queue
+    self:history(now, 'failed', {['group'] = group}, oldqueue)
+
+    redis.call('hmset', QlessJob.ns .. self.jid, 'state', 'failed',
+      'worker', '',
+      'expires', '')
+    if group ~= nil and message ~= nil then
+      redis.call('hset', QlessJob.ns .. self.jid,
+        'failure', cjson.encode({
+          ['group']   = group,
+          ['message'] = message,
+          ['when']    = math.floor(now),
+          ['worker']  = worker
+        })
+      )
+    else
+      redis.call('hset', QlessJob.ns .. self.jid,
+      'failure', cjson.encode({
+        ['group']   = group,
+        ['message'] =
+          'Job exhausted retries in queue "' .. oldqueue .. '"',
+        ['when']    = now,
+        ['worker']  = unpack(self:data('worker'))
+      }))
+    end
+
+    Qless.add_failure(group, self.jid, now)
+    local bin = now - (now % 86400)
+    redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. queue, 'failures', 1)
+    redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. queue, 'failed'  , 1)
+  else
+    local queue_obj = Qless.queue(queue)
+    if delay > 0 then
+      queue_obj.scheduled.add(now + delay, self.jid)
+      redis.call('hset', QlessJob.ns .. self.jid, 'state', 'scheduled')
+    else
+      if self:acquire_resources(now) then
+        queue_obj.work.add(now, priority, self.jid)
+        queue_obj:signal(1)
+      end
+      redis.call('hset', QlessJob.ns .. self.jid, 'state', 'waiting')
+    end
+
+    if group ~= nil and message ~= nil then
+      redis.call('hset', QlessJob.ns .. self.jid,
+        'failure', cjson.encode({
+          ['group']   = group,
+          ['message'] = message,
+          ['when']    = math.floor(now),
+          ['worker']  = worker
+        })
+      )
+    end
+  end
+
+  return math.floor(remaining)
+end
+
+function QlessJob:depends(now, command, ...)
+  assert(command, 'Depends(): Arg "command" missing')
+  local state = redis.call('hget', QlessJob.ns .. self.jid, 'state')
+  if state ~= 'depends' then
+    error('Depends(): Job ' .. self.jid ..
+      ' not in the depends state: ' .. tostring(state))
+  end
+
+  if command == 'on' then
+    for i, j in ipairs(arg) do
+      local state = redis.call('hget', QlessJob.ns .. j, 'state')
+      if (state and state ~= 'complete') then
+        redis.call(
+          'sadd', QlessJob.ns .. j .. '-dependents'  , self.jid)
+        redis.call(
+          'sadd', QlessJob.ns .. self.jid .. '-dependencies', j)
+      end
+    end
+    return true
+  elseif command == 'off' then
+    if arg[1] == 'all' then
+      for i, j in ipairs(redis.call(
+        'smembers', QlessJob.ns .. self.jid .. '-dependencies')) do
+        redis.call('srem', QlessJob.ns .. j .. '-dependents', self.jid)
+      end
+      redis.call('del', QlessJob.ns .. self.jid .. '-dependencies')
+      local q, p = unpack(redis.call(
+        'hmget', QlessJob.ns .. self.jid, 'queue', 'priority'))
+      if q then
+        local queue_obj = Qless.queue(q)
+        queue_obj.depends.remove(self.jid)
+        if self:acquire_resources(now) then
+          queue_obj.work.add(now, p, self.jid)
+          queue_obj:signal(1)
+        end
+        redis.call('hset', QlessJob.ns .. self.jid, 'state', 'waiting')
+      end
+    else
+      for i, j in ipairs(arg) do
+        redis.call('srem', QlessJob.ns .. j .. '-dependents', self.jid)
+        redis.call(
+          'srem', QlessJob.ns .. self.jid .. '-dependencies', j)
+        if redis.call('scard',
+          QlessJob.ns .. self.jid .. '-dependencies') == 0 then
+          local q, p = unpack(redis.call(
+            'hmget', QlessJob.ns .. self.jid, 'queue', 'priority'))
+          if q then
+            local queue_obj = Qless.queue(q)
+            queue_obj.depends.remove(self.jid)
+            if self:acquire_resources(now) then
+              queue_obj.work.add(now, p, self.jid)
+              queue_obj:signal(1)
+            end
+            redis.call('hset',
+              QlessJob.ns .. self.jid, 'state', 'waiting')
+          end
+        end
+      end
+    end
+    return true
+  else
+    error('Depends(): Argument "command" must be "on" or "off"')
+  end
+end
+
+function QlessJob:heartbeat(now, worker, data, batch)
+  assert(worker, 'Heatbeat(): Arg "worker" missing')
+
+  if data then
+    data = cjson.decode(data)
+  end
+
+  local job_worker, state, queue = unpack(
+    redis.call('hmget', QlessJob.ns .. self.jid, 'worker', 'state', 'queue'))
+  if job_worker == false then
+    error('Heartbeat(): Job ' .. self.jid .. ' does not exist')
+  elseif state ~= 'running' then
+    error(
+      'Heartbeat(): Job ' .. self.jid .. ' not currently running: ' .. state)
+  elseif job_worker ~= worker or #job_worker == 0 then
+    error(
+      'Heartbeat(): Job ' .. self.jid ..
+      ' given out to another worker: ' .. job_worker)
+  end
+
+  local interval = batch and batch.intervals[queue]
+  if not interval then
+    interval = tonumber(
+      Qless.config.get(queue .. '-heartbeat') or
+      Qless.config.get('heartbeat', 60))
+    if batch then
+      batch.intervals[queue] = interval
+    end
+  end
+  local expires = now + interval
+
+  if data then
+    redis.call('hmset', QlessJob.ns .. self.jid, 'expires',
+      expires, 'worker', worker, 'data', cjson.encode(data))
+  else
+    redis.call('hmset', QlessJob.ns .. self.jid,
+      'expires', expires, 'worker', worker)
+  end
+
+  if batch then
+    table.insert(batch.jobs, expires)
+    table.insert(batch.jobs, self.jid)
+    if not batch.locks[queue] then
+      batch.locks[queue] = {}
+      table.insert(batch.queues, queue)
+    end
+    table.insert(batch.locks[queue], expires)
+    table.insert(batch.locks[queue], self.jid)
+    return expires
+  end
+
+  redis.call('zadd', 'ql:w:' .. worker .. ':jobs', expires, self.jid)
+
+  redis.call('zadd', 'ql:workers', now, worker)
+
+  Qless.queue(queue).locks.add(expires, self.jid)
+  return expires
+end
+
+function QlessJob:priority(priority)
+  priority = assert(tonumber(priority),
+    'Priority(): Arg "priority" missing or not a number: ' ..
+    tostring(priority))
+
+  local queue = redis.call('hget', QlessJob.ns .. self.jid, 'queue')
+
+  if queue == nil or queue == false then
+    error('Priority(): Job ' .. self.jid .. ' does not exist')
+  elseif queue == '' then
+    redis.call('hset', QlessJob.ns .. self.jid, 'priority', priority)
+    return priority
+  else
+    local queue_obj = Qless.queue(queue)
+    if queue_obj.work.score(self.jid) then
+      queue_obj.work.add(0, priority, self.jid)
+    end
+    redis.call('hset', QlessJob.ns .. self.jid, 'priority', priority)
+    return priority
+  end
+end
+
+function QlessJob:update(data)
+  local tmp = {}
+  for k, v in pairs(data) do
+    table.insert(tmp, k)
+    table.insert(tmp, v)
+  end
+  redis.call('hmset', QlessJob.ns .. self.jid, unpack(tmp))
+end
+
+function QlessJob:timeout(now)
+  local queue_name, state, worker = unpack(redis.call('hmget',
+    QlessJob.ns .. self.jid, 'queue', 'state', 'worker'))
+  if queue_name == nil or queue_name == false then
+    error('Timeout(): Job ' .. self.jid .. ' does not exist')
+  elseif state ~= 'running' then
+    error('Timeout(): Job ' .. self.jid .. ' not running')
+  else
+    self:history(now, 'timed-out', nil, queue_name)
+    local queue = Qless.queue(queue_name)
+    queue.locks.remove(self.jid)
+    queue.work.add(now, '+inf', self.jid)
+    queue:signal(1)
+    redis.call('hmset', QlessJob.ns .. self.jid,
+      'state', 'stalled', 'expires', 0)
+    local encoded = cjson.encode({
+      jid    = self.jid,
+      event  = 'lock_lost',
+      worker = worker
+    })
+    Qless.publish('w:' .. worker, encoded)
+    Qless.publish('log', encoded)
+    return queue_name
+  end
+end
+
+function QlessJob:cancel(now)
+  local jid = self.jid
+  local real_jid, state, queue, failure, worker = unpack(redis.call(
+    'hmget', QlessJob.ns .. jid, 'jid', 'state', 'queue', 'failure', 'worker'))
+
+  if state ~= false and state ~= 'complete' then
+    local encoded = cjson.encode({
+      jid    = jid,
+      worker = worker,
+      event  = 'canceled',
+      queue  = queue
+    })
+    Qless.publish('log', encoded)
+
+    if worker and (worker ~= '') then
+      redis.call('zrem', 'ql:w:' .. worker .. ':jobs', jid)
+      Qless.publish('w:' .. worker, encoded)
+    end
+
+    if queue then
+      local queue = Qless.queue(queue)
+      queue.work.remove(jid)
+      queue.locks.remove(jid)
+      queue.scheduled.remove(jid)
+      queue.depends.remove(jid)
+    end
+
+    self:release_resources(now)
+
+    for i, j in ipairs(redis.call(
+      'smembers', QlessJob.ns .. jid .. '-dependencies')) do
+      redis.call('srem', QlessJob.ns .. j .. '-dependents', jid)
+    end
+
+    redis.call('del', QlessJob.ns .. jid .. '-dependencies')
+
+    if state == 'failed' then
+      failure = cjson.decode(failure)
+      Qless.remove_failures(failure.group, jid)
+      local bin = failure.when - (failure.when % 86400)
+      local failed = redis.call(
+        'hget', 'ql:s:stats:' .. bin .. ':' .. queue, 'failed')
+      redis.call('hset',
+        'ql:s:stats:' .. bin .. ':' .. queue, 'failed', failed - 1)
+    end
+
+    local tags = cjson.decode(
+      redis.call('hget', QlessJob.ns .. jid, 'tags') or '{}')
+    for i, tag in ipairs(tags) do
+      redis.call('zrem', 'ql:t:' .. tag, jid)
+      redis.call('zincrby', 'ql:tags', -1, tag)
+    end
+
+    if redis.call('zscore', 'ql:tracked', jid) ~= false then
+      Qless.publish('canceled', jid)
+    end
+
+    Qless.unlink(QlessJob.ns .. jid, QlessJob.ns .. jid .. '-history')
+    return true
+  end
+  return false
+end
+
+function QlessJob:exists()
+  return redis.call('exists', QlessJob.ns .. self.jid) == 1
+end
+
+function QlessJob.history_limit(queue)
+  local policy
+  if queue and queue ~= '' then
+    policy = Qless.config.get(queue .. '-history')
+  end
+  policy = policy or ('capped:' .. Qless.config.get('max-job-history', 100))
+
+  if policy == 'full' then
+    return -1
+  elseif policy == 'off' then
+    return 0
+  end
+  local limit = tonumber(string.match(policy, '^capped:(%d+)$'))
+  if not limit then
+    error('History(): Unknown history policy for ' .. tostring(queue) ..
+      ': ' .. policy)
+  end
+  if limit == 0 then
+    return -1
+  end
+  return limit
+end
+
+function QlessJob:start_history(now, what, item, queue)
+  if QlessJob.history_limit(queue) ~= 0 then
+    redis.call('hset', QlessJob.ns .. self.jid, 'history_first',
+      cjson.encode({math.floor(now), what, item}))
+  end
+end
+
+function QlessJob:history(now, what, item, queue)
+  if what == nil then
+    return self:history_items(0)
+  else
+    queue = queue or redis.call('hget', QlessJob.ns .. self.jid, 'queue')
+    local limit = QlessJob.history_limit(queue)
+    if limit == 0 then
+      return 0
+    end
+
+    local length = redis.call('rpush', QlessJob.ns .. self.jid .. '-history',
+      cjson.encode({math.floor(now), what, item}))
+    if limit > 0 and length > limit - 1 then
+      redis.call('ltrim', QlessJob.ns .. self.jid .. '-history',
+        length - limit + 1, -1)
+    end
+    return length
+  end
+end
+
+function QlessJob:history_items(offset, count)
+  local key = QlessJob.ns .. self.jid .. '-history'
+  local first, legacy = unpack(redis.call('hmget', QlessJob.ns .. self.jid,
+    'history_first', 'history'))
+  if legacy then
+    self:migrate_history()
+    first = redis.call('hget', QlessJob.ns .. self.jid, 'history_first')
+  end
+  if offset < 0 then
+    local length = redis.call('llen', key) + (first and 1 or 0)
+    offset = math.max(length + offset, 0)
+  end
+
+  local values = {}
+  if count == 0 then
+    return values
+  elseif first then
+    if offset == 0 then
+      table.insert(values, first)
+      count = count and count - 1
+    else
+      offset = offset - 1
+    end
+  end
+  if count == nil or count > 0 then
+    local stop = count and offset + count - 1 or -1
+    for _, value in ipairs(redis.call('lrange', key, offset, stop)) do
+      table.insert(values, value)
+    end
+  end
+
+  local response = {}
+  for i, value in ipairs(values) do
+    value = cjson.decode(value)
+    local dict = value[3] or {}
+    dict['when'] = value[1]
+    dict['what'] = value[2]
+    table.insert(response, dict)
+  end
+  return response
+end
+
+function QlessJob:migrate_history()
+  local key = QlessJob.ns .. self.jid .. '-history'
+  local migrated = false
+
+  local history = redis.call('hget', QlessJob.ns .. self.jid, 'history')
+  if history then
+    history = cjson.decode(history)
+    for i, value in ipairs(history) do
+      redis.call('rpush', key,
+        cjson.encode({math.floor(value.put), 'put', {q = value.q}}))
+
+      if value.popped then
+        redis.call('rpush', key,
+          cjson.encode({math.floor(value.popped), 'popped',
+            {worker = value.worker}}))
+      end
+
+      if value.failed then
+        redis.call('rpush', key,
+          cjson.encode(
+            {math.floor(value.failed), 'failed', nil}))
+      end
+
+      if value.done then
+        redis.call('rpush', key,
+          cjson.encode(
+            {math.floor(value.done), 'done', nil}))
+      end
+    end
+    redis.call('hdel', QlessJob.ns .. self.jid, 'history')
+    migrated = true
+  end
+
+  if redis.call('hexists', QlessJob.ns .. self.jid, 'history_first') == 0 then
+    local first = redis.call('lpop', key)
+    if first then
+      redis.call('hset', QlessJob.ns .. self.jid, 'history_first', first)
+      migrated = true
+    end
+  end
+  return migrated
+end
+
+function QlessJob.migrate_histories(cursor, budget)
+  cursor = assert(tonumber(cursor or 0),
+    'HistoryMigrate(): Arg "cursor" not a number: ' .. tostring(cursor))
+  budget = assert(tonumber(budget or 100),
+    'HistoryMigrate(): Arg "budget" not a number: ' .. tostring(budget))
+
+  local reply = redis.call('scan', cursor,
+    'match', QlessJob.ns .. '*', 'count', budget)
+  local migrated = 0
+  for _, key in ipairs(reply[2]) do
+    if redis.call('type', key)['ok'] == 'hash' and
+      Qless.job(string.sub(key, #QlessJob.ns + 1)):migrate_history() then
+      migrated = migrated + 1
+    end
+  end
+  return tonumber(reply[1]), migrated
+end
+
+function QlessJob:release_resources(now)
+  local resources = redis.call('hget', QlessJob.ns .. self.jid, 'resources')
+  resources = QlessResource.weights(cjson.decode(resources or '[]'))
+  for _, res in ipairs(resources) do
+    Qless.resource(res[1]):release(now, self.jid, res[2])
+  end
+  for _, res in ipairs(resources) do
+    Qless.resource(res[1]):promote(now)
+  end
+end
+
+function QlessJob:acquire_resources(now)
+  local resources, priority = unpack(redis.call('hmget', QlessJob.ns .. self.jid, 'resources', 'priority'))
+  resources = QlessResource.weights(cjson.decode(resources or '[]'))
+  if (#resources == 0) then
+    return true
+  end
+
+  local available, acquired_all = {}, true
+  for i, res in ipairs(resources) do
+    available[i] = Qless.resource(res[1]):available(self.jid, res[2])
+    acquired_all = acquired_all and available[i]
+  end
+
+  for i, res in ipairs(resources) do
+    if acquired_all then
+      Qless.resource(res[1]):acquire(self.jid, res[2])
+    elseif available[i] then
+      Qless.resource(res[1]):release(now, self.jid, res[2])
+    else
+      Qless.resource(res[1]):wait(now, priority, self.jid)
+    end
+  end
+  return acquired_all
+end
+function Qless.queue(name)
+  assert(name, 'Queue(): no queue name provided')
+  local queue = {}
+  setmetatable(queue, QlessQueue)
+  queue.name = name
+
+  queue.work = {
+    peek = function(count, klasses)
+      if count == 0 then
+        return {}
+      end
+      if klasses then
+        return queue:peek_klasses(count, klasses)
+      end
+      local jids = {}
+      for index, jid in ipairs(redis.call(
+        'zrevrange', queue:prefix('work'), 0, count - 1)) do
+        table.insert(jids, jid)
+      end
+      return jids
+    end, remove = function(...)
+      if #arg > 0 then
+        for _, jid in ipairs(arg) do
+          local klass = redis.call('hget', QlessJob.ns .. jid, 'klass')
+          if klass then
+            redis.call('zrem', queue:prefix('work-' .. klass), jid)
+          end
+        end
+        local removed = redis.call('zrem', queue:prefix('work'), unpack(arg))
+        queue:count('waiting', -removed)
+        return removed
+      end
+    end, add = function(now, priority, jid)
+      if priority ~= '+inf' then
+        priority = priority - (now / 10000000000)
+      end
+      local klass = redis.call('hget', QlessJob.ns .. jid, 'klass')
+      if klass then
+        redis.call('zadd', queue:prefix('work-' .. klass), priority, jid)
+      end
+      if redis.call('zcard', queue:prefix('work')) == 0 then
+        redis.call('set', queue:prefix('klass-indexed'), 1)
+      end
+      local added = redis.call('zadd', queue:prefix('work'), priority, jid)
+      queue:count('waiting', added)
+      return added
+    end, score = function(jid)
+      return redis.call('zscore', queue:prefix('work'), jid)
+    end, length = function()
+      return redis.call('zcard', queue:prefix('work'))
+    end
+  }
+
+  queue.locks = {
+    expired = function(now, offset, count)
+      return redis.call('zrangebyscore',
+        queue:prefix('locks'), '-inf', now, 'LIMIT', offset, count)
+    end, peek = function(now, offset, count)
+      return redis.call('zrangebyscore', queue:prefix('locks'),
+        now, '+inf', 'LIMIT', offset, count)
+    end, add = function(expires, jid)
+      if redis.call('zadd', queue:prefix('locks'), expires, jid) == 1 then
+        queue:count('running', 1)
+        queue:concurrency(jid, 1)
+      end
+    end, add_many = function(members)
+      local renewed = {}
+      for i = 1, #members, 2 do
+        if redis.call('zscore', queue:prefix('locks'), members[i + 1]) then
+          table.insert(renewed, members[i])
+          table.insert(renewed, members[i + 1])
+        else
+          queue.locks.add(members[i], members[i + 1])
+        end
+      end
+      Qless.zadd(queue:prefix('locks'), renewed)
+    end, remove = function(...)
+      local removed = 0
+      for _, jid in ipairs(arg) do
+        if redis.call('zrem', queue:prefix('locks'), jid) == 1 then
+          queue:concurrency(jid, -1)
+          removed = removed + 1
+        end
+      end
+      queue:count('running', -removed)
+      return removed
+    end, running = function(now)
+      return redis.call('zcount', queue:prefix('locks'), now, '+inf')
+    end, length = function(now)
+      if now then
+        return redis.call('zcount', queue:prefix('locks'), 0, now)
+      else
+        return redis.call('zcard', queue:prefix('locks'))
+      end
+    end, job_time_left = function(now, jid)
+      return tonumber(redis.call('zscore', queue:prefix('locks'), jid) or 0) - now
+    end
+  }
+
+  queue.depends = {
+    peek = function(now, offset, count)
+      return redis.call('zrange',
+        queue:prefix('depends'), offset, offset + count - 1)
+    end, add = function(now, jid)
+      queue:count('depends',
+        redis.call('zadd', queue:prefix('depends'), now, jid))
+    end, remove = function(...)
+      if #arg > 0 then
+        local removed = redis.call('zrem', queue:prefix('depends'), unpack(arg))
+        queue:count('depends', -removed)
+        return removed
+      end
+    end, length = function()
+      return redis.call('zcard', queue:prefix('depends'))
+    end
+  }
+
+  queue.scheduled = {
+    peek = function(now, offset, count)
+      return redis.call('zrange',
+        queue:prefix('scheduled'), offset, offset + count - 1)
+    end, ready = function(now, offset, count)
+      return redis.call('zrangebyscore',
+        queue:prefix('scheduled'), 0, now, 'LIMIT', offset, count)
+    end, add = function(when, jid)
+      queue:count('scheduled',
+        redis.call('zadd', queue:prefix('scheduled'), when, jid))
+    end, remove = function(...)
+      if #arg > 0 then
+        local removed = redis.call(
+          'zrem', queue:prefix('scheduled'), unpack(arg))
+        queue:count('scheduled', -removed)
+        return removed
+      end
+    end, length = function()
+      return redis.call('zcard', queue:prefix('scheduled'))
+    end
+  }
+
+  queue.recurring = {
+    peek = function(now, offset, count)
+      return redis.call('zrangebyscore', queue:prefix('recur'),
+        0, now, 'LIMIT', offset, count)
+    end, ready = function(now, offset, count)
+    end, add = function(when, jid)
+      queue:count('recurring',
+        redis.call('zadd', queue:prefix('recur'), when, jid))
+    end, remove = function(...)
+      if #arg > 0 then
+        local removed = redis.call('zrem', queue:prefix('recur'), unpack(arg))
+        queue:count('recurring', -removed)
+        return removed
+      end
+    end, update = function(increment, jid)
+      redis.call('zincrby', queue:prefix('recur'), increment, jid)
+    end, score = function(jid)
+      return redis.call('zscore', queue:prefix('recur'), jid)
+    end, length = function()
+      return redis.call('zcard', queue:prefix('recur'))
+    end
+  }
+  return queue
+end
+
+function QlessQueue:prefix(group)
+  if group then
+    return QlessQueue.ns..self.name..'-'..group
+  else
+    return QlessQueue.ns..self.name
+  end
+end
+
+function QlessQueue:signal(count)
+  local limit = tonumber(Qless.config.get('max-queue-signals', 100))
+  count = math.min(count or 1, limit)
+  if count <= 0 then
+    return
+  end
+  local tokens = {}
+  for i = 1, count do
+    table.insert(tokens, 1)
+  end
+  local key = self:prefix('signal')
+  local length = redis.call('rpush', key, unpack(tokens))
+  if length > limit then
+    redis.call('ltrim', key, -limit, -1)
+  end
+end
+
+function QlessQueue:stats(now, date)
+  date = assert(tonumber(date),
+    'Stats(): Arg "date" missing or not a number: '.. (date or 'nil'))
+
+  local bin = date - (date % 86400)
+
+  local mkstats = function(name, bin, queue)
+    local results = {}
+
+    local key = 'ql:s:' .. name .. ':' .. bin .. ':' .. queue
+    local count, mean, vk, compact = unpack(
+      redis.call('hmget', key, 'total', 'mean', 'vk', 'compact'))
+
+    count = tonumber(count) or 0
+    mean  = tonumber(mean) or 0
+    vk    = tonumber(vk)
+
+    results.count     = count or 0
+    results.mean      = mean  or 0
+    results.histogram = {}
+
+    if not count then
+      results.std = 0
+    else
+      if count > 1 then
+        results.std = math.sqrt(vk / (count - 1))
+      else
+        results.std = 0
+      end
+    end
+
+    if compact then
+      results.histogram = QlessQueue.histogram_counts(key .. '-histogram')
+    else
+      local histogram = redis.call('hmget', key, unpack(QlessQueue.histokeys))
+      for i=1,#QlessQueue.histokeys do
+        table.insert(results.histogram, tonumber(histogram[i]) or 0)
+      end
+    end
+    return results
+  end
+
+  local retries, failed, failures = unpack(redis.call('hmget', 'ql:s:stats:' .. bin .. ':' .. self.name, 'retries', 'failed', 'failures'))
+  return {
+    retries  = tonumber(retries  or 0),
+    failed   = tonumber(failed   or 0),
+    failures = tonumber(failures or 0),
+    wait     = mkstats('wait', bin, self.name),
+    run      = mkstats('run' , bin, self.name)
+  }
+end
+
+function QlessQueue:peek(now, count)
+  count = assert(tonumber(count),
+    'Peek(): Arg "count" missing or not a number: ' .. tostring(count))
+
+  local jids = self.locks.expired(now, 0, count)
+
+  self:check_recurring(now, count - #jids)
+
+  self:signal(self:check_scheduled(now, count - #jids))
+
+  local per_key = tonumber(
+    Qless.config.get(self.name .. '-max-concurrency-per-key', 0))
+  if per_key > 0 then
+    table.extend(jids, self:concurrency_peek(count - #jids, per_key))
+  else
+    table.extend(jids, self.work.peek(count - #jids))
+  end
+
+  return jids
+end
+
+function QlessQueue:paused()
+  return redis.call('sismember', 'ql:paused_queues', self.name) == 1
+end
+
+function QlessQueue.pause(now, ...)
+  redis.call('sadd', 'ql:paused_queues', unpack(arg))
+end
+
+function QlessQueue.unpause(...)
+  redis.call('srem', 'ql:paused_queues', unpack(arg))
+end
+
+function QlessQueue:pop(now, worker, count, klasses)
+  assert(worker, 'Pop(): Arg "worker" missing')
+  count = assert(tonumber(count),
+    'Pop(): Arg "count" missing or not a number: ' .. tostring(count))
+
+  local expires = now + tonumber(
+    Qless.config.get(self.name .. '-heartbeat') or
+    Qless.config.get('heartbeat', 60))
+
+  if self:paused() then
+    return {}
+  end
+
+  redis.call('zadd', 'ql:workers', now, worker)
+
+  local max_concurrency = tonumber(
+    Qless.config.get(self.name .. '-max-concurrency', 0))
+
+  if max_concurrency > 0 then
+    local allowed = math.max(0, max_concurrency - self.locks.running(now))
+    count = math.min(allowed, count)
+    if count == 0 then
+      return {}
+    end
+  end
+
+  local jids = self:invalidate_locks(now, count, klasses)
+
+  self:check_recurring(now, count - #jids)
+
+  local ready = self:check_scheduled(now, count - #jids)
+
+  local invalidated = #jids
+  local per_key = tonumber(
+    Qless.config.get(self.name .. '-max-concurrency-per-key', 0))
+  if per_key > 0 then
+    table.extend(jids, self:concurrency_peek(count - #jids, per_key, klasses))
+  else
+    table.extend(jids, self.work.peek(count - #jids, klasses))
+  end
+
+  self:signal(ready - (#jids - invalidated))
+
+  local state
+  for index, jid in ipairs(jids) do
+    local job = Qless.job(jid)
+    state = unpack(job:data('state'))
+    job:history(now, 'popped', {worker = worker}, self.name)
+
+    local time = tonumber(
+      redis.call('hget', QlessJob.ns .. jid, 'time') or now)
+    local waiting = now - time
+    self:stat(now, 'wait', waiting)
+    redis.call('hset', QlessJob.ns .. jid,
+      'time', string.format("%.20f", now))
+
+    redis.call('zadd', 'ql:w:' .. worker .. ':jobs', expires, jid)
+
+    job:update({
+      worker  = worker,
+      expires = expires,
+      state   = 'running'
+    })
+
+    self.locks.add(expires, jid)
+
+    local tracked = redis.call('zscore', 'ql:tracked', jid) ~= false
+    if tracked then
+      Qless.publish('popped', jid)
+    end
+  end
+
+  self.work.remove(unpack(jids))
+
+  return jids
+end
+
+function QlessQueue:peek_klasses(count, klasses)
+  local seen = {}
+  local found = {}
+  local candidates = {}
+  for _, klass in ipairs(klasses) do
+    if not seen[klass] then
+      seen[klass] = true
+      local reply = redis.call('zrevrange', self:prefix('work-' .. klass),
+        0, count - 1, 'withscores')
+      for i = 1, #reply, 2 do
+        found[reply[i]] = true
+        table.insert(candidates,
+          {jid = reply[i], score = tonumber(reply[i + 1])})
+      end
+    end
+  end
+
+  if not self:indexed() then
+    local limit = tonumber(Qless.config.get('pop-scan-limit', 100))
+    local reply = redis.call('zrevrange', self:prefix('work'),
+      0, count + limit - 1, 'withscores')
+    for i = 1, #reply, 2 do
+      local klass = redis.call('hget', QlessJob.ns .. reply[i], 'klass')
+      if not found[reply[i]] and klass and seen[klass] then
+        table.insert(candidates,
+          {jid = reply[i], score = tonumber(reply[i + 1])})
+      end
+    end
+  end
+
+  table.sort(candidates, function(a, b)
+    if a.score ~= b.score then
+      return a.score > b.score
+    end
+    return a.jid > b.jid
+  end)
+
+  local jids = {}
+  for i = 1, math.min(count, #candidates) do
+    table.insert(jids, candidates[i].jid)
+  end
+  return jids
+end
+
+function QlessQueue:indexed()
+  return redis.call('exists', self:prefix('klass-indexed')) == 1
+end
+
+function QlessQueue:reindex(budget, cursor)
+  budget = assert(tonumber(budget or 100),
+    'Reindex(): Arg "budget" not a number: ' .. tostring(budget))
+  cursor = assert(tonumber(cursor or 0),
+    'Reindex(): Arg "cursor" not a number: ' .. tostring(cursor))
+
+  local reply = redis.call('zscan', self:prefix('work'), cursor,
+    'count', budget)
+  local jids = reply[2]
+  for i = 1, #jids, 2 do
+    local klass = redis.call('hget', QlessJob.ns .. jids[i], 'klass')
+    if klass then
+      redis.call('zadd', self:prefix('work-' .. klass), jids[i + 1], jids[i])
+    end
+  end
+
+  cursor = tonumber(reply[1])
+  if cursor == 0 then
+    redis.call('set', self:prefix('klass-indexed'), 1)
+  end
+  return cursor
+end
+
+function QlessQueue:concurrency(jid, delta)
+  local key = redis.call('hget', QlessJob.ns .. jid, 'concurrency_key')
+  if key then
+    local running = redis.call(
+      'hincrby', self:prefix('concurrency'), key, delta)
+    if running <= 0 then
+      redis.call('hdel', self:prefix('concurrency'), key)
+    end
+  end
+end
+
+function QlessQueue:concurrency_peek(count, limit, klasses)
+  if count <= 0 then
+    return {}
+  end
+
+  local scan = tonumber(Qless.config.get('pop-scan-limit', 100))
+  local jids = {}
+  local taken = {}
+  for _, jid in ipairs(self.work.peek(count + scan, klasses)) do
+    local key = redis.call('hget', QlessJob.ns .. jid, 'concurrency_key')
+    if key then
+      if not taken[key] then
+        taken[key] = tonumber(redis.call(
+          'hget', self:prefix('concurrency'), key) or 0)
+      end
+      if taken[key] < limit then
+        taken[key] = taken[key] + 1
+        table.insert(jids, jid)
+      end
+    else
+      table.insert(jids, jid)
+    end
+
+    if #jids >= count then
+      break
+    end
+  end
+  return jids
+end
+
+function QlessQueue.pop_multi(now, worker, count, queues, mode)
+  assert(worker, 'PopMulti(): Arg "worker" missing')
+  count = assert(tonumber(count),
+    'PopMulti(): Arg "count" missing or not a number: ' .. tostring(count))
+  assert(#queues > 0, 'PopMulti(): No queues provided')
+  mode = mode or 'priority'
+  assert(mode == 'priority' or mode == 'weighted',
+    'PopMulti(): Arg "mode" must be "priority" or "weighted": ' ..
+    tostring(mode))
+
+  local shares = {}
+  local exhausted = {}
+  for i = 1, #queues do shares[i] = 0 end
+
+  if mode == 'weighted' then
+    local weights = {}
+    local total = 0
+    for i, name in ipairs(queues) do
+      weights[i] = assert(tonumber(Qless.config.get(name .. '-weight', 1)),
+        'PopMulti(): Weight for ' .. name .. ' not a number')
+      weights[i] = math.max(weights[i], 0)
+      total = total + weights[i]
+    end
+
+    if total > 0 then
+      local golden = 0.6180339887498949
+      for n = 1, count do
+        local point = ((math.floor(now) + n) * golden) % 1 * total
+        for i = 1, #queues do
+          point = point - weights[i]
+          if point < 0 or i == #queues then
+            shares[i] = shares[i] + 1
+            break
+          end
+        end
+      end
+    end
+  else
+    shares[1] = count
+  end
+
+  local jids = {}
+  local pop_from = function(i, share)
+    local queue = Qless.queue(queues[i])
+    local found = queue:pop(now, worker, share)
+    if #found < share then
+      exhausted[i] = true
+    end
+    table.extend(jids, found)
+  end
+
+  for i = 1, #queues do
+    if shares[i] > 0 then
+      pop_from(i, shares[i])
+    end
+  end
+
+  for i = 1, #queues do
+    if #jids >= count then
+      break
+    end
+    if not exhausted[i] then
+      pop_from(i, count - #jids)
+    end
+  end
+
+  return jids
+end
+
+QlessQueue.histokeys = {
+  's0','s1','s2','s3','s4','s5','s6','s7','s8','s9','s10','s11','s12','s13','s14','s15','s16','s17','s18','s19','s20','s21','s22','s23','s24','s25','s26','s27','s28','s29','s30','s31','s32','s33','s34','s35','s36','s37','s38','s39','s40','s41','s42','s43','s44','s45','s46','s47','s48','s49','s50','s51','s52','s53','s54','s55','s56','s57','s58','s59',
+  'm1','m2','m3','m4','m5','m6','m7','m8','m9','m10','m11','m12','m13','m14','m15','m16','m17','m18','m19','m20','m21','m22','m23','m24','m25','m26','m27','m28','m29','m30','m31','m32','m33','m34','m35','m36','m37','m38','m39','m40','m41','m42','m43','m44','m45','m46','m47','m48','m49','m50','m51','m52','m53','m54','m55','m56','m57','m58','m59',
+  'h1','h2','h3','h4','h5','h6','h7','h8','h9','h10','h11','h12','h13','h14','h15','h16','h17','h18','h19','h20','h21','h22','h23',
+  'd1','d2','d3','d4','d5','d6'
+}
+
+function QlessQueue.histogram_index(val)
+  val = math.floor(val)
+  if val < 0 then
+    return nil
+  elseif val < 60 then -- seconds
+    return val
+  elseif val < 3600 then -- minutes
+    return 59 + math.floor(val / 60)
+  elseif val < 86400 then -- hours
+    return 118 + math.floor(val / 3600)
+  elseif val < 7 * 86400 then -- days
+    return 141 + math.floor(val / 86400)
+  end
+end
+
+function QlessQueue.histogram_counts(key)
+  local packed = redis.call('get', key) or ''
+  local counts = {}
+  for i = 1, #QlessQueue.histokeys do
+    local a, b, c, d = string.byte(packed, 4 * i - 3, 4 * i)
+    table.insert(counts,
+      (((a or 0) * 256 + (b or 0)) * 256 + (c or 0)) * 256 + (d or 0))
+  end
+  return counts
+end
+
+function QlessQueue.histogram_add(key, increments, order)
+  if #order == 0 then
+    return
+  end
+
+  if Qless.can_bitfield ~= false then
+    local args = {'OVERFLOW', 'SAT'}
+    for _, index in ipairs(order) do
+      table.insert(args, 'INCRBY')
+      table.insert(args, 'u32')
+      table.insert(args, '#' .. index)
+      table.insert(args, increments[index])
+    end
+    local reply = redis.pcall('bitfield', key, unpack(args))
+    if type(reply) ~= 'table' or not reply.err then
+      Qless.can_bitfield = true
+      return
+    end
+    Qless.can_bitfield = false
+  end
+
+  for _, index in ipairs(order) do
+    local offset = 4 * index
+    local a, b, c, d = string.byte(
+      redis.call('getrange', key, offset, offset + 3), 1, 4)
+    local value = math.min(4294967295,
+      (((a or 0) * 256 + (b or 0)) * 256 + (c or 0)) * 256 + (d or 0) +
+      increments[index])
+    redis.call('setrange', key, offset, string.char(
+      math.floor(value / 16777216) % 256,
+      math.floor(value / 65536) % 256,
+      math.floor(value / 256) % 256,
+      value % 256))
+  end
+end
+
+function QlessQueue:stat(now, stat, val)
+  return self:stat_many(now, stat, {val})
+end
+
+function QlessQueue:stat_many(now, stat, vals)
+  if #vals == 0 then
+    return
+  end
+
+  local bin = now - (now % 86400)
+  local key = 'ql:s:' .. stat .. ':' .. bin .. ':' .. self.name
+
+  local count, mean, vk, compact = unpack(
+    redis.call('hmget', key, 'total', 'mean', 'vk', 'compact'))
+
+  count = tonumber(count or 0)
+  mean  = tonumber(mean or 0)
+  vk    = tonumber(vk or 0)
+
+  local increments = {}
+  local order = {}
+  local increment = function(index, by)
+    if not increments[index] then
+      increments[index] = 0
+      table.insert(order, index)
+    end
+    increments[index] = increments[index] + by
+  end
+
+  if count > 0 and not compact then
+    local histogram = redis.call('hmget', key, unpack(QlessQueue.histokeys))
+    for i = 1, #QlessQueue.histokeys do
+      local value = tonumber(histogram[i])
+      if value then
+        increment(i - 1, value)
+      end
+    end
+    redis.call('hdel', key, unpack(QlessQueue.histokeys))
+  end
+
+  for _, val in ipairs(vals) do
+    if count == 0 then
+      mean  = val
+      vk    = 0
+      count = 1
+    else
+      count = count + 1
+      local oldmean = mean
+      mean  = mean + (val - mean) / count
+      vk    = vk + (val - mean) * (val - oldmean)
+    end
+
+    local index = QlessQueue.histogram_index(val)
+    if index then
+      increment(index, 1)
+    end
+  end
+
+  QlessQueue.histogram_add(key .. '-histogram', increments, order)
+  redis.call('hmset', key,
+    'total', count, 'mean', mean, 'vk', vk, 'compact', 1)
+end
+
+function QlessQueue:put(now, worker, jid, klass, raw_data, delay, ...)
+  assert(jid  , 'Put(): Arg "jid" missing')
+  assert(klass, 'Put(): Arg "klass" missing')
+  local data = assert(cjson.decode(raw_data),
+    'Put(): Arg "data" missing or not JSON: ' .. tostring(raw_data))
+  delay = assert(tonumber(delay),
+    'Put(): Arg "delay" not a number: ' .. tostring(delay))
+
+  if #arg % 2 == 1 then
+    error('Odd number of additional args: ' .. tostring(arg))
+  end
+  local options = {}
+  for i = 1, #arg, 2 do options[arg[i]] = arg[i + 1] end
+
+  return self:enqueue(now, worker, jid, klass, raw_data, delay, options)
+end
+
+function QlessQueue:put_many(now, worker, raw_jobs)
+  assert(raw_jobs, 'PutMany(): Arg "jobs" missing')
+  local jobs = assert(cjson.decode(raw_jobs),
+    'PutMany(): Arg "jobs" not JSON: ' .. tostring(raw_jobs))
+  assert(type(jobs) == 'table',
+    'PutMany(): Arg "jobs" not a JSON array: ' .. tostring(raw_jobs))
+
+  QlessJob.history_limit(self.name)
+  local specs = {}
+  for i, job in ipairs(jobs) do
+    assert(type(job) == 'table',
+      'PutMany(): Job ' .. i .. ' is not a JSON object')
+    local jid = assert(job.jid, 'PutMany(): Job ' .. i .. ' missing "jid"')
+    assert(type(jid) == 'string' or type(jid) == 'number',
+      'PutMany(): Job ' .. i .. ' "jid" not a string')
+    assert(job.klass, 'PutMany(): Job ' .. jid .. ' missing "klass"')
+    assert(type(job.klass) == 'string',
+      'PutMany(): Job ' .. jid .. ' "klass" not a string')
+
+    local raw_data = job.data
+    if type(raw_data) == 'string' then
+      assert(cjson.decode(raw_data),
+        'PutMany(): Job ' .. jid .. ' "data" not JSON: ' .. raw_data)
+    else
+      raw_data = cjson.encode(raw_data or {})
+    end
+
+    local delay = assert(tonumber(job.delay or 0),
+      'PutMany(): Job ' .. jid .. ' "delay" not a number: ' ..
+      tostring(job.delay))
+
+    local options = {}
+    for _, key in ipairs({'priority', 'retries', 'replace'}) do
+      if job[key] ~= nil then
+        options[key] = assert(tonumber(job[key]),
+          'PutMany(): Job ' .. jid .. ' "' .. key .. '" not a number: ' ..
+          tostring(job[key]))
+      end
+    end
+    for _, key in ipairs({'tags', 'depends'}) do
+      if job[key] ~= nil then
+        assert(type(job[key]) == 'table',
+          'PutMany(): Job ' .. jid .. ' "' .. key .. '" not a JSON array')
+        for _, value in ipairs(job[key]) do
+          assert(type(value) == 'string' or type(value) == 'number',
+            'PutMany(): Job ' .. jid .. ' "' .. key .. '" not all strings')
+        end
+        options[key] = cjson.encode(job[key])
+      end
+    end
+    if job.resources ~= nil then
+      assert(type(job.resources) == 'table', 'PutMany(): Job ' .. jid ..
+        ' "resources" not a JSON array or object')
+      QlessResource.check(QlessResource.weights(job.resources), 'PutMany')
+      options.resources = cjson.encode(job.resources)
+    end
+    if job.concurrency_key ~= nil then
+      options.concurrency_key = tostring(job.concurrency_key)
+    end
+
+    table.insert(specs, {
+      jid      = tostring(jid),
+      klass    = job.klass,
+      raw_data = raw_data,
+      delay    = delay,
+      options  = options
+    })
+  end
+
+  local batch = {
+    jids    = {},
+    ready   = 0,
+    tracked = redis.call('zcard', 'ql:tracked') > 0
+  }
+  local response = {}
+  for _, spec in ipairs(specs) do
+    table.insert(response, self:enqueue(now, worker, spec.jid, spec.klass,
+      spec.raw_data, spec.delay, spec.options, batch))
+  end
+
+  if #batch.jids > 0 then
+    if redis.call('zscore', 'ql:queues', self.name) == false then
+      redis.call('zadd', 'ql:queues', now, self.name)
+    end
+  end
+  self:signal(batch.ready)
+
+  return response
+end
+
+function QlessQueue:complete_many(now, worker, raw_jobs)
+  assert(worker, 'CompleteMany(): Arg "worker" missing')
+  assert(raw_jobs, 'CompleteMany(): Arg "jobs" missing')
+  local jobs = assert(cjson.decode(raw_jobs),
+    'CompleteMany(): Arg "jobs" not JSON: ' .. tostring(raw_jobs))
+  assert(type(jobs) == 'table',
+    'CompleteMany(): Arg "jobs" not a JSON array: ' .. tostring(raw_jobs))
+
+  local batch = {
+    jids    = {},
+    waits   = {},
+    queues  = {},
+    tracked = redis.call('zcard', 'ql:tracked') > 0
+  }
+  local response = {}
+  for i, job in ipairs(jobs) do
+    assert(type(job) == 'table' and job.jid,
+      'CompleteMany(): Job ' .. i .. ' is not a JSON object with a "jid"')
+    local jid = tostring(job.jid)
+
+    local raw_data = job.data
+    if raw_data ~= nil and type(raw_data) ~= 'string' then
+      raw_data = cjson.encode(raw_data)
+    end
+    local options = {
+      next  = job.next,
+      delay = job.delay
+    }
+    if job.depends ~= nil then
+      options.depends = cjson.encode(job.depends)
+    end
+
+    local ok, result = Qless.attempt(function()
+      return Qless.job(jid):finish(
+        now, worker, self.name, raw_data, options, batch)
+    end)
+    if ok then
+      table.insert(response, {jid = jid, state = result})
+    else
+      table.insert(response, {jid = jid, error = result})
+    end
+  end
+
+  if #batch.jids > 0 then
+    self:stat_many(now, 'run', batch.waits)
+    redis.call('zrem', 'ql:w:' .. worker .. ':jobs', unpack(batch.jids))
+    Qless.gc(now,
+      Qless.config.get('gc-inline-budget', 10) * #batch.jids)
+  end
+
+  return response
+end
+
+function QlessQueue:enqueue(now, worker, jid, klass, raw_data, delay, options,
+  batch)
+  local job = Qless.job(jid)
+  local priority, tags, oldqueue, state, failure, retries, oldworker,
+    concurrency_key = unpack(redis.call('hmget', QlessJob.ns .. jid,
+      'priority', 'tags', 'queue', 'state', 'failure', 'retries', 'worker',
+      'concurrency_key'))
+
+  local replace = assert(tonumber(options['replace'] or 1) ,
+    'Put(): Arg "replace" not a number: ' .. tostring(options['replace']))
+
+  if replace == 0 and state == 'running' then
+    local time_left = self.locks.job_time_left(now, jid)
+    if time_left > 0 then
+      return time_left
+    end
+  end
+
+  retries  = assert(tonumber(options['retries']  or retries or 5) ,
+    'Put(): Arg "retries" not a number: ' .. tostring(options['retries']))
+  local oldtags = cjson.decode(tags or '[]')
+  tags     = assert(cjson.decode(options['tags'] or tags or '[]' ),
+    'Put(): Arg "tags" not JSON'          .. tostring(options['tags']))
+  priority = assert(tonumber(options['priority'] or priority or 0),
+    'Put(): Arg "priority" not a number'  .. tostring(options['priority']))
+  local depends = assert(cjson.decode(options['depends'] or '[]') ,
+    'Put(): Arg "depends" not JSON: '     .. tostring(options['depends']))
+  local resources = assert(cjson.decode(options['resources'] or '[]'),
+    'Put(): Arg "resources" not JSON array or object: '     .. tostring(options['resources']))
+  QlessResource.check(QlessResource.weights(resources), 'Put')
+
+  if #depends > 0 then
+    local new = {}
+    for _, d in ipairs(depends) do new[d] = 1 end
+
+    local original = redis.call(
+      'smembers', QlessJob.ns .. jid .. '-dependencies')
+    for _, dep in pairs(original) do
+      if new[dep] == nil or new[dep] == false then
+        redis.call('srem', QlessJob.ns .. dep .. '-dependents'  , jid)
+        redis.call('srem', QlessJob.ns .. jid .. '-dependencies', dep)
+      end
+    end
+  end
+
+  if batch then
+    table.insert(batch.jids, jid)
+  end
+  Qless.publish('log', cjson.encode({
+    jid   = jid,
+    event = 'put',
+    queue = self.name
+  }))
+
+  if state then
+    job:history(now, 'put', {q = self.name}, self.name)
+  else
+    job:start_history(now, 'put', {q = self.name}, self.name)
+  end
+
+  if oldqueue then
+    local queue_obj = Qless.queue(oldqueue)
+    queue_obj.work.remove(jid)
+    queue_obj.locks.remove(jid)
+    queue_obj.depends.remove(jid)
+    queue_obj.scheduled.remove(jid)
+  end
+
+  if oldworker and oldworker ~= '' then
+    redis.call('zrem', 'ql:w:' .. oldworker .. ':jobs', jid)
+    if oldworker ~= worker then
+      local encoded = cjson.encode({
+        jid    = jid,
+        event  = 'lock_lost',
+        worker = oldworker
+      })
+      Qless.publish('w:' .. oldworker, encoded)
+      Qless.publish('log', encoded)
+    end
+  end
+
+  if state == 'complete' then
+    redis.call('zrem', 'ql:completed', jid)
+  end
+
+  Qless.retag(now, jid, oldtags, tags)
+
+  if state == 'failed' then
+    failure = cjson.decode(failure)
+    Qless.remove_failures(failure.group, jid)
+    local bin = failure.when - (failure.when % 86400)
+    redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. self.name, 'failed'  , -1)
+  end
+
+  redis.call('hmset', QlessJob.ns .. jid,
+    'jid'      , jid,
+    'klass'    , klass,
+    'data'     , raw_data,
+    'priority' , priority,
+    'tags'     , cjson.encode(tags),
+    'resources', cjson.encode(resources),
+    'state'    , ((delay > 0) and 'scheduled') or 'waiting',
+    'worker'   , '',
+    'expires'  , 0,
+    'queue'    , self.name,
+    'retries'  , retries,
+    'remaining', retries,
+    'time'     , string.format("%.20f", now))
+  concurrency_key = options['concurrency_key'] or concurrency_key
+  if concurrency_key and concurrency_key ~= '' then
+    redis.call('hset', QlessJob.ns .. jid, 'concurrency_key', concurrency_key)
+  else
+    redis.call('hdel', QlessJob.ns .. jid, 'concurrency_key')
+  end
+
+  for i, j in ipairs(depends) do
+    local state = redis.call('hget', QlessJob.ns .. j, 'state')
+    if (state and state ~= 'complete') then
+      redis.call('sadd', QlessJob.ns .. j .. '-dependents'  , jid)
+      redis.call('sadd', QlessJob.ns .. jid .. '-dependencies', j)
+    end
+  end
+
+  local ready = false
+  if delay > 0 then
+    if redis.call('scard', QlessJob.ns .. jid .. '-dependencies') > 0 then
+      self.depends.add(now, jid)
+      redis.call('hmset', QlessJob.ns .. jid,
+        'state', 'depends',
+        'scheduled', now + delay)
+    else
+      self.scheduled.add(now + delay, jid)
+    end
+  else
+    if redis.call('scard', QlessJob.ns .. jid .. '-dependencies') > 0 then
+      self.depends.add(now, jid)
+      redis.call('hset', QlessJob.ns .. jid, 'state', 'depends')
+    elseif next(resources) then
+      if Qless.job(jid):acquire_resources(now) then
+        self.work.add(now, priority, jid)
+        ready = true
+      end
+    else
+      self.work.add(now, priority, jid)
+      ready = true
+    end
+  end
+
+  if ready then
+    if batch then
+      batch.ready = batch.ready + 1
+    else
+      self:signal(1)
+    end
+  end
+
+  if not batch and redis.call('zscore', 'ql:queues', self.name) == false then
+    redis.call('zadd', 'ql:queues', now, self.name)
+  end
+
+  if (not batch or batch.tracked) and
+    redis.call('zscore', 'ql:tracked', jid) ~= false then
+    Qless.publish('put', jid)
+  end
+
+  return jid
+end
+
+function QlessQueue:unfail(now, group, count)
+  assert(group, 'Unfail(): Arg "group" missing')
+  count = assert(tonumber(count or 25),
+    'Unfail(): Arg "count" not a number: ' .. tostring(count))
+
+  local key, legacy = Qless.failure_group(group)
+  local jids
+  if legacy then
+    jids = redis.call('lrange', key, -count, -1)
+  else
+    jids = redis.call('zrange', key, 0, count - 1)
+  end
+
+  local toinsert = {}
+  local ready = 0
+  for index, jid in ipairs(jids) do
+    local job = Qless.job(jid)
+    local data = job:data()
+    job:history(now, 'put', {q = self.name}, self.name)
+    redis.call('hmset', QlessJob.ns .. data.jid,
+      'state'    , 'waiting',
+      'worker'   , '',
+      'expires'  , 0,
+      'queue'    , self.name,
+      'remaining', data.retries or 5)
+
+    if #data['resources'] then
+      if job:acquire_resources(now) then
+        self.work.add(now, data.priority, data.jid)
+        ready = ready + 1
+      end
+    else
+      self.work.add(now, data.priority, data.jid)
+      ready = ready + 1
+    end
+  end
+  self:signal(ready)
+
+  if #jids > 0 then
+    if legacy then
+      redis.call('ltrim', key, 0, -#jids - 1)
+      for _, jid in ipairs(jids) do
+        redis.call('zrem', key .. '-migrating', jid)
+      end
+    else
+      redis.call('zremrangebyrank', key, 0, #jids - 1)
+    end
+    Qless.removed_failures(group, #jids)
+  end
+
+  return #jids
+end
+
+function QlessQueue:recur(now, jid, klass, raw_data, spec, ...)
+  assert(jid  , 'RecurringJob On(): Arg "jid" missing')
+  assert(klass, 'RecurringJob On(): Arg "klass" missing')
+  assert(spec , 'RecurringJob On(): Arg "spec" missing')
+  local data = assert(cjson.decode(raw_data),
+    'RecurringJob On(): Arg "data" not JSON: ' .. tostring(raw_data))
+
+  if spec == 'interval' then
+    local interval = assert(tonumber(arg[1]),
+      'Recur(): Arg "interval" not a number: ' .. tostring(arg[1]))
+    local offset   = assert(tonumber(arg[2]),
+      'Recur(): Arg "offset" not a number: '   .. tostring(arg[2]))
+    if interval <= 0 then
+      error('Recur(): Arg "interval" must be greater than 0')
+    end
+
+    if #arg % 2 == 1 then
+      error('Odd number of additional args: ' .. tostring(arg))
+    end
+
+    local options = {}
+    for i = 3, #arg, 2 do options[arg[i]] = arg[i + 1] end
+    options.tags = assert(cjson.decode(options.tags or '{}'),
+      'Recur(): Arg "tags" must be JSON string array: ' .. tostring(
+        options.tags))
+    options.priority = assert(tonumber(options.priority or 0),
+      'Recur(): Arg "priority" not a number: ' .. tostring(
+        options.priority))
+    options.retries = assert(tonumber(options.retries  or 0),
+      'Recur(): Arg "retries" not a number: ' .. tostring(
+        options.retries))
+    options.backlog = assert(tonumber(options.backlog  or 0),
+      'Recur(): Arg "backlog" not a number: ' .. tostring(
+        options.backlog))
+    options.resources = assert(cjson.decode(options['resources'] or '[]'),
+      'Recur(): Arg "resources" not JSON array or object: '     .. tostring(options['resources']))
+    QlessResource.check(QlessResource.weights(options.resources), 'Recur')
+
+    local count, old_queue = unpack(redis.call('hmget', 'ql:r:' .. jid, 'count', 'queue'))
+    count = count or 0
+
+    if old_queue then
+      Qless.queue(old_queue).recurring.remove(jid)
+    end
+
+    redis.call('hmset', 'ql:r:' .. jid,
+      'jid'     , jid,
+      'klass'   , klass,
+      'data'    , raw_data,
+      'priority', options.priority,
+      'tags'    , cjson.encode(options.tags or {}),
+      'state'   , 'recur',
+      'queue'   , self.name,
+      'type'    , 'interval',
+      'count'   , count,
+      'interval', interval,
+      'retries' , options.retries,
+      'backlog' , options.backlog,
+      'resources', cjson.encode(options.resources))
+    self.recurring.add(now + offset, jid)
+
+    if redis.call('zscore', 'ql:queues', self.name) == false then
+      redis.call('zadd', 'ql:queues', now, self.name)
+    end
+
+    return jid
+  else
+    error('Recur(): schedule type "' .. tostring(spec) .. '" unknown')
+  end
+end
+
+function QlessQueue:length()
+  return  self.locks.length() + self.work.length() + self.scheduled.length()
+end
+
+function QlessQueue:check_recurring(now, count)
+  local moved = 0
+  local r = self.recurring.peek(now, 0, count)
+  for index, jid in ipairs(r) do
+    local klass, data, priority, tags, retries, interval, backlog, resources = unpack(
+      redis.call('hmget', 'ql:r:' .. jid, 'klass', 'data', 'priority',
+        'tags', 'retries', 'interval', 'backlog', 'resources'))
+    local _tags = cjson.decode(tags)
+    local resources = cjson.decode(resources or '[]')
+    local score = math.floor(tonumber(self.recurring.score(jid)))
+    interval = tonumber(interval)
+
+    backlog = tonumber(backlog or 0)
+    if backlog ~= 0 then
+      local num = ((now - score) / interval)
+      if num > backlog then
+        score = score + (
+          math.ceil(num - backlog) * interval
+        )
+      end
+    end
+
+    while (score <= now) and (moved < count) do
+      local count = redis.call('hincrby', 'ql:r:' .. jid, 'count', 1)
+      moved = moved + 1
+
+      local child_jid = jid .. '-' .. count
+
+      Qless.retag(now, child_jid, {}, _tags)
+
+      redis.call('hmset', QlessJob.ns .. child_jid,
+        'jid'             , child_jid,
+        'klass'           , klass,
+        'data'            , data,
+        'priority'        , priority,
+        'tags'            , tags,
+        'state'           , 'waiting',
+        'worker'          , '',
+        'expires'         , 0,
+        'queue'           , self.name,
+        'retries'         , retries,
+        'remaining'       , retries,
+        'time'            , string.format("%.20f", score),
+        'spawned_from_jid', jid,
+        'resources', cjson.encode(resources))
+
+      local job = Qless.job(child_jid)
+      job:start_history(score, 'put', {q = self.name}, self.name)
+      
+
+      local add_job = true
+      if #resources then
+        add_job = job:acquire_resources(score)
+      end
+      if add_job then
+        self.work.add(score, priority, child_jid)
+      end
+      
+      score = score + interval
+      self.recurring.add(score, jid)
+    end
+  end
+end
+
+function QlessQueue:check_scheduled(now, count)
+  local ready = 0
+  local scheduled = self.scheduled.ready(now, 0, count)
+  for index, jid in ipairs(scheduled) do
+    local priority = tonumber(
+      redis.call('hget', QlessJob.ns .. jid, 'priority') or 0)
+    if Qless.job(jid):acquire_resources(now) then
+      self.work.add(now, priority, jid)
+      ready = ready + 1
+    end
+    self.scheduled.remove(jid)
+
+    redis.call('hset', QlessJob.ns .. jid, 'state', 'waiting')
+  end
+  return ready
+end
+
+function QlessQueue:invalidate_locks(now, count, klasses)
+  local jids = {}
+  local expired = self.locks.expired(now, 0, count)
+  if klasses then
+    local allowed = {}
+    for _, klass in ipairs(klasses) do allowed[klass] = true end
+    local filtered = {}
+    for _, jid in ipairs(expired) do
+      if allowed[redis.call('hget', QlessJob.ns .. jid, 'klass')] then
+        table.insert(filtered, jid)
+      end
+    end
+    self:signal(#expired - #filtered)
+    expired = filtered
+  end
+
+  for index, jid in ipairs(expired) do
+    local worker, failure = unpack(
+      redis.call('hmget', QlessJob.ns .. jid, 'worker', 'failure'))
+    redis.call('zrem', 'ql:w:' .. worker .. ':jobs', jid)
+
+    local grace_period = tonumber(Qless.config.get('grace-period'))
+
+    local courtesy_sent = tonumber(
+      redis.call('hget', QlessJob.ns .. jid, 'grace') or 0)
+
+    local send_message = (courtesy_sent ~= 1)
+    local invalidate   = not send_message
+
+    if grace_period <= 0 then
+      send_message = true
+      invalidate   = true
+    end
+
+    if send_message then
+      if redis.call('zscore', 'ql:tracked', jid) ~= false then
+        Qless.publish('stalled', jid)
+      end
+      Qless.job(jid):history(now, 'timed-out', nil, self.name)
+      redis.call('hset', QlessJob.ns .. jid, 'grace', 1)
+
+      local encoded = cjson.encode({
+        jid    = jid,
+        event  = 'lock_lost',
+        worker = worker
+      })
+      Qless.publish('w:' .. worker, encoded)
+      Qless.publish('log', encoded)
+      self.locks.add(now + grace_period, jid)
+
+      local bin = now - (now % 86400)
+      redis.call('hincrby',
+        'ql:s:stats:' .. bin .. ':' .. self.name, 'retries', 1)
+    end
+
+    if invalidate then
+      redis.call('hdel', QlessJob.ns .. jid, 'grace', 0)
+
+      local remaining = tonumber(redis.call(
+        'hincrby', QlessJob.ns .. jid, 'remaining', -1))
+
+      if remaining < 0 then
+        Qless.job(jid):release_resources(now)
+
+        self.work.remove(jid)
+        self.locks.remove(jid)
+        self.scheduled.remove(jid)
+
+        local group = 'failed-retries-' .. Qless.job(jid):data()['queue']
+        local job = Qless.job(jid)
+        job:history(now, 'failed', {group = group}, self.name)
+        redis.call('hmset', QlessJob.ns .. jid, 'state', 'failed',
+          'worker', '',
+          'expires', '')
+        redis.call('hset', QlessJob.ns .. jid,
+        'failure', cjson.encode({
+          ['group']   = group,
+          ['message'] =
+            'Job exhausted retries in queue "' .. self.name .. '"',
+          ['when']    = now,
+          ['worker']  = unpack(job:data('worker'))
+        }))
+
+        Qless.add_failure(group, jid, now)
+
+        if redis.call('zscore', 'ql:tracked', jid) ~= false then
+          Qless.publish('failed', jid)
+        end
+        Qless.publish('log', cjson.encode({
+          jid     = jid,
+          event   = 'failed',
+          group   = group,
+          worker  = worker,
+          message =
+            'Job exhausted retries in queue "' .. self.name .. '"'
+        }))
+
+        local bin = now - (now % 86400)
+        redis.call('hincrby',
+          'ql:s:stats:' .. bin .. ':' .. self.name, 'failures', 1)
+        redis.call('hincrby',
+          'ql:s:stats:' .. bin .. ':' .. self.name, 'failed'  , 1)
+      else
+        table.insert(jids, jid)
+      end
+    end
+  end
+
+  return jids
+end
+
+function QlessQueue.deregister(...)
+  redis.call('zrem', Qless.ns .. 'queues', unpack(arg))
+end
+
+function QlessQueue.counts(now, name)
+  if name then
+    local queue = Qless.queue(name)
+    local counts = queue:counters()
+    local stalled = queue.locks.length(now)
+    local ready = redis.call('zcount', queue:prefix('scheduled'), 0, now)
+    return {
+      name      = name,
+      waiting   = counts.waiting + ready,
+      stalled   = stalled,
+      running   = counts.running - stalled,
+      scheduled = counts.scheduled - ready,
+      depends   = counts.depends,
+      recurring = counts.recurring,
+      paused    = queue:paused()
+    }
+  else
+    local queues = redis.call('zrange', 'ql:queues', 0, -1)
+    local response = {}
+    for index, qname in ipairs(queues) do
+      table.insert(response, QlessQueue.counts(now, qname))
+    end
+    return response
+  end
+end
+
+function QlessQueue.list(now, offset, count)
+  offset = assert(tonumber(offset or 0),
+    'List(): Arg "offset" not a number: ' .. tostring(offset))
+  count = assert(tonumber(count or 25),
+    'List(): Arg "count" not a number: ' .. tostring(count))
+  local response = {}
+  for index, qname in ipairs(redis.call(
+    'zrange', 'ql:queues', offset, offset + count - 1)) do
+    table.insert(response, QlessQueue.counts(now, qname))
+  end
+  return response
+end
+
+QlessQueue.counter_names = {
+  'waiting', 'running', 'scheduled', 'depends', 'recurring'}
+
+function QlessQueue:count(name, delta)
+  if delta == 0 then
+    return
+  end
+  if not self.counted then
+    self.counted = true
+    if redis.call('exists', self:prefix('counts')) == 0 then
+      self:recount()
+      return
+    end
+  end
+  redis.call('hincrby', self:prefix('counts'), name, delta)
+end
+
+function QlessQueue:counters()
+  local values = redis.call(
+    'hmget', self:prefix('counts'), unpack(QlessQueue.counter_names))
+  if not values[1] then
+    return self:sizes()
+  end
+  local counts = {}
+  for index, name in ipairs(QlessQueue.counter_names) do
+    counts[name] = tonumber(values[index] or 0)
+  end
+  return counts
+end
+
+function QlessQueue:sizes()
+  return {
+    waiting   = self.work.length(),
+    running   = self.locks.length(),
+    scheduled = self.scheduled.length(),
+    depends   = self.depends.length(),
+    recurring = self.recurring.length()
+  }
+end
+
+function QlessQueue:recount()
+  local counts = self:sizes()
+  local args = {}
+  for _, name in ipairs(QlessQueue.counter_names) do
+    table.insert(args, name)
+    table.insert(args, counts[name])
+  end
+  redis.call('hmset', self:prefix('counts'), unpack(args))
+  self.counted = true
+  return counts
+end
+function QlessRecurringJob:data()
+  local job = redis.call(
+    'hmget', 'ql:r:' .. self.jid, 'jid', 'klass', 'state', 'queue',
+    'priority', 'interval', 'retries', 'count', 'data', 'tags', 'backlog')
+
+  if not job[1] then
+    return nil
+  end
+
+  return {
+    jid          = job[1],
+    klass        = job[2],
+    state        = job[3],
+    queue        = job[4],
+    priority     = tonumber(job[5]),
+    interval     = tonumber(job[6]),
+    retries      = tonumber(job[7]),
+    count        = tonumber(job[8]),
+    data         = job[9],
+    tags         = cjson.decode(job[10]),
+    backlog      = tonumber(job[11] or 0)
+  }
+end
+
+function QlessRecurringJob:update(now, ...)
+  local options = {}
+  if redis.call('exists', 'ql:r:' .. self.jid) ~= 0 then
+    for i = 1, #arg, 2 do
+      local key = arg[i]
+      local value = arg[i+1]
+      assert(value, 'No value provided for ' .. tostring(key))
+      if key == 'priority' or key == 'interval' or key == 'retries' then
+        value = assert(tonumber(value), 'Recur(): Arg "' .. key .. '" must be a number: ' .. tostring(value))
+        if key == 'interval' then
+          local queue, interval = unpack(redis.call('hmget', 'ql:r:' .. self.jid, 'queue', 'interval'))
+          Qless.queue(queue).recurring.update(
+            value - tonumber(interval), self.jid)
+        end
+        redis.call('hset', 'ql:r:' .. self.jid, key, value)
+      elseif key == 'data' then
+        assert(cjson.decode(value), 'Recur(): Arg "data" is not JSON-encoded: ' .. tostring(value))
+        redis.call('hset', 'ql:r:' .. self.jid, 'data', value)
+      elseif key == 'klass' then
+        redis.call('hset', 'ql:r:' .. self.jid, 'klass', value)
+      elseif key == 'queue' then
+        local queue_obj = Qless.queue(
+          redis.call('hget', 'ql:r:' .. self.jid, 'queue'))
+        local score = queue_obj.recurring.score(self.jid)
+        queue_obj.recurring.remove(self.jid)
+        Qless.queue(value).recurring.add(score, self.jid)
+        redis.call('hset', 'ql:r:' .. self.jid, 'queue', value)
+        if redis.call('zscore', 'ql:queues', value) == false then
+          redis.call('zadd', 'ql:queues', now, value)
+        end
+      elseif key == 'backlog' then
+        value = assert(tonumber(value),
+          'Recur(): Arg "backlog" not a number: ' .. tostring(value))
+        redis.call('hset', 'ql:r:' .. self.jid, 'backlog', value)
+      else
+        error('Recur(): Unrecognized option "' .. key .. '"')
+      end
+    end
+    return true
+  else
+    error('Recur(): No recurring job ' .. self.jid)
+  end
+end
+
+function QlessRecurringJob:tag(...)
+  local tags = redis.call('hget', 'ql:r:' .. self.jid, 'tags')
+  if tags then
+    tags = cjson.decode(tags)
+    local _tags = {}
+    for i,v in ipairs(tags) do _tags[v] = true end
+
+    for i=1,#arg do if _tags[arg[i]] == nil or _tags[arg[i]] == false then table.insert(tags, arg[i]) end end
+
+    tags = cjson.encode(tags)
+    redis.call('hset', 'ql:r:' .. self.jid, 'tags', tags)
+    return tags
+  else
+    error('Tag(): Job ' .. self.jid .. ' does not exist')
+  end
+end
+
+function QlessRecurringJob:untag(...)
+  local tags = redis.call('hget', 'ql:r:' .. self.jid, 'tags')
+  if tags then
+    tags = cjson.decode(tags)
+    local _tags    = {}
+    for i,v in ipairs(tags) do _tags[v] = true end
+    for i = 1,#arg do _tags[arg[i]] = nil end
+    local results = {}
+    for i, tag in ipairs(tags) do if _tags[tag] then table.insert(results, tag) end end
+    tags = cjson.encode(results)
+    redis.call('hset', 'ql:r:' .. self.jid, 'tags', tags)
+    return tags
+  else
+    error('Untag(): Job ' .. self.jid .. ' does not exist')
+  end
+end
+
+function QlessRecurringJob:unrecur()
+  local queue = redis.call('hget', 'ql:r:' .. self.jid, 'queue')
+  if queue then
+    Qless.queue(queue).recurring.remove(self.jid)
+    redis.call('del', 'ql:r:' .. self.jid)
+    return true
+  else
+    return true
+  end
+end
+function QlessWorker.deregister(...)
+  redis.call('zrem', 'ql:workers', unpack(arg))
+end
+
+function QlessWorker.heartbeat(now, worker, raw_jobs)
+  assert(worker, 'HeartbeatMany(): Arg "worker" missing')
+  assert(raw_jobs, 'HeartbeatMany(): Arg "jobs" missing')
+  local jobs = assert(cjson.decode(raw_jobs),
+    'HeartbeatMany(): Arg "jobs" not JSON: ' .. tostring(raw_jobs))
+  assert(type(jobs) == 'table',
+    'HeartbeatMany(): Arg "jobs" not a JSON array: ' .. tostring(raw_jobs))
+
+  local batch = {
+    jobs      = {},
+    locks     = {},
+    queues    = {},
+    intervals = {}
+  }
+  local response = {}
+  for i, job in ipairs(jobs) do
+    assert(type(job) == 'table' and job.jid,
+      'HeartbeatMany(): Job ' .. i .. ' is not a JSON object with a "jid"')
+    local jid = tostring(job.jid)
+
+    local data = job.data
+    if data ~= nil and type(data) ~= 'string' then
+      data = cjson.encode(data)
+    end
+
+    local ok, result = Qless.attempt(function()
+      return Qless.job(jid):heartbeat(now, worker, data, batch)
+    end)
+    if ok then
+      table.insert(response, {jid = jid, expires = result})
+    else
+      table.insert(response, {jid = jid, error = result})
+    end
+  end
+
+  if #batch.jobs > 0 then
+    Qless.zadd('ql:w:' .. worker .. ':jobs', batch.jobs)
+    for _, queue in ipairs(batch.queues) do
+      Qless.queue(queue).locks.add_many(batch.locks[queue])
+    end
+  end
+
+  redis.call('zadd', 'ql:workers', now, worker)
+
+  return response
+end
+
+function QlessWorker.counts(now, worker)
+  if worker then
+    return {
+      jobs    = redis.call('zrevrangebyscore', 'ql:w:' .. worker .. ':jobs', now + 8640000, now),
+      stalled = redis.call('zrevrangebyscore', 'ql:w:' .. worker .. ':jobs', now, 0)
+    }
+  else
+    return QlessWorker.list(now)
+  end
+end
+
+function QlessWorker.list(now, offset, count)
+  offset = assert(tonumber(offset or 0),
+    'List(): Arg "offset" not a number: ' .. tostring(offset))
+  local interval = tonumber(Qless.config.get('max-worker-age', 86400))
+  local workers
+  if count then
+    count = assert(tonumber(count),
+      'List(): Arg "count" not a number: ' .. tostring(count))
+    workers = redis.call('zrevrangebyscore', 'ql:workers',
+      '+inf', '(' .. (now - interval), 'LIMIT', offset, count)
+  else
+    workers = redis.call('zrevrangebyscore', 'ql:workers',
+      '+inf', '(' .. (now - interval))
+  end
+
+  local response = {}
+  for index, worker in ipairs(workers) do
+    table.insert(response, {
+      name    = worker,
+      jobs    = redis.call('zcount', 'ql:w:' .. worker .. ':jobs', now, now + 8640000),
+      stalled = redis.call('zcount', 'ql:w:' .. worker .. ':jobs', 0, now)
+    })
+  end
+  return response
+end
+
+function QlessWorker.reap(now, budget)
+  budget = assert(tonumber(budget),
+    'Reap(): Arg "budget" not a number: ' .. tostring(budget))
+  local interval = tonumber(Qless.config.get('max-worker-age', 86400))
+
+  local workers = {}
+  if budget > 0 then
+    workers = redis.call('zrangebyscore', 'ql:workers',
+      0, now - interval, 'LIMIT', 0, budget)
+  end
+  for i = 1, #workers, 100 do
+    local last = math.min(i + 99, #workers)
+    local keys = {}
+    for index = i, last do
+      table.insert(keys, 'ql:w:' .. workers[index] .. ':jobs')
+    end
+    Qless.unlink(unpack(keys))
+    redis.call('zrem', 'ql:workers', unpack(workers, i, last))
+  end
+
+  return redis.call('zcount', 'ql:workers', 0, now - interval)
+end
+
+function QlessResource:data(...)
+  local res = redis.call(
+      'hmget', QlessResource.ns .. self.rid, 'rid', 'max')
+
+  if not res[1] then
+    return nil
+  end
+
+  local data = {
+    rid          = res[1],
+    max          = tonumber(res[2] or 0),
+    used         = self:used(),
+    pending      = redis.call('zrevrange', self:prefix('pending'), 0, -1),
+    locks        = redis.call('smembers', self:prefix('locks')),
+  }
+
+  return data
+end
+
+function QlessResource:counts(now, rid)
+  if rid then
+    local resource = redis.call(
+      'hmget', QlessResource.ns .. rid, 'rid', 'max', 'used')
+
+    if not resource[1] then
+      return nil
+    end
+
+    return {
+      rid          = resource[1],
+      max          = tonumber(resource[2] or 0),
+      used         = tonumber(resource[3] or
+        redis.call('scard', QlessResource.ns .. rid .. '-locks')),
+      pending      = redis.call('zcard', QlessResource.ns .. rid .. '-pending'),
+      locks        = redis.call('scard', QlessResource.ns .. rid .. '-locks')
+    }
+  else
+    local resources = redis.call('smembers', 'ql:resources')
+    local response = {}
+    for _, rname in ipairs(resources) do
+      local c = QlessResource:counts(now, rname)
+      response[rname] = {
+        max        = c.max,
+        used       = c.used,
+        pending    = c.pending,
+        locks      = c.locks
+      }
+    end
+
+    return response
+  end
+end
+
+function QlessResource:pending(offset, count)
+  offset = assert(tonumber(offset or 0),
+    'Pending(): Arg "offset" not a number: ' .. tostring(offset))
+  count = assert(tonumber(count or 25),
+    'Pending(): Arg "count" not a number: ' .. tostring(count))
+  return {
+    total = redis.call('zcard', self:prefix('pending')),
+    jobs  = redis.call('zrevrange', self:prefix('pending'),
+      offset, offset + count - 1)
+  }
+end
+
+function QlessResource:holders(cursor, count)
+  cursor = assert(tonumber(cursor or 0),
+    'Holders(): Arg "cursor" not a number: ' .. tostring(cursor))
+  count = assert(tonumber(count or 25),
+    'Holders(): Arg "count" not a number: ' .. tostring(count))
+  local reply = redis.call('sscan', self:prefix('locks'), cursor,
+    'count', count)
+  return {
+    total  = redis.call('scard', self:prefix('locks')),
+    cursor = tonumber(reply[1]),
+    jobs   = reply[2]
+  }
+end
+
+function QlessResource:set(now, max)
+  local max = assert(tonumber(max), 'Set(): Arg "max" not a number: ' .. tostring(max))
+
+  redis.call('sadd', 'ql:resources', self.rid)
+  redis.call('hmset', QlessResource.ns .. self.rid, 'rid', self.rid, 'max', max);
+
+  self:promote(now)
+
+  return self.rid
+end
+
+function QlessResource.weights(resources)
+  local weights = {}
+  if #resources > 0 then
+    for _, rid in ipairs(resources) do
+      table.insert(weights, {rid, 1})
+    end
+  else
+    local rids = {}
+    for rid, _ in pairs(resources) do
+      table.insert(rids, rid)
+    end
+    table.sort(rids)
+    for _, rid in ipairs(rids) do
+      local weight = tonumber(resources[rid])
+      assert(weight and weight > 0 and weight == math.floor(weight),
+        'Resources(): Weight for "' .. rid .. '" not a positive integer: ' ..
+        tostring(resources[rid]))
+      table.insert(weights, {rid, weight})
+    end
+  end
+  return weights
+end
+
+function QlessResource.check(weights, command)
+  for _, res in ipairs(weights) do
+    assert(redis.call('exists', QlessResource.ns .. res[1]) == 1,
+      command .. '(): resource ' .. res[1] .. ' does not exist')
+  end
+end
+
+function QlessResource:unset()
+  redis.call('srem', 'ql:resources', self.rid)
+  return redis.call('del', QlessResource.ns .. self.rid);
+end
+
+function QlessResource:prefix(group)
+  if group then
+    return QlessResource.ns..self.rid..'-'..group
+  end
+
+  return QlessResource.ns..self.rid
+end
+
+function QlessResource:available(jid, weight)
+  local keyLocks = self:prefix('locks')
+  local max = redis.call('hget', self:prefix(), 'max')
+  assert(max, 'Acquire(): resource ' .. self.rid .. ' does not exist')
+  assert(type(jid) ~= 'table', 'Acquire(): invalid jid')
+
+  if redis.call('sismember', keyLocks, jid) == 1 then
+    return true
+  end
+
+  return self:used() + (weight or 1) <= tonumber(max)
+end
+
+function QlessResource:acquire(jid, weight)
+  self:used()
+  if redis.call('sadd', self:prefix('locks'), jid) == 1 then
+    redis.call('hset', self:prefix('units'), jid, weight or 1)
+    redis.call('hincrby', self:prefix(), 'used', weight or 1)
+  end
+  redis.call('zrem', self:prefix('pending'), jid)
+end
+
+function QlessResource:wait(now, priority, jid)
+  local pending = redis.call('zscore', self:prefix('pending'), jid)
+  if pending == nil or pending == false then
+    redis.call('zadd', self:prefix('pending'), priority - (now / 10000000000), jid)
+  end
+end
+
+function QlessResource:release(now, jid, weight)
+  self:used()
+  if redis.call('srem', self:prefix('locks'), jid) == 1 then
+    local units = redis.call('hget', self:prefix('units'), jid)
+    redis.call('hdel', self:prefix('units'), jid)
+    redis.call('hincrby', self:prefix(), 'used', -(tonumber(units) or weight or 1))
+  end
+  redis.call('zrem', self:prefix('pending'), jid)
+end
+
+function QlessResource:used()
+  local used = redis.call('hget', self:prefix(), 'used')
+  if not used then
+    used = redis.call('scard', self:prefix('locks'))
+    if redis.call('exists', self:prefix()) == 1 then
+      redis.call('hset', self:prefix(), 'used', used)
+    end
+  end
+  return tonumber(used)
+end
+
+function QlessResource:promote(now)
+  local max = redis.call('hget', self:prefix(), 'max')
+  if not max then
+    return {}
+  end
+
+  local free = tonumber(max) - self:used()
+  if free <= 0 then
+    return {}
+  end
+
+  local promoted = {}
+  local limit = tonumber(Qless.config.get('resource-scan-limit', 100))
+  local jids = redis.call('zrevrange', self:prefix('pending'),
+    0, math.max(free, limit) - 1, 'withscores')
+  for i = 1, #jids, 2 do
+    if self:used() >= tonumber(max) then
+      break
+    end
+
+    local jid, score = jids[i], jids[i + 1]
+    if Qless.job(jid):acquire_resources(now) then
+      table.insert(promoted, jid)
+      local queue = Qless.queue(
+        redis.call('hget', QlessJob.ns .. jid, 'queue'))
+      queue.work.add(score, 0, jid)
+      queue:signal(1)
+    end
+  end
+
+  return promoted
+end
+
+function QlessResource:locks()
+  return redis.call('scard', self:prefix('locks'))
+end
+
+function QlessResource:exists()
+  return redis.call('exists', self:prefix())
+end-------------------------------------------------------------------------------
+local QlessAPI = {}
+
+local job_options = {fields = true, history = true, dependencies = true}
+
+local function read_job_options(command, args)
+  if #args % 2 == 1 then
+    error(command .. '(): Odd number of additional args: ' .. tostring(#args))
+  end
+  local options = {}
+  for i = 1, #args, 2 do
+    assert(job_options[args[i]],
+      command .. '(): Unknown option "' .. tostring(args[i]) .. '"')
+    options[args[i]] = args[i + 1]
+  end
+
+  if options.fields then
+    local fields = {}
+    for field in string.gmatch(options.fields, '[^,]+') do
+      assert(QlessJob.fields[field],
+        command .. '(): Unknown field "' .. field .. '"')
+      table.insert(fields, field)
+    end
+    options.fields = fields
+  end
+
+  if options.history then
+    local history = options.history
+    local last = string.match(history, '^last:(%d+)$')
+    local offset, count = string.match(history, '^range:(%d+):(%d+)$')
+    if history == 'none' then
+      options.history = false
+    elseif history == 'all' then
+      options.history = nil
+    elseif last then
+      options.history = {offset = -tonumber(last), count = tonumber(last)}
+    elseif offset then
+      options.history = {offset = tonumber(offset), count = tonumber(count)}
+    else
+      error(command .. '(): Arg "history" must be "all", "none", "last:N" ' ..
+        'or "range:OFFSET:COUNT": ' .. history)
+    end
+  end
+
+  if options.dependencies then
+    assert(options.dependencies == '0' or options.dependencies == '1',
+      command .. '(): Arg "dependencies" must be 0 or 1: ' ..
+        options.dependencies)
+    options.dependencies = options.dependencies == '1'
+  end
+  return options
+end
+
+local function job_data(jid, options)
+  if options.history == nil and options.dependencies ~= false then
+    if options.fields then
+      return Qless.job(jid):data(options.fields)
+    end
+    return Qless.job(jid):data()
+  end
+
+  local history = false
+  local fields = {}
+  for _, field in ipairs(options.fields or QlessJob.field_names) do
+    if field == 'history' then
+      history = true
+    elseif options.dependencies ~= false or (
+      field ~= 'dependents' and field ~= 'dependencies') then
+      table.insert(fields, field)
+    end
+  end
+
+  local job = Qless.job(jid)
+  local data = job:data(fields)
+  if data and history and options.history ~= false then
+    if options.history then
+      data.history = job:history_items(
+        options.history.offset, options.history.count)
+    else
+      data.history = job:history()
+    end
+  end
+  return data
+end
+
+function QlessAPI.get(now, jid, ...)
+  local data = job_data(jid, read_job_options('Get', arg))
+  if not data then
+    return nil
+  end
+  return cjson.encode(data)
+end
+
+local function trailing_options(args, names)
+  local options = {}
+  while #args >= 2 and names[args[#args - 1]] do
+    table.insert(options, 1, table.remove(args))
+    table.insert(options, 1, table.remove(args))
+  end
+  return options
+end
+
+function QlessAPI.multiget(now, ...)
+  local jids = arg
+  local options = read_job_options('Multiget',
+    trailing_options(jids, job_options))
+
+  local results = {}
+  for i, jid in ipairs(jids) do
+    table.insert(results, job_data(jid, options))
+  end
+  return cjson.encode(results)
+end
+
+QlessAPI['config.get'] = function(now, key)
+  if not key then
+    return cjson.encode(Qless.config.get(key))
+  else
+    return Qless.config.get(key)
+  end
+end
+
+QlessAPI['config.set'] = function(now, key, value)
+  return Qless.config.set(key, value)
+end
+
+QlessAPI['config.unset'] = function(now, key)
+  return Qless.config.unset(key)
+end
+
+QlessAPI.queues = function(now, queue)
+  return cjson.encode(QlessQueue.counts(now, queue))
+end
+
+QlessAPI['queues.list'] = function(now, offset, count)
+  return cjson.encode(QlessQueue.list(now, offset, count))
+end
+
+QlessAPI['queue.reindex'] = function(now, queue, budget, cursor)
+  return Qless.queue(queue):reindex(budget, cursor)
+end
+
+QlessAPI['queue.recount'] = function(now, queue)
+  return cjson.encode(Qless.queue(queue):recount())
+end
+
+QlessAPI.complete = function(now, jid, worker, queue, data, ...)
+  return Qless.job(jid):complete(now, worker, queue, data, unpack(arg))
+end
+
+QlessAPI['complete.many'] = function(now, worker, queue, jobs)
+  return cjson.encode(Qless.queue(queue):complete_many(now, worker, jobs))
+end
+
+QlessAPI.gc = function(now, budget)
+  return Qless.gc(now, budget)
+end
+
+QlessAPI.failed = function(now, group, start, limit)
+  return cjson.encode(Qless.failed(group, start, limit))
+end
+
+QlessAPI['failed.range'] = function(now, group, from, to, offset, count)
+  return cjson.encode(Qless.failed_range(group, from, to, offset, count))
+end
+
+QlessAPI['failed.migrate'] = function(now, budget)
+  return Qless.failed_migrate(now, budget)
+end
+
+QlessAPI.fail = function(now, jid, worker, group, message, data)
+  return Qless.job(jid):fail(now, worker, group, message, data)
+end
+
+QlessAPI.jobs = function(now, state, ...)
+  return Qless.jobs(now, state, unpack(arg))
+end
+
+QlessAPI.retry = function(now, jid, queue, worker, delay, group, message)
+  return Qless.job(jid):retry(now, queue, worker, delay, group, message)
+end
+
+QlessAPI.depends = function(now, jid, command, ...)
+  return Qless.job(jid):depends(now, command, unpack(arg))
+end
+
+QlessAPI.heartbeat = function(now, jid, worker, data)
+  return Qless.job(jid):heartbeat(now, worker, data)
+end
+
+QlessAPI['heartbeat.many'] = function(now, worker, jobs)
+  return cjson.encode(QlessWorker.heartbeat(now, worker, jobs))
+end
+
+QlessAPI.workers = function(now, worker)
+  return cjson.encode(QlessWorker.counts(now, worker))
+end
+
+QlessAPI['workers.list'] = function(now, offset, count)
+  return cjson.encode(QlessWorker.list(now, offset, count or 25))
+end
+
+QlessAPI['worker.reap'] = function(now, budget)
+  return QlessWorker.reap(now, budget)
+end
+
+QlessAPI.track = function(now, command, ...)
+  if command == 'list' then
+    local args = {}
+    for i = 3, #arg do table.insert(args, arg[i]) end
+    local options = read_job_options('Track', args)
+    return cjson.encode(Qless.tracked(arg[1], arg[2], options.fields))
+  end
+  return cjson.encode(Qless.track(now, command, arg[1]))
+end
+
+QlessAPI.tag = function(now, command, ...)
+  return cjson.encode(Qless.tag(now, command, unpack(arg)))
+end
+
+QlessAPI['tag.query'] = function(now, query, offset, count)
+  return cjson.encode(Qless.tag_query(now, query, offset, count))
+end
+
+QlessAPI.stats = function(now, queue, date)
+  return cjson.encode(Qless.queue(queue):stats(now, date))
+end
+
+QlessAPI.priority = function(now, jid, priority)
+  return Qless.job(jid):priority(priority)
+end
+
+QlessAPI.log = function(now, jid, message, data)
+  assert(jid, "Log(): Argument 'jid' missing")
+  assert(message, "Log(): Argument 'message' missing")
+  if data then
+    data = assert(cjson.decode(data),
+      "Log(): Argument 'data' not cjson: " .. tostring(data))
+  end
+
+  local queue = redis.call('hget', QlessJob.ns .. jid, 'queue')
+  assert(queue, 'Log(): Job ' .. jid .. ' does not exist')
+  Qless.job(jid):history(now, message, data, queue)
+end
+
+QlessAPI['history.migrate'] = function(now, ...)
+  if arg[1] == 'scan' then
+    local cursor, migrated = QlessJob.migrate_histories(arg[2], arg[3])
+    return cjson.encode({cursor = cursor, migrated = migrated})
+  end
+  local migrated = 0
+  for _, jid in ipairs(arg) do
+    if Qless.job(jid):migrate_history() then
+      migrated = migrated + 1
+    end
+  end
+  return migrated
+end
+
+QlessAPI.peek = function(now, queue, count, ...)
+  local options = read_job_options('Peek', arg)
+  local jids = Qless.queue(queue):peek(now, count)
+  local response = {}
+  for i, jid in ipairs(jids) do
+    table.insert(response, job_data(jid, options))
+  end
+  return cjson.encode(response)
+end
+
+QlessAPI.pop = function(now, queue, worker, count, ...)
+  local klasses
+  for i = #arg - 1, 1, -2 do
+    if arg[i] == 'klass' then
+      klasses = {}
+      for klass in string.gmatch(arg[i + 1], '[^,]+') do
+        table.insert(klasses, klass)
+      end
+      table.remove(arg, i + 1)
+      table.remove(arg, i)
+    end
+  end
+  local options = read_job_options('Pop', arg)
+  local jids = Qless.queue(queue):pop(now, worker, count, klasses)
+  local response = {}
+  for i, jid in ipairs(jids) do
+    table.insert(response, job_data(jid, options))
+  end
+  return cjson.encode(response)
+end
+
+QlessAPI['pop.multi'] = function(now, worker, count, ...)
+  local queues = arg
+  local args = trailing_options(queues,
+    {mode = true, fields = true, history = true, dependencies = true})
+  local mode
+  for i = #args - 1, 1, -2 do
+    if args[i] == 'mode' then
+      mode = args[i + 1]
+      table.remove(args, i + 1)
+      table.remove(args, i)
+    end
+  end
+  local options = read_job_options('PopMulti', args)
+
+  if options.fields then
+    table.insert(options.fields, 'queue')
+  end
+
+  local jids = QlessQueue.pop_multi(now, worker, count, queues, mode)
+  local response = {}
+  for i, jid in ipairs(jids) do
+    table.insert(response, job_data(jid, options))
+  end
+  return cjson.encode(response)
+end
+
+QlessAPI.pause = function(now, ...)
+  return QlessQueue.pause(now, unpack(arg))
+end
+
+QlessAPI.unpause = function(now, ...)
+  return QlessQueue.unpause(unpack(arg))
+end
+
+QlessAPI.paused = function(now, queue)
+  return Qless.queue(queue):paused()
+end
+
+QlessAPI.cancel = function(now, ...)
+  return Qless.cancel(now, unpack(arg))
+end
+
+QlessAPI['cancel.query'] = function(now, queue, query, budget, cursor)
+  return cjson.encode(Qless.cancel_query(now, queue, query, budget, cursor))
+end
+
+QlessAPI.timeout = function(now, ...)
+  for _, jid in ipairs(arg) do
+    Qless.job(jid):timeout(now)
+  end
+end
+
+QlessAPI.put = function(now, me, queue, jid, klass, data, delay, ...)
+  return Qless.queue(queue):put(now, me, jid, klass, data, delay, unpack(arg))
+end
+
+QlessAPI['put.many'] = function(now, me, queue, jobs)
+  return cjson.encode(Qless.queue(queue):put_many(now, me, jobs))
+end
+
+QlessAPI.requeue = function(now, me, queue, jid, ...)
+  local job = Qless.job(jid)
+  assert(job:exists(), 'Requeue(): Job ' .. jid .. ' does not exist')
+  return QlessAPI.put(now, me, queue, jid, unpack(arg))
+end
+
+QlessAPI.unfail = function(now, queue, group, count)
+  return Qless.queue(queue):unfail(now, group, count)
+end
+
+QlessAPI.recur = function(now, queue, jid, klass, data, spec, ...)
+  return Qless.queue(queue):recur(now, jid, klass, data, spec, unpack(arg))
+end
+
+QlessAPI.unrecur = function(now, jid)
+  return Qless.recurring(jid):unrecur()
+end
+
+QlessAPI['recur.get'] = function(now, jid)
+  local data = Qless.recurring(jid):data()
+  if not data then
+    return nil
+  end
+  return cjson.encode(data)
+end
+
+QlessAPI['recur.update'] = function(now, jid, ...)
+  return Qless.recurring(jid):update(now, unpack(arg))
+end
+
+QlessAPI['recur.tag'] = function(now, jid, ...)
+  return Qless.recurring(jid):tag(unpack(arg))
+end
+
+QlessAPI['recur.untag'] = function(now, jid, ...)
+  return Qless.recurring(jid):untag(unpack(arg))
+end
+
+QlessAPI.length = function(now, queue)
+  return Qless.queue(queue):length()
+end
+
+QlessAPI['worker.deregister'] = function(now, ...)
+  return QlessWorker.deregister(unpack(arg))
+end
+
+QlessAPI['queue.forget'] = function(now, ...)
+  QlessQueue.deregister(unpack(arg))
+end
+
+QlessAPI['resource.set'] = function(now, rid, max)
+  return Qless.resource(rid):set(now, max)
+end
+
+QlessAPI['resource.rebalance'] = function(now, rid)
+  return cjson.encode(Qless.resource(rid):promote(now))
+end
+
+QlessAPI['resource.get'] = function(now, rid)
+  local data = Qless.resource(rid):data()
+  if not data then
+    return nil
+  end
+  return cjson.encode(data)
+end
+
+QlessAPI['resource.pending'] = function(now, rid, offset, count)
+  return cjson.encode(Qless.resource(rid):pending(offset, count))
+end
+
+QlessAPI['resource.holders'] = function(now, rid, cursor, count)
+  return cjson.encode(Qless.resource(rid):holders(cursor, count))
+end
+
+QlessAPI['resource.unset'] = function(now, rid)
+  return Qless.resource(rid):unset()
+end
+
+QlessAPI['resource.locks'] = function(now, rid)
+  return Qless.resource(rid):locks()
+end
+
+QlessAPI['resources'] = function(now, rid)
+  return cjson.encode(QlessResource:counts(now, rid))
+end
+
+
+if #KEYS > 0 then error('No Keys should be provided') end
+
+local command_name = assert(table.remove(ARGV, 1), 'Must provide a command')
+local command      = assert(
+  QlessAPI[command_name], 'Unknown command ' .. command_name)
+
+local now          = tonumber(table.remove(ARGV, 1))
+local now          = assert(
+  now, 'Arg "now" missing or not a number: ' .. (now or 'nil'))
+
+return command(now, unpack(ARGV))
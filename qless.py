@@ -40,6 +40,16 @@ class QlessRecorder(object):
         except TypeError:
             return result
 
+    def bpop(self, now, worker, queues, count=1, timeout=1):
+        '''Wait up to `timeout` seconds for any of the queues to be signalled
+        as having work, and then pop up to `count` jobs from them. This pops
+        even when the wait times out, since jobs that become ready with time
+        (delayed and recurring jobs, and jobs whose locks expire) only join
+        the queue when it's popped, and aren't signalled before then'''
+        keys = ['ql:q:%s-signal' % queue for queue in queues]
+        self._client.blpop(keys, timeout)
+        return self('pop.multi', now, worker, count, *queues)
+
     def flush(self):
         '''Flush the database'''
         self._client.flushdb()
@@ -10,10 +10,13 @@ function Qless.queue(name)
 
   -- Access to our work
   queue.work = {
-    peek = function(count)
+    peek = function(count, klasses)
       if count == 0 then
         return {}
       end
+      if klasses then
+        return queue:peek_klasses(count, klasses)
+      end
       local jids = {}
       for index, jid in ipairs(redis.call(
         'zrevrange', queue:prefix('work'), 0, count - 1)) do
@@ -22,14 +25,33 @@ function Qless.queue(name)
       return jids
     end, remove = function(...)
       if #arg > 0 then
-        return redis.call('zrem', queue:prefix('work'), unpack(arg))
+        -- Each job is also kept in the work set for its klass
+        for _, jid in ipairs(arg) do
+          local klass = redis.call('hget', QlessJob.ns .. jid, 'klass')
+          if klass then
+            redis.call('zrem', queue:prefix('work-' .. klass), jid)
+          end
+        end
+        local removed = redis.call('zrem', queue:prefix('work'), unpack(arg))
+        queue:count('waiting', -removed)
+        return removed
       end
     end, add = function(now, priority, jid)
       if priority ~= '+inf' then
         priority = priority - (now / 10000000000)
       end
-      return redis.call('zadd',
-        queue:prefix('work'), priority, jid)
+      local klass = redis.call('hget', QlessJob.ns .. jid, 'klass')
+      if klass then
+        redis.call('zadd', queue:prefix('work-' .. klass), priority, jid)
+      end
+      -- Once the work set has been empty, every job in it is in its klass's
+      -- work set too
+      if redis.call('zcard', queue:prefix('work')) == 0 then
+        redis.call('set', queue:prefix('klass-indexed'), 1)
+      end
+      local added = redis.call('zadd', queue:prefix('work'), priority, jid)
+      queue:count('waiting', added)
+      return added
     end, score = function(jid)
       return redis.call('zscore', queue:prefix('work'), jid)
     end, length = function()
@@ -46,11 +68,35 @@ function Qless.queue(name)
       return redis.call('zrangebyscore', queue:prefix('locks'),
         now, '+inf', 'LIMIT', offset, count)
     end, add = function(expires, jid)
-      redis.call('zadd', queue:prefix('locks'), expires, jid)
+      -- Jobs only count against their concurrency key when they start
+      -- running, and not when their lock is renewed
+      if redis.call('zadd', queue:prefix('locks'), expires, jid) == 1 then
+        queue:count('running', 1)
+        queue:concurrency(jid, 1)
+      end
+    end, add_many = function(members)
+      -- Renew a flat list of expires and jid pairs at once. Any job that
+      -- isn't locked yet goes through `add`, to be counted as running
+      local renewed = {}
+      for i = 1, #members, 2 do
+        if redis.call('zscore', queue:prefix('locks'), members[i + 1]) then
+          table.insert(renewed, members[i])
+          table.insert(renewed, members[i + 1])
+        else
+          queue.locks.add(members[i], members[i + 1])
+        end
+      end
+      Qless.zadd(queue:prefix('locks'), renewed)
     end, remove = function(...)
-      if #arg > 0 then
-        return redis.call('zrem', queue:prefix('locks'), unpack(arg))
+      local removed = 0
+      for _, jid in ipairs(arg) do
+        if redis.call('zrem', queue:prefix('locks'), jid) == 1 then
+          queue:concurrency(jid, -1)
+          removed = removed + 1
+        end
       end
+      queue:count('running', -removed)
+      return removed
     end, running = function(now)
       return redis.call('zcount', queue:prefix('locks'), now, '+inf')
     end, length = function(now)
@@ -72,10 +118,13 @@ function Qless.queue(name)
       return redis.call('zrange',
         queue:prefix('depends'), offset, offset + count - 1)
     end, add = function(now, jid)
-      redis.call('zadd', queue:prefix('depends'), now, jid)
+      queue:count('depends',
+        redis.call('zadd', queue:prefix('depends'), now, jid))
     end, remove = function(...)
       if #arg > 0 then
-        return redis.call('zrem', queue:prefix('depends'), unpack(arg))
+        local removed = redis.call('zrem', queue:prefix('depends'), unpack(arg))
+        queue:count('depends', -removed)
+        return removed
       end
     end, length = function()
       return redis.call('zcard', queue:prefix('depends'))
@@ -91,10 +140,14 @@ function Qless.queue(name)
       return redis.call('zrangebyscore',
         queue:prefix('scheduled'), 0, now, 'LIMIT', offset, count)
     end, add = function(when, jid)
-      redis.call('zadd', queue:prefix('scheduled'), when, jid)
+      queue:count('scheduled',
+        redis.call('zadd', queue:prefix('scheduled'), when, jid))
     end, remove = function(...)
       if #arg > 0 then
-        return redis.call('zrem', queue:prefix('scheduled'), unpack(arg))
+        local removed = redis.call(
+          'zrem', queue:prefix('scheduled'), unpack(arg))
+        queue:count('scheduled', -removed)
+        return removed
       end
     end, length = function()
       return redis.call('zcard', queue:prefix('scheduled'))
@@ -108,10 +161,13 @@ function Qless.queue(name)
         0, now, 'LIMIT', offset, count)
     end, ready = function(now, offset, count)
     end, add = function(when, jid)
-      redis.call('zadd', queue:prefix('recur'), when, jid)
+      queue:count('recurring',
+        redis.call('zadd', queue:prefix('recur'), when, jid))
     end, remove = function(...)
       if #arg > 0 then
-        return redis.call('zrem', queue:prefix('recur'), unpack(arg))
+        local removed = redis.call('zrem', queue:prefix('recur'), unpack(arg))
+        queue:count('recurring', -removed)
+        return removed
       end
     end, update = function(increment, jid)
       redis.call('zincrby', queue:prefix('recur'), increment, jid)
@@ -133,6 +189,28 @@ function QlessQueue:prefix(group)
   end
 end
 
+-- Let workers waiting on this queue know that `count` jobs have become ready
+-- to pop, by pushing a token per job onto the list `ql:q:<name>-signal`.
+-- Workers can BLPOP that list rather than polling `pop`. The list is kept to
+-- at most `max-queue-signals` tokens, since one token is enough to wake a
+-- worker that then pops many jobs.
+function QlessQueue:signal(count)
+  local limit = tonumber(Qless.config.get('max-queue-signals', 100))
+  count = math.min(count or 1, limit)
+  if count <= 0 then
+    return
+  end
+  local tokens = {}
+  for i = 1, count do
+    table.insert(tokens, 1)
+  end
+  local key = self:prefix('signal')
+  local length = redis.call('rpush', key, unpack(tokens))
+  if length > limit then
+    redis.call('ltrim', key, -limit, -1)
+  end
+end
+
 -- Stats(now, date)
 -- ---------------------
 -- Return the current statistics for a given queue on a given date. The
@@ -173,20 +251,13 @@ function QlessQueue:stats(now, date)
   -- 24 * 60 * 60 = 86400
   local bin = date - (date % 86400)
 
-  -- This a table of all the keys we want to use in order to produce a histogram
-  local histokeys = {
-    's0','s1','s2','s3','s4','s5','s6','s7','s8','s9','s10','s11','s12','s13','s14','s15','s16','s17','s18','s19','s20','s21','s22','s23','s24','s25','s26','s27','s28','s29','s30','s31','s32','s33','s34','s35','s36','s37','s38','s39','s40','s41','s42','s43','s44','s45','s46','s47','s48','s49','s50','s51','s52','s53','s54','s55','s56','s57','s58','s59',
-    'm1','m2','m3','m4','m5','m6','m7','m8','m9','m10','m11','m12','m13','m14','m15','m16','m17','m18','m19','m20','m21','m22','m23','m24','m25','m26','m27','m28','m29','m30','m31','m32','m33','m34','m35','m36','m37','m38','m39','m40','m41','m42','m43','m44','m45','m46','m47','m48','m49','m50','m51','m52','m53','m54','m55','m56','m57','m58','m59',
-    'h1','h2','h3','h4','h5','h6','h7','h8','h9','h10','h11','h12','h13','h14','h15','h16','h17','h18','h19','h20','h21','h22','h23',
-    'd1','d2','d3','d4','d5','d6'
-  }
-
   local mkstats = function(name, bin, queue)
     -- The results we'll be sending back
     local results = {}
 
     local key = 'ql:s:' .. name .. ':' .. bin .. ':' .. queue
-    local count, mean, vk = unpack(redis.call('hmget', key, 'total', 'mean', 'vk'))
+    local count, mean, vk, compact = unpack(
+      redis.call('hmget', key, 'total', 'mean', 'vk', 'compact'))
 
     count = tonumber(count) or 0
     mean  = tonumber(mean) or 0
@@ -206,9 +277,14 @@ function QlessQueue:stats(now, date)
       end
     end
 
-    local histogram = redis.call('hmget', key, unpack(histokeys))
-    for i=1,#histokeys do
-      table.insert(results.histogram, tonumber(histogram[i]) or 0)
+    if compact then
+      results.histogram = QlessQueue.histogram_counts(key .. '-histogram')
+    else
+      -- Bins from before the histogram was kept compact
+      local histogram = redis.call('hmget', key, unpack(QlessQueue.histokeys))
+      for i=1,#QlessQueue.histokeys do
+        table.insert(results.histogram, tonumber(histogram[i]) or 0)
+      end
     end
     return results
   end
@@ -244,12 +320,18 @@ function QlessQueue:peek(now, count)
   -- we still need values in order to meet the demand, then we
   -- should check if any scheduled items, and if so, we should
   -- insert them to ensure correctness when pulling off the next
-  -- unit of work.
-  self:check_scheduled(now, count - #jids)
+  -- unit of work. Since peek doesn't take them, waiting workers are told.
+  self:signal(self:check_scheduled(now, count - #jids))
 
   -- With these in place, we can expand this list of jids based on the work
   -- queue itself and the priorities therein
-  table.extend(jids, self.work.peek(count - #jids))
+  local per_key = tonumber(
+    Qless.config.get(self.name .. '-max-concurrency-per-key', 0))
+  if per_key > 0 then
+    table.extend(jids, self:concurrency_peek(count - #jids, per_key))
+  else
+    table.extend(jids, self.work.peek(count - #jids))
+  end
 
   return jids
 end
@@ -277,7 +359,7 @@ end
 
 -- Checks for expired locks, scheduled and recurring jobs, returning any
 -- jobs that are ready to be processes
-function QlessQueue:pop(now, worker, count)
+function QlessQueue:pop(now, worker, count, klasses)
   assert(worker, 'Pop(): Arg "worker" missing')
   count = assert(tonumber(count),
     'Pop(): Arg "count" missing or not a number: ' .. tostring(count))
@@ -308,7 +390,7 @@ function QlessQueue:pop(now, worker, count)
     end
   end
 
-  local jids = self:invalidate_locks(now, count)
+  local jids = self:invalidate_locks(now, count, klasses)
   -- Now we've checked __all__ the locks for this queue the could
   -- have expired, and are no more than the number requested.
 
@@ -320,17 +402,28 @@ function QlessQueue:pop(now, worker, count)
   -- should check if any scheduled items, and if so, we should
   -- insert them to ensure correctness when pulling off the next
   -- unit of work.
-  self:check_scheduled(now, count - #jids)
+  local ready = self:check_scheduled(now, count - #jids)
 
   -- With these in place, we can expand this list of jids based on the work
   -- queue itself and the priorities therein
-  table.extend(jids, self.work.peek(count - #jids))
+  local invalidated = #jids
+  local per_key = tonumber(
+    Qless.config.get(self.name .. '-max-concurrency-per-key', 0))
+  if per_key > 0 then
+    table.extend(jids, self:concurrency_peek(count - #jids, per_key, klasses))
+  else
+    table.extend(jids, self.work.peek(count - #jids, klasses))
+  end
+
+  -- Scheduled jobs this pop passed over, for their klass or concurrency key,
+  -- are left waiting for other workers
+  self:signal(ready - (#jids - invalidated))
 
   local state
   for index, jid in ipairs(jids) do
     local job = Qless.job(jid)
     state = unpack(job:data('state'))
-    job:history(now, 'popped', {worker = worker})
+    job:history(now, 'popped', {worker = worker}, self.name)
 
     -- Update the wait time statistics
     local time = tonumber(
@@ -365,55 +458,383 @@ function QlessQueue:pop(now, worker, count)
   return jids
 end
 
+-- Like `work.peek`, but only for jobs of the provided klasses. The first
+-- `count` jobs of each klass's work set are merged in the order they'd have
+-- in the queue's work set.
+function QlessQueue:peek_klasses(count, klasses)
+  local seen = {}
+  local found = {}
+  local candidates = {}
+  for _, klass in ipairs(klasses) do
+    if not seen[klass] then
+      seen[klass] = true
+      local reply = redis.call('zrevrange', self:prefix('work-' .. klass),
+        0, count - 1, 'withscores')
+      for i = 1, #reply, 2 do
+        found[reply[i]] = true
+        table.insert(candidates,
+          {jid = reply[i], score = tonumber(reply[i + 1])})
+      end
+    end
+  end
+
+  -- Jobs that were waiting before the klass work sets were kept may be missing
+  -- from them until `reindex` is done, so the top of the work set is checked
+  -- for them as well
+  if not self:indexed() then
+    local limit = tonumber(Qless.config.get('pop-scan-limit', 100))
+    local reply = redis.call('zrevrange', self:prefix('work'),
+      0, count + limit - 1, 'withscores')
+    for i = 1, #reply, 2 do
+      local klass = redis.call('hget', QlessJob.ns .. reply[i], 'klass')
+      if not found[reply[i]] and klass and seen[klass] then
+        table.insert(candidates,
+          {jid = reply[i], score = tonumber(reply[i + 1])})
+      end
+    end
+  end
+
+  -- Ties are broken the same way zrevrange breaks them
+  table.sort(candidates, function(a, b)
+    if a.score ~= b.score then
+      return a.score > b.score
+    end
+    return a.jid > b.jid
+  end)
+
+  local jids = {}
+  for i = 1, math.min(count, #candidates) do
+    table.insert(jids, candidates[i].jid)
+  end
+  return jids
+end
+
+-- Whether every job in the work set is also in the work set of its klass
+function QlessQueue:indexed()
+  return redis.call('exists', self:prefix('klass-indexed')) == 1
+end
+
+-- Add up to `budget` jobs of the work set (100 by default) to the work sets
+-- of their klasses, for jobs that were waiting before those were kept. It
+-- scans the work set with a ZSCAN cursor: start with 0, and pass back the
+-- returned cursor until it's 0 again, when the queue is marked as indexed.
+function QlessQueue:reindex(budget, cursor)
+  budget = assert(tonumber(budget or 100),
+    'Reindex(): Arg "budget" not a number: ' .. tostring(budget))
+  cursor = assert(tonumber(cursor or 0),
+    'Reindex(): Arg "cursor" not a number: ' .. tostring(cursor))
+
+  local reply = redis.call('zscan', self:prefix('work'), cursor,
+    'count', budget)
+  local jids = reply[2]
+  for i = 1, #jids, 2 do
+    local klass = redis.call('hget', QlessJob.ns .. jids[i], 'klass')
+    if klass then
+      redis.call('zadd', self:prefix('work-' .. klass), jids[i + 1], jids[i])
+    end
+  end
+
+  cursor = tonumber(reply[1])
+  if cursor == 0 then
+    redis.call('set', self:prefix('klass-indexed'), 1)
+  end
+  return cursor
+end
+
+-- Update the number of running jobs that share a job's concurrency key, if
+-- it has one. Counters are made the first time a key is used, and deleted
+-- when no jobs with that key are running.
+function QlessQueue:concurrency(jid, delta)
+  local key = redis.call('hget', QlessJob.ns .. jid, 'concurrency_key')
+  if key then
+    local running = redis.call(
+      'hincrby', self:prefix('concurrency'), key, delta)
+    if running <= 0 then
+      redis.call('hdel', self:prefix('concurrency'), key)
+    end
+  end
+end
+
+-- Like `work.peek`, but passes over jobs whose concurrency key already has
+-- `limit` jobs running, counting those that'll be popped along with them. At
+-- most `pop-scan-limit` jobs past the `count` wanted are looked at, so a
+-- queue full of saturated keys can't make pop scan the whole work set.
+function QlessQueue:concurrency_peek(count, limit, klasses)
+  if count <= 0 then
+    return {}
+  end
+
+  local scan = tonumber(Qless.config.get('pop-scan-limit', 100))
+  local jids = {}
+  local taken = {}
+  for _, jid in ipairs(self.work.peek(count + scan, klasses)) do
+    local key = redis.call('hget', QlessJob.ns .. jid, 'concurrency_key')
+    if key then
+      if not taken[key] then
+        taken[key] = tonumber(redis.call(
+          'hget', self:prefix('concurrency'), key) or 0)
+      end
+      if taken[key] < limit then
+        taken[key] = taken[key] + 1
+        table.insert(jids, jid)
+      end
+    else
+      table.insert(jids, jid)
+    end
+
+    if #jids >= count then
+      break
+    end
+  end
+  return jids
+end
+
+-- PopMulti(now, worker, count, queues, mode)
+-- ------------------------------------------
+-- Pop up to `count` jobs from across several queues, each popped just as
+-- `pop` would, so their pause state, `max-concurrency` and heartbeat settings
+-- all apply. With the `priority` mode (the default), the queues are served in
+-- the order they're listed, and a queue is only popped from when those
+-- before it can't fill the count. With the `weighted` mode, the count is
+-- shared between the queues by their `<queue>-weight` setting (default 1),
+-- and whatever a queue can't fill is offered to the others in order.
+function QlessQueue.pop_multi(now, worker, count, queues, mode)
+  assert(worker, 'PopMulti(): Arg "worker" missing')
+  count = assert(tonumber(count),
+    'PopMulti(): Arg "count" missing or not a number: ' .. tostring(count))
+  assert(#queues > 0, 'PopMulti(): No queues provided')
+  mode = mode or 'priority'
+  assert(mode == 'priority' or mode == 'weighted',
+    'PopMulti(): Arg "mode" must be "priority" or "weighted": ' ..
+    tostring(mode))
+
+  -- How many jobs we've asked each queue for, and whether it gave them all
+  local shares = {}
+  local exhausted = {}
+  for i = 1, #queues do shares[i] = 0 end
+
+  if mode == 'weighted' then
+    local weights = {}
+    local total = 0
+    for i, name in ipairs(queues) do
+      weights[i] = assert(tonumber(Qless.config.get(name .. '-weight', 1)),
+        'PopMulti(): Weight for ' .. name .. ' not a number')
+      weights[i] = math.max(weights[i], 0)
+      total = total + weights[i]
+    end
+
+    -- Hand out each job in turn, at points spread evenly along the weights.
+    -- The points start somewhere different each second, so that queues with
+    -- small weights get their share over successive pops even when the
+    -- count is small.
+    if total > 0 then
+      local golden = 0.6180339887498949
+      for n = 1, count do
+        local point = ((math.floor(now) + n) * golden) % 1 * total
+        for i = 1, #queues do
+          point = point - weights[i]
+          if point < 0 or i == #queues then
+            shares[i] = shares[i] + 1
+            break
+          end
+        end
+      end
+    end
+  else
+    shares[1] = count
+  end
+
+  local jids = {}
+  local pop_from = function(i, share)
+    local queue = Qless.queue(queues[i])
+    local found = queue:pop(now, worker, share)
+    if #found < share then
+      exhausted[i] = true
+    end
+    table.extend(jids, found)
+  end
+
+  for i = 1, #queues do
+    if shares[i] > 0 then
+      pop_from(i, shares[i])
+    end
+  end
+
+  -- And now offer whatever is left over to the queues in order
+  for i = 1, #queues do
+    if #jids >= count then
+      break
+    end
+    if not exhausted[i] then
+      pop_from(i, count - #jids)
+    end
+  end
+
+  return jids
+end
+
+-- The names of the histogram's buckets, in the order that they're reported
+-- by `stats`. The histogram of each day's bin is kept as an array of unsigned
+-- 32-bit big-endian counters, in this order, in the string key
+-- `ql:s:<stat>:<bin>:<queue>-histogram`.
+QlessQueue.histokeys = {
+  's0','s1','s2','s3','s4','s5','s6','s7','s8','s9','s10','s11','s12','s13','s14','s15','s16','s17','s18','s19','s20','s21','s22','s23','s24','s25','s26','s27','s28','s29','s30','s31','s32','s33','s34','s35','s36','s37','s38','s39','s40','s41','s42','s43','s44','s45','s46','s47','s48','s49','s50','s51','s52','s53','s54','s55','s56','s57','s58','s59',
+  'm1','m2','m3','m4','m5','m6','m7','m8','m9','m10','m11','m12','m13','m14','m15','m16','m17','m18','m19','m20','m21','m22','m23','m24','m25','m26','m27','m28','m29','m30','m31','m32','m33','m34','m35','m36','m37','m38','m39','m40','m41','m42','m43','m44','m45','m46','m47','m48','m49','m50','m51','m52','m53','m54','m55','m56','m57','m58','m59',
+  'h1','h2','h3','h4','h5','h6','h7','h8','h9','h10','h11','h12','h13','h14','h15','h16','h17','h18','h19','h20','h21','h22','h23',
+  'd1','d2','d3','d4','d5','d6'
+}
+
+-- The 0-based index of the histogram bucket for a value in seconds, or nil
+-- if the histogram doesn't cover it
+function QlessQueue.histogram_index(val)
+  val = math.floor(val)
+  if val < 0 then
+    return nil
+  elseif val < 60 then -- seconds
+    return val
+  elseif val < 3600 then -- minutes
+    return 59 + math.floor(val / 60)
+  elseif val < 86400 then -- hours
+    return 118 + math.floor(val / 3600)
+  elseif val < 7 * 86400 then -- days
+    return 141 + math.floor(val / 86400)
+  end
+end
+
+-- Read all the counters of the histogram stored at `key`
+function QlessQueue.histogram_counts(key)
+  local packed = redis.call('get', key) or ''
+  local counts = {}
+  for i = 1, #QlessQueue.histokeys do
+    local a, b, c, d = string.byte(packed, 4 * i - 3, 4 * i)
+    table.insert(counts,
+      (((a or 0) * 256 + (b or 0)) * 256 + (c or 0)) * 256 + (d or 0))
+  end
+  return counts
+end
+
+-- Add to the counters of the histogram stored at `key`. `increments` maps
+-- each 0-based bucket index to how much to add, and `order` lists the
+-- indexes to update. Servers without BITFIELD update each counter in turn.
+function QlessQueue.histogram_add(key, increments, order)
+  if #order == 0 then
+    return
+  end
+
+  if Qless.can_bitfield ~= false then
+    local args = {'OVERFLOW', 'SAT'}
+    for _, index in ipairs(order) do
+      table.insert(args, 'INCRBY')
+      table.insert(args, 'u32')
+      table.insert(args, '#' .. index)
+      table.insert(args, increments[index])
+    end
+    local reply = redis.pcall('bitfield', key, unpack(args))
+    if type(reply) ~= 'table' or not reply.err then
+      Qless.can_bitfield = true
+      return
+    end
+    Qless.can_bitfield = false
+  end
+
+  for _, index in ipairs(order) do
+    local offset = 4 * index
+    local a, b, c, d = string.byte(
+      redis.call('getrange', key, offset, offset + 3), 1, 4)
+    local value = math.min(4294967295,
+      (((a or 0) * 256 + (b or 0)) * 256 + (c or 0)) * 256 + (d or 0) +
+      increments[index])
+    redis.call('setrange', key, offset, string.char(
+      math.floor(value / 16777216) % 256,
+      math.floor(value / 65536) % 256,
+      math.floor(value / 256) % 256,
+      value % 256))
+  end
+end
+
 -- Update the stats for this queue
 function QlessQueue:stat(now, stat, val)
+  return self:stat_many(now, stat, {val})
+end
+
+-- Update the stats for this queue with several values at once, reading and
+-- writing the summary and each histogram bin only once
+function QlessQueue:stat_many(now, stat, vals)
+  if #vals == 0 then
+    return
+  end
+
   -- The bin is midnight of the provided day
   local bin = now - (now % 86400)
   local key = 'ql:s:' .. stat .. ':' .. bin .. ':' .. self.name
 
   -- Get the current data
-  local count, mean, vk = unpack(
-    redis.call('hmget', key, 'total', 'mean', 'vk'))
+  local count, mean, vk, compact = unpack(
+    redis.call('hmget', key, 'total', 'mean', 'vk', 'compact'))
 
   -- If there isn't any data there presently, then we must initialize it
-  count = count or 0
-  if count == 0 then
-    mean  = val
-    vk    = 0
-    count = 1
-  else
-    count = count + 1
-    local oldmean = mean
-    mean  = mean + (val - mean) / count
-    vk    = vk + (val - mean) * (val - oldmean)
+  count = tonumber(count or 0)
+  mean  = tonumber(mean or 0)
+  vk    = tonumber(vk or 0)
+
+  -- Now, update the histogram, counting up how much each bucket changes
+  local increments = {}
+  local order = {}
+  local increment = function(index, by)
+    if not increments[index] then
+      increments[index] = 0
+      table.insert(order, index)
+    end
+    increments[index] = increments[index] + by
   end
 
-  -- Now, update the histogram
-  -- - `s1`, `s2`, ..., -- second-resolution histogram counts
-  -- - `m1`, `m2`, ..., -- minute-resolution
-  -- - `h1`, `h2`, ..., -- hour-resolution
-  -- - `d1`, `d2`, ..., -- day-resolution
-  val = math.floor(val)
-  if val < 60 then -- seconds
-    redis.call('hincrby', key, 's' .. val, 1)
-  elseif val < 3600 then -- minutes
-    redis.call('hincrby', key, 'm' .. math.floor(val / 60), 1)
-  elseif val < 86400 then -- hours
-    redis.call('hincrby', key, 'h' .. math.floor(val / 3600), 1)
-  else -- days
-    redis.call('hincrby', key, 'd' .. math.floor(val / 86400), 1)
+  -- If this bin was started before the histogram was kept compact, then
+  -- move its counts over
+  if count > 0 and not compact then
+    local histogram = redis.call('hmget', key, unpack(QlessQueue.histokeys))
+    for i = 1, #QlessQueue.histokeys do
+      local value = tonumber(histogram[i])
+      if value then
+        increment(i - 1, value)
+      end
+    end
+    redis.call('hdel', key, unpack(QlessQueue.histokeys))
   end
-  redis.call('hmset', key, 'total', count, 'mean', mean, 'vk', vk)
+
+  for _, val in ipairs(vals) do
+    if count == 0 then
+      mean  = val
+      vk    = 0
+      count = 1
+    else
+      count = count + 1
+      local oldmean = mean
+      mean  = mean + (val - mean) / count
+      vk    = vk + (val - mean) * (val - oldmean)
+    end
+
+    local index = QlessQueue.histogram_index(val)
+    if index then
+      increment(index, 1)
+    end
+  end
+
+  QlessQueue.histogram_add(key .. '-histogram', increments, order)
+  redis.call('hmset', key,
+    'total', count, 'mean', mean, 'vk', vk, 'compact', 1)
 end
 
 -- Put(now, jid, klass, data, delay,
 --     [priority, p],
 --     [tags, t],
 --     [retries, r],
---     [depends, '[...]'])
+--     [depends, '[...]'],
+--     [concurrency_key, k])
 -- -----------------------
 -- Insert a job into the queue with the given priority, tags, delay, klass and
--- data.
+-- data. Jobs with the same concurrency key run at most
+-- `<queue>-max-concurrency-per-key` at a time in this queue. Putting a job
+-- again with an empty concurrency key clears the one it had.
 function QlessQueue:put(now, worker, jid, klass, raw_data, delay, ...)
   assert(jid  , 'Put(): Arg "jid" missing')
   assert(klass, 'Put(): Arg "klass" missing')
@@ -430,11 +851,218 @@ function QlessQueue:put(now, worker, jid, klass, raw_data, delay, ...)
   local options = {}
   for i = 1, #arg, 2 do options[arg[i]] = arg[i + 1] end
 
+  return self:enqueue(now, worker, jid, klass, raw_data, delay, options)
+end
+
+-- PutMany(now, worker, jobs)
+-- --------------------------
+-- Insert a batch of jobs into the queue. `jobs` is a JSON array of job specs:
+--
+--  [
+--      {
+--          'jid'      : ...,
+--          'klass'    : ...,
+--          'data'     : {...},
+--          # All of these are optional, and mean the same as they do in `put`
+--          'delay'    : 0,
+--          'priority' : 0,
+--          'tags'     : [...],
+--          'retries'  : 5,
+--          'depends'  : [...],
+--          'resources': [...],
+--          'concurrency_key': ...,
+--          'replace'  : 1
+--      }, {
+--          ...
+--      }
+--  ]
+--
+-- Every spec is validated before any job is inserted. The work shared by all
+-- the jobs (registering the queue, checking for tracked jobs, signalling
+-- workers) is done once for the batch. Returns a list with one entry per spec,
+-- holding whatever `put` would have returned for that job.
+function QlessQueue:put_many(now, worker, raw_jobs)
+  assert(raw_jobs, 'PutMany(): Arg "jobs" missing')
+  local jobs = assert(cjson.decode(raw_jobs),
+    'PutMany(): Arg "jobs" not JSON: ' .. tostring(raw_jobs))
+  assert(type(jobs) == 'table',
+    'PutMany(): Arg "jobs" not a JSON array: ' .. tostring(raw_jobs))
+
+  -- Validate everything first, so that a bad spec doesn't leave the batch
+  -- half-inserted, since what's already been written isn't rolled back. That
+  -- includes the queue's history policy, which every job's history uses
+  QlessJob.history_limit(self.name)
+  local specs = {}
+  for i, job in ipairs(jobs) do
+    assert(type(job) == 'table',
+      'PutMany(): Job ' .. i .. ' is not a JSON object')
+    local jid = assert(job.jid, 'PutMany(): Job ' .. i .. ' missing "jid"')
+    assert(type(jid) == 'string' or type(jid) == 'number',
+      'PutMany(): Job ' .. i .. ' "jid" not a string')
+    assert(job.klass, 'PutMany(): Job ' .. jid .. ' missing "klass"')
+    assert(type(job.klass) == 'string',
+      'PutMany(): Job ' .. jid .. ' "klass" not a string')
+
+    local raw_data = job.data
+    if type(raw_data) == 'string' then
+      assert(cjson.decode(raw_data),
+        'PutMany(): Job ' .. jid .. ' "data" not JSON: ' .. raw_data)
+    else
+      raw_data = cjson.encode(raw_data or {})
+    end
+
+    local delay = assert(tonumber(job.delay or 0),
+      'PutMany(): Job ' .. jid .. ' "delay" not a number: ' ..
+      tostring(job.delay))
+
+    local options = {}
+    for _, key in ipairs({'priority', 'retries', 'replace'}) do
+      if job[key] ~= nil then
+        options[key] = assert(tonumber(job[key]),
+          'PutMany(): Job ' .. jid .. ' "' .. key .. '" not a number: ' ..
+          tostring(job[key]))
+      end
+    end
+    for _, key in ipairs({'tags', 'depends'}) do
+      if job[key] ~= nil then
+        assert(type(job[key]) == 'table',
+          'PutMany(): Job ' .. jid .. ' "' .. key .. '" not a JSON array')
+        for _, value in ipairs(job[key]) do
+          assert(type(value) == 'string' or type(value) == 'number',
+            'PutMany(): Job ' .. jid .. ' "' .. key .. '" not all strings')
+        end
+        options[key] = cjson.encode(job[key])
+      end
+    end
+    if job.resources ~= nil then
+      assert(type(job.resources) == 'table', 'PutMany(): Job ' .. jid ..
+        ' "resources" not a JSON array or object')
+      QlessResource.check(QlessResource.weights(job.resources), 'PutMany')
+      options.resources = cjson.encode(job.resources)
+    end
+    if job.concurrency_key ~= nil then
+      options.concurrency_key = tostring(job.concurrency_key)
+    end
+
+    table.insert(specs, {
+      jid      = tostring(jid),
+      klass    = job.klass,
+      raw_data = raw_data,
+      delay    = delay,
+      options  = options
+    })
+  end
+
+  local batch = {
+    jids    = {},
+    ready   = 0,
+    tracked = redis.call('zcard', 'ql:tracked') > 0
+  }
+  local response = {}
+  for _, spec in ipairs(specs) do
+    table.insert(response, self:enqueue(now, worker, spec.jid, spec.klass,
+      spec.raw_data, spec.delay, spec.options, batch))
+  end
+
+  if #batch.jids > 0 then
+    if redis.call('zscore', 'ql:queues', self.name) == false then
+      redis.call('zadd', 'ql:queues', now, self.name)
+    end
+  end
+  self:signal(batch.ready)
+
+  return response
+end
+
+-- CompleteMany(now, worker, jobs)
+-- -------------------------------
+-- Complete a batch of jobs that `worker` is running in this queue. `jobs` is a
+-- JSON array of completions:
+--
+--  [
+--      {
+--          'jid'    : ...,
+--          # All of these are optional, and mean the same as they do in
+--          # `complete`, except that a job without 'data' keeps its own
+--          'data'   : {...},
+--          'next'   : 'queue',
+--          'delay'  : 0,
+--          'depends': [...]
+--      }, {
+--          ...
+--      }
+--  ]
+--
+-- Each job is completed on its own, so one that can't be completed (because
+-- it has been handed to another worker, for instance) doesn't stop the rest.
+-- The run stats, the worker's job list and the inline reaping of old
+-- completed jobs are handled once for the whole batch. Returns a list with
+-- one entry per job, either `{jid, state}` or `{jid, error}`.
+function QlessQueue:complete_many(now, worker, raw_jobs)
+  assert(worker, 'CompleteMany(): Arg "worker" missing')
+  assert(raw_jobs, 'CompleteMany(): Arg "jobs" missing')
+  local jobs = assert(cjson.decode(raw_jobs),
+    'CompleteMany(): Arg "jobs" not JSON: ' .. tostring(raw_jobs))
+  assert(type(jobs) == 'table',
+    'CompleteMany(): Arg "jobs" not a JSON array: ' .. tostring(raw_jobs))
+
+  local batch = {
+    jids    = {},
+    waits   = {},
+    queues  = {},
+    tracked = redis.call('zcard', 'ql:tracked') > 0
+  }
+  local response = {}
+  for i, job in ipairs(jobs) do
+    assert(type(job) == 'table' and job.jid,
+      'CompleteMany(): Job ' .. i .. ' is not a JSON object with a "jid"')
+    local jid = tostring(job.jid)
+
+    -- Without any data, the job keeps the data it has
+    local raw_data = job.data
+    if raw_data ~= nil and type(raw_data) ~= 'string' then
+      raw_data = cjson.encode(raw_data)
+    end
+    local options = {
+      next  = job.next,
+      delay = job.delay
+    }
+    if job.depends ~= nil then
+      options.depends = cjson.encode(job.depends)
+    end
+
+    local ok, result = Qless.attempt(function()
+      return Qless.job(jid):finish(
+        now, worker, self.name, raw_data, options, batch)
+    end)
+    if ok then
+      table.insert(response, {jid = jid, state = result})
+    else
+      table.insert(response, {jid = jid, error = result})
+    end
+  end
+
+  if #batch.jids > 0 then
+    self:stat_many(now, 'run', batch.waits)
+    redis.call('zrem', 'ql:w:' .. worker .. ':jobs', unpack(batch.jids))
+    Qless.gc(now,
+      Qless.config.get('gc-inline-budget', 10) * #batch.jids)
+  end
+
+  return response
+end
+
+-- Do the actual work of putting a job in this queue, with its optional
+-- arguments already collected into `options`. If `batch` is provided, this
+-- job is part of a `put_many`, and the per-batch work is left to the caller.
+function QlessQueue:enqueue(now, worker, jid, klass, raw_data, delay, options,
+  batch)
   -- Let's see what the old priority and tags were
   local job = Qless.job(jid)
-  local priority, tags, oldqueue, state, failure, retries, oldworker =
-    unpack(redis.call('hmget', QlessJob.ns .. jid, 'priority', 'tags',
-      'queue', 'state', 'failure', 'retries', 'worker'))
+  local priority, tags, oldqueue, state, failure, retries, oldworker,
+    concurrency_key = unpack(redis.call('hmget', QlessJob.ns .. jid,
+      'priority', 'tags', 'queue', 'state', 'failure', 'retries', 'worker',
+      'concurrency_key'))
 
   -- true if empty or anything other than false
   local replace = assert(tonumber(options['replace'] or 1) ,
@@ -447,14 +1075,10 @@ function QlessQueue:put(now, worker, jid, klass, raw_data, delay, ...)
     end
   end
 
-  -- If there are old tags, then we should remove the tags this job has
-  if tags then
-    Qless.tag(now, 'remove', jid, unpack(cjson.decode(tags)))
-  end
-
   -- Sanity check on optional args
   retries  = assert(tonumber(options['retries']  or retries or 5) ,
     'Put(): Arg "retries" not a number: ' .. tostring(options['retries']))
+  local oldtags = cjson.decode(tags or '[]')
   tags     = assert(cjson.decode(options['tags'] or tags or '[]' ),
     'Put(): Arg "tags" not JSON'          .. tostring(options['tags']))
   priority = assert(tonumber(options['priority'] or priority or 0),
@@ -462,7 +1086,8 @@ function QlessQueue:put(now, worker, jid, klass, raw_data, delay, ...)
   local depends = assert(cjson.decode(options['depends'] or '[]') ,
     'Put(): Arg "depends" not JSON: '     .. tostring(options['depends']))
   local resources = assert(cjson.decode(options['resources'] or '[]'),
-    'Put(): Arg "resources" not JSON array: '     .. tostring(options['resources']))
+    'Put(): Arg "resources" not JSON array or object: '     .. tostring(options['resources']))
+  QlessResource.check(QlessResource.weights(resources), 'Put')
 
   -- If the job has old dependencies, determine which dependencies are
   -- in the new dependencies but not in the old ones, and which are in the
@@ -485,6 +1110,9 @@ function QlessQueue:put(now, worker, jid, klass, raw_data, delay, ...)
   end
 
   -- Send out a log message
+  if batch then
+    table.insert(batch.jids, jid)
+  end
   Qless.publish('log', cjson.encode({
     jid   = jid,
     event = 'put',
@@ -492,7 +1120,11 @@ function QlessQueue:put(now, worker, jid, klass, raw_data, delay, ...)
   }))
 
   -- Update the history to include this new change
-  job:history(now, 'put', {q = self.name})
+  if state then
+    job:history(now, 'put', {q = self.name}, self.name)
+  else
+    job:start_history(now, 'put', {q = self.name}, self.name)
+  end
 
   -- If this item was previously in another queue, then we should remove it from there
   if oldqueue then
@@ -527,20 +1159,15 @@ function QlessQueue:put(now, worker, jid, klass, raw_data, delay, ...)
     redis.call('zrem', 'ql:completed', jid)
   end
 
-  -- Add this job to the list of jobs tagged with whatever tags were supplied
-  for i, tag in ipairs(tags) do
-    redis.call('zadd', 'ql:t:' .. tag, now, jid)
-    redis.call('zincrby', 'ql:tags', 1, tag)
-  end
+  -- Bring the job's entries in the tag sets in line with the tags supplied,
+  -- leaving alone those it already had
+  Qless.retag(now, jid, oldtags, tags)
 
   -- If we're in the failed state, remove all of our data
   if state == 'failed' then
     failure = cjson.decode(failure)
     -- We need to make this remove it from the failed queues
-    redis.call('lrem', 'ql:f:' .. failure.group, 0, jid)
-    if redis.call('llen', 'ql:f:' .. failure.group) == 0 then
-      redis.call('srem', 'ql:failures', failure.group)
-    end
+    Qless.remove_failures(failure.group, jid)
     -- The bin is midnight of the provided day
     -- 24 * 60 * 60 = 86400
     local bin = failure.when - (failure.when % 86400)
@@ -564,6 +1191,14 @@ function QlessQueue:put(now, worker, jid, klass, raw_data, delay, ...)
     'retries'  , retries,
     'remaining', retries,
     'time'     , string.format("%.20f", now))
+  -- An empty concurrency key clears the one the job had, and leaving it out
+  -- keeps it. The job isn't running by now, so it's not in any counts.
+  concurrency_key = options['concurrency_key'] or concurrency_key
+  if concurrency_key and concurrency_key ~= '' then
+    redis.call('hset', QlessJob.ns .. jid, 'concurrency_key', concurrency_key)
+  else
+    redis.call('hdel', QlessJob.ns .. jid, 'concurrency_key')
+  end
 
   -- These are the jids we legitimately have to wait on
   for i, j in ipairs(depends) do
@@ -578,6 +1213,7 @@ function QlessQueue:put(now, worker, jid, klass, raw_data, delay, ...)
   -- Now, if a delay was provided, and if it's in the future,
   -- then we'll have to schedule it. Otherwise, we're just
   -- going to add it to the work queue.
+  local ready = false
   if delay > 0 then
     if redis.call('scard', QlessJob.ns .. jid .. '-dependencies') > 0 then
       -- We've already put it in 'depends'. Now, we must just save the data
@@ -593,23 +1229,35 @@ function QlessQueue:put(now, worker, jid, klass, raw_data, delay, ...)
     if redis.call('scard', QlessJob.ns .. jid .. '-dependencies') > 0 then
       self.depends.add(now, jid)
       redis.call('hset', QlessJob.ns .. jid, 'state', 'depends')
-    elseif #resources > 0 then
+    elseif next(resources) then
       if Qless.job(jid):acquire_resources(now) then
         self.work.add(now, priority, jid)
+        ready = true
       end
     else
       self.work.add(now, priority, jid)
+      ready = true
+    end
+  end
+
+  -- Wake up a worker waiting for work in this queue
+  if ready then
+    if batch then
+      batch.ready = batch.ready + 1
+    else
+      self:signal(1)
     end
   end
 
   -- Lastly, we're going to make sure that this item is in the
   -- set of known queues. We should keep this sorted by the
   -- order in which we saw each of these queues
-  if redis.call('zscore', 'ql:queues', self.name) == false then
+  if not batch and redis.call('zscore', 'ql:queues', self.name) == false then
     redis.call('zadd', 'ql:queues', now, self.name)
   end
 
-  if redis.call('zscore', 'ql:tracked', jid) ~= false then
+  if (not batch or batch.tracked) and
+    redis.call('zscore', 'ql:tracked', jid) ~= false then
     Qless.publish('put', jid)
   end
 
@@ -622,15 +1270,23 @@ function QlessQueue:unfail(now, group, count)
   count = assert(tonumber(count or 25),
     'Unfail(): Arg "count" not a number: ' .. tostring(count))
 
-  -- Get up to that many jobs, and we'll put them in the appropriate queue
-  local jids = redis.call('lrange', 'ql:f:' .. group, -count, -1)
+  -- Get up to that many of the oldest jobs, and we'll put them in the
+  -- appropriate queue
+  local key, legacy = Qless.failure_group(group)
+  local jids
+  if legacy then
+    jids = redis.call('lrange', key, -count, -1)
+  else
+    jids = redis.call('zrange', key, 0, count - 1)
+  end
 
   -- And now set each job's state, and put it into the appropriate queue
   local toinsert = {}
+  local ready = 0
   for index, jid in ipairs(jids) do
     local job = Qless.job(jid)
     local data = job:data()
-    job:history(now, 'put', {q = self.name})
+    job:history(now, 'put', {q = self.name}, self.name)
     redis.call('hmset', QlessJob.ns .. data.jid,
       'state'    , 'waiting',
       'worker'   , '',
@@ -641,16 +1297,26 @@ function QlessQueue:unfail(now, group, count)
     if #data['resources'] then
       if job:acquire_resources(now) then
         self.work.add(now, data.priority, data.jid)
+        ready = ready + 1
       end
     else
       self.work.add(now, data.priority, data.jid)
+      ready = ready + 1
     end
   end
+  self:signal(ready)
 
   -- Remove these jobs from the failed state
-  redis.call('ltrim', 'ql:f:' .. group, 0, -count - 1)
-  if (redis.call('llen', 'ql:f:' .. group) == 0) then
-    redis.call('srem', 'ql:failures', group)
+  if #jids > 0 then
+    if legacy then
+      redis.call('ltrim', key, 0, -#jids - 1)
+      for _, jid in ipairs(jids) do
+        redis.call('zrem', key .. '-migrating', jid)
+      end
+    else
+      redis.call('zremrangebyrank', key, 0, #jids - 1)
+    end
+    Qless.removed_failures(group, #jids)
   end
 
   return #jids
@@ -697,7 +1363,8 @@ function QlessQueue:recur(now, jid, klass, raw_data, spec, ...)
       'Recur(): Arg "backlog" not a number: ' .. tostring(
         options.backlog))
     options.resources = assert(cjson.decode(options['resources'] or '[]'),
-      'Recur(): Arg "resources" not JSON array: '     .. tostring(options['resources']))
+      'Recur(): Arg "resources" not JSON array or object: '     .. tostring(options['resources']))
+    QlessResource.check(QlessResource.weights(options.resources), 'Recur')
 
     local count, old_queue = unpack(redis.call('hmget', 'ql:r:' .. jid, 'count', 'queue'))
     count = count or 0
@@ -791,10 +1458,7 @@ function QlessQueue:check_recurring(now, count)
 
       -- Add this job to the list of jobs tagged with whatever tags were
       -- supplied
-      for i, tag in ipairs(_tags) do
-        redis.call('zadd', 'ql:t:' .. tag, now, child_jid)
-        redis.call('zincrby', 'ql:tags', 1, tag)
-      end
+      Qless.retag(now, child_jid, {}, _tags)
 
       -- First, let's save its data
       redis.call('hmset', QlessJob.ns .. child_jid,
@@ -814,7 +1478,7 @@ function QlessQueue:check_recurring(now, count)
         'resources', cjson.encode(resources))
 
       local job = Qless.job(child_jid)
-      job:history(score, 'put', {q = self.name})
+      job:start_history(score, 'put', {q = self.name}, self.name)
       
       -- Now, if a delay was provided, and if it's in the future,
       -- then we'll have to schedule it. Otherwise, we're just
@@ -835,11 +1499,13 @@ function QlessQueue:check_recurring(now, count)
 end
 
 -- Check for any jobs that have been scheduled, and shovel them onto
--- the work queue. Returns nothing, but afterwards, up to `count`
--- scheduled jobs will be moved into the work queue
+-- the work queue. Afterwards, up to `count` scheduled jobs will be moved
+-- into the work queue, and the number that were is returned. It's up to
+-- callers to `signal` the jobs they don't take themselves.
 function QlessQueue:check_scheduled(now, count)
   -- zadd is a list of arguments that we'll be able to use to
   -- insert into the work queue
+  local ready = 0
   local scheduled = self.scheduled.ready(now, 0, count)
   for index, jid in ipairs(scheduled) do
     -- With these in hand, we'll have to go out and find the
@@ -850,6 +1516,7 @@ function QlessQueue:check_scheduled(now, count)
       redis.call('hget', QlessJob.ns .. jid, 'priority') or 0)
     if Qless.job(jid):acquire_resources(now) then
       self.work.add(now, priority, jid)
+      ready = ready + 1
     end
     self.scheduled.remove(jid)
 
@@ -857,15 +1524,32 @@ function QlessQueue:check_scheduled(now, count)
     -- instead of 'scheduled'
     redis.call('hset', QlessJob.ns .. jid, 'state', 'waiting')
   end
+  return ready
 end
 
 -- Check for and invalidate any locks that have been lost. Returns the
 -- list of jids that have been invalidated
-function QlessQueue:invalidate_locks(now, count)
+function QlessQueue:invalidate_locks(now, count, klasses)
   local jids = {}
+  local expired = self.locks.expired(now, 0, count)
+  -- A worker that only runs some klasses is only handed those jobs
+  if klasses then
+    local allowed = {}
+    for _, klass in ipairs(klasses) do allowed[klass] = true end
+    local filtered = {}
+    for _, jid in ipairs(expired) do
+      if allowed[redis.call('hget', QlessJob.ns .. jid, 'klass')] then
+        table.insert(filtered, jid)
+      end
+    end
+    -- The rest are ready to be handed out to workers for their klasses
+    self:signal(#expired - #filtered)
+    expired = filtered
+  end
+
   -- Iterate through all the expired locks and add them to the list
   -- of keys that we'll return
-  for index, jid in ipairs(self.locks.expired(now, 0, count)) do
+  for index, jid in ipairs(expired) do
     -- Remove this job from the jobs that the worker that was running it
     -- has
     local worker, failure = unpack(
@@ -899,7 +1583,7 @@ function QlessQueue:invalidate_locks(now, count)
       if redis.call('zscore', 'ql:tracked', jid) ~= false then
         Qless.publish('stalled', jid)
       end
-      Qless.job(jid):history(now, 'timed-out')
+      Qless.job(jid):history(now, 'timed-out', nil, self.name)
       redis.call('hset', QlessJob.ns .. jid, 'grace', 1)
 
       -- Send a message to let the worker know that its lost its lock on
@@ -942,7 +1626,7 @@ function QlessQueue:invalidate_locks(now, count)
 
         local group = 'failed-retries-' .. Qless.job(jid):data()['queue']
         local job = Qless.job(jid)
-        job:history(now, 'failed', {group = group})
+        job:history(now, 'failed', {group = group}, self.name)
         redis.call('hmset', QlessJob.ns .. jid, 'state', 'failed',
           'worker', '',
           'expires', '')
@@ -956,10 +1640,8 @@ function QlessQueue:invalidate_locks(now, count)
           ['worker']  = unpack(job:data('worker'))
         }))
 
-        -- Add this type of failure to the list of failures
-        redis.call('sadd', 'ql:failures', group)
-        -- And add this particular instance to the failed types
-        redis.call('lpush', 'ql:f:' .. group, jid)
+        -- Add this particular instance to the failed types
+        Qless.add_failure(group, jid, now)
 
         if redis.call('zscore', 'ql:tracked', jid) ~= false then
           Qless.publish('failed', jid)
@@ -1007,20 +1689,24 @@ end
 --          ...
 --      }
 --  ]
+--
+-- The sizes of the queue's sets are read from its counters, so this doesn't
+-- move any scheduled jobs. Those that are due are reported as waiting, since
+-- that's where the next pop or peek will put them.
 function QlessQueue.counts(now, name)
   if name then
     local queue = Qless.queue(name)
+    local counts = queue:counters()
     local stalled = queue.locks.length(now)
-    -- Check for any scheduled jobs that need to be moved
-    queue:check_scheduled(now, queue.scheduled.length())
+    local ready = redis.call('zcount', queue:prefix('scheduled'), 0, now)
     return {
       name      = name,
-      waiting   = queue.work.length(),
+      waiting   = counts.waiting + ready,
       stalled   = stalled,
-      running   = queue.locks.length() - stalled,
-      scheduled = queue.scheduled.length(),
-      depends   = queue.depends.length(),
-      recurring = queue.recurring.length(),
+      running   = counts.running - stalled,
+      scheduled = counts.scheduled - ready,
+      depends   = counts.depends,
+      recurring = counts.recurring,
       paused    = queue:paused()
     }
   else
@@ -1032,3 +1718,78 @@ function QlessQueue.counts(now, name)
     return response
   end
 end
+
+-- The counts of a page of the known queues, in the order they were first seen
+function QlessQueue.list(now, offset, count)
+  offset = assert(tonumber(offset or 0),
+    'List(): Arg "offset" not a number: ' .. tostring(offset))
+  count = assert(tonumber(count or 25),
+    'List(): Arg "count" not a number: ' .. tostring(count))
+  local response = {}
+  for index, qname in ipairs(redis.call(
+    'zrange', 'ql:queues', offset, offset + count - 1)) do
+    table.insert(response, QlessQueue.counts(now, qname))
+  end
+  return response
+end
+
+-- The number of jobs in each of this queue's sets is kept in the hash
+-- `ql:q:<name>-counts`, and updated by the accessors as jobs are added and
+-- removed.
+QlessQueue.counter_names = {
+  'waiting', 'running', 'scheduled', 'depends', 'recurring'}
+
+-- Adjust one of this queue's counters. A queue without counters, like one
+-- from before they were kept, is recounted instead. That count already
+-- includes the change being made, so there's nothing left to add.
+function QlessQueue:count(name, delta)
+  if delta == 0 then
+    return
+  end
+  if not self.counted then
+    self.counted = true
+    if redis.call('exists', self:prefix('counts')) == 0 then
+      self:recount()
+      return
+    end
+  end
+  redis.call('hincrby', self:prefix('counts'), name, delta)
+end
+
+-- Read this queue's counters, or the sizes of its sets if it hasn't got any
+function QlessQueue:counters()
+  local values = redis.call(
+    'hmget', self:prefix('counts'), unpack(QlessQueue.counter_names))
+  if not values[1] then
+    return self:sizes()
+  end
+  local counts = {}
+  for index, name in ipairs(QlessQueue.counter_names) do
+    counts[name] = tonumber(values[index] or 0)
+  end
+  return counts
+end
+
+-- The number of jobs in each of this queue's sets
+function QlessQueue:sizes()
+  return {
+    waiting   = self.work.length(),
+    running   = self.locks.length(),
+    scheduled = self.scheduled.length(),
+    depends   = self.depends.length(),
+    recurring = self.recurring.length()
+  }
+end
+
+-- Set this queue's counters from the sizes of its sets
+function QlessQueue:recount()
+  local counts = self:sizes()
+  local args = {}
+  for _, name in ipairs(QlessQueue.counter_names) do
+    table.insert(args, name)
+    table.insert(args, counts[name])
+  end
+  redis.call('hmset', self:prefix('counts'), unpack(args))
+  self.counted = true
+  return counts
+end
@@ -20,6 +20,7 @@ function QlessResource:data(...)
   local data = {
     rid          = res[1],
     max          = tonumber(res[2] or 0),
+    used         = self:used(),
     pending      = redis.call('zrevrange', self:prefix('pending'), 0, -1),
     locks        = redis.call('smembers', self:prefix('locks')),
   }
@@ -37,30 +38,20 @@ end
 function QlessResource:counts(now, rid)
   if rid then
     local resource = redis.call(
-      'hmget', QlessResource.ns .. rid, 'rid', 'max')
+      'hmget', QlessResource.ns .. rid, 'rid', 'max', 'used')
 
     -- Return nil if we haven't found it
     if not resource[1] then
       return nil
     end
 
-    local pending = redis.call('zrevrange', QlessResource.ns .. rid .. '-' .. 'pending', 0, -1)
-    local pcount = 0
-    for _, _ in pairs(pending) do
-      pcount = pcount + 1
-    end
-
-    local locks = redis.call('smembers', QlessResource.ns .. rid .. '-' .. 'locks')
-    local lcount = 0
-    for _, _ in pairs(locks) do
-      lcount = lcount + 1
-    end
-
     return {
       rid          = resource[1],
       max          = tonumber(resource[2] or 0),
-      pending      = tonumber(pcount or 0),
-      locks        = tonumber(lcount or 0)
+      used         = tonumber(resource[3] or
+        redis.call('scard', QlessResource.ns .. rid .. '-locks')),
+      pending      = redis.call('zcard', QlessResource.ns .. rid .. '-pending'),
+      locks        = redis.call('scard', QlessResource.ns .. rid .. '-locks')
     }
   else
     local resources = redis.call('smembers', 'ql:resources')
@@ -69,6 +60,7 @@ function QlessResource:counts(now, rid)
       local c = QlessResource:counts(now, rname)
       response[rname] = {
         max        = c.max,
+        used       = c.used,
         pending    = c.pending,
         locks      = c.locks
       }
@@ -78,15 +70,102 @@ function QlessResource:counts(now, rid)
   end
 end
 
-function QlessResource:set(max)
+---
+-- A page of the jobs waiting on this resource, in the order in which they'll
+-- be given a lock, along with how many are waiting in total
+-- @param offset
+-- @param count
+--
+function QlessResource:pending(offset, count)
+  offset = assert(tonumber(offset or 0),
+    'Pending(): Arg "offset" not a number: ' .. tostring(offset))
+  count = assert(tonumber(count or 25),
+    'Pending(): Arg "count" not a number: ' .. tostring(count))
+  return {
+    total = redis.call('zcard', self:prefix('pending')),
+    jobs  = redis.call('zrevrange', self:prefix('pending'),
+      offset, offset + count - 1)
+  }
+end
+
+---
+-- A page of the jobs holding a lock on this resource. The locks are kept in
+-- an unordered set, so this pages with an SSCAN cursor rather than an offset:
+-- start with cursor 0, and pass back the returned cursor until it's 0 again.
+-- Like SSCAN, a page may hold more or fewer than `count` jobs.
+-- @param cursor
+-- @param count
+--
+function QlessResource:holders(cursor, count)
+  cursor = assert(tonumber(cursor or 0),
+    'Holders(): Arg "cursor" not a number: ' .. tostring(cursor))
+  count = assert(tonumber(count or 25),
+    'Holders(): Arg "count" not a number: ' .. tostring(count))
+  local reply = redis.call('sscan', self:prefix('locks'), cursor,
+    'count', count)
+  return {
+    total  = redis.call('scard', self:prefix('locks')),
+    cursor = tonumber(reply[1]),
+    jobs   = reply[2]
+  }
+end
+
+function QlessResource:set(now, max)
   local max = assert(tonumber(max), 'Set(): Arg "max" not a number: ' .. tostring(max))
 
   redis.call('sadd', 'ql:resources', self.rid)
   redis.call('hmset', QlessResource.ns .. self.rid, 'rid', self.rid, 'max', max);
 
+  -- If we've just raised the limit, put the new capacity to use right away
+  -- rather than waiting for a release for each slot
+  self:promote(now)
+
   return self.rid
 end
 
+--- Turns a job's `resources` into a list of {rid, weight} pairs. They may be
+-- given as a list of resource ids, each of which uses a single unit, or as an
+-- object of resource ids to the number of units the job uses.
+-- @param resources -- the decoded resources of a job
+--
+function QlessResource.weights(resources)
+  local weights = {}
+  if #resources > 0 then
+    for _, rid in ipairs(resources) do
+      table.insert(weights, {rid, 1})
+    end
+  else
+    -- Sorted, so that jobs wait on and take their resources in a fixed order
+    local rids = {}
+    for rid, _ in pairs(resources) do
+      table.insert(rids, rid)
+    end
+    table.sort(rids)
+    for _, rid in ipairs(rids) do
+      local weight = tonumber(resources[rid])
+      assert(weight and weight > 0 and weight == math.floor(weight),
+        'Resources(): Weight for "' .. rid .. '" not a positive integer: ' ..
+        tostring(resources[rid]))
+      table.insert(weights, {rid, weight})
+    end
+  end
+  return weights
+end
+
+--- Raises an error unless every one of the {rid, weight} pairs names a
+-- resource that exists. A job may use more units than its resource has for
+-- now, since the limit can be set to zero to hold jobs back, and such a job
+-- waits until the limit is raised to fit it.
+-- @param weights -- from `QlessResource.weights`
+-- @param command -- the name of the command, for the error
+--
+function QlessResource.check(weights, command)
+  for _, res in ipairs(weights) do
+    assert(redis.call('exists', QlessResource.ns .. res[1]) == 1,
+      command .. '(): resource ' .. res[1] .. ' does not exist')
+  end
+end
+
 function QlessResource:unset()
   redis.call('srem', 'ql:resources', self.rid)
   return redis.call('del', QlessResource.ns .. self.rid);
@@ -100,60 +179,126 @@ function QlessResource:prefix(group)
   return QlessResource.ns..self.rid
 end
 
-function QlessResource:acquire(now, priority, jid)
+--- Whether the job with the provided jid could take a lock on this resource,
+-- either because it already holds one or because there's a free slot.
+-- @param jid
+--
+function QlessResource:available(jid, weight)
   local keyLocks = self:prefix('locks')
-  local data = self:data()
-  assert(data, 'Acquire(): resource ' .. self.rid .. ' does not exist')
+  -- Only read the limit here rather than all of data(), which would load the
+  -- whole pending and locks sets and make every acquire cost grow with them
+  local max = redis.call('hget', self:prefix(), 'max')
+  assert(max, 'Acquire(): resource ' .. self.rid .. ' does not exist')
   assert(type(jid) ~= 'table', 'Acquire(): invalid jid')
 
   -- Don't allow multiple locks on same aquire
-  if redis.call('sismember', self:prefix('locks'), jid) == 1 then
+  if redis.call('sismember', keyLocks, jid) == 1 then
     return true
   end
 
-  local remaining = data['max'] - redis.pcall('scard', keyLocks)
+  return self:used() + (weight or 1) <= tonumber(max)
+end
 
-  if remaining > 0 then
-    -- acquire a lock and release it from the pending queue
-    redis.call('sadd', keyLocks, jid)
-    redis.call('zrem', self:prefix('pending'), jid)
-    return true
+--- Takes a lock for the job, and releases it from the pending queue. This
+-- doesn't check the limit, so it's only to be used after `available`.
+-- @param jid
+-- @param weight -- how many units of the resource the job uses
+--
+function QlessResource:acquire(jid, weight)
+  self:used()
+  if redis.call('sadd', self:prefix('locks'), jid) == 1 then
+    -- Remember what was taken, as the job's weight may change before it's
+    -- given back
+    redis.call('hset', self:prefix('units'), jid, weight or 1)
+    redis.call('hincrby', self:prefix(), 'used', weight or 1)
   end
+  redis.call('zrem', self:prefix('pending'), jid)
+end
 
+--- Adds the job to the pending queue, if it's not already waiting
+-- @param now
+-- @param priority
+-- @param jid
+--
+function QlessResource:wait(now, priority, jid)
   local pending = redis.call('zscore', self:prefix('pending'), jid)
   if pending == nil or pending == false then
     redis.call('zadd', self:prefix('pending'), priority - (now / 10000000000), jid)
   end
-
-  return false
 end
 
---- Releases the resource for the specified job identifier and assigns it to the next waiting job
+--- Releases the resource for the specified job identifier, giving back the
+-- units it took. The freed slot is handed on by `promote`, which is left to
+-- the caller so that a job giving up several resources can release all of
+-- them first.
 -- @param now
 -- @param jid
+-- @param weight -- the job's weight, for locks taken before units were kept
 --
-function QlessResource:release(now, jid)
-  local keyLocks = self:prefix('locks')
-  local keyPending = self:prefix('pending')
+function QlessResource:release(now, jid, weight)
+  self:used()
+  if redis.call('srem', self:prefix('locks'), jid) == 1 then
+    local units = redis.call('hget', self:prefix('units'), jid)
+    redis.call('hdel', self:prefix('units'), jid)
+    redis.call('hincrby', self:prefix(), 'used', -(tonumber(units) or weight or 1))
+  end
+  redis.call('zrem', self:prefix('pending'), jid)
+end
+
+--- Returns how many units of this resource are held. Resources locked before
+-- units were tracked have no `used` count, and so it's set from the number of
+-- locks the first time it's needed, each of which held a single unit.
+--
+function QlessResource:used()
+  local used = redis.call('hget', self:prefix(), 'used')
+  if not used then
+    used = redis.call('scard', self:prefix('locks'))
+    if redis.call('exists', self:prefix()) == 1 then
+      redis.call('hset', self:prefix(), 'used', used)
+    end
+  end
+  return tonumber(used)
+end
 
-  redis.call('srem', keyLocks, jid)
-  redis.call('zrem', keyPending, jid)
+--- Hands any free capacity to the jobs waiting on this resource, in the order
+-- they're waiting, and moves them into the work sets of their queues. A job
+-- only takes its locks if it can take all of them at once, and so waiters
+-- that are still blocked on another resource are skipped (and left to wait
+-- on that resource instead). At most `resource-scan-limit` waiters are looked
+-- at. Returns the promoted jids.
+-- @param now
+--
+function QlessResource:promote(now)
+  local max = redis.call('hget', self:prefix(), 'max')
+  if not max then
+    return {}
+  end
 
-  local jids = redis.call('zrevrange', keyPending, 0, 0, 'withscores')
-  if #jids == 0 then
-    return false
+  local free = tonumber(max) - self:used()
+  if free <= 0 then
+    return {}
   end
 
-  local newJid = jids[1]
-  local score = jids[2]
+  local promoted = {}
+  local limit = tonumber(Qless.config.get('resource-scan-limit', 100))
+  local jids = redis.call('zrevrange', self:prefix('pending'),
+    0, math.max(free, limit) - 1, 'withscores')
+  for i = 1, #jids, 2 do
+    if self:used() >= tonumber(max) then
+      break
+    end
 
-  -- multiple resource validation
-  if Qless.job(newJid):acquire_resources(now) then
-    local data = Qless.job(newJid):data()
-    Qless.queue(data['queue']).work.add(score, 0, newJid)
+    local jid, score = jids[i], jids[i + 1]
+    if Qless.job(jid):acquire_resources(now) then
+      table.insert(promoted, jid)
+      local queue = Qless.queue(
+        redis.call('hget', QlessJob.ns .. jid, 'queue'))
+      queue.work.add(score, 0, jid)
+      queue:signal(1)
+    end
   end
 
-  return newJid
+  return promoted
 end
 
 --- Return the number of active locks for this resource
@@ -41,3 +41,16 @@ class TestConfig(TestQless):
         self.assertEqual(self.lua('config.get', 0, 'foo'), 5)
         self.lua('config.unset', 0, 'foo')
         self.assertEqual(self.lua('config.get', 0, 'foo'), None)
+
+    def test_all_overrides(self):
+        '''Getting all the settings includes what's been set, over defaults'''
+        self.lua('config.set', 0, 'heartbeat', 100)
+        self.lua('config.set', 0, 'foo', 'bar')
+        config = self.lua('config.get', 0)
+        self.assertEqual(config['heartbeat'], '100')
+        self.assertEqual(config['foo'], 'bar')
+        self.lua('config.unset', 0, 'heartbeat')
+        self.lua('config.unset', 0, 'foo')
+        config = self.lua('config.get', 0)
+        self.assertEqual(config['heartbeat'], 60)
+        self.assertFalse('foo' in config)
@@ -155,6 +155,81 @@ class TestFailed(TestQless):
         self.assertEqual(
             self.lua('failed', 0, 'group', 50, 50)['jobs'], jids[50:])
 
+    def fail(self, now, jid, group='group'):
+        '''Put, pop and fail a job at the provided time'''
+        self.lua('put', now, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.lua('pop', now, 'queue', 'worker', 10)
+        self.lua('fail', now, jid, 'worker', group, 'message')
+
+    def test_range(self):
+        '''We can page through the jobs that failed in a time range'''
+        for now in range(10):
+            self.fail(now, str(now))
+        self.assertEqual(self.lua('failed.range', 10, 'group', 3, 6), {
+            'total': 4,
+            'jobs': ['6', '5', '4', '3']})
+        self.assertEqual(self.lua('failed.range', 10, 'group', 3, 6, 1, 2), {
+            'total': 4,
+            'jobs': ['5', '4']})
+        self.assertEqual(
+            self.lua('failed.range', 10, 'group')['total'], 10)
+
+    def test_counts(self):
+        '''The counts of each group are kept as jobs come and go'''
+        self.fail(0, 'a')
+        self.fail(1, 'b')
+        self.fail(2, 'c', 'other')
+        self.assertEqual(self.lua('failed', 3), {'group': 2, 'other': 1})
+        self.lua('put', 3, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('cancel', 3, 'c')
+        self.assertEqual(self.lua('failed', 3), {'group': 1})
+        self.assertEqual(self.redis.hgetall('ql:failure-counts'), {'group': '1'})
+
+    def test_legacy_lists(self):
+        '''Failure groups kept as lists keep working until they're migrated'''
+        for now in range(3):
+            self.fail(now, str(now))
+        self.redis.delete('ql:f:group', 'ql:failure-counts')
+        self.redis.lpush('ql:f:group', '0', '1', '2')
+        self.assertEqual(self.lua('failed', 3), {'group': 3})
+        self.assertEqual(self.redis.type('ql:f:group'), 'list')
+        self.assertEqual(
+            self.lua('failed', 3, 'group')['jobs'], ['2', '1', '0'])
+        # Reading them doesn't count them
+        self.lua('failed', 3, 'unknown')
+        self.assertEqual(self.redis.hgetall('ql:failure-counts'), {})
+        self.lua('put', 3, 'worker', 'queue', '1', 'klass', {}, 0)
+        self.assertEqual(self.lua('failed', 3, 'group'), {
+            'total': 2, 'jobs': ['2', '0']})
+        self.fail(4, '3')
+        self.assertEqual(self.lua('failed', 4, 'group'), {
+            'total': 3, 'jobs': ['3', '2', '0']})
+        self.assertEqual(self.lua('unfail', 4, 'queue', 'group', 1), 1)
+        self.assertEqual(self.lua('failed', 4), {'group': 2})
+        self.assertRaisesRegexp(Exception, r'failed.migrate',
+            self.lua, 'failed.range', 4, 'group')
+
+    def test_migrate(self):
+        '''Failure groups kept as lists are migrated a few jobs at a time'''
+        for now in range(5):
+            self.fail(now, str(now))
+        self.redis.delete('ql:f:group', 'ql:failure-counts')
+        self.redis.lpush('ql:f:group', '0', '1', '2', '3', '4')
+        self.assertEqual(self.lua('failed.migrate', 5, 2), 3)
+        self.assertEqual(self.redis.type('ql:f:group'), 'list')
+        # Jobs that come and go while it's migrating are kept track of
+        self.lua('put', 5, 'worker', 'queue', '0', 'klass', {}, 0)
+        self.lua('put', 5, 'worker', 'queue', '3', 'klass', {}, 0)
+        self.fail(6, '5')
+        self.assertEqual(self.lua('failed.migrate', 6, 1), 2)
+        self.assertEqual(self.lua('failed.migrate', 6, 10), 0)
+        self.assertEqual(self.redis.type('ql:f:group'), 'zset')
+        self.assertEqual(self.redis.exists('ql:f:group-migrating'), False)
+        self.assertEqual(self.lua('failed', 6), {'group': 4})
+        self.assertEqual(self.lua('failed.range', 6, 'group'), {
+            'total': 4, 'jobs': ['5', '4', '2', '1']})
+        self.assertEqual(self.lua('failed.migrate', 6, 10), 0)
+
 
 class TestUnfailed(TestQless):
     '''Test access to unfailed'''
@@ -169,3 +244,17 @@ class TestUnfailed(TestQless):
         self.lua('unfail', 0, 'queue', 'group', 100)
         for jid in jids:
             self.assertEqual(self.lua('get', 0, jid)['state'], 'waiting')
+
+    def test_oldest_first(self):
+        '''Unfail moves the jobs that failed longest ago first'''
+        for now in range(5):
+            jid = str(now)
+            self.lua('put', now, 'worker', 'queue', jid, 'klass', {}, 0)
+            self.lua('pop', now, 'queue', 'worker', 10)
+            self.lua('fail', now, jid, 'worker', 'group', 'message')
+        self.assertEqual(self.lua('unfail', 5, 'queue', 'group', 2), 2)
+        self.assertEqual(self.lua('failed', 5, 'group'), {
+            'total': 3, 'jobs': ['4', '3', '2']})
+        self.assertEqual(self.lua('failed', 5), {'group': 3})
+        self.assertEqual(self.lua('unfail', 5, 'queue', 'group', 10), 3)
+        self.assertEqual(self.lua('failed', 5), {})
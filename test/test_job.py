@@ -1,5 +1,6 @@
 '''Test job-centric operations'''
 
+import json
 import redis
 from common import TestQless
 
@@ -40,6 +41,206 @@ class TestJob(TestQless):
             {'q': 'queue', 'what': 'put', 'when': 98},
             {'q': 'queue', 'what': 'put', 'when': 99}])
 
+    def test_get_fields(self):
+        '''We can ask for just some of the fields of a job'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0,
+            'tags', ['foo'])
+        self.assertEqual(
+            self.lua('get', 0, 'jid', 'fields', 'jid,klass,tags,history'), {
+                'jid': 'jid',
+                'klass': 'klass',
+                'tags': ['foo'],
+                'history': [{'q': 'queue', 'what': 'put', 'when': 0}]})
+        self.assertEqual(
+            self.lua('get', 0, 'nonexistent', 'fields', 'jid,klass'), None)
+
+    def test_get_fields_malformed(self):
+        '''Only known fields can be asked for'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertMalformed(self.lua, [
+            ('get', 0, 'jid', 'fields'),
+            ('get', 0, 'jid', 'fields', 'jid,foo'),
+            ('get', 0, 'jid', 'foo', 'jid'),
+        ])
+
+    def test_multiget_fields(self):
+        '''Multiget takes the fields after the jids'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('put', 0, 'worker', 'queue', 'b', 'klass', {}, 0)
+        self.assertEqual(
+            self.lua('multiget', 0, 'a', 'b', 'c', 'fields', 'jid,state'), [
+                {'jid': 'a', 'state': 'waiting'},
+                {'jid': 'b', 'state': 'waiting'}])
+
+    def test_get_history(self):
+        '''We can ask for just part of a job's history'''
+        self.lua('config.set', 0, 'max-job-history', 0)
+        for index in range(5):
+            self.lua('put', index, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        when = lambda *args: [
+            item['when'] for item in self.lua(*args)['history']]
+        self.assertEqual(when('get', 0, 'jid', 'history', 'all'), range(5))
+        self.assertEqual(when('get', 0, 'jid', 'history', 'last:2'), [3, 4])
+        self.assertEqual(when('get', 0, 'jid', 'history', 'last:9'), range(5))
+        self.assertEqual(
+            when('get', 0, 'jid', 'history', 'range:0:2'), [0, 1])
+        self.assertEqual(
+            when('get', 0, 'jid', 'history', 'range:1:2'), [1, 2])
+        self.assertEqual(
+            when('get', 0, 'jid', 'history', 'range:4:5'), [4])
+        self.assertEqual(when('get', 0, 'jid', 'history', 'range:0:0'), [])
+        self.assertFalse(
+            'history' in self.lua('get', 0, 'jid', 'history', 'none'))
+
+    def test_get_dependencies(self):
+        '''We can leave out a job's dependents and dependencies'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('put', 0, 'worker', 'queue', 'b', 'klass', {}, 0,
+            'depends', ['a'])
+        job = self.lua('get', 0, 'b', 'dependencies', '0', 'history', 'none')
+        self.assertFalse('dependencies' in job)
+        self.assertFalse('dependents' in job)
+        self.assertEqual(job['state'], 'depends')
+        self.assertEqual(self.lua('get', 0, 'b', 'dependencies', '1',
+            'fields', 'jid,dependencies'), {'jid': 'b', 'dependencies': ['a']})
+
+    def test_multiget_history(self):
+        '''Multiget takes the history mode after the jids'''
+        for jid in ('a', 'b'):
+            self.lua('put', 0, 'worker', 'queue', jid, 'klass', {}, 0)
+            self.lua('put', 1, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.assertEqual(self.lua('multiget', 0, 'a', 'b',
+            'fields', 'jid,history', 'history', 'last:1'), [
+                {'jid': 'a', 'history': [
+                    {'q': 'queue', 'what': 'put', 'when': 1}]},
+                {'jid': 'b', 'history': [
+                    {'q': 'queue', 'what': 'put', 'when': 1}]}])
+
+    def test_get_history_malformed(self):
+        '''Only known history modes can be asked for'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertMalformed(self.lua, [
+            ('get', 0, 'jid', 'history', 'foo'),
+            ('get', 0, 'jid', 'history', 'last:'),
+            ('get', 0, 'jid', 'history', 'range:1'),
+            ('get', 0, 'jid', 'dependencies', 'foo'),
+        ])
+
+class TestHistory(TestQless):
+    '''Test the history policies of queues'''
+    def history(self, jid):
+        '''The `what` of each item in a job's history'''
+        return [item['what'] for item in self.lua('get', 0, jid)['history']]
+
+    def test_off(self):
+        '''Queues can keep no history at all'''
+        self.lua('config.set', 0, 'queue-history', 'off')
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('pop', 1, 'queue', 'worker', 10)
+        self.lua('complete', 2, 'jid', 'worker', 'queue', {})
+        self.assertEqual(self.history('jid'), [])
+
+    def test_capped(self):
+        '''Queues can keep the first and most recent history items'''
+        self.lua('config.set', 0, 'queue-history', 'capped:3')
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        for index in range(5):
+            self.lua('pop', index, 'queue', 'worker', 10)
+            self.lua('fail', index, 'jid', 'worker', 'group', 'message', {})
+            self.lua('put', index, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertEqual(self.history('jid'), ['put', 'failed', 'put'])
+
+    def test_full(self):
+        '''Queues can keep all of their jobs' history'''
+        self.lua('config.set', 0, 'max-job-history', 5)
+        self.lua('config.set', 0, 'queue-history', 'full')
+        for index in range(10):
+            self.lua('put', index, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertEqual(len(self.history('jid')), 10)
+
+    def test_per_queue(self):
+        '''The policy is that of the queue the job is in'''
+        self.lua('config.set', 0, 'foo-history', 'off')
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('put', 1, 'worker', 'foo', 'jid', 'klass', {}, 0)
+        self.lua('pop', 2, 'foo', 'worker', 10)
+        self.lua('complete', 3, 'jid', 'worker', 'foo', {}, 'next', 'queue')
+        self.assertEqual(self.history('jid'), ['put', 'put'])
+
+    def test_unknown_policy(self):
+        '''Unknown policies are an error'''
+        self.lua('config.set', 0, 'queue-history', 'foo')
+        self.assertRaisesRegexp(redis.ResponseError, r'Unknown history policy',
+            self.lua, 'put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+
+    def test_migrate(self):
+        '''Histories with the first item at the head of the list migrate'''
+        self.lua('config.set', 0, 'max-job-history', 3)
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        # Move the first item back into the list, as it used to be stored
+        first = self.redis.hget('ql:j:jid', 'history_first')
+        self.redis.hdel('ql:j:jid', 'history_first')
+        self.redis.lpush('ql:j:jid-history', first)
+        self.assertEqual(self.lua('history.migrate', 0, 'jid', 'foo'), 1)
+        self.assertEqual(self.lua('history.migrate', 0, 'jid'), 0)
+        for index in range(1, 5):
+            self.lua('put', index, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertEqual(
+            [item['when'] for item in self.lua('get', 5, 'jid')['history']],
+            [0, 3, 4])
+
+    def test_migrate_scan(self):
+        '''Every job's history can be migrated a page at a time'''
+        self.lua('config.set', 0, 'max-job-history', 3)
+        for jid in range(10):
+            self.lua('put', 0, 'worker', 'queue', jid, 'klass', {}, 0,
+                'depends', [jid - 1] if jid else [])
+            first = self.redis.hget('ql:j:%s' % jid, 'history_first')
+            self.redis.hdel('ql:j:%s' % jid, 'history_first')
+            self.redis.lpush('ql:j:%s-history' % jid, first)
+        migrated = 0
+        response = self.lua('history.migrate', 0, 'scan', 0, 2)
+        while True:
+            migrated += response['migrated']
+            if not response['cursor']:
+                break
+            response = self.lua(
+                'history.migrate', 0, 'scan', response['cursor'], 2)
+        self.assertEqual(migrated, 10)
+        for index in range(1, 5):
+            self.lua('put', index, 'worker', 'queue', 0, 'klass', {}, 0)
+        self.assertEqual(
+            [item['when'] for item in self.lua('get', 5, 0)['history']],
+            [0, 3, 4])
+
+    def test_unmigrated_old_style(self):
+        '''Histories stored in the job's hash are read without migrating'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.redis.hdel('ql:j:jid', 'history_first')
+        self.redis.hset('ql:j:jid', 'history', json.dumps([
+            {'q': 'queue', 'put': 1, 'popped': 2, 'worker': 'worker'}]))
+        self.assertEqual(self.lua('get', 3, 'jid')['history'], [
+            {'q': 'queue', 'what': 'put', 'when': 1},
+            {'what': 'popped', 'when': 2, 'worker': 'worker'}])
+        self.lua('put', 4, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertEqual(
+            [item['when'] for item in self.lua('get', 5, 'jid')['history']],
+            [1, 2, 4])
+
+    def test_migrate_old_style(self):
+        '''Histories stored in the job's hash migrate'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.redis.hdel('ql:j:jid', 'history_first')
+        self.redis.hset('ql:j:jid', 'history', json.dumps([
+            {'q': 'queue', 'put': 1, 'popped': 2, 'worker': 'worker',
+             'done': 3}]))
+        self.assertEqual(self.lua('history.migrate', 0, 'jid'), 1)
+        self.assertEqual(self.lua('get', 0, 'jid')['history'], [
+            {'q': 'queue', 'what': 'put', 'when': 1},
+            {'what': 'popped', 'when': 2, 'worker': 'worker'},
+            {'what': 'done', 'when': 3}])
+
+
 class TestRequeue(TestQless):
     def test_requeue_existing_job(self):
         '''Requeueing an existing job is identical to `put`'''
@@ -240,6 +441,144 @@ class TestComplete(TestQless):
 
 
 
+class TestCompleteMany(TestQless):
+    '''Test completing a batch of jobs'''
+    def test_malformed(self):
+        '''Enumerate all the way they can be malformed'''
+        self.assertMalformed(self.lua, [
+            ('complete.many', 0, 'worker', 'queue'),
+            ('complete.many', 0, 'worker', 'queue', '[}'),
+            ('complete.many', 0, 'worker', 'queue', [{'data': {}}]),
+        ])
+
+    def test_basic(self):
+        '''Jobs completed in a batch are the same as those completed singly'''
+        for jid in ['a', 'b']:
+            self.lua('put', 0, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.lua('pop', 1, 'queue', 'worker', 10)
+        self.assertEqual(self.lua('complete.many', 2, 'worker', 'queue', [
+            {'jid': 'a', 'data': {'foo': 'bar'}},
+            {'jid': 'b', 'next': 'foo', 'delay': 10}]), [
+            {'jid': 'a', 'state': 'complete'},
+            {'jid': 'b', 'state': 'scheduled'}])
+        job = self.lua('get', 3, 'a')
+        self.assertEqual(job['state'], 'complete')
+        self.assertEqual(job['data'], '{"foo":"bar"}')
+        self.assertEqual(job['history'][-1], {'what': 'done', 'when': 2})
+        self.assertEqual(self.lua('get', 3, 'b')['queue'], 'foo')
+        self.assertEqual(self.lua('workers', 3, 'worker')['jobs'], {})
+        self.assertEqual(
+            self.lua('stats', 3, 'queue', 3)['run']['count'], 2)
+
+    def test_partial(self):
+        '''Jobs that can't be completed don't stop the rest'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0, 'priority', 1)
+        self.lua('put', 0, 'worker', 'queue', 'b', 'klass', {}, 0, 'priority', 1)
+        self.lua('put', 0, 'worker', 'queue', 'c', 'klass', {}, 0)
+        self.lua('pop', 1, 'queue', 'worker', 2)
+        results = self.lua('complete.many', 2, 'worker', 'queue', [
+            {'jid': 'a'}, {'jid': 'c'}, {'jid': 'd'}, {'jid': 'b'}])
+        self.assertEqual(results[0], {'jid': 'a', 'state': 'complete'})
+        self.assertEqual(results[1]['jid'], 'c')
+        self.assertRegexpMatches(results[1]['error'],
+            r'^Complete\(\): .* not currently running')
+        self.assertEqual(results[2]['jid'], 'd')
+        self.assertRegexpMatches(results[2]['error'], r'does not exist')
+        self.assertEqual(results[3], {'jid': 'b', 'state': 'complete'})
+        self.assertEqual(self.lua('get', 3, 'c')['state'], 'waiting')
+        self.assertEqual(
+            self.lua('stats', 3, 'queue', 3)['run']['count'], 2)
+
+    def test_keeps_data(self):
+        '''Jobs completed without data keep the data they had'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {'foo': 'bar'}, 0)
+        self.lua('pop', 1, 'queue', 'worker', 10)
+        self.lua('complete.many', 2, 'worker', 'queue', [{'jid': 'jid'}])
+        self.assertEqual(self.lua('get', 3, 'jid')['data'], '{"foo": "bar"}')
+
+    def test_wrong_worker(self):
+        '''Only the worker running the jobs can complete them'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('pop', 1, 'queue', 'worker', 10)
+        results = self.lua(
+            'complete.many', 2, 'another', 'queue', [{'jid': 'jid'}])
+        self.assertRegexpMatches(results[0]['error'], r'another worker')
+        self.assertEqual(self.lua('get', 3, 'jid')['state'], 'running')
+
+    def test_expire_complete_count(self):
+        '''Completed jobs still expire when completed in a batch'''
+        self.lua('config.set', 0, 'jobs-history-count', 5)
+        for jid in range(10):
+            self.lua('put', 0, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.lua('pop', 1, 'queue', 'worker', 10)
+        self.lua('complete.many', 2, 'worker', 'queue',
+            [{'jid': jid} for jid in range(10)])
+        existing = [self.lua('get', 3, jid) for jid in range(10)]
+        self.assertEqual(len([i for i in existing if i]), 5)
+
+
+class TestGC(TestQless):
+    '''Test the reaping of old completed jobs'''
+    def test_malformed(self):
+        '''Enumerate all the way they can be malformed'''
+        self.assertMalformed(self.lua, [
+            ('gc', 0),
+            ('gc', 0, 'foo'),
+        ])
+
+    def complete(self, now, jids):
+        '''Put, pop and complete each of the jids at the given time'''
+        for jid in jids:
+            self.lua('put', now, 'worker', 'queue', jid, 'klass', {}, 0)
+            self.lua('pop', now, 'queue', 'worker', 1)
+            self.lua('complete', now, jid, 'worker', 'queue', {})
+
+    def existing(self, jids):
+        '''The jids of those jobs that still exist'''
+        return [jid for jid in jids if self.lua('get', 100, jid)]
+
+    def test_budget_count(self):
+        '''Reaps at most the budget, oldest first, for jobs-history-count'''
+        self.lua('config.set', 0, 'gc-inline-budget', 0)
+        jids = map(str, range(10))
+        for jid in jids:
+            self.complete(int(jid), [jid])
+        self.lua('config.set', 0, 'jobs-history-count', 5)
+        self.assertEqual(self.lua('gc', 10, 2), 3)
+        self.assertEqual(self.existing(jids), jids[2:])
+        self.assertEqual(self.lua('gc', 10, 10), 0)
+        self.assertEqual(self.existing(jids), jids[5:])
+        self.assertEqual(self.lua('jobs', 10, 'complete'), jids[5:][::-1])
+
+    def test_budget_time(self):
+        '''Reaps at most the budget, oldest first, for jobs-history'''
+        self.lua('config.set', 0, 'gc-inline-budget', 0)
+        self.lua('config.set', 0, 'jobs-history', 100)
+        self.lua('put', 0, 'worker', 'queue', 'tagged', 'klass', {}, 0,
+            'tags', ['foo'])
+        self.lua('pop', 0, 'queue', 'worker', 1)
+        self.lua('complete', 0, 'tagged', 'worker', 'queue', {})
+        self.complete(1, ['a', 'b'])
+        self.complete(50, ['c'])
+        self.assertEqual(self.lua('gc', 50, 10), 0)
+        self.assertEqual(self.lua('gc', 102, 1), 2)
+        self.assertEqual(self.lua('tag', 102, 'get', 'foo', 0, 10)['jobs'], {})
+        self.assertEqual(self.lua('gc', 102, 10), 0)
+        self.assertEqual(self.existing(['tagged', 'a', 'b', 'c']), ['c'])
+
+    def test_inline_budget(self):
+        '''Completing a job only reaps a bounded number of old jobs'''
+        self.lua('config.set', 0, 'gc-inline-budget', 0)
+        jids = map(str, range(10))
+        self.complete(0, jids)
+        self.lua('config.set', 0, 'jobs-history-count', 1)
+        self.lua('config.set', 0, 'gc-inline-budget', 2)
+        self.complete(1, ['last'])
+        self.assertEqual(len(self.existing(jids)), 8)
+        self.assertEqual(self.lua('gc', 1, 100), 0)
+        self.assertEqual(self.existing(jids + ['last']), ['last'])
+
+
 class TestCancel(TestQless):
     '''Canceling jobs'''
     def test_cancel_waiting(self):
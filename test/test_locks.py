@@ -131,6 +131,66 @@ class TestLocks(TestQless):
             self.lua, 'heartbeat',  2, 'jid', 'another', {})
         self.lua('heartbeat', 2, 'jid', 'worker', {})
 
+    def test_heartbeat_many_malformed(self):
+        '''Enumerate malformed inputs into heartbeat.many'''
+        self.assertMalformed(self.lua, [
+            ('heartbeat.many', 0),
+            ('heartbeat.many', 0, 'worker'),
+            ('heartbeat.many', 0, 'worker', '[}'),
+            ('heartbeat.many', 0, 'worker', [{'data': {}}])
+        ])
+
+    def test_heartbeat_many(self):
+        '''Heartbeating several jobs at once extends all their locks'''
+        self.lua('config.set', 0, 'other-heartbeat', 120)
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('put', 0, 'worker', 'queue', 'b', 'klass', {}, 0)
+        self.lua('put', 0, 'worker', 'other', 'c', 'klass', {}, 0)
+        self.lua('pop', 1, 'queue', 'worker', 10)
+        self.lua('pop', 1, 'other', 'worker', 10)
+        self.assertEqual(self.lua('heartbeat.many', 2, 'worker', [
+            {'jid': 'a', 'data': {'foo': 'bar'}},
+            {'jid': 'b'},
+            {'jid': 'c'}]), [
+            {'jid': 'a', 'expires': 62},
+            {'jid': 'b', 'expires': 62},
+            {'jid': 'c', 'expires': 122}])
+        self.assertEqual(self.lua('get', 3, 'a')['data'], '{"foo":"bar"}')
+        self.assertEqual(self.lua('get', 3, 'b')['data'], '{}')
+        # The locks should have been extended
+        self.assertEqual(self.lua('pop', 50, 'queue', 'another', 10), {})
+        self.assertEqual(self.lua('pop', 100, 'other', 'another', 10), {})
+        self.assertEqual(
+            self.lua('workers', 100, 'worker')['jobs'], ['c'])
+
+    def test_heartbeat_many_large(self):
+        '''Large batches of heartbeats keep the running counts right'''
+        jids = map(str, range(5000))
+        self.lua('put.many', 0, 'worker', 'queue',
+            [{'jid': jid, 'klass': 'klass'} for jid in jids])
+        self.lua('pop', 1, 'queue', 'worker', 5000)
+        results = self.lua('heartbeat.many', 2, 'worker',
+            [{'jid': jid} for jid in jids])
+        self.assertEqual(set(r.get('expires') for r in results), set([62]))
+        self.assertEqual(
+            self.lua('queues', 2, 'queue')['running'], 5000)
+        self.assertEqual(self.lua('queue.recount', 2, 'queue')['running'], 5000)
+
+    def test_heartbeat_many_lost(self):
+        '''Jobs the worker has lost get an error but don't stop the rest'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('put', 0, 'worker', 'queue', 'b', 'klass', {}, 0)
+        self.lua('pop', 1, 'queue', 'worker', 10)
+        self.lua('put', 2, 'worker', 'queue', 'b', 'klass', {}, 0)
+        results = self.lua('heartbeat.many', 3, 'worker', [
+            {'jid': 'a'}, {'jid': 'b'}, {'jid': 'c'}])
+        self.assertEqual(results[0], {'jid': 'a', 'expires': 63})
+        self.assertEqual(results[1]['jid'], 'b')
+        self.assertRegexpMatches(results[1]['error'],
+            r'^Heartbeat\(\): .* not currently running: waiting')
+        self.assertEqual(results[2]['jid'], 'c')
+        self.assertRegexpMatches(results[2]['error'], r'does not exist')
+
 
 class TestRetries(TestQless):
     '''Test all the behavior surrounding retries'''
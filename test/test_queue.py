@@ -1,5 +1,7 @@
 '''Test the queue functionality'''
 
+import json
+
 from common import TestQless
 
 
@@ -322,6 +324,68 @@ class TestQueue(TestQless):
         self.assertEqual(self.lua('queues', 20), [expected])
         self.assertEqual(self.lua('queues', 20, 'queue'), expected)
 
+    def test_scheduled_not_moved(self):
+        '''Checking counts doesn't move scheduled jobs'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 10)
+        self.lua('queues', 20, 'queue')
+        self.assertEqual(self.redis.zcard('ql:q:queue-scheduled'), 1)
+        self.assertEqual(self.redis.zcard('ql:q:queue-work'), 0)
+
+    def test_counters(self):
+        '''The counters agree with a recount as jobs move around'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0,
+            'priority', 2)
+        self.lua('put', 0, 'worker', 'queue', 'b', 'klass', {}, 0,
+            'priority', 1)
+        self.lua('put', 0, 'worker', 'queue', 'c', 'klass', {}, 10,
+            'depends', ['a'])
+        self.lua('put', 0, 'worker', 'queue', 'd', 'klass', {}, 10)
+        self.lua('recur', 0, 'queue', 'e', 'klass', {}, 'interval', 60, 0)
+        self.lua('pop', 1, 'queue', 'worker', 2)
+        self.lua('complete', 2, 'a', 'worker', 'queue', {})
+        self.lua('fail', 2, 'b', 'worker', 'group', 'message', {})
+        self.lua('cancel', 2, 'd')
+        counters = self.redis.hgetall('ql:q:queue-counts')
+        self.assertEqual(counters, {
+            'waiting': '1', 'running': '0', 'scheduled': '1', 'depends': '0',
+            'recurring': '1'})
+        self.assertEqual(self.lua('queue.recount', 2, 'queue'), {
+            'waiting': 1, 'running': 0, 'scheduled': 1, 'depends': 0,
+            'recurring': 1})
+        self.assertEqual(self.redis.hgetall('ql:q:queue-counts'), counters)
+
+    def test_counters_missing(self):
+        '''Queues without counters are recounted when they're next changed'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('put', 0, 'worker', 'queue', 'b', 'klass', {}, 0)
+        self.redis.delete('ql:q:queue-counts')
+        expected = dict(self.expected)
+        expected['waiting'] = 2
+        self.assertEqual(self.lua('queues', 0, 'queue'), expected)
+        self.lua('put', 0, 'worker', 'queue', 'c', 'klass', {}, 0)
+        self.lua('pop', 1, 'queue', 'worker', 1)
+        self.assertEqual(
+            self.redis.hgetall('ql:q:queue-counts')['waiting'], '2')
+
+    def test_counters_key(self):
+        '''Counters don't collide with the sets of similarly-named queues'''
+        self.lua('put', 0, 'worker', 'foo', 'a', 'klass', {}, 0)
+        self.lua('put', 0, 'worker', 'foo-work', 'b', 'klass', {}, 0)
+        self.assertEqual(self.lua('queues', 0, 'foo')['waiting'], 1)
+        self.assertEqual(self.lua('queues', 0, 'foo-work')['waiting'], 1)
+        self.assertEqual(
+            [job['jid'] for job in self.lua('pop', 1, 'foo', 'worker', 10)],
+            ['a'])
+
+    def test_list(self):
+        '''We can page through the queues'''
+        for queue in ('a', 'b', 'c'):
+            self.lua('put', 0, 'worker', queue, 'jid-' + queue, 'klass', {}, 0)
+        self.assertEqual(
+            [queue['name'] for queue in self.lua('queues.list', 0, 1, 5)],
+            ['b', 'c'])
+        self.assertEqual(self.lua('queues.list', 0, 1, 1)[0]['waiting'], 1)
+
 
 class TestPut(TestQless):
     '''Test putting jobs into a queue'''
@@ -561,11 +625,99 @@ class TestPut(TestQless):
 
 
 
+class TestPutMany(TestQless):
+    '''Test putting a batch of jobs into a queue'''
+    def test_malformed(self):
+        '''Enumerate all the ways in which the input can be messed up'''
+        self.assertMalformed(self.lua, [
+            ('put.many', 0, 'worker', 'queue'),
+            ('put.many', 0, 'worker', 'queue', '[}'),
+            ('put.many', 0, 'worker', 'queue', [{'klass': 'klass'}]),
+            ('put.many', 0, 'worker', 'queue', [{'jid': 'jid'}]),
+            ('put.many', 0, 'worker', 'queue',
+                [{'jid': 'jid', 'klass': 'klass', 'delay': 'foo'}]),
+            ('put.many', 0, 'worker', 'queue',
+                [{'jid': 'jid', 'klass': 'klass', 'priority': 'foo'}]),
+            ('put.many', 0, 'worker', 'queue',
+                [{'jid': 'jid', 'klass': 'klass', 'tags': 'foo'}]),
+        ])
+
+    def test_malformed_inserts_nothing(self):
+        '''A bad spec anywhere in the batch means nothing is inserted'''
+        self.assertRaisesRegexp(Exception, r'not a number',
+            self.lua, 'put.many', 0, 'worker', 'queue', [
+                {'jid': 'a', 'klass': 'klass'},
+                {'jid': 'b', 'klass': 'klass', 'retries': 'foo'}])
+        self.assertEqual(self.lua('get', 0, 'a'), None)
+
+    def test_basic(self):
+        '''Jobs put in a batch are the same as those put one at a time'''
+        self.assertEqual(self.lua('put.many', 0, 'worker', 'queue', [
+            {'jid': 'a', 'klass': 'klass', 'data': {'foo': 'bar'}},
+            {'jid': 'b', 'klass': 'klass', 'delay': 10},
+            {'jid': 'c', 'klass': 'klass', 'priority': 5, 'tags': ['foo'],
+                'retries': 2}]), ['a', 'b', 'c'])
+        self.lua('put', 0, 'worker', 'queue', 'd', 'klass', {}, 0,
+            'priority', 5, 'tags', ['foo'], 'retries', 2)
+        c, d = self.lua('get', 0, 'c'), self.lua('get', 0, 'd')
+        for key in ('klass', 'priority', 'tags', 'retries', 'state', 'queue'):
+            self.assertEqual(c[key], d[key])
+        self.assertEqual(self.lua('get', 0, 'a')['data'], '{"foo":"bar"}')
+        self.assertEqual(self.lua('get', 0, 'b')['state'], 'scheduled')
+        jids = [job['jid'] for job in self.lua('pop', 1, 'queue', 'worker', 10)]
+        self.assertEqual(set(jids[:2]), set(['c', 'd']))
+        self.assertEqual(jids[2:], ['a'])
+        self.assertEqual(self.lua('queues', 0, 'queue')['scheduled'], 1)
+
+    def test_depends(self):
+        '''Jobs in a batch can depend on one another'''
+        self.lua('put.many', 0, 'worker', 'queue', [
+            {'jid': 'a', 'klass': 'klass'},
+            {'jid': 'b', 'klass': 'klass', 'depends': ['a']}])
+        self.assertEqual(self.lua('get', 0, 'b')['state'], 'depends')
+        self.assertEqual(self.lua('get', 0, 'a')['dependents'], ['b'])
+
+    def test_no_replace(self):
+        '''Each job reports back what put would have'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('pop', 1, 'queue', 'worker', 1)
+        self.assertEqual(self.lua('put.many', 5, 'worker', 'queue', [
+            {'jid': 'a', 'klass': 'klass', 'replace': 0},
+            {'jid': 'b', 'klass': 'klass', 'replace': 0}]), [56, 'b'])
+
+    def test_malformed_options_insert_nothing(self):
+        '''Specs that put would reject are caught before anything is written'''
+        self.lua('resource.set', 0, 'r-1', 1)
+        for spec in (
+            {'jid': 'b', 'klass': 'klass', 'resources': ['r-2']},
+            {'jid': 'b', 'klass': 'klass', 'resources': {'r-1': 0}},
+            {'jid': 'b', 'klass': 'klass', 'tags': [{}]},
+            {'jid': 'b', 'klass': 'klass', 'depends': [[]]},
+            {'jid': 'b', 'klass': {}}):
+            self.assertRaises(Exception, self.lua, 'put.many', 0, 'worker',
+                'queue', [{'jid': 'a', 'klass': 'klass'}, spec])
+            self.assertEqual(self.lua('get', 0, 'a'), None)
+        self.lua('config.set', 0, 'queue-history', 'foo')
+        self.assertRaises(Exception, self.lua, 'put.many', 0, 'worker',
+            'queue', [{'jid': 'a', 'klass': 'klass'}])
+        self.assertEqual(self.lua('get', 0, 'a'), None)
+
+    def test_log(self):
+        '''A log message is sent for each job, as with put'''
+        with self.lua:
+            self.lua('put.many', 0, 'worker', 'queue', [
+                {'jid': 'a', 'klass': 'klass'},
+                {'jid': 'b', 'klass': 'klass'}])
+        self.assertEqual([json.loads(m['data']) for m in self.lua.log], [
+            {'jid': 'a', 'event': 'put', 'queue': 'queue'},
+            {'jid': 'b', 'event': 'put', 'queue': 'queue'}])
+
+
 class TestPeek(TestQless):
     '''Test peeking jobs'''
     # For reference:
     #
-    #   QlessAPI.peek = function(now, queue, count)
+    #   QlessAPI.peek = function(now, queue, count, ...)
     def test_malformed(self):
         '''Enumerate all the ways in which the input can be malformed'''
         self.assertMalformed(self.lua, [
@@ -574,6 +726,16 @@ class TestPeek(TestQless):
             ('peek', 12345, 'foo', 'number'),         # Count arg malformed
         ])
 
+    def test_fields(self):
+        '''We can ask for just some of the fields of peeked jobs'''
+        self.lua('put', 0, 'worker', 'foo', 'jid', 'klass', {}, 0)
+        self.assertEqual(
+            self.lua('peek', 1, 'foo', 10, 'fields', 'jid,state'),
+            [{'jid': 'jid', 'state': 'waiting'}])
+        self.assertMalformed(self.lua, [
+            ('peek', 1, 'foo', 10, 'fields', 'jid,foo'),
+        ])
+
     def test_basic(self):
         '''Can peek at a single waiting job'''
         # No jobs for an empty queue
@@ -669,7 +831,7 @@ class TestPop(TestQless):
     '''Test popping jobs'''
     # For reference:
     #
-    #   QlessAPI.pop = function(now, queue, worker, count)
+    #   QlessAPI.pop = function(now, queue, worker, count, ...)
     def test_malformed(self):
         '''Enumerate all the ways this can be malformed'''
         self.assertMalformed(self.lua, [
@@ -706,6 +868,20 @@ class TestPop(TestQless):
             'spawned_from_jid': False,
             'resources': {}}])
 
+    def test_fields(self):
+        '''We can ask for just some of the fields of popped jobs'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertEqual(self.lua('pop', 1, 'queue', 'worker', 1,
+            'fields', 'jid,klass,data,priority,tags,expires'), [{
+                'jid': 'jid',
+                'klass': 'klass',
+                'data': '{}',
+                'priority': 0,
+                'tags': {},
+                'expires': 61}])
+        # The job is popped just the same
+        self.assertEqual(self.lua('get', 2, 'jid')['worker'], 'worker')
+
     def test_pop_many(self):
         '''We should be able to pop off many jobs'''
         for jid in range(10):
@@ -794,6 +970,388 @@ class TestPop(TestQless):
         self.assertEqual(job['jid'], 'b')
 
 
+class TestPopMulti(TestQless):
+    '''Test popping from several queues at once'''
+    #
+    #   QlessAPI['pop.multi'] = function(now, worker, count, ...)
+    def test_malformed(self):
+        '''Enumerate all the ways this can be malformed'''
+        self.assertMalformed(self.lua, [
+            ('pop.multi', 0),
+            ('pop.multi', 0, 'worker'),
+            ('pop.multi', 0, 'worker', 'number', 'queue'),
+            ('pop.multi', 0, 'worker', 10),
+            ('pop.multi', 0, 'worker', 10, 'queue', 'mode', 'foo'),
+        ])
+
+    def put(self, queue, count):
+        '''Put `count` jobs in the queue'''
+        for index in range(count):
+            self.lua('put', 0, 'worker', queue, '%s-%s' % (queue, index),
+                'klass', {}, 0)
+
+    def queues(self, jobs):
+        '''The queue that each of the jobs came from'''
+        return [job['queue'] for job in jobs]
+
+    def test_priority(self):
+        '''Queues are served in the order they're listed'''
+        self.put('a', 2)
+        self.put('b', 3)
+        self.put('c', 3)
+        jobs = self.lua('pop.multi', 1, 'worker', 4, 'a', 'b', 'c')
+        self.assertEqual(self.queues(jobs), ['a', 'a', 'b', 'b'])
+        self.assertEqual(
+            [job['worker'] for job in jobs], ['worker'] * 4)
+        jobs = self.lua(
+            'pop.multi', 1, 'worker', 4, 'a', 'b', 'c', 'mode', 'priority')
+        self.assertEqual(self.queues(jobs), ['b', 'c', 'c', 'c'])
+
+    def test_paused(self):
+        '''Paused queues are skipped'''
+        self.put('a', 2)
+        self.put('b', 2)
+        self.lua('pause', 0, 'a')
+        jobs = self.lua('pop.multi', 1, 'worker', 4, 'a', 'b')
+        self.assertEqual(self.queues(jobs), ['b', 'b'])
+
+    def test_max_concurrency(self):
+        '''Each queue's max-concurrency is respected'''
+        self.lua('config.set', 0, 'a-max-concurrency', 1)
+        self.put('a', 2)
+        self.put('b', 2)
+        jobs = self.lua('pop.multi', 1, 'worker', 3, 'a', 'b')
+        self.assertEqual(self.queues(jobs), ['a', 'b', 'b'])
+
+    def test_heartbeat(self):
+        '''Each queue's heartbeat is used for its jobs'''
+        self.lua('config.set', 0, 'b-heartbeat', 10)
+        self.put('a', 1)
+        self.put('b', 1)
+        jobs = self.lua('pop.multi', 1, 'worker', 2, 'a', 'b')
+        self.assertEqual([job['expires'] for job in jobs], [61, 11])
+
+    def test_weighted(self):
+        '''The count is shared between queues by their weights'''
+        self.lua('config.set', 0, 'a-weight', 3)
+        self.put('a', 50)
+        self.put('b', 50)
+        jobs = self.lua(
+            'pop.multi', 1, 'worker', 40, 'a', 'b', 'mode', 'weighted')
+        self.assertEqual(len(jobs), 40)
+        self.assertTrue(28 <= self.queues(jobs).count('a') <= 32)
+
+    def test_weighted_small_counts(self):
+        '''Over successive pops, each queue gets its share'''
+        self.lua('config.set', 0, 'a-weight', 3)
+        self.put('a', 50)
+        self.put('b', 50)
+        queues = []
+        for now in range(40):
+            queues.extend(self.queues(self.lua(
+                'pop.multi', now, 'worker', 1, 'a', 'b', 'mode', 'weighted')))
+        self.assertEqual(len(queues), 40)
+        self.assertTrue(28 <= queues.count('a') <= 32)
+
+    def test_weighted_leftover(self):
+        '''What one queue can't fill is offered to the others'''
+        self.lua('config.set', 0, 'a-weight', 3)
+        self.put('a', 1)
+        self.put('b', 10)
+        jobs = self.lua(
+            'pop.multi', 1, 'worker', 8, 'a', 'b', 'mode', 'weighted')
+        self.assertEqual(sorted(self.queues(jobs)), ['a'] + ['b'] * 7)
+
+    def test_fields(self):
+        '''Jobs always say which queue they came from'''
+        self.put('a', 1)
+        self.assertEqual(self.lua('pop.multi', 1, 'worker', 1, 'a',
+            'mode', 'priority', 'fields', 'jid'), [{'jid': 'a-0', 'queue': 'a'}])
+
+
+class TestSignal(TestQless):
+    '''Test the signal that work has become available in a queue'''
+    def signals(self, queue):
+        '''The number of tokens in the queue's signal list'''
+        return self.redis.llen('ql:q:%s-signal' % queue)
+
+    def test_put(self):
+        '''Putting a job that's ready to pop signals its queue'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.assertEqual(self.signals('queue'), 1)
+        # Scheduled and dependent jobs aren't ready yet
+        self.lua('put', 0, 'worker', 'queue', 'b', 'klass', {}, 10)
+        self.lua('put', 0, 'worker', 'queue', 'c', 'klass', {}, 0,
+            'depends', ['a'])
+        self.assertEqual(self.signals('queue'), 1)
+
+    def test_put_many(self):
+        '''Putting a batch signals once for each ready job'''
+        self.lua('put.many', 0, 'worker', 'queue', [
+            {'jid': 'a', 'klass': 'klass'},
+            {'jid': 'b', 'klass': 'klass'},
+            {'jid': 'c', 'klass': 'klass', 'delay': 10}])
+        self.assertEqual(self.signals('queue'), 2)
+
+    def test_limit(self):
+        '''The signal list is kept short'''
+        self.lua('config.set', 0, 'max-queue-signals', 2)
+        for jid in range(5):
+            self.lua('put', 0, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.assertEqual(self.signals('queue'), 2)
+
+    def test_complete_next(self):
+        '''Completing a job into another queue signals that queue'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('pop', 1, 'queue', 'worker', 10)
+        self.lua('complete', 2, 'jid', 'worker', 'queue', {}, 'next', 'foo')
+        self.assertEqual(self.signals('foo'), 1)
+
+    def test_dependents(self):
+        '''Completing a job signals the queues of the jobs it releases'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('put', 0, 'worker', 'foo', 'b', 'klass', {}, 0,
+            'depends', ['a'])
+        self.lua('pop', 1, 'queue', 'worker', 10)
+        self.lua('complete', 2, 'a', 'worker', 'queue', {})
+        self.assertEqual(self.signals('foo'), 1)
+
+    def test_timeout(self):
+        '''Timing out a job signals its queue'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('pop', 1, 'queue', 'worker', 10)
+        self.redis.delete('ql:q:queue-signal')
+        self.lua('timeout', 2, 'jid')
+        self.assertEqual(self.signals('queue'), 1)
+
+    def test_scheduled(self):
+        '''Scheduled jobs signal when they're moved to be popped'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 10)
+        self.lua('jobs', 11, 'scheduled', 'queue')
+        self.assertEqual(self.signals('queue'), 1)
+        # But not when it's a pop that moves and takes them
+        self.lua('put', 0, 'worker', 'queue', 'b', 'klass', {}, 10)
+        self.lua('pop', 12, 'queue', 'worker', 10)
+        self.assertEqual(self.signals('queue'), 1)
+
+    def test_scheduled_peek(self):
+        '''Scheduled jobs moved by a peek signal their queue'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 10)
+        self.lua('peek', 11, 'queue', 10)
+        self.assertEqual(self.signals('queue'), 1)
+
+    def test_scheduled_passed_over(self):
+        '''Scheduled jobs moved but passed over by a pop signal their queue'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'A', {}, 10)
+        self.lua('put', 0, 'worker', 'queue', 'b', 'B', {}, 10)
+        jobs = self.lua('pop', 11, 'queue', 'worker', 10, 'klass', 'A')
+        self.assertEqual([job['jid'] for job in jobs], ['a'])
+        self.assertEqual(self.signals('queue'), 1)
+
+    def test_expired_passed_over(self):
+        '''Expired locks passed over by a pop signal their queue'''
+        self.lua('config.set', 0, 'grace-period', 0)
+        self.lua('put', 0, 'worker', 'queue', 'a', 'A', {}, 0)
+        self.lua('pop', 1, 'queue', 'worker', 10)
+        self.redis.delete('ql:q:queue-signal')
+        self.lua('pop', 100, 'queue', 'other', 10, 'klass', 'B')
+        self.assertEqual(self.signals('queue'), 1)
+
+    def test_bpop(self):
+        '''We can wait on the signal and then pop'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        jobs = self.lua.bpop(1, 'worker', ['foo', 'queue'], 10)
+        self.assertEqual([job['jid'] for job in jobs], ['jid'])
+        self.assertEqual(self.lua.bpop(2, 'worker', ['foo', 'queue']), {})
+
+    def test_bpop_scheduled(self):
+        '''Waiting pops get delayed jobs once they're due, without a signal'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 1)
+        self.redis.delete('ql:q:queue-signal')
+        jobs = self.lua.bpop(10, 'worker', ['queue'])
+        self.assertEqual([job['jid'] for job in jobs], ['jid'])
+
+    def test_bpop_recurring(self):
+        '''Waiting pops get the jobs of recurring jobs, without a signal'''
+        self.lua('recur', 0, 'queue', 'jid', 'klass', {}, 'interval', 60, 0)
+        jobs = self.lua.bpop(10, 'worker', ['queue'])
+        self.assertEqual([job['jid'] for job in jobs], ['jid-1'])
+
+    def test_bpop_stalled(self):
+        '''Waiting pops get jobs whose locks have expired, without a signal'''
+        self.lua('config.set', 0, 'grace-period', 0)
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('pop', 1, 'queue', 'worker', 10)
+        self.redis.delete('ql:q:queue-signal')
+        jobs = self.lua.bpop(100, 'other', ['queue'])
+        self.assertEqual([job['jid'] for job in jobs], ['jid'])
+
+
+class TestConcurrencyKey(TestQless):
+    '''Test limiting how many jobs sharing a key run at once'''
+    def concurrency(self, queue):
+        '''The running counts of each key in the queue'''
+        return self.redis.hgetall('ql:q:%s-concurrency' % queue)
+
+    def put(self, now, jid, key, priority=0):
+        '''Put a job with the provided concurrency key'''
+        self.lua('put', now, 'worker', 'queue', jid, 'klass', {}, 0,
+            'concurrency_key', key, 'priority', priority)
+
+    def test_pop(self):
+        '''Pop skips jobs whose key has as many running as allowed'''
+        self.lua('config.set', 0, 'queue-max-concurrency-per-key', 2)
+        for jid in range(3):
+            self.put(0, 'a-%s' % jid, 'a', 10 - jid)
+        self.put(0, 'b', 'b')
+        jobs = self.lua('pop', 1, 'queue', 'worker', 10)
+        self.assertEqual([job['jid'] for job in jobs], ['a-0', 'a-1', 'b'])
+        self.assertEqual(jobs[0]['concurrency_key'], 'a')
+        self.assertEqual(self.concurrency('queue'), {'a': '2', 'b': '1'})
+        self.assertEqual(self.lua('pop', 2, 'queue', 'worker', 10), {})
+
+        # Once one finishes, the next can run
+        self.lua('complete', 3, 'a-0', 'worker', 'queue', {})
+        jobs = self.lua('pop', 4, 'queue', 'worker', 10)
+        self.assertEqual([job['jid'] for job in jobs], ['a-2'])
+
+    def test_counters_removed(self):
+        '''Counters are deleted once no jobs with their key are running'''
+        self.put(0, 'a', 'a')
+        self.put(0, 'b', 'b')
+        self.lua('pop', 1, 'queue', 'worker', 10)
+        self.assertEqual(self.concurrency('queue'), {'a': '1', 'b': '1'})
+        self.lua('fail', 2, 'a', 'worker', 'group', 'message', {})
+        self.lua('retry', 2, 'b', 'queue', 'worker', 0)
+        self.assertEqual(self.concurrency('queue'), {})
+
+    def test_clear(self):
+        '''An empty concurrency key clears the job's key'''
+        self.put(0, 'a', 'a')
+        self.lua('pop', 1, 'queue', 'worker', 10)
+        self.lua('put', 2, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.assertEqual(self.lua('get', 2, 'a')['concurrency_key'], 'a')
+        self.lua('pop', 3, 'queue', 'worker', 10)
+        self.put(4, 'a', '')
+        self.assertNotIn('concurrency_key', self.lua('get', 4, 'a'))
+        self.assertEqual(self.concurrency('queue'), {})
+        self.lua('pop', 5, 'queue', 'worker', 10)
+        self.assertEqual(self.concurrency('queue'), {})
+
+    def test_no_limit(self):
+        '''Without a limit, keys don't hold back pop'''
+        for jid in range(3):
+            self.put(0, jid, 'a')
+        self.assertEqual(len(self.lua('pop', 1, 'queue', 'worker', 10)), 3)
+        self.assertEqual(self.concurrency('queue'), {'a': '3'})
+
+    def test_scan_limit(self):
+        '''Pop only looks past so many saturated jobs'''
+        self.lua('config.set', 0, 'queue-max-concurrency-per-key', 1)
+        self.lua('config.set', 0, 'pop-scan-limit', 2)
+        for jid in range(5):
+            self.put(0, 'a-%s' % jid, 'a', 10 - jid)
+        self.put(0, 'b', 'b')
+        jobs = self.lua('pop', 1, 'queue', 'worker', 1)
+        self.assertEqual([job['jid'] for job in jobs], ['a-0'])
+        self.assertEqual(self.lua('pop', 2, 'queue', 'worker', 1), {})
+
+
+class TestKlassPop(TestQless):
+    '''Test popping only jobs of some klasses'''
+    def index(self, queue, klass):
+        '''The jids in the work set for the provided klass'''
+        return self.redis.zrange('ql:q:%s-work-%s' % (queue, klass), 0, -1)
+
+    def test_pop(self):
+        '''Pop only returns jobs of the klasses asked for, by priority'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'A', {}, 0, 'priority', 1)
+        self.lua('put', 0, 'worker', 'queue', 'b', 'B', {}, 0, 'priority', 3)
+        self.lua('put', 0, 'worker', 'queue', 'c', 'C', {}, 0, 'priority', 2)
+        jobs = self.lua('pop', 1, 'queue', 'worker', 10, 'klass', 'A,C')
+        self.assertEqual([job['jid'] for job in jobs], ['c', 'a'])
+        self.assertEqual(
+            [job['jid'] for job in self.lua('peek', 1, 'queue', 10)], ['b'])
+
+    def test_fields(self):
+        '''The klass option can be given along with fields'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'A', {}, 0)
+        self.assertEqual(self.lua('pop', 1, 'queue', 'worker', 10,
+            'fields', 'jid', 'klass', 'A'), [{'jid': 'a'}])
+
+    def test_index(self):
+        '''Jobs are kept in their klass's work set only while waiting'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'A', {}, 0)
+        self.lua('put', 0, 'worker', 'queue', 'b', 'A', {}, 10)
+        self.assertEqual(self.index('queue', 'A'), ['a'])
+        self.lua('pop', 1, 'queue', 'worker', 10)
+        self.assertEqual(self.index('queue', 'A'), [])
+        self.lua('retry', 2, 'a', 'queue', 'worker', 0)
+        self.assertEqual(self.index('queue', 'A'), ['a'])
+        # Scheduled jobs join once they're moved into the work set
+        self.lua('peek', 11, 'queue', 10)
+        self.assertEqual(sorted(self.index('queue', 'A')), ['a', 'b'])
+        # And moving a job to another klass moves it between sets
+        self.lua('put', 12, 'worker', 'queue', 'a', 'B', {}, 0)
+        self.assertEqual(self.index('queue', 'A'), ['b'])
+        self.assertEqual(self.index('queue', 'B'), ['a'])
+
+    def test_expired(self):
+        '''Jobs with expired locks go only to workers for their klass'''
+        self.lua('config.set', 0, 'grace-period', 0)
+        self.lua('put', 0, 'worker', 'queue', 'a', 'A', {}, 0)
+        self.lua('pop', 1, 'queue', 'worker', 10)
+        self.assertEqual(
+            self.lua('pop', 100, 'queue', 'other', 10, 'klass', 'B'), {})
+        jobs = self.lua('pop', 100, 'queue', 'other', 10, 'klass', 'A')
+        self.assertEqual([job['jid'] for job in jobs], ['a'])
+
+    def unindex(self, queue, *klasses):
+        '''Drop the klass work sets, as for jobs put before they were kept'''
+        for klass in klasses:
+            self.redis.delete('ql:q:%s-work-%s' % (queue, klass))
+        self.redis.delete('ql:q:%s-klass-indexed' % queue)
+
+    def test_unindexed(self):
+        '''Jobs missing from their klass's work set can still be popped'''
+        for index, jid in enumerate('abc'):
+            self.lua('put', index, 'worker', 'queue', jid, 'A', {}, 0)
+        self.lua('put', 0, 'worker', 'queue', 'd', 'B', {}, 0)
+        self.unindex('queue', 'A', 'B')
+        jobs = self.lua('pop', 1, 'queue', 'worker', 2, 'klass', 'A')
+        self.assertEqual([job['jid'] for job in jobs], ['a', 'b'])
+        jobs = self.lua('pop', 1, 'queue', 'worker', 10, 'klass', 'A')
+        self.assertEqual([job['jid'] for job in jobs], ['c'])
+
+    def test_reindex(self):
+        '''Reindexing adds waiting jobs to their klass's work set'''
+        for jid in 'abc':
+            self.lua('put', 0, 'worker', 'queue', jid, 'A', {}, 0)
+        self.lua('put', 0, 'worker', 'queue', 'd', 'B', {}, 0)
+        self.unindex('queue', 'A', 'B')
+        cursor = self.lua('queue.reindex', 1, 'queue', 1)
+        while cursor:
+            self.assertFalse(self.redis.exists('ql:q:queue-klass-indexed'))
+            cursor = self.lua('queue.reindex', 1, 'queue', 1, cursor)
+        self.assertTrue(self.redis.exists('ql:q:queue-klass-indexed'))
+        self.assertEqual(self.index('queue', 'A'), ['a', 'b', 'c'])
+        self.assertEqual(self.index('queue', 'B'), ['d'])
+
+    def test_klass_named_indexed(self):
+        '''A klass can be called anything, without colliding with other keys'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'indexed', {}, 0)
+        self.lua('put', 0, 'worker', 'queue', 'b', 'indexed', {}, 0)
+        self.assertEqual(self.index('queue', 'indexed'), ['a', 'b'])
+        jobs = self.lua('pop', 1, 'queue', 'worker', 10, 'klass', 'indexed')
+        self.assertEqual(len(jobs), 2)
+
+    def test_indexed(self):
+        '''A queue whose work set was empty is indexed'''
+        self.assertFalse(self.redis.exists('ql:q:queue-klass-indexed'))
+        self.lua('put', 0, 'worker', 'queue', 'a', 'A', {}, 0)
+        self.assertTrue(self.redis.exists('ql:q:queue-klass-indexed'))
+
+
 class TestResources(TestQless):
     """Queues should correctly handle jobs that require resources"""
 
@@ -861,4 +1419,99 @@ class TestResources(TestQless):
 
         res = self.lua('resource.get', 0, 'r-1')
         self.assertEqual(res['locks'], ['jid-high'])
-        self.assertEqual(res['pending'], ['jid-low'])
\ No newline at end of file
+        self.assertEqual(res['pending'], ['jid-low'])
+
+class TestCancelQuery(TestQless):
+    '''Test cancelling the jobs matching a query'''
+    def test_malformed(self):
+        '''Enumerate all the ways it could be malformed'''
+        self.assertMalformed(self.lua, [
+            ('cancel.query', 0),
+            ('cancel.query', 0, 'queue', '[}'),
+            ('cancel.query', 0, 'queue', {}),
+            ('cancel.query', 0, 'queue', {'state': 'foo'}),
+            ('cancel.query', 0, 'queue', {'state': 'waiting'}, 'foo'),
+            ('cancel.query', 0, 'queue', {'state': 'waiting'}, 10, 'foo'),
+        ])
+
+    def test_state(self):
+        '''We can cancel the jobs in a state'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('put', 0, 'worker', 'queue', 'b', 'klass', {}, 10)
+        self.lua('put', 0, 'worker', 'other', 'c', 'klass', {}, 0)
+        self.assertEqual(
+            self.lua('cancel.query', 0, 'queue', {'state': 'waiting'}), {
+                'cancelled': ['a'], 'cursor': '1:0', 'done': True})
+        self.assertEqual(self.lua('get', 0, 'a'), None)
+        self.assertEqual(self.lua('get', 0, 'b')['state'], 'scheduled')
+        self.assertEqual(self.lua('get', 0, 'c')['state'], 'waiting')
+
+    def test_failed(self):
+        '''We can cancel the failed jobs of a queue, in any group'''
+        for jid, queue, group in [('a', 'queue', 'foo'), ('b', 'queue', 'bar'),
+            ('c', 'other', 'foo'), ('d', 'queue', 'foo')]:
+            self.lua('put', 0, 'worker', queue, jid, 'klass', {}, 0)
+            self.lua('pop', 1, queue, 'worker', 10)
+            self.lua('fail', 2, jid, 'worker', group, 'message', {})
+        self.lua('put', 3, 'worker', 'queue', 'e', 'klass', {}, 0)
+        # Groups that are still lists are read as lists
+        self.redis.delete('ql:f:bar')
+        self.redis.lpush('ql:f:bar', 'b')
+        response = self.lua('cancel.query', 4, 'queue', {'state': 'failed'})
+        self.assertEqual(response['cancelled'], ['b', 'a', 'd'])
+        self.assertTrue(response['done'])
+        self.assertEqual(self.lua('failed', 4), {'foo': 1})
+        self.assertEqual(self.lua('get', 4, 'e')['state'], 'waiting')
+
+    def test_tag(self):
+        '''We can cancel the jobs in a queue with a tag'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0,
+            'tags', ['foo'])
+        self.lua('put', 0, 'worker', 'queue', 'b', 'klass', {}, 0)
+        self.lua('put', 0, 'worker', 'other', 'c', 'klass', {}, 0,
+            'tags', ['foo'])
+        self.assertEqual(
+            self.lua('cancel.query', 0, 'queue', {'tag': 'foo'}), {
+                'cancelled': ['a'], 'cursor': '1:0', 'done': True})
+        self.assertEqual(self.lua('tag', 0, 'get', 'foo')['jobs'], ['c'])
+
+    def test_klass(self):
+        '''We can cancel the jobs of a klass in any state'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'foo', {}, 0)
+        self.lua('put', 0, 'worker', 'queue', 'b', 'foo', {}, 10)
+        self.lua('put', 0, 'worker', 'queue', 'c', 'bar', {}, 0)
+        response = self.lua('cancel.query', 0, 'queue', {'klass': 'foo'})
+        self.assertEqual(sorted(response['cancelled']), ['a', 'b'])
+        self.assertTrue(response['done'])
+        self.assertEqual(self.lua('get', 0, 'c')['state'], 'waiting')
+
+    def test_budget(self):
+        '''Each call looks at no more than its budget of jobs'''
+        for jid in range(5):
+            self.lua('put', jid, 'worker', 'queue', jid, 'klass', {}, 0,
+                'tags', ['foo'])
+        self.lua('put', 5, 'worker', 'other', 5, 'klass', {}, 0,
+            'tags', ['foo'])
+        self.lua('put', 6, 'worker', 'queue', 6, 'klass', {}, 0,
+            'tags', ['foo'])
+        query = {'tag': 'foo'}
+        self.assertEqual(self.lua('cancel.query', 0, 'queue', query, 3), {
+            'cancelled': ['0', '1', '2'], 'cursor': '0:0', 'done': False})
+        self.assertEqual(
+            self.lua('cancel.query', 0, 'queue', query, 3, '0:0'), {
+                'cancelled': ['3', '4'], 'cursor': '0:1', 'done': False})
+        self.assertEqual(
+            self.lua('cancel.query', 0, 'queue', query, 3, '0:1'), {
+                'cancelled': ['6'], 'cursor': '1:0', 'done': True})
+
+    def test_dependencies(self):
+        '''Jobs that others depend on are left until their dependents go'''
+        self.lua('put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('put', 0, 'worker', 'queue', 'b', 'klass', {}, 0,
+            'depends', ['a'])
+        self.lua('put', 0, 'worker', 'queue', 'c', 'klass', {}, 0)
+        self.lua('put', 0, 'worker', 'other', 'd', 'klass', {}, 0,
+            'depends', ['c'])
+        response = self.lua('cancel.query', 0, 'queue', {'klass': 'klass'})
+        self.assertEqual(sorted(response['cancelled']), ['a', 'b'])
+        self.assertEqual(self.lua('get', 0, 'c')['state'], 'waiting')
@@ -12,7 +12,14 @@ class TestResources(TestQless):
             ('resource.set', 0, 'test', 'sfdgl'),
             ('resource.get', 0),
             ('resource.unset', 0),
+            ('resource.rebalance', 0),
             ('resource.locks', 0),
+            ('resource.pending', 0),
+            ('resource.pending', 0, 'test', 'foo'),
+            ('resource.pending', 0, 'test', 0, 'foo'),
+            ('resource.holders', 0),
+            ('resource.holders', 0, 'test', 'foo'),
+            ('resource.holders', 0, 'test', 0, 'foo'),
         ])
 
     def test_set(self):
@@ -38,6 +45,201 @@ class TestResources(TestQless):
         locks = self.lua('resource.locks', 0, 'test')
         self.assertEquals(locks, 0)
 
+    def test_acquire_missing_resource(self):
+        '''Putting a job that needs an unknown resource is an error'''
+        self.assertRaisesRegexp(Exception, r'does not exist', self.lua,
+            'put', 0, None, 'queue', 'jid', 'klass', {}, 0,
+            'resources', ['missing'])
+
+    def test_release_promotes_into_queue(self):
+        '''Releasing a lock moves the next waiter into its own queue'''
+        self.lua('resource.set', 0, 'r-1', 1)
+        self.lua('put', 0, None, 'foo', 'jid-1', 'klass', {}, 0,
+            'resources', ['r-1'])
+        self.lua('put', 0, None, 'bar', 'jid-2', 'klass', {}, 0,
+            'resources', ['r-1'])
+        self.assertEqual(self.lua('peek', 0, 'bar', 10), {})
+        self.lua('pop', 1, 'foo', 'worker', 1)
+        self.lua('complete', 2, 'jid-1', 'worker', 'foo', {})
+        self.assertEqual(
+            [job['jid'] for job in self.lua('peek', 3, 'bar', 10)], ['jid-2'])
+
+    def test_pending_paging(self):
+        '''We can page through the jobs waiting on a resource'''
+        self.lua('resource.set', 0, 'r-1', 1)
+        for jid in range(5):
+            self.lua('put', jid, None, 'queue', 'jid-%s' % jid, 'klass', {},
+                0, 'resources', ['r-1'], 'priority', jid)
+        self.assertEqual(self.lua('resource.pending', 5, 'r-1'), {
+            'total': 4,
+            'jobs': ['jid-4', 'jid-3', 'jid-2', 'jid-1']})
+        self.assertEqual(self.lua('resource.pending', 5, 'r-1', 1, 2), {
+            'total': 4,
+            'jobs': ['jid-3', 'jid-2']})
+
+    def test_holders_paging(self):
+        '''We can scan through the jobs holding a resource'''
+        self.lua('resource.set', 0, 'r-1', 10)
+        for jid in range(5):
+            self.lua('put', 0, None, 'queue', 'jid-%s' % jid, 'klass', {},
+                0, 'resources', ['r-1'])
+        holders, cursor = [], 0
+        while True:
+            page = self.lua('resource.holders', 0, 'r-1', cursor, 2)
+            self.assertEqual(page['total'], 5)
+            holders.extend(page['jobs'])
+            cursor = page['cursor']
+            if cursor == 0:
+                break
+        self.assertEqual(
+            sorted(holders), ['jid-%s' % jid for jid in range(5)])
+
+    def test_set_promotes_waiters(self):
+        '''Raising a resource's limit hands the new slots to waiting jobs'''
+        self.lua('resource.set', 0, 'r-1', 1)
+        for jid in range(4):
+            self.lua('put', jid, None, 'queue', 'jid-%s' % jid, 'klass', {},
+                0, 'resources', ['r-1'], 'priority', jid)
+        self.assertEqual(self.lua('resource.pending', 4, 'r-1')['total'], 3)
+        self.lua('resource.set', 4, 'r-1', 3)
+        self.assertEqual(self.lua('resource.pending', 4, 'r-1'), {
+            'total': 1, 'jobs': ['jid-1']})
+        self.assertEqual(
+            sorted(job['jid'] for job in self.lua('peek', 5, 'queue', 10)),
+            ['jid-0', 'jid-2', 'jid-3'])
+
+    def test_rebalance(self):
+        '''Rebalancing promotes waiters into any free capacity'''
+        self.lua('resource.set', 0, 'r-1', 1)
+        for jid in range(3):
+            self.lua('put', jid, None, 'queue', 'jid-%s' % jid, 'klass', {},
+                0, 'resources', ['r-1'], 'priority', jid)
+        self.assertEqual(self.lua('resource.rebalance', 3, 'r-1'), {})
+        # Bump the limit behind our back, as a client on an older version might
+        self.redis.hset('ql:rs:r-1', 'max', 3)
+        self.assertEqual(
+            self.lua('resource.rebalance', 3, 'r-1'), ['jid-2', 'jid-1'])
+        self.assertEqual(self.lua('resource.locks', 3, 'r-1'), 3)
+        self.assertEqual(len(self.lua('peek', 3, 'queue', 10)), 3)
+
+    def test_all_or_nothing(self):
+        '''A job waiting on one resource doesn't hold a slot on another'''
+        self.lua('resource.set', 0, 'r-1', 1)
+        self.lua('resource.set', 0, 'r-2', 1)
+        self.lua('put', 0, None, 'queue', 'jid-1', 'klass', {}, 0,
+            'resources', ['r-2'])
+        self.lua('put', 1, None, 'queue', 'jid-2', 'klass', {}, 0,
+            'resources', ['r-1', 'r-2'])
+        self.assertEqual(self.lua('resource.locks', 1, 'r-1'), 0)
+        self.assertEqual(self.lua('resource.pending', 1, 'r-1')['total'], 0)
+        self.assertEqual(
+            self.lua('resource.pending', 1, 'r-2')['jobs'], ['jid-2'])
+
+        # Once r-2 is released, jid-2 takes both of its resources together
+        self.lua('pop', 2, 'queue', 'worker', 1)
+        self.lua('complete', 3, 'jid-1', 'worker', 'queue', {})
+        self.assertEqual(self.lua('resource.locks', 3, 'r-1'), 1)
+        self.assertEqual(self.lua('resource.locks', 3, 'r-2'), 1)
+        self.assertEqual(
+            [job['jid'] for job in self.lua('peek', 3, 'queue', 10)],
+            ['jid-2'])
+
+    def test_promote_skips_blocked_waiters(self):
+        '''A waiter still blocked on another resource doesn't hold up others'''
+        self.lua('resource.set', 0, 'r-1', 1)
+        self.lua('resource.set', 0, 'r-2', 1)
+        self.lua('put', 0, None, 'queue', 'jid-1', 'klass', {}, 0,
+            'resources', ['r-1'])
+        self.lua('put', 1, None, 'queue', 'jid-2', 'klass', {}, 0,
+            'resources', ['r-2'])
+        self.lua('put', 2, None, 'queue', 'jid-3', 'klass', {}, 0,
+            'resources', ['r-1', 'r-2'], 'priority', 10)
+        self.lua('put', 3, None, 'queue', 'jid-4', 'klass', {}, 0,
+            'resources', ['r-1'])
+        self.assertEqual(
+            self.lua('resource.pending', 3, 'r-1')['jobs'], ['jid-3', 'jid-4'])
+
+        # Releasing r-1 can't run jid-3 while jid-2 holds r-2, so jid-4 runs
+        self.lua('pop', 4, 'queue', 'worker', 2)
+        self.lua('complete', 5, 'jid-1', 'worker', 'queue', {})
+        self.assertEqual(
+            self.lua('resource.holders', 5, 'r-1')['jobs'], ['jid-4'])
+        self.assertEqual(
+            self.lua('resource.pending', 5, 'r-2')['jobs'], ['jid-3'])
+
+    def test_weighted(self):
+        '''Jobs can use several units of a resource'''
+        self.lua('resource.set', 0, 'db', 20)
+        self.lua('put', 0, None, 'queue', 'jid-1', 'klass', {}, 0,
+            'resources', {'db': 15})
+        self.lua('put', 1, None, 'queue', 'jid-2', 'klass', {}, 0,
+            'resources', {'db': 10})
+        self.lua('put', 2, None, 'queue', 'jid-3', 'klass', {}, 0,
+            'resources', ['db'])
+        counts = self.lua('resources', 2, 'db')
+        self.assertEqual((counts['used'], counts['locks'], counts['pending']),
+            (16, 2, 1))
+
+        # Only once the big job finishes is there room for the other
+        self.lua('pop', 3, 'queue', 'worker', 10)
+        self.lua('complete', 4, 'jid-1', 'worker', 'queue', {})
+        counts = self.lua('resources', 4, 'db')
+        self.assertEqual((counts['used'], counts['locks'], counts['pending']),
+            (11, 2, 0))
+        self.assertEqual(self.lua('get', 4, 'jid-2')['resources'], {'db': 10})
+
+    def test_weighted_malformed(self):
+        '''Resource weights must be positive integers'''
+        self.lua('resource.set', 0, 'db', 20)
+        for weight in (0, -1, 1.5, 'foo'):
+            self.assertRaisesRegexp(Exception, r'not a positive integer',
+                self.lua, 'put', 0, None, 'queue', 'jid', 'klass', {}, 0,
+                'resources', {'db': weight})
+
+    def test_weight_changed(self):
+        '''A job gives back the units it took, even if its weight changed'''
+        self.lua('resource.set', 0, 'db', 20)
+        self.lua('put', 0, None, 'queue', 'jid', 'klass', {}, 0,
+            'resources', {'db': 20})
+        self.lua('pop', 1, 'queue', 'worker', 10)
+        self.lua('put', 2, None, 'queue', 'jid', 'klass', {}, 0,
+            'resources', {'db': 5})
+        self.lua('pop', 3, 'queue', 'worker', 10)
+        self.lua('complete', 4, 'jid', 'worker', 'queue', {})
+        counts = self.lua('resources', 4, 'db')
+        self.assertEqual((counts['used'], counts['locks'], counts['pending']),
+            (0, 0, 0))
+        self.assertEqual(self.redis.hgetall('ql:rs:db-units'), {})
+
+    def test_weight_over_max(self):
+        '''A job needing more units than there are waits for the max to grow'''
+        self.lua('resource.set', 0, 'db', 5)
+        self.lua('put', 0, None, 'queue', 'jid', 'klass', {}, 0,
+            'resources', {'db': 10})
+        self.assertEqual(self.lua('resources', 0, 'db')['pending'], 1)
+        self.lua('resource.set', 1, 'db', 10)
+        self.assertEqual(self.lua('resource.holders', 1, 'db')['jobs'], ['jid'])
+
+    def test_unknown_resource(self):
+        '''Jobs can't be put with resources that don't exist'''
+        self.assertRaisesRegexp(Exception, r'resource db does not exist',
+            self.lua, 'put', 0, None, 'queue', 'jid', 'klass', {}, 10,
+            'resources', ['db'])
+        self.assertEqual(self.lua('get', 0, 'jid'), None)
+
+    def test_used_from_locks(self):
+        '''Resources locked before units were counted use one unit per lock'''
+        self.lua('resource.set', 0, 'r-1', 3)
+        self.lua('put', 0, None, 'queue', 'jid-1', 'klass', {}, 0,
+            'resources', ['r-1'])
+        self.redis.hdel('ql:rs:r-1', 'used')
+        self.lua('put', 0, None, 'queue', 'jid-2', 'klass', {}, 0,
+            'resources', {'r-1': 2})
+        self.assertEqual(self.lua('resources', 0, 'r-1')['used'], 3)
+        self.lua('put', 0, None, 'queue', 'jid-3', 'klass', {}, 0,
+            'resources', ['r-1'])
+        self.assertEqual(self.lua('resources', 0, 'r-1')['pending'], 1)
+
     def test_does_not_add_lock_and_pending(self):
         self.lua('resource.set', 0, 'r-1', 1)
 
@@ -143,7 +345,8 @@ class TestResources(TestQless):
             'rid': 'r-1',
             'max': 1,
             'pending': 0,
-            'locks': 0
+            'locks': 0,
+            'used': 0
         })
 
         self.lua('put', 0, None, 'queue', 'jid-1', 'klass', {}, 0, 'resources', ['r-1'])
@@ -153,7 +356,8 @@ class TestResources(TestQless):
             'rid': 'r-1',
             'max': 1,
             'pending': 1,
-            'locks': 1
+            'locks': 1,
+            'used': 1
         })
 
         self.lua('pop', 10, 'queue', 'worker-1', 10)
@@ -164,7 +368,8 @@ class TestResources(TestQless):
             'rid': 'r-1',
             'max': 1,
             'pending': 0,
-            'locks': 1
+            'locks': 1,
+            'used': 1
         })
 
         self.lua('pop', 10, 'queue', 'worker-1', 10)
@@ -175,7 +380,8 @@ class TestResources(TestQless):
             'rid': 'r-1',
             'max': 1,
             'pending': 0,
-            'locks': 0
+            'locks': 0,
+            'used': 0
         })
 
         self.lua('resource.unset', 0, 'r-1')
@@ -190,7 +396,8 @@ class TestResources(TestQless):
             'r-1': {
                 'max': 1,
                 'pending': 0,
-                'locks': 0
+                'locks': 0,
+                'used': 0
             }
         })
 
@@ -202,12 +409,14 @@ class TestResources(TestQless):
             'r-2': {
                 'max': 1,
                 'pending': 0,
-                'locks': 0
+                'locks': 0,
+                'used': 0
             },
             'r-1': {
                 'max': 1,
                 'pending': 1,
-                'locks': 1
+                'locks': 1,
+                'used': 1
             }
         })
 
@@ -217,7 +426,8 @@ class TestResources(TestQless):
             'r-2': {
                 'max': 1,
                 'pending': 0,
-                'locks': 0
+                'locks': 0,
+                'used': 0
             }
         })
 
@@ -118,3 +118,41 @@ class TestStats(TestQless):
         self.lua('pop', 2, 'queue', 'worker', 10)
         self.assertEqual(self.lua('stats', 0, 'queue', 0)['failed'], 1)
         self.assertEqual(self.lua('stats', 0, 'queue', 0)['failures'], 1)
+
+    def test_histogram_buckets(self):
+        '''Wait times land in the second, minute, hour and day buckets'''
+        waits = [0, 59, 60, 3599, 3600, 86399, 86400, 6 * 86400 + 1]
+        for index, wait in enumerate(waits):
+            self.lua('put', -wait, 'worker', 'queue', index, 'klass', {}, 0)
+            self.lua('pop', 0, 'queue', 'worker', 1)
+        histogram = self.lua('stats', 0, 'queue', 0)['wait']['histogram']
+        self.assertEqual(len(histogram), 148)
+        for index in [0, 59, 60, 118, 119, 141, 142, 147]:
+            self.assertEqual(histogram[index], 1)
+        self.assertEqual(sum(histogram), 8)
+
+    def test_compact(self):
+        '''The histogram is kept in a string, not in the stats hash'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('pop', 5, 'queue', 'worker', 1)
+        self.assertEqual(self.redis.hget('ql:s:wait:0:queue', 's5'), None)
+        self.assertEqual(
+            self.redis.getrange('ql:s:wait:0:queue-histogram', 20, 23),
+            '\x00\x00\x00\x01')
+
+    def test_legacy_histogram(self):
+        '''Histograms kept in the stats hash are read, and then moved'''
+        self.redis.hmset('ql:s:wait:0:queue', {
+            'total': 3, 'mean': 1, 'vk': 0, 's1': 2, 'm1': 1})
+        histogram = self.lua('stats', 0, 'queue', 0)['wait']['histogram']
+        self.assertEqual((histogram[1], histogram[60]), (2, 1))
+        self.assertEqual(sum(histogram), 3)
+
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('pop', 1, 'queue', 'worker', 1)
+        stats = self.lua('stats', 0, 'queue', 0)['wait']
+        self.assertEqual(stats['count'], 4)
+        self.assertEqual(
+            (stats['histogram'][1], stats['histogram'][60]), (3, 1))
+        self.assertEqual(sum(stats['histogram']), 4)
+        self.assertEqual(self.redis.hget('ql:s:wait:0:queue', 's1'), None)
@@ -1,5 +1,7 @@
 '''Test our tagging functionality'''
 
+import hashlib
+import json
 from common import TestQless
 
 
@@ -145,6 +147,29 @@ class TestTag(TestQless):
         self.assertEqual(
             self.lua('tag', 0, 'get', 'foo', 0, 10)['jobs'], ['jid-1'])
 
+    def test_put_retags(self):
+        '''Putting a job again only moves it between the tags that changed'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0,
+            'tags', ['foo', 'bar'])
+        self.lua('put', 1, 'worker', 'queue', 'jid', 'klass', {}, 0,
+            'tags', ['bar', 'baz'])
+        self.assertEqual(self.lua('tag', 1, 'get', 'foo')['jobs'], {})
+        self.assertEqual(self.lua('tag', 1, 'get', 'baz')['jobs'], ['jid'])
+        # The tag it kept still has the time it was first added
+        self.assertEqual(self.redis.zscore('ql:t:bar', 'jid'), 0)
+        self.assertEqual(self.redis.zscore('ql:tags', 'foo'), 0)
+        self.assertEqual(self.redis.zscore('ql:tags', 'bar'), 1)
+        self.assertEqual(self.redis.zscore('ql:tags', 'baz'), 1)
+
+    def test_put_keeps_tags(self):
+        '''Putting a job again without tags keeps the ones it has'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0,
+            'tags', ['foo'])
+        self.lua('put', 1, 'worker', 'other', 'jid', 'klass', {}, 0)
+        self.assertEqual(self.lua('get', 1, 'jid')['tags'], ['foo'])
+        self.assertEqual(self.redis.zscore('ql:t:foo', 'jid'), 0)
+        self.assertEqual(self.redis.zscore('ql:tags', 'foo'), 1)
+
     def test_pagination_get(self):
         '''Pagination should work for tag.get'''
         jids = map(str, range(100))
@@ -169,3 +194,77 @@ class TestTag(TestQless):
             self.lua('tag', 100, 'top', 0, 5), jids[:5])
         self.assertEqual(
             self.lua('tag', 100, 'top', 5, 5), jids[5:])
+
+
+class TestTagQuery(TestQless):
+    '''Test querying jobs by combinations of tags'''
+    def setUp(self):
+        TestQless.setUp(self)
+        for jid, tags in (('a', ['x', 'y']), ('b', ['x']), ('c', ['y', 'z'])):
+            self.lua('put', ord(jid), 'worker', 'queue', jid, 'klass', {}, 0,
+                'tags', tags)
+
+    def query(self, query, *args):
+        '''The sorted jids matching the query'''
+        return sorted(self.lua('tag.query', 0, query, *args)['jobs'])
+
+    def test_malformed(self):
+        '''Enumerate all the ways it could be malformed'''
+        self.assertMalformed(self.lua, [
+            ('tag.query', 0),
+            ('tag.query', 0, '[}'),
+            ('tag.query', 0, {'not': 'x'}),
+            ('tag.query', 0, {'or': ['x', {'not': 'y'}]}),
+            ('tag.query', 0, {'and': [{'not': 'y'}]}),
+            ('tag.query', 0, {'and': []}),
+            ('tag.query', 0, {'xor': ['x']}),
+            ('tag.query', 0, 'x', 'foo'),
+            ('tag.query', 0, 'x', 0, 'foo'),
+        ])
+
+    def test_tag(self):
+        '''A lone tag is the same as getting the tag'''
+        self.assertEqual(self.lua('tag.query', 0, json.dumps('x')),
+            self.lua('tag', 0, 'get', 'x'))
+
+    def test_and(self):
+        '''We can find the jobs with all of several tags'''
+        self.assertEqual(self.query({'and': ['x', 'y']}), ['a'])
+
+    def test_or(self):
+        '''We can find the jobs with any of several tags'''
+        self.assertEqual(self.query({'or': ['x', 'z']}), ['a', 'b', 'c'])
+
+    def test_not(self):
+        '''We can leave out the jobs with a tag'''
+        self.assertEqual(
+            self.query({'and': ['x', {'not': 'y'}]}), ['b'])
+        self.assertEqual(self.query({'and': [
+            {'or': ['x', 'y']}, {'not': {'and': ['x', 'y']}}]}), ['b', 'c'])
+
+    def test_paging(self):
+        '''Later pages are read from the cached result'''
+        query = json.dumps({'or': ['x', 'y']})
+        self.assertEqual(self.lua('tag.query', 0, query, 0, 2), {
+            'total': 3, 'jobs': ['a', 'b']})
+        # Changes made since aren't seen until the cached result expires
+        self.lua('put', 0, 'worker', 'queue', 'd', 'klass', {}, 0,
+            'tags', ['x'])
+        self.assertEqual(self.lua('tag.query', 0, query, 2, 2), {
+            'total': 3, 'jobs': ['c']})
+        self.assertTrue(0 < self.redis.ttl(
+            'ql:tq:' + hashlib.sha1(query).hexdigest()) <= 60)
+        # And only the result is kept
+        self.assertEqual(len(self.redis.keys('ql:tq:*')), 1)
+
+    def test_empty(self):
+        '''Empty results are cached too'''
+        query = json.dumps({'and': ['x', 'z']})
+        self.assertEqual(self.lua('tag.query', 0, query), {
+            'total': 0, 'jobs': {}})
+        self.lua('put', 0, 'worker', 'queue', 'd', 'klass', {}, 0,
+            'tags', ['x', 'z'])
+        self.assertEqual(self.lua('tag.query', 0, query), {
+            'total': 0, 'jobs': {}})
+        self.assertTrue(0 < self.redis.ttl(
+            'ql:tq:' + hashlib.sha1(query).hexdigest()) <= 60)
@@ -11,7 +11,12 @@ class TestTrack(TestQless):
         self.assertMalformed(self.lua, [
             ('track', 0, 'track'),
             ('track', 0, 'untrack'),
-            ('track', 0, 'foo')
+            ('track', 0, 'foo'),
+            ('track', 0, 'list', 'foo'),
+            ('track', 0, 'list', 0, 'foo'),
+            ('track', 0, 'list', 0, 10, 'fields'),
+            ('track', 0, 'list', 0, 10, 'fields', 'foo'),
+            ('track', 0, 'list', 0, 10, 'foo', 'jid')
         ])
 
     def test_track(self):
@@ -64,3 +69,33 @@ class TestTrack(TestQless):
         '''Jobs know when they're not tracked'''
         self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
         self.assertEqual(self.lua('get', 0, 'jid')['tracked'], False)
+
+    def test_list(self):
+        '''We can page through the tracked jobs'''
+        for jid in ('a', 'b', 'c'):
+            self.lua('put', 0, 'worker', 'queue', jid, 'klass', {}, 0)
+            self.lua('track', ord(jid), 'track', jid)
+        response = self.lua('track', 0, 'list', 1, 10)
+        self.assertEqual(response['total'], 3)
+        self.assertEqual(response['expired'], {})
+        self.assertEqual([job['jid'] for job in response['jobs']], ['b', 'c'])
+        self.assertEqual(response['jobs'][0],
+            self.lua('get', 0, 'b'))
+
+    def test_list_fields(self):
+        '''We can list just some of the fields of the tracked jobs'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('track', 0, 'track', 'jid')
+        self.assertEqual(
+            self.lua('track', 0, 'list', 0, 10, 'fields', 'jid,state'), {
+                'total': 1,
+                'jobs': [{'jid': 'jid', 'state': 'waiting'}],
+                'expired': {}})
+
+    def test_list_expired(self):
+        '''Tracked jobs that have expired are listed apart'''
+        self.lua('put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('track', 0, 'track', 'jid')
+        self.redis.delete('ql:j:jid')
+        self.assertEqual(self.lua('track', 0, 'list'), {
+            'total': 1, 'jobs': {}, 'expired': ['jid']})
@@ -196,3 +196,38 @@ class TestWorker(TestQless):
             'jobs': {},
             'stalled': {}
         })
+
+    def test_reap(self):
+        '''Stale workers are reaped a budget at a time'''
+        self.lua('config.set', 0, 'max-worker-age', 10)
+        for worker in range(3):
+            self.lua('put', 0, 'worker', 'queue', worker, 'klass', {}, 0)
+            self.lua('pop', worker, 'queue', worker, 1)
+        self.lua('pop', 20, 'queue', 'fresh', 1)
+        # Stale workers aren't listed, even before they're reaped
+        self.assertEqual(
+            [worker['name'] for worker in self.lua('workers', 20)], ['fresh'])
+        self.assertEqual(self.lua('worker.reap', 20, 2), 1)
+        self.assertEqual(self.redis.zcard('ql:workers'), 2)
+        self.assertFalse(self.redis.exists('ql:w:0:jobs'))
+        self.assertTrue(self.redis.exists('ql:w:2:jobs'))
+        self.assertEqual(self.lua('worker.reap', 20, 2), 0)
+        self.assertEqual(self.redis.zrange('ql:workers', 0, -1), ['fresh'])
+
+    def test_reap_large(self):
+        '''Large budgets reap many workers at once'''
+        self.lua('config.set', 0, 'max-worker-age', 10)
+        with self.redis.pipeline() as pipe:
+            for worker in range(10000):
+                pipe.zadd('ql:workers', 'worker-%s' % worker, 0)
+            pipe.execute()
+        self.assertEqual(self.lua('worker.reap', 20, 20000), 0)
+        self.assertEqual(self.redis.zcard('ql:workers'), 0)
+
+    def test_list(self):
+        '''We can page through the workers'''
+        for worker in range(5):
+            self.lua('pop', worker, 'queue', 'worker-%s' % worker, 1)
+        self.assertEqual(
+            [worker['name'] for worker in self.lua('workers.list', 5, 1, 2)],
+            ['worker-3', 'worker-2'])
@@ -3,6 +3,69 @@ function QlessWorker.deregister(...)
   redis.call('zrem', 'ql:workers', unpack(arg))
 end
 
+-- Renew the locks on a batch of jobs that `worker` is running. `jobs` is a
+-- JSON array of the form:
+--
+--  [
+--      {
+--          'jid' : ...,
+--          # Optional, replaces the job's data as with `heartbeat`
+--          'data': {...}
+--      }, {
+--          ...
+--      }
+--  ]
+--
+-- Returns a list with one entry per job, either `{jid, expires}` or, if the
+-- worker has lost the job, `{jid, error}`
+function QlessWorker.heartbeat(now, worker, raw_jobs)
+  assert(worker, 'HeartbeatMany(): Arg "worker" missing')
+  assert(raw_jobs, 'HeartbeatMany(): Arg "jobs" missing')
+  local jobs = assert(cjson.decode(raw_jobs),
+    'HeartbeatMany(): Arg "jobs" not JSON: ' .. tostring(raw_jobs))
+  assert(type(jobs) == 'table',
+    'HeartbeatMany(): Arg "jobs" not a JSON array: ' .. tostring(raw_jobs))
+
+  local batch = {
+    jobs      = {},
+    locks     = {},
+    queues    = {},
+    intervals = {}
+  }
+  local response = {}
+  for i, job in ipairs(jobs) do
+    assert(type(job) == 'table' and job.jid,
+      'HeartbeatMany(): Job ' .. i .. ' is not a JSON object with a "jid"')
+    local jid = tostring(job.jid)
+
+    local data = job.data
+    if data ~= nil and type(data) ~= 'string' then
+      data = cjson.encode(data)
+    end
+
+    local ok, result = Qless.attempt(function()
+      return Qless.job(jid):heartbeat(now, worker, data, batch)
+    end)
+    if ok then
+      table.insert(response, {jid = jid, expires = result})
+    else
+      table.insert(response, {jid = jid, error = result})
+    end
+  end
+
+  if #batch.jobs > 0 then
+    Qless.zadd('ql:w:' .. worker .. ':jobs', batch.jobs)
+    for _, queue in ipairs(batch.queues) do
+      Qless.queue(queue).locks.add_many(batch.locks[queue])
+    end
+  end
+
+  -- Make sure we this worker to the list of seen workers
+  redis.call('zadd', 'ql:workers', now, worker)
+
+  return response
+end
+
 -- Provide data about all the workers, or if a specific worker is provided,
 -- then which jobs that worker is responsible for. If no worker is provided,
 -- expect a response of the form:
@@ -32,34 +95,71 @@ end
 --  }
 --
 function QlessWorker.counts(now, worker)
-  -- Clean up all the workers' job lists if they're too old. This is
-  -- determined by the `max-worker-age` configuration, defaulting to the
-  -- last day. Seems like a 'reasonable' default
-  local interval = tonumber(Qless.config.get('max-worker-age', 86400))
-
-  local workers  = redis.call('zrangebyscore', 'ql:workers', 0, now - interval)
-  for index, worker in ipairs(workers) do
-    redis.call('del', 'ql:w:' .. worker .. ':jobs')
-  end
-
-  -- And now remove them from the list of known workers
-  redis.call('zremrangebyscore', 'ql:workers', 0, now - interval)
-
   if worker then
     return {
       jobs    = redis.call('zrevrangebyscore', 'ql:w:' .. worker .. ':jobs', now + 8640000, now),
       stalled = redis.call('zrevrangebyscore', 'ql:w:' .. worker .. ':jobs', now, 0)
     }
   else
-    local response = {}
-    local workers = redis.call('zrevrange', 'ql:workers', 0, -1)
-    for index, worker in ipairs(workers) do
-      table.insert(response, {
-        name    = worker,
-        jobs    = redis.call('zcount', 'ql:w:' .. worker .. ':jobs', now, now + 8640000),
-        stalled = redis.call('zcount', 'ql:w:' .. worker .. ':jobs', 0, now)
-      })
+    return QlessWorker.list(now)
+  end
+end
+
+-- The counts of a page of the workers that have been seen recently, as in
+-- `counts`, most recently seen first. Workers that haven't been seen in
+-- `max-worker-age` seconds aren't listed, whether or not they've been reaped.
+function QlessWorker.list(now, offset, count)
+  offset = assert(tonumber(offset or 0),
+    'List(): Arg "offset" not a number: ' .. tostring(offset))
+  local interval = tonumber(Qless.config.get('max-worker-age', 86400))
+  local workers
+  if count then
+    count = assert(tonumber(count),
+      'List(): Arg "count" not a number: ' .. tostring(count))
+    workers = redis.call('zrevrangebyscore', 'ql:workers',
+      '+inf', '(' .. (now - interval), 'LIMIT', offset, count)
+  else
+    workers = redis.call('zrevrangebyscore', 'ql:workers',
+      '+inf', '(' .. (now - interval))
+  end
+
+  local response = {}
+  for index, worker in ipairs(workers) do
+    table.insert(response, {
+      name    = worker,
+      jobs    = redis.call('zcount', 'ql:w:' .. worker .. ':jobs', now, now + 8640000),
+      stalled = redis.call('zcount', 'ql:w:' .. worker .. ':jobs', 0, now)
+    })
+  end
+  return response
+end
+
+-- Reap(now, budget)
+-- -----------------
+-- Forget the workers that haven't been seen in `max-worker-age` seconds
+-- (defaulting to the last day), along with their lists of jobs. At most
+-- `budget` workers are reaped, and the number of stale workers that remain is
+-- returned, so that this can be called until it returns 0.
+function QlessWorker.reap(now, budget)
+  budget = assert(tonumber(budget),
+    'Reap(): Arg "budget" not a number: ' .. tostring(budget))
+  local interval = tonumber(Qless.config.get('max-worker-age', 86400))
+
+  local workers = {}
+  if budget > 0 then
+    workers = redis.call('zrangebyscore', 'ql:workers',
+      0, now - interval, 'LIMIT', 0, budget)
+  end
+  -- Remove them in batches, to keep clear of the limit on unpack
+  for i = 1, #workers, 100 do
+    local last = math.min(i + 99, #workers)
+    local keys = {}
+    for index = i, last do
+      table.insert(keys, 'ql:w:' .. workers[index] .. ':jobs')
     end
-    return response
+    Qless.unlink(unpack(keys))
+    redis.call('zrem', 'ql:workers', unpack(workers, i, last))
   end
+
+  return redis.call('zcount', 'ql:workers', 0, now - interval)
 end